@@ -4,7 +4,8 @@ from django.utils.translation import gettext_lazy as _
 from .models import (
     Case, Exercise, Exam, ExamRecord, UserProgress, UserAnswer, ExamResult,
     ClinicalCase, ExaminationOption, DiagnosisOption, TreatmentOption, 
-    StudentClinicalSession, TeachingFeedback
+    StudentClinicalSession, SessionRun, TeachingFeedback, DailyCaseStats, DailyStudentStats,
+    StudentLearningProfile, CaseTuningSummary,
 )
 
 # 自定义 AdminSite 以加载自定义 CSS
@@ -323,7 +324,7 @@ class StudentClinicalSessionAdmin(admin.ModelAdmin):
             'fields': ('time_spent', 'started_at', 'completed_at', 'last_activity')
         }),
         ('学习成果', {
-            'fields': ('learning_notes', 'reflection'),
+            'fields': ('reflection',),
             'classes': ('collapse',)
         }),
     )
@@ -337,27 +338,81 @@ class StudentClinicalSessionAdmin(admin.ModelAdmin):
 
 class TeachingFeedbackAdmin(admin.ModelAdmin):
     """教学反馈管理"""
-    list_display = ['student_session', 'feedback_stage', 'feedback_type', 'is_automated', 'created_at']
+    list_display = ['student_session', 'feedback_stage', 'feedback_type', 'repeat_count', 'is_automated', 'created_at']
     list_filter = ['feedback_stage', 'feedback_type', 'is_automated', 'created_at']
-    search_fields = ['student_session__student__username', 'feedback_content']
-    readonly_fields = ['created_at']
-    raw_id_fields = ['student_session']
+    search_fields = ['student_session__student__username', 'feedback_content', 'template__template_text']
+    readonly_fields = ['rendered_content', 'created_at', 'last_seen_at']
+    raw_id_fields = ['student_session', 'template']
     
     fieldsets = (
         ('基本信息', {
             'fields': ('student_session', 'feedback_stage', 'feedback_type', 'is_automated')
         }),
         ('反馈内容', {
-            'fields': ('feedback_content', 'improvement_suggestions')
+            'fields': ('rendered_content', 'template', 'params', 'repeat_count', 'feedback_content', 'improvement_suggestions')
         }),
         ('相关资源', {
             'fields': ('reference_materials',)
         }),
         ('时间信息', {
-            'fields': ('created_at',),
+            'fields': ('created_at', 'last_seen_at'),
             'classes': ('collapse',)
         }),
     )
+    
+    def rendered_content(self, obj):
+        return obj.content
+    rendered_content.short_description = '反馈内容（渲染）'
+
+
+class SessionRunAdmin(admin.ModelAdmin):
+    """会话历史轮次（只读归档）"""
+    list_display = ['student', 'clinical_case', 'run', 'end_reason', 'overall_score', 'study_minutes', 'completed_at', 'created_at']
+    list_filter = ['end_reason', 'created_at']
+    search_fields = ['student__username', 'clinical_case__title', 'clinical_case__case_id']
+    raw_id_fields = ['student', 'clinical_case', 'session']
+
+    def get_readonly_fields(self, request, obj=None):
+        return [field.name for field in self.model._meta.fields]
+
+
+class DailyStatsAdmin(admin.ModelAdmin):
+    """每日汇总（由增量累加与 rebuild_daily_stats 命令维护，只读）"""
+    list_display = ['date', 'sessions_started', 'sessions_completed', 'score_count', 'active_seconds']
+    list_filter = ['date']
+    date_hierarchy = 'date'
+
+    def get_readonly_fields(self, request, obj=None):
+        return [field.name for field in self.model._meta.fields]
+
+
+class DailyCaseStatsAdmin(DailyStatsAdmin):
+    list_display = ['date', 'clinical_case'] + DailyStatsAdmin.list_display[1:]
+    raw_id_fields = ['clinical_case']
+
+
+class DailyStudentStatsAdmin(DailyStatsAdmin):
+    list_display = ['date', 'student'] + DailyStatsAdmin.list_display[1:]
+    raw_id_fields = ['student']
+
+
+class StudentLearningProfileAdmin(admin.ModelAdmin):
+    """学生学习画像（由增量累加与 rebuild_learning_profiles 命令维护，只读）"""
+    list_display = ['student', 'runs_completed', 'score_ewma', 'hinted_runs', 'last_completed_at']
+    search_fields = ['student__username']
+    raw_id_fields = ['student']
+
+    def get_readonly_fields(self, request, obj=None):
+        return [field.name for field in self.model._meta.fields]
+
+
+class CaseTuningSummaryAdmin(admin.ModelAdmin):
+    """病例调优摘要（由增量累加与 rebuild_case_tuning 命令维护，只读）"""
+    list_display = ['clinical_case', 'runs_completed', 'updated_at']
+    search_fields = ['clinical_case__case_id', 'clinical_case__title']
+
+    def get_readonly_fields(self, request, obj=None):
+        return [field.name for field in self.model._meta.fields]
 
 
 # 将临床推理模型注册到管理后台
@@ -366,6 +421,11 @@ custom_admin_site.register(ExaminationOption, ExaminationOptionAdmin)
 custom_admin_site.register(DiagnosisOption, DiagnosisOptionAdmin)
 custom_admin_site.register(TreatmentOption, TreatmentOptionAdmin)
 custom_admin_site.register(StudentClinicalSession, StudentClinicalSessionAdmin)
+custom_admin_site.register(SessionRun, SessionRunAdmin)
+custom_admin_site.register(DailyCaseStats, DailyCaseStatsAdmin)
+custom_admin_site.register(DailyStudentStats, DailyStudentStatsAdmin)
+custom_admin_site.register(StudentLearningProfile, StudentLearningProfileAdmin)
+custom_admin_site.register(CaseTuningSummary, CaseTuningSummaryAdmin)
 custom_admin_site.register(TeachingFeedback, TeachingFeedbackAdmin)
 
 
@@ -0,0 +1,107 @@
+"""
+病例计数器维护（CaseCounters，教师端病例列表与搜索只连接这一张窄表）
+- 选项（检查/诊断/治疗）保存或删除：重新统计该病例的选项数（选项表小，按病例 COUNT 即可）
+- 会话新建/删除，或完成时间/得分发生变化：按该会话前后的值用 F() 增减计数，
+  不再每次保存都对病例的全部会话做 COUNT/SUM
+- 增量漏掉或出错时由 rebuild_case_counters 命令按病例完整重算修正
+- 只更新已有的计数器行（新病例保存时创建）：病例级联删除过程中选项/会话的 post_delete
+  不会再插入一行指向正在删除的病例
+"""
+from django.db.models import Count, F, Q, Sum, Value
+from django.db.models.functions import Greatest
+
+from .models import (
+    CaseCounters, ClinicalCase, DiagnosisOption, ExaminationOption, StudentClinicalSession, TreatmentOption,
+)
+
+
+# 影响会话计数的字段（save_session 写入这些字段时增减）
+SESSION_COUNTER_FIELDS = frozenset({'completed_at', 'overall_score'})
+
+_SESSION_DELTA_FIELDS = ('session_count', 'completed_count', 'score_sum', 'score_count')
+
+
+def _option_counts(case_id):
+    return {
+        'examination_count': ExaminationOption.objects.filter(clinical_case_id=case_id).count(),
+        'diagnosis_count': DiagnosisOption.objects.filter(clinical_case_id=case_id).count(),
+        'treatment_count': TreatmentOption.objects.filter(clinical_case_id=case_id).count(),
+    }
+
+
+def _session_counts(case_id):
+    scored = Q(overall_score__gt=0)
+    agg = StudentClinicalSession.objects.filter(clinical_case_id=case_id).aggregate(
+        session_count=Count('id'),
+        completed_count=Count('id', filter=Q(completed_at__isnull=False)),
+        score_sum=Sum('overall_score', filter=scored),
+        score_count=Count('id', filter=scored),
+    )
+    agg['score_sum'] = agg['score_sum'] or 0.0
+    return agg
+
+
+def refresh_case_counters(case_id, options=True, sessions=True):
+    """重新统计某病例的计数器（options/sessions 指定要刷新的部分）"""
+    values = {}
+    if options:
+        values.update(_option_counts(case_id))
+    if sessions:
+        values.update(_session_counts(case_id))
+    if values:
+        CaseCounters.objects.filter(clinical_case_id=case_id).update(**values)
+
+
+def create_case_counters(case_id):
+    """新病例（或缺少计数器的病例）创建计数器行并完整统计"""
+    CaseCounters.objects.get_or_create(clinical_case_id=case_id)
+    refresh_case_counters(case_id)
+
+
+def rebuild_case_counters(case_ids=None):
+    """
+    按病例完整重算计数器（缺省为全部病例），缺少计数器行的病例一并创建
+
+    Returns:
+        int: 重算的病例数
+    """
+    cases = ClinicalCase.objects.all()
+    if case_ids is not None:
+        cases = cases.filter(pk__in=case_ids)
+    count = 0
+    for case_id in cases.values_list('pk', flat=True).iterator():
+        create_case_counters(case_id)
+        count += 1
+    return count
+
+
+def _session_contribution(values):
+    """一条会话 (completed_at, overall_score) 对计数器的贡献；None 表示不存在"""
+    if values is None:
+        return dict.fromkeys(_SESSION_DELTA_FIELDS, 0)
+    completed_at, overall_score = values
+    scored = (overall_score or 0) > 0
+    return {
+        'session_count': 1,
+        'completed_count': int(completed_at is not None),
+        'score_sum': float(overall_score) if scored else 0.0,
+        'score_count': int(scored),
+    }
+
+
+def apply_session_delta(case_id, old=None, new=None):
+    """
+    按一条会话前后的 (completed_at, overall_score) 用 F() 增减计数器
+    old 为 None 表示新建，new 为 None 表示删除；值没有变化时不写库
+    """
+    before, after = _session_contribution(old), _session_contribution(new)
+    updates = {}
+    for name in _SESSION_DELTA_FIELDS:
+        delta = after[name] - before[name]
+        if delta > 0:
+            updates[name] = F(name) + delta
+        elif delta < 0:
+            # 计数偏差时不减到负数（无符号列），由 rebuild_case_counters 修正
+            updates[name] = Greatest(F(name) + delta, Value(0))
+    if updates:
+        CaseCounters.objects.filter(clinical_case_id=case_id).update(**updates)
@@ -0,0 +1,162 @@
+"""
+学生端案例库分页
+- 一次查询取出本页案例及当前学生的会话阶段/得分（FilteredRelation 左连接，不再逐个病例查询会话）
+- 按 (created_at, id) 倒序做游标分页，支持难度、学习状态筛选
+- 卡片的静态部分（标题、主诉摘要、学习目标等）按“案例库版本”缓存；
+  ClinicalCase 保存/删除时 signals 递增版本，旧缓存自然失效
+- 版本号存在默认缓存里，只对单进程部署可靠（见 settings.CACHES）；卡片 TTL 取得较短，
+  多进程部署下其他进程最多 CARD_CACHE_TTL 后看到病例修改
+"""
+import base64
+from datetime import datetime
+
+from django.core.cache import cache
+from django.db.models import FilteredRelation, Q
+
+from .models import ClinicalCase
+from .state_machine import STAGES
+
+
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+CARD_CACHE_TTL = 10 * 60
+
+DIFFICULTY_LEVELS = ('beginner', 'intermediate', 'advanced')
+
+# 未完成的会话阶段（“学习中”筛选）
+_OPEN_STAGES = tuple(stage for stage in STAGES if stage != 'completed')
+
+_REVISION_KEY = 'case_library:revision'
+_CARD_KEY = 'case_library:{revision}:card:{case_pk}'
+
+# 卡片只用到的字段（不读取病史、体格检查、图片等大字段）
+_CARD_FIELDS = ('id', 'case_id', 'title', 'patient_age', 'patient_gender', 'chief_complaint',
+                'learning_objectives', 'difficulty_level')
+
+
+class InvalidCursor(ValueError):
+    """分页游标无法解析"""
+
+
+def library_revision():
+    """当前案例库版本号"""
+    cache.add(_REVISION_KEY, 1, None)
+    return cache.get(_REVISION_KEY) or 1
+
+
+def bump_library_revision():
+    """案例变更后递增版本号，使卡片缓存失效"""
+    try:
+        cache.incr(_REVISION_KEY)
+    except ValueError:
+        cache.set(_REVISION_KEY, 2, None)
+
+
+def encode_cursor(created_at, case_pk):
+    raw = f'{created_at.isoformat()}|{case_pk}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, case_pk = raw.rsplit('|', 1)
+        return datetime.fromisoformat(created_at), int(case_pk)
+    except Exception:
+        raise InvalidCursor('无效的分页游标')
+
+
+def _card(case):
+    return {
+        'case_id': case.case_id,
+        'title': case.title,
+        'patient_age': case.patient_age,
+        'patient_gender': case.get_patient_gender_display(),
+        'chief_complaint': case.chief_complaint[:120],
+        # 卡片只展示前两个学习目标
+        'learning_objectives': list(case.learning_objectives or [])[:2],
+        'difficulty_level': case.difficulty_level,
+    }
+
+
+def case_cards(case_pks):
+    """按主键批量取卡片静态部分：先读缓存，未命中的一次查询补齐并写回"""
+    revision = library_revision()
+    keys = {_CARD_KEY.format(revision=revision, case_pk=pk): pk for pk in case_pks}
+    cached = cache.get_many(list(keys))
+    cards = {keys[key]: card for key, card in cached.items()}
+
+    missing = [pk for pk in case_pks if pk not in cards]
+    if missing:
+        fresh = {case.pk: _card(case) for case in ClinicalCase.objects.filter(pk__in=missing).only(*_CARD_FIELDS)}
+        cache.set_many(
+            {_CARD_KEY.format(revision=revision, case_pk=pk): card for pk, card in fresh.items()},
+            CARD_CACHE_TTL,
+        )
+        cards.update(fresh)
+    return cards
+
+
+def _progress_status(session_status, completed_at, has_session):
+    if not has_session:
+        return 'not_started'
+    if session_status == 'completed' or completed_at is not None:
+        return 'completed'
+    return 'in_progress'
+
+
+def student_case_page(student, difficulty=None, status=None, cursor=None, limit=PAGE_SIZE):
+    """
+    学生端案例库的一页
+
+    Returns:
+        dict: {'cases': [...], 'next_cursor': str | None, 'has_more': bool}
+
+    Raises:
+        InvalidCursor: 游标无法解析
+    """
+    try:
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    except (TypeError, ValueError):
+        limit = PAGE_SIZE
+    qs = ClinicalCase.objects.filter(is_active=True).annotate(
+        mine=FilteredRelation('studentclinicalsession', condition=Q(studentclinicalsession__student=student)),
+    )
+    if difficulty in DIFFICULTY_LEVELS:
+        qs = qs.filter(difficulty_level=difficulty)
+
+    if status == 'not_started':
+        qs = qs.filter(mine__id__isnull=True)
+    elif status == 'completed':
+        qs = qs.filter(Q(mine__session_status='completed') | Q(mine__completed_at__isnull=False))
+    elif status == 'in_progress':
+        qs = qs.filter(mine__session_status__in=_OPEN_STAGES, mine__completed_at__isnull=True)
+
+    if cursor:
+        created_at, case_pk = decode_cursor(cursor)
+        qs = qs.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=case_pk))
+
+    rows = list(
+        qs.order_by('-created_at', '-id')
+        .values('id', 'created_at', 'mine__id', 'mine__session_status', 'mine__overall_score', 'mine__completed_at')
+        [:limit + 1]
+    )
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    cards = case_cards([row['id'] for row in rows])
+
+    cases = []
+    for row in rows:
+        card = dict(cards[row['id']])
+        card.update({
+            'status': _progress_status(row['mine__session_status'], row['mine__completed_at'], row['mine__id'] is not None),
+            'session_status': row['mine__session_status'],
+            'progress': {'overall_score': row['mine__overall_score'] or 0},
+        })
+        cases.append(card)
+
+    return {
+        'cases': cases,
+        'next_cursor': encode_cursor(rows[-1]['created_at'], rows[-1]['id']) if has_more else None,
+        'has_more': has_more,
+    }
@@ -0,0 +1,146 @@
+"""
+病例调优摘要（CaseTuningSummary，教师调整干扰项、提示与必选检查时参考）
+- 每完成一轮（archive_run 归档后）把本轮的检查/诊断/治疗得分（每 10 分一档）和
+  检查提交次数、诊断尝试次数（1~4 次各一档，5 次及以上合为一档）计入该病例的直方图，
+  读改写在锁住摘要行的事务中完成；写入失败不影响学习请求，由 rebuild_case_tuning 命令重算修正
+- 检查提交次数来自 session_data['examination_selection_success']（归档时记入 SessionRun，见 learning_profiles）
+- 调优页与接口只读这一行，不随会话数增长
+"""
+import logging
+
+from django.db import DatabaseError, transaction
+
+from .models import CaseTuningSummary, SessionRun
+
+
+logger = logging.getLogger(__name__)
+
+TUNING_SCORE_FIELDS = ('examination_score', 'diagnosis_score', 'treatment_score')
+# 直方图名 -> SessionRun 上的提交次数字段
+TUNING_ATTEMPT_FIELDS = {
+    'examination_attempts': 'examination_attempt_count',
+    'diagnosis_attempts': 'diagnosis_attempt_count',
+}
+TUNING_LABELS = {
+    'examination_score': '检查得分',
+    'diagnosis_score': '诊断得分',
+    'treatment_score': '治疗得分',
+    'examination_attempts': '检查提交次数',
+    'diagnosis_attempts': '诊断尝试次数',
+}
+
+SCORE_BIN_WIDTH = 10
+SCORE_BINS = 10
+ATTEMPT_BINS = 5
+
+_RUN_FIELDS = ('clinical_case_id', *TUNING_SCORE_FIELDS, *TUNING_ATTEMPT_FIELDS.values())
+
+
+def _score_bin(score):
+    return min(max(int((score or 0) // SCORE_BIN_WIDTH), 0), SCORE_BINS - 1)
+
+
+def _empty_histograms():
+    histograms = {field: [0] * SCORE_BINS for field in TUNING_SCORE_FIELDS}
+    histograms.update({name: [0] * ATTEMPT_BINS for name in TUNING_ATTEMPT_FIELDS})
+    return histograms
+
+
+def _add_run(histograms, sums, run):
+    """把一轮（SessionRun 字段字典）计入直方图与合计（原地修改）"""
+    for field in TUNING_SCORE_FIELDS:
+        score = float(run[field] or 0)
+        histograms[field][_score_bin(score)] += 1
+        sums[field] = sums.get(field, 0) + score
+    for name, field in TUNING_ATTEMPT_FIELDS.items():
+        attempts = run[field]
+        if not attempts or attempts < 1:
+            continue
+        histograms[name][min(attempts, ATTEMPT_BINS) - 1] += 1
+        sums[name] = sums.get(name, 0) + attempts
+
+
+def record_tuning_run(run):
+    """完成的轮次归档后调用（中途重置的轮次不计入）"""
+    if run is None or run.end_reason != 'completed':
+        return
+    values = {name: getattr(run, name) for name in _RUN_FIELDS}
+    try:
+        with transaction.atomic():
+            CaseTuningSummary.objects.get_or_create(clinical_case_id=run.clinical_case_id)
+            summary = CaseTuningSummary.objects.select_for_update().get(clinical_case_id=run.clinical_case_id)
+            histograms = {**_empty_histograms(), **(summary.histograms or {})}
+            sums = dict(summary.sums or {})
+            _add_run(histograms, sums, values)
+            summary.histograms = histograms
+            summary.sums = sums
+            summary.runs_completed += 1
+            summary.save(update_fields=['histograms', 'sums', 'runs_completed', 'updated_at'])
+    except DatabaseError:
+        logger.exception('调优摘要更新失败（case=%s, run=%s）', run.clinical_case_id, run.pk)
+
+
+def rebuild_case_tuning(case_ids=None):
+    """
+    按 SessionRun 重算调优摘要（缺省为全部病例）
+
+    Args:
+        case_ids: 只重算这些病例（主键）
+
+    Returns:
+        int: 写入的摘要行数
+    """
+    runs = SessionRun.objects.filter(end_reason='completed')
+    if case_ids is not None:
+        runs = runs.filter(clinical_case_id__in=case_ids)
+
+    summaries = {}
+    for run in runs.order_by('clinical_case_id', 'id').values(*_RUN_FIELDS).iterator(chunk_size=2000):
+        summary = summaries.get(run['clinical_case_id'])
+        if summary is None:
+            summary = summaries[run['clinical_case_id']] = CaseTuningSummary(
+                clinical_case_id=run['clinical_case_id'], histograms=_empty_histograms(), sums={},
+            )
+        _add_run(summary.histograms, summary.sums, run)
+        summary.runs_completed += 1
+
+    with transaction.atomic():
+        stale = CaseTuningSummary.objects.all()
+        if case_ids is not None:
+            stale = stale.filter(clinical_case_id__in=case_ids)
+        stale.delete()
+        CaseTuningSummary.objects.bulk_create(summaries.values(), batch_size=500)
+    return len(summaries)
+
+
+def _bin_labels(name):
+    if name in TUNING_SCORE_FIELDS:
+        return [
+            f'{index * SCORE_BIN_WIDTH}-{(index + 1) * SCORE_BIN_WIDTH}' for index in range(SCORE_BINS)
+        ]
+    return [str(count) for count in range(1, ATTEMPT_BINS)] + [f'{ATTEMPT_BINS}+']
+
+
+def tuning_summary(clinical_case):
+    """读取某个病例的调优摘要（一次查询）；尚无完成记录时各档为 0"""
+    summary = CaseTuningSummary.objects.filter(clinical_case=clinical_case).first()
+    histograms = {**_empty_histograms(), **(summary.histograms if summary else {})}
+    sums = summary.sums if summary else {}
+    result = {
+        'case_id': clinical_case.case_id,
+        'runs_completed': summary.runs_completed if summary else 0,
+        'updated_at': summary.updated_at if summary else None,
+        'histograms': {},
+    }
+    for name, counts in histograms.items():
+        total = sum(counts)
+        result['histograms'][name] = {
+            'label': TUNING_LABELS[name],
+            'bins': _bin_labels(name),
+            'counts': counts,
+            'total': total,
+            'mean': round(sums.get(name, 0) / total, 2) if total else None,
+        }
+        if name in TUNING_ATTEMPT_FIELDS:
+            result['histograms'][name]['first_try_rate'] = round(counts[0] / total * 100, 1) if total else None
+    return result
@@ -0,0 +1,183 @@
+"""
+StudentClinicalSession 乐观并发写入
+同一页面的笔记自动保存、阶段切换、病史汇总和评分提交可能并发到达，
+原来各自 save() 全部字段会互相覆盖 session_data 中的键；SQLite 上
+select_for_update 又会把请求全部串行化。这里改为：
+
+- 只写本次请求实际改动的字段（与载入时的基线比较）
+- UPDATE ... WHERE id=? AND version=? 比较并交换，成功后 version +1
+- 版本不匹配时重新读取最新值做三方合并后重试：
+  对方改、我方未改的字段采用对方的值；JSON 对象按键递归合并，
+  双方改了同一个键（或同一个普通字段）且值不同则抛出 SessionConflictError；
+  会话阶段等“以最后一次为准”的字段直接覆盖
+- 没有需要写入的字段时直接返回，不递增版本号
+- 本轮已完成的会话再次写入时（last_activity 前移），顺带刷新学习时长，学习反馈阶段的停留时间照常计入
+"""
+import copy
+
+from django.db.models import F
+from django.dispatch import Signal
+from django.utils import timezone
+
+from .models import StudentClinicalSession
+from .stage_events import EVENT_COLUMN_FIELDS
+from .timing import STUDY_MINUTES_FIELDS, refresh_study_minutes
+
+
+# 每轮比较并交换至少有一个写入者成功，N 个并发写入最多需要 N-1 次重试
+MAX_RETRIES = 10
+
+# 不参与比较与合并的字段：主键、版本号、每次写入都会刷新的 last_activity
+_IGNORED_FIELDS = ('id', 'version', 'last_activity')
+
+# 阶段切换、完成标记及完成时写入的快照以最后一次写入为准（阶段事件另有 SessionStageEvent 完整记录）
+LAST_WRITER_WINS_FIELDS = ('session_status', 'completed_at', 'review_snapshot') + EVENT_COLUMN_FIELDS + STUDY_MINUTES_FIELDS
+
+_MISSING = object()
+
+# save_session 以 UPDATE 写入、不触发 post_save，写入成功后发送此信号
+# （instance, fields=写入的字段名, previous={字段名: 写入前的值}）
+session_fields_saved = Signal()
+
+
+class SessionConflictError(Exception):
+    """并发请求修改了同一字段/同一 JSON 键，无法自动合并"""
+
+    def __init__(self, field, path=()):
+        self.field = field
+        self.path = tuple(path)
+        where = '.'.join([field] + [str(key) for key in self.path])
+        super().__init__(f'会话已在其他请求中更新（{where}），请刷新后重试')
+
+
+def _session_fields():
+    return [
+        field for field in StudentClinicalSession._meta.concrete_fields
+        if field.attname not in _IGNORED_FIELDS
+    ]
+
+
+def changed_fields(session):
+    """与载入基线相比发生变化的字段 attname 列表；没有基线时返回全部字段（未读取过的 JSON 字段视为未改动）"""
+    loaded = getattr(session, '_loaded_values', None)
+    fields = _session_fields()
+    if loaded is None:
+        return [field.attname for field in fields]
+    unread = session.unread_json_fields()
+    return [
+        field.attname for field in fields
+        if field.attname in loaded and field.attname not in unread
+        and getattr(session, field.attname) != loaded[field.attname]
+    ]
+
+
+def merge_json_keys(base, ours, theirs, field='', path=()):
+    """
+    JSON 对象三方合并：以对方（数据库中最新）的值为底，叠加我方相对基线的改动
+    双方对同一键写入不同的值时抛出 SessionConflictError
+    """
+    result = dict(theirs)
+    for key in set(base) | set(ours):
+        b = base.get(key, _MISSING)
+        o = ours.get(key, _MISSING)
+        if o == b:
+            continue
+        t = theirs.get(key, _MISSING)
+        if t == b or t == o:
+            merged = o
+        elif all(isinstance(v, dict) for v in (b, o, t)):
+            merged = merge_json_keys(b, o, t, field, path + (key,))
+        else:
+            raise SessionConflictError(field, path + (key,))
+        if merged is _MISSING:
+            result.pop(key, None)
+        else:
+            result[key] = merged
+    return result
+
+
+def _merge_latest(session, latest, ours_changed, force_fields):
+    """把数据库中的最新值合并进 session，返回合并后仍需写入的字段"""
+    loaded = session._loaded_values
+    to_write = []
+    for field in _session_fields():
+        name = field.attname
+        if name not in latest:
+            continue
+        theirs = latest[name]
+        if name not in ours_changed:
+            setattr(session, name, copy.deepcopy(theirs))
+            continue
+        base = loaded.get(name, _MISSING)
+        ours = getattr(session, name)
+        if ours == theirs or ours == base:
+            setattr(session, name, copy.deepcopy(theirs))
+            continue
+        if theirs == base or field.name in force_fields:
+            to_write.append(name)
+        elif all(isinstance(v, dict) for v in (base, ours, theirs)):
+            setattr(session, name, merge_json_keys(base, ours, theirs, field.name))
+            to_write.append(name)
+        else:
+            raise SessionConflictError(field.name)
+
+    session.version = latest['version']
+    session.last_activity = latest['last_activity']
+    session._loaded_values = {
+        name: copy.deepcopy(value) for name, value in latest.items() if name != 'id'
+    }
+    return to_write
+
+
+def save_session(session, fields=None, force_fields=LAST_WRITER_WINS_FIELDS, max_retries=MAX_RETRIES):
+    """
+    以比较并交换方式保存会话，只写改动过的字段
+
+    Args:
+        session: 从数据库载入的 StudentClinicalSession（新建对象直接 save()）
+        fields: 显式指定要写入的字段，缺省按载入基线自动比较
+        force_fields: 冲突时以本次请求为准的字段
+        max_retries: 版本不匹配时的合并重试次数
+
+    Raises:
+        SessionConflictError: 同一字段/JSON 键被并发修改且无法合并
+    """
+    if session._state.adding or session.pk is None or not hasattr(session, '_loaded_values'):
+        session.save()
+        return session
+
+    if fields is None:
+        to_write = changed_fields(session)
+    else:
+        to_write = [StudentClinicalSession._meta.get_field(name).attname for name in fields]
+        to_write = [name for name in dict.fromkeys(to_write) if name not in _IGNORED_FIELDS]
+    if not to_write:
+        # 没有改动：不递增版本、不刷新 last_activity，也不发送 session_fields_saved
+        return session
+    if not set(STUDY_MINUTES_FIELDS) & set(to_write):
+        to_write.extend(refresh_study_minutes(session))
+    queryset = StudentClinicalSession.objects.filter(pk=session.pk)
+
+    for _ in range(max_retries + 1):
+        now = timezone.now()
+        values = {name: getattr(session, name) for name in to_write}
+        updated = queryset.filter(version=session.version).update(
+            version=F('version') + 1, last_activity=now, **values
+        )
+        if updated:
+            # 比较并交换成功说明写入前的数据库值就是基线
+            previous = {name: session._loaded_values.get(name) for name in to_write}
+            session.version += 1
+            session.last_activity = now
+            session.remember_loaded_values()
+            session_fields_saved.send(
+                sender=StudentClinicalSession, instance=session, fields=frozenset(to_write), previous=previous,
+            )
+            return session
+
+        latest = queryset.values(*[field.attname for field in StudentClinicalSession._meta.concrete_fields]).first()
+        if latest is None:
+            raise StudentClinicalSession.DoesNotExist('会话不存在或已被删除')
+        to_write = _merge_latest(session, latest, set(to_write), force_fields)
+
+    raise SessionConflictError('version')
@@ -6,9 +6,11 @@ from django.contrib.auth.decorators import login_required, user_passes_test
 from django.views.decorators.http import require_POST, require_http_methods
 from django.shortcuts import get_object_or_404
 from .models import ClinicalCase, DiagnosisOption, StudentClinicalSession
+from . import scoring
+from .concurrency import SessionConflictError, save_session
+from .item_analysis import record_option_exposures, stash_option_exposure
+from .state_machine import stage_required
 import json
-import re
-from difflib import SequenceMatcher
 
 
 def is_student(user):
@@ -65,6 +67,7 @@ def get_diagnosis_options(request, case_id):
         # 3. 合并选项并随机排序
         all_options = correct_diagnoses + selected_distractors
         random.shuffle(all_options)
+        stash_option_exposure(request, clinical_case, 'diagnosis', all_options)
         
         # 4. 构建返回数据（不返回is_correct字段给前端）
         options_data = [{
@@ -97,6 +100,7 @@ def get_diagnosis_options(request, case_id):
 @login_required
 @user_passes_test(is_student, login_url='login')
 @require_POST
+@stage_required('submit_diagnosis')
 def submit_diagnosis(request, case_id):
     """提交诊断并评分（支持单选和多选）"""
     try:
@@ -129,7 +133,7 @@ def submit_diagnosis(request, case_id):
             student=request.user,
             clinical_case=clinical_case,
             defaults={
-                'session_status': 'diagnosis',
+                'session_status': 'diagnosis_reasoning',
                 'session_data': {}
             }
         )
@@ -152,31 +156,16 @@ def submit_diagnosis(request, case_id):
                 'message': '该病例没有设置正确诊断，请联系教师'
             }, status=400)
         
-        # 正确选中的数量
-        correctly_selected = len(selected_diagnosis_ids & correct_diagnosis_ids)
-        # 错误选中的数量（选了不该选的）
-        incorrectly_selected = len(selected_diagnosis_ids - correct_diagnosis_ids)
-        # 遗漏的数量（没选应该选的）
-        missed = len(correct_diagnosis_ids - selected_diagnosis_ids)
+        # 记录本次作答分布（干扰项分析）
+        record_option_exposures(request, session, 'diagnosis', diagnosis_ids, correct_diagnosis_ids)
         
-        # 评分规则：
-        # - 全部选对且没有多选：100分
-        # - 部分正确：按比例给分，但要扣除错选的分数
-        if missed == 0 and incorrectly_selected == 0:
-            diagnosis_score = 100  # 完全正确
-            is_correct = True
-        else:
-            # 准确率：选中的正确诊断 / 总共选中的诊断
-            precision = correctly_selected / len(selected_diagnosis_ids) if selected_diagnosis_ids else 0
-            # 召回率：选中的正确诊断 / 应该选中的诊断
-            recall = correctly_selected / len(correct_diagnosis_ids)
-            # F1分数作为诊断分数
-            if precision + recall > 0:
-                f1_score = 2 * (precision * recall) / (precision + recall)
-                diagnosis_score = f1_score * 100
-            else:
-                diagnosis_score = 0
-            is_correct = False
+        # 评分规则：全部选对且没有多选100分，否则按 F1（精确率 × 召回率）给分
+        diagnosis_result = scoring.diagnosis_set_score(selected_diagnosis_ids, correct_diagnosis_ids)
+        is_correct = diagnosis_result['is_correct']
+        diagnosis_score = diagnosis_result['score']
+        correctly_selected = diagnosis_result['correctly_selected']
+        incorrectly_selected = diagnosis_result['incorrectly_selected']
+        missed = diagnosis_result['missed']
         
         # 2. 诊断依据评分（0-100分）- 使用第一个正确诊断的标准答案
         first_correct = correct_diagnoses.first()
@@ -187,7 +176,7 @@ def submit_diagnosis(request, case_id):
         )
         
         # 3. 总分计算（诊断占70%，依据占30%）
-        total_score = diagnosis_score * 0.7 + rationale_score * 0.3
+        total_score = scoring.combine_choice_and_rationale(diagnosis_score, rationale_score)
         
         # 生成反馈
         selected_names = [opt.diagnosis_name for opt in diagnosis_options]
@@ -232,7 +221,7 @@ def submit_diagnosis(request, case_id):
         else:
             session.session_status = 'diagnosis_reasoning'
         
-        session.save()
+        save_session(session)
         
         return JsonResponse({
             'success': True,
@@ -255,6 +244,11 @@ def submit_diagnosis(request, case_id):
             'success': False,
             'message': '无效的JSON数据'
         }, status=400)
+    except SessionConflictError as e:
+        return JsonResponse({
+            'success': False,
+            'message': str(e)
+        }, status=409)
     except Exception as e:
         return JsonResponse({
             'success': False,
@@ -268,49 +262,9 @@ def calculate_rationale_score(student_rationale, correct_rationale, key_points):
     基于：
     1. 与标准答案的文本相似度
     2. 关键点覆盖率
+    评分实现见 cases.scoring.core.diagnosis_rationale_score
     """
-    if not correct_rationale and not key_points:
-        # 如果没有标准答案，按字数给基础分
-        word_count = len(student_rationale)
-        if word_count >= 200:
-            return 80
-        elif word_count >= 100:
-            return 60
-        elif word_count >= 50:
-            return 40
-        else:
-            return 20
-    
-    score = 0
-    
-    # 1. 文本相似度得分（60分）
-    if correct_rationale:
-        similarity = SequenceMatcher(None, student_rationale, correct_rationale).ratio()
-        score += similarity * 60
-    
-    # 2. 关键点覆盖率（40分）
-    if key_points:
-        if isinstance(key_points, str):
-            # 如果是字符串，尝试按逗号或分号分割
-            key_points = [kp.strip() for kp in re.split('[,，;；]', key_points) if kp.strip()]
-        
-        matched_points = 0
-        for point in key_points:
-            if point.lower() in student_rationale.lower():
-                matched_points += 1
-        
-        if len(key_points) > 0:
-            coverage_rate = matched_points / len(key_points)
-            score += coverage_rate * 40
-    
-    # 字数奖励（最多10分）
-    word_count = len(student_rationale)
-    if word_count >= 200:
-        score += 10
-    elif word_count >= 100:
-        score += 5
-    
-    return min(score, 100)
+    return scoring.diagnosis_rationale_score(student_rationale, correct_rationale, key_points)
 
 
 def generate_diagnosis_feedback(is_correct, rationale_score, diagnosis_name, correct_rationale):
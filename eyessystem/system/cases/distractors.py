@@ -0,0 +1,113 @@
+"""
+治疗干扰项池的维护与抽样
+- 写入侧：TreatmentOption 保存/删除时同步 TreatmentDistractor（按名称去重）
+- queryset.update()/bulk_update() 不发信号，由 TreatmentOptionQuerySet.update 在更新后按新旧名称同步
+- 读取侧：按 (treatment_type, difficulty_level) 索引分桶，每个桶一次 COUNT，每个干扰项一次随机偏移取行
+  （连同治疗选项一并取出），查询数只与干扰项数有关，耗时不随干扰项池大小增长
+"""
+import random
+
+from .models import TreatmentOption, TreatmentDistractor
+
+
+def sync_treatment_distractor(treatment_name):
+    """按名称重新计算干扰项池中的代表选项（同名取 id 最小的最佳治疗）"""
+    if not treatment_name:
+        return None
+
+    representative = (
+        TreatmentOption.objects.filter(treatment_name=treatment_name, is_optimal=True)
+        .order_by('id')
+        .first()
+    )
+    if representative is None:
+        TreatmentDistractor.objects.filter(treatment_name=treatment_name).delete()
+        return None
+
+    entry, _ = TreatmentDistractor.objects.update_or_create(
+        treatment_name=treatment_name,
+        defaults={
+            'treatment': representative,
+            'treatment_type': representative.treatment_type,
+            'difficulty_level': representative.difficulty_level,
+            'clinical_case_id': representative.clinical_case_id,
+        },
+    )
+    return entry
+
+
+def sync_treatment_distractor_for_option(treatment):
+    """单个治疗选项保存后的同步：处理改名、取消最佳、类型/难度变化"""
+    # 改名后旧名称的条目仍指向该选项，需要先释放再重新选代表
+    stale_names = list(
+        TreatmentDistractor.objects.filter(treatment=treatment)
+        .exclude(treatment_name=treatment.treatment_name)
+        .values_list('treatment_name', flat=True)
+    )
+    if stale_names:
+        TreatmentDistractor.objects.filter(treatment=treatment, treatment_name__in=stale_names).delete()
+        for name in stale_names:
+            sync_treatment_distractor(name)
+
+    return sync_treatment_distractor(treatment.treatment_name)
+
+
+def rebuild_treatment_distractors():
+    """全量重建干扰项池（用于历史数据回填或 queryset.update 绕过信号后的修复）"""
+    names = set(
+        TreatmentOption.objects.filter(is_optimal=True).values_list('treatment_name', flat=True)
+    )
+    TreatmentDistractor.objects.exclude(treatment_name__in=names).delete()
+    for name in names:
+        sync_treatment_distractor(name)
+    return len(names)
+
+
+def sync_treatment_distractor_names(old_names, new_names):
+    """批量更新后的同步：先处理旧名称（释放改名选项占用的条目），再处理新名称"""
+    for name in dict.fromkeys([*old_names, *new_names]):
+        sync_treatment_distractor(name)
+
+
+def _random_entries(queryset, count):
+    """在给定桶内随机取 count 条：一次 COUNT + 每条一次按随机偏移取行"""
+    if count <= 0:
+        return []
+    total = queryset.count()
+    if total == 0:
+        return []
+    ordered = queryset.select_related('treatment').order_by('id')
+    return [
+        entry
+        for offset in random.sample(range(total), min(count, total))
+        for entry in ordered[offset:offset + 1]
+    ]
+
+
+def sample_treatment_distractors(clinical_case, exclude_names=(), count=3, strata=None, difficulty_level=None):
+    """
+    从干扰项池中抽取干扰治疗选项
+
+    Args:
+        clinical_case: 当前病例（排除其自身的治疗）
+        exclude_names: 需要排除的治疗名称（通常是当前病例最佳治疗的名称）
+        count: 干扰项总数
+        strata: 分层抽样的治疗类型列表，如 ['surgery', 'medication'] 表示各取一个
+        difficulty_level: 只在指定难度的桶内抽样
+
+    Returns:
+        list[TreatmentOption]: 抽中的干扰项（顺序随机）
+    """
+    pool = TreatmentDistractor.objects.exclude(clinical_case=clinical_case)
+    if exclude_names:
+        pool = pool.exclude(treatment_name__in=list(exclude_names))
+    if difficulty_level:
+        pool = pool.filter(difficulty_level=difficulty_level)
+
+    picked = []
+    for treatment_type in (strata or [])[:count]:
+        picked.extend(_random_entries(
+            pool.filter(treatment_type=treatment_type).exclude(id__in=[entry.id for entry in picked]), 1,
+        ))
+    picked.extend(_random_entries(pool.exclude(id__in=[entry.id for entry in picked]), count - len(picked)))
+    return [entry.treatment for entry in picked]
@@ -0,0 +1,225 @@
+"""
+教师端成绩导出（CSV / XLSX）
+- 按病例、按学生分组（auth Group，即班级/批次）或全系统导出会话明细
+- 会话按主键顺序 iterator(chunk_size=EXPORT_CHUNK_SIZE) 分块读取，逐行生成，不整体载入内存
+- CSV 用 StreamingHttpResponse 边生成边发送（带 BOM，Excel 直接打开不乱码）
+- XLSX 用 xlsxwriter 的 constant_memory 模式逐行写入临时文件，写完后以 FileResponse 分块发送；
+  未安装 xlsxwriter 时抛出 ExportUnavailable
+- 已选检查/诊断/治疗名称按病例首次出现时一次查询载入，不逐行查询
+- 检查提交/错误次数取自 session_data，治疗提交次数由本轮选项作答记录的子查询随会话一并读出
+- 文件名去掉控制字符与路径分隔符后经 content_disposition_header 编码；学生姓名、用户名、病例标题等自由文本
+  以 = + - @ 等开头时前置单引号，防止在 Excel/WPS 中被当作公式执行
+"""
+import csv
+import re
+import tempfile
+
+from django.db.models import Count, F, OuterRef, Q, Subquery
+from django.http import FileResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.http import content_disposition_header
+
+from .models import DiagnosisOption, ExaminationOption, OptionExposure, StudentClinicalSession, TreatmentOption
+from .state_machine import STAGE_LABELS
+from .timing import STAGE_MINUTES_FIELDS
+
+
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_FORMATS = ('csv', 'xlsx')
+
+# 以这些字符开头的文本会被表格软件当作公式
+_FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+# 文件名中不允许的字符（控制字符、路径分隔符），替换为下划线
+_UNSAFE_FILENAME_CHARS = re.compile(r'[\x00-\x1f\x7f/\\]')
+
+_STAGE_MINUTE_HEADERS = {
+    'case_presentation': '病例呈现（分钟）',
+    'examination_selection': '检查选择（分钟）',
+    'diagnosis_reasoning': '诊断推理（分钟）',
+    'treatment_selection': '治疗选择（分钟）',
+    'learning_feedback': '学习反馈（分钟）',
+}
+
+EXPORT_HEADERS = [
+    '学生用户名', '学生姓名', '病例编号', '病例标题', '学习阶段', '开始时间', '完成时间',
+    '检查得分', '诊断得分', '治疗得分', '总分', '检查提交次数', '检查错误次数', '诊断尝试次数', '治疗提交次数',
+    '学习时长（分钟）',
+    *[_STAGE_MINUTE_HEADERS[stage] for stage in STAGE_MINUTES_FIELDS],
+    '已选检查', '已选诊断', '已选治疗',
+]
+
+_SESSION_FIELDS = (
+    'session_status', 'started_at', 'completed_at',
+    'examination_score', 'diagnosis_score', 'treatment_score', 'overall_score', 'diagnosis_attempt_count',
+    'study_minutes', *STAGE_MINUTES_FIELDS.values(), 'session_data', 'treatment_attempt_count',
+    'selected_examinations', 'selected_diagnoses', 'selected_treatments',
+    'student__username', 'student__first_name', 'student__last_name',
+    'clinical_case_id', 'clinical_case__case_id', 'clinical_case__title',
+)
+
+
+class ExportUnavailable(Exception):
+    """导出格式所需的依赖未安装"""
+
+
+def export_queryset(clinical_case=None, group=None):
+    """
+    待导出的会话（按主键顺序，只取导出列的字典）
+    不实例化模型：十万行导出时只读取导出用到的列
+    """
+    treatment_attempts = OptionExposure.objects.filter(
+        Q(session__run_started_at__isnull=True) | Q(created_at__gte=F('session__run_started_at')),
+        session=OuterRef('pk'), option_kind='treatment',
+    ).values('session').annotate(n=Count('attempt', distinct=True)).values('n')
+    queryset = StudentClinicalSession.objects.annotate(treatment_attempt_count=Subquery(treatment_attempts))
+    if clinical_case is not None:
+        queryset = queryset.filter(clinical_case=clinical_case)
+    if group:
+        queryset = queryset.filter(student__groups__name=group)
+    return queryset.order_by('id').values(*_SESSION_FIELDS)
+
+
+class _OptionNames:
+    """按病例懒加载 选项 id -> 名称"""
+
+    _SOURCES = {
+        'examination': (ExaminationOption, 'examination_name'),
+        'diagnosis': (DiagnosisOption, 'diagnosis_name'),
+        'treatment': (TreatmentOption, 'treatment_name'),
+    }
+
+    def __init__(self):
+        self._names = {}
+
+    def join(self, kind, case_pk, ids):
+        key = (kind, case_pk)
+        if key not in self._names:
+            model, field = self._SOURCES[kind]
+            self._names[key] = dict(model.objects.filter(clinical_case_id=case_pk).values_list('id', field))
+        names = self._names[key]
+        result = []
+        for option_id in ids or []:
+            try:
+                result.append(names.get(int(option_id)) or f'#{option_id}')
+            except (TypeError, ValueError):
+                continue
+        return '；'.join(result)
+
+
+def _format_dt(value):
+    return timezone.localtime(value).strftime('%Y-%m-%d %H:%M') if value else ''
+
+
+def _minutes(value):
+    return round(value, 1) if value is not None else ''
+
+
+def _safe_cell(value):
+    """自由文本以公式字符开头时前置单引号，按普通文本显示"""
+    if isinstance(value, str) and value.startswith(_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def _safe_filename(filename):
+    return _UNSAFE_FILENAME_CHARS.sub('_', filename)
+
+
+def _examination_counts(session_data):
+    """(检查提交次数, 检查错误次数)：已通过取通过时的记录，否则取当前计数"""
+    data = session_data or {}
+    success = data.get('examination_selection_success') or {}
+    if success.get('final_attempt'):
+        return success['final_attempt'], success.get('total_errors', 0)
+    return data.get('examination_current_attempt_count') or 0, len(data.get('examination_selection_errors') or [])
+
+
+def export_rows(queryset):
+    """逐行生成导出数据（不含表头）"""
+    names = _OptionNames()
+    for row in queryset.iterator(chunk_size=EXPORT_CHUNK_SIZE):
+        case_pk = row['clinical_case_id']
+        examination_attempts, examination_errors = _examination_counts(row['session_data'])
+        yield [
+            _safe_cell(row['student__username']),
+            _safe_cell(f"{row['student__first_name']} {row['student__last_name']}".strip()),
+            row['clinical_case__case_id'],
+            _safe_cell(row['clinical_case__title']),
+            STAGE_LABELS.get(row['session_status'], row['session_status']),
+            _format_dt(row['started_at']),
+            _format_dt(row['completed_at']),
+            row['examination_score'],
+            row['diagnosis_score'],
+            row['treatment_score'],
+            row['overall_score'],
+            examination_attempts,
+            examination_errors,
+            row['diagnosis_attempt_count'],
+            row['treatment_attempt_count'] or 0,
+            _minutes(row['study_minutes']),
+            *[_minutes(row[field]) for field in STAGE_MINUTES_FIELDS.values()],
+            names.join('examination', case_pk, row['selected_examinations']),
+            names.join('diagnosis', case_pk, row['selected_diagnoses']),
+            names.join('treatment', case_pk, row['selected_treatments']),
+        ]
+
+
+class _Echo:
+    """csv.writer 的伪文件对象：write() 直接返回写入的文本"""
+
+    def write(self, value):
+        return value
+
+
+def csv_response(rows, filename):
+    writer = csv.writer(_Echo())
+
+    def stream():
+        yield '\ufeff'
+        yield writer.writerow(EXPORT_HEADERS)
+        for row in rows:
+            yield writer.writerow(row)
+
+    response = StreamingHttpResponse(stream(), content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = content_disposition_header(True, f'{filename}.csv')
+    return response
+
+
+def xlsx_response(rows, filename):
+    try:
+        import xlsxwriter
+    except ImportError:
+        raise ExportUnavailable('导出 XLSX 需要安装 xlsxwriter：pip install xlsxwriter')
+
+    output = tempfile.TemporaryFile()
+    workbook = xlsxwriter.Workbook(output, {
+        'constant_memory': True, 'tmpdir': tempfile.gettempdir(), 'strings_to_formulas': False,
+    })
+    sheet = workbook.add_worksheet('会话明细')
+    sheet.write_row(0, 0, EXPORT_HEADERS, workbook.add_format({'bold': True}))
+    for index, row in enumerate(rows, start=1):
+        sheet.write_row(index, 0, row)
+    workbook.close()
+    output.seek(0)
+    return FileResponse(
+        output, as_attachment=True, filename=f'{filename}.xlsx',
+        content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    )
+
+
+def export_response(queryset, export_format, filename):
+    """
+    构造导出响应
+
+    Raises:
+        ValueError: 不支持的导出格式
+        ExportUnavailable: XLSX 依赖未安装
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f'不支持的导出格式：{export_format}')
+    rows = export_rows(queryset)
+    filename = _safe_filename(filename)
+    if export_format == 'xlsx':
+        return xlsx_response(rows, filename)
+    return csv_response(rows, filename)
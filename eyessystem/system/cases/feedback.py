@@ -0,0 +1,78 @@
+"""
+教学反馈的驻留存储
+- 反馈文本拆成“模板 + 少量参数”，相同模板只在 FeedbackTemplate 中存一份
+- 同一会话同一阶段连续出现完全相同的反馈时，只累加 repeat_count，不再插入新行
+- 读取时通过 TeachingFeedback.content 延迟渲染
+- 模板不做进程内缓存：压缩命令可能删除无引用的模板，每次按唯一的内容哈希 get_or_create（一次索引查询）
+"""
+import hashlib
+
+from django.db.models import F
+from django.utils import timezone
+
+from .models import FeedbackTemplate, TeachingFeedback
+
+
+def escape_template_text(text):
+    """将任意文本（如病例提示语）转义为可安全 format 的模板片段"""
+    return (text or '').replace('{', '{{').replace('}', '}}')
+
+
+def _hash_template(template_text):
+    return hashlib.sha1(template_text.encode('utf-8')).hexdigest()
+
+
+def intern_feedback_template(template_text):
+    """获取或创建反馈模板（按内容哈希去重）"""
+    template, _ = FeedbackTemplate.objects.get_or_create(
+        content_hash=_hash_template(template_text),
+        defaults={'template_text': template_text},
+    )
+    return template
+
+
+def record_feedback(session, feedback_stage, feedback_type, template_text, params=None, is_automated=True):
+    """
+    记录一条教学反馈
+
+    Args:
+        session: StudentClinicalSession
+        feedback_stage / feedback_type: 同 TeachingFeedback 字段
+        template_text: 模板文本（动态数字用 {name} 占位，固定文本需先 escape_template_text）
+        params: 模板参数，只放计数、分数等小数据
+
+    Returns:
+        str: 渲染后的反馈文本
+    """
+    params = params or {}
+    template = intern_feedback_template(template_text)
+    rendered = template.render(params)
+
+    # 与本阶段最近一条反馈完全相同时只累加计数（一次 UPDATE，不新增行）
+    latest = (
+        TeachingFeedback.objects.filter(student_session=session, feedback_stage=feedback_stage)
+        .order_by('-id')
+        .values('id', 'feedback_type', 'template_id', 'params')
+        .first()
+    )
+    if (
+        latest
+        and latest['template_id'] == template.id
+        and latest['feedback_type'] == feedback_type
+        and (latest['params'] or {}) == params
+    ):
+        TeachingFeedback.objects.filter(id=latest['id']).update(
+            repeat_count=F('repeat_count') + 1,
+            last_seen_at=timezone.now(),
+        )
+        return rendered
+
+    TeachingFeedback.objects.create(
+        student_session=session,
+        feedback_stage=feedback_stage,
+        feedback_type=feedback_type,
+        template=template,
+        params=params or None,
+        is_automated=is_automated,
+    )
+    return rendered
@@ -0,0 +1,216 @@
+"""
+学习心跳：按阶段统计有效学习时长
+- 前端每 HEARTBEAT_INTERVAL_SECONDS 秒（以及页面隐藏/离开时用 sendBeacon）上报这段时间内
+  页面可见且有操作的秒数；单次上报超过 HEARTBEAT_MAX_SECONDS 的部分视为挂机，直接截断，
+  同一 (会话, 阶段) 的连续心跳也不会计入超过两次心跳间隔的时长（多开标签页/重放不会重复累加）
+- 只接受会话当前阶段的心跳（由视图检查 session_status）
+- 心跳只在进程内按 (会话, 阶段) 累加，距上次写库超过 HEARTBEAT_FLUSH_SECONDS 后由下一次心跳
+  批量写入 SessionActiveTime（进程退出时也会写入），不再每次心跳写一次库
+- 轮次在写库时按会话当前最大 run 归属；开始新一轮前先 flush 该会话
+- 同一事务内按心跳日期累加 SessionActiveDay，每日汇总重算时跨天的学习按天拆分
+- 本轮已完成的会话（停留在学习反馈页）写入心跳后，按本轮全部有效时长重写其学习时长字段
+"""
+import atexit
+import math
+import threading
+import time
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import F, Max, Sum
+from django.utils import timezone
+
+from .models import SessionActiveDay, SessionActiveTime, SessionStageEvent, StudentClinicalSession
+from .rollups import record_active_seconds, rollup_date
+from .student_stats import invalidate_student_stats
+from .timing import MAJOR_STAGES, STAGE_MINUTES_FIELDS, STUDY_MINUTES_FIELDS
+
+
+HEARTBEAT_INTERVAL_SECONDS = 15
+HEARTBEAT_MAX_SECONDS = 2 * HEARTBEAT_INTERVAL_SECONDS
+HEARTBEAT_FLUSH_SECONDS = 30
+
+# 前端阶段名 -> 计时阶段
+STAGE_ALIASES = {
+    'examination_results': 'examination_selection',
+    'completed': 'learning_feedback',
+}
+
+
+def normalize_stage(stage):
+    """前端上报的阶段名 -> MAJOR_STAGES 中的阶段，无法识别返回 None"""
+    stage = STAGE_ALIASES.get(stage, stage)
+    return stage if stage in MAJOR_STAGES else None
+
+
+def _current_runs(session_ids):
+    return dict(
+        SessionStageEvent.objects.filter(session_id__in=session_ids)
+        .values('session_id')
+        .annotate(max_run=Max('run'))
+        .values_list('session_id', 'max_run')
+    )
+
+
+def _refresh_completed_minutes(runs_by_session):
+    """已完成会话的学习时长 = 本轮各阶段有效时长之和（{session_id: run}，一次读取 + 一次批量更新）"""
+    active = {}
+    for sid, run, stage, seconds in SessionActiveTime.objects.filter(
+        session_id__in=runs_by_session
+    ).values_list('session_id', 'run', 'stage', 'active_seconds'):
+        if run == runs_by_session[sid]:
+            active.setdefault(sid, {})[stage] = seconds
+    sessions = []
+    for sid, stages in active.items():
+        session = StudentClinicalSession(id=sid, study_minutes=sum(stages.values()) / 60)
+        for stage, field in STAGE_MINUTES_FIELDS.items():
+            setattr(session, field, stages[stage] / 60 if stage in stages else None)
+        sessions.append(session)
+    StudentClinicalSession.objects.bulk_update(sessions, STUDY_MINUTES_FIELDS)
+
+
+def _write_batch(batch):
+    """一次事务写入一批 {(session_id, stage): [seconds, beats, last_at]}"""
+    owners = {}
+    completed = set()
+    for sid, case_id, student_id, completed_at in StudentClinicalSession.objects.filter(
+        id__in={sid for sid, _ in batch}
+    ).values_list('id', 'clinical_case_id', 'student_id', 'completed_at'):
+        owners[sid] = (case_id, student_id)
+        if completed_at is not None:
+            completed.add(sid)
+    session_ids = set(owners)
+    runs = _current_runs(session_ids)
+    rows = {
+        (sid, runs.get(sid) or 1, stage): entry
+        for (sid, stage), entry in batch.items()
+        if sid in session_ids
+    }
+    if not rows:
+        return
+    with transaction.atomic():
+        SessionActiveTime.objects.bulk_create(
+            [SessionActiveTime(session_id=sid, run=run, stage=stage) for sid, run, stage in rows],
+            ignore_conflicts=True,
+        )
+        for (sid, run, stage), (seconds, beats, last_at) in rows.items():
+            SessionActiveTime.objects.filter(session_id=sid, run=run, stage=stage).update(
+                active_seconds=F('active_seconds') + seconds,
+                heartbeats=F('heartbeats') + beats,
+                last_heartbeat_at=last_at,
+            )
+        days = defaultdict(float)
+        for (sid, _, _), (seconds, _, last_at) in rows.items():
+            days[(sid, rollup_date(last_at))] += seconds
+        SessionActiveDay.objects.bulk_create(
+            [SessionActiveDay(session_id=sid, date=day) for sid, day in days], ignore_conflicts=True,
+        )
+        for (sid, day), seconds in days.items():
+            SessionActiveDay.objects.filter(session_id=sid, date=day).update(active_seconds=F('active_seconds') + seconds)
+        if completed:
+            _refresh_completed_minutes({sid: run for sid, run, _ in rows if sid in completed})
+    for sid in completed:
+        invalidate_student_stats(owners[sid][1])
+    record_active_seconds(
+        (*owners[sid], last_at, seconds) for (sid, _, _), (seconds, _, last_at) in rows.items()
+    )
+
+
+class HeartbeatBuffer:
+    """进程内心跳缓冲区（线程安全）"""
+
+    def __init__(self, flush_interval=HEARTBEAT_FLUSH_SECONDS):
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pending = {}
+        # (会话, 阶段) -> 上次心跳的 monotonic 时间，用于按心跳间隔截断计入的秒数
+        self._last_beat = {}
+        self._last_flush = time.monotonic()
+
+    def record(self, session_id, stage, seconds, at=None):
+        """累加一次心跳，返回实际计入的秒数（不超过距上次心跳的间隔）；到达写库间隔时顺带批量写入"""
+        seconds = float(seconds)
+        if not math.isfinite(seconds):
+            return 0.0
+        key = (session_id, stage)
+        now = time.monotonic()
+        with self._lock:
+            last_beat = self._last_beat.get(key)
+            self._last_beat[key] = now
+            limit = HEARTBEAT_MAX_SECONDS if last_beat is None else min(HEARTBEAT_MAX_SECONDS, now - last_beat)
+            seconds = max(0.0, min(seconds, limit))
+            if seconds > 0:
+                entry = self._pending.setdefault(key, [0.0, 0, None])
+                entry[0] += seconds
+                entry[1] += 1
+                entry[2] = at or timezone.now()
+            due = now - self._last_flush >= self.flush_interval
+        if due:
+            self.flush()
+        return seconds
+
+    def pending_seconds(self, session_id):
+        """尚未写库的各阶段秒数"""
+        with self._lock:
+            return {stage: entry[0] for (sid, stage), entry in self._pending.items() if sid == session_id}
+
+    def pending_beats(self, session_id):
+        """尚未写库的心跳次数"""
+        with self._lock:
+            return sum(entry[1] for (sid, _), entry in self._pending.items() if sid == session_id)
+
+    def flush(self, session_ids=None):
+        """写入缓冲区（session_ids 为空时写入全部），返回写入的条目数；失败时放回缓冲区"""
+        with self._lock:
+            if session_ids is None:
+                batch, self._pending = self._pending, {}
+                self._last_flush = now = time.monotonic()
+                # 超过 HEARTBEAT_MAX_SECONDS 未再心跳的键不再影响截断，清理掉避免无限增长
+                self._last_beat = {
+                    key: at for key, at in self._last_beat.items() if now - at < HEARTBEAT_MAX_SECONDS
+                }
+            else:
+                batch = {key: self._pending.pop(key) for key in list(self._pending) if key[0] in session_ids}
+        if not batch:
+            return 0
+        try:
+            _write_batch(batch)
+        except Exception:
+            with self._lock:
+                for key, (seconds, beats, last_at) in batch.items():
+                    entry = self._pending.setdefault(key, [0.0, 0, last_at])
+                    entry[0] += seconds
+                    entry[1] += beats
+            return 0
+        return len(batch)
+
+
+heartbeat_buffer = HeartbeatBuffer()
+atexit.register(heartbeat_buffer.flush)
+
+
+def active_seconds(session):
+    """本轮各阶段有效学习时长（秒，含本进程尚未写库的心跳）；没有心跳记录时返回 {}"""
+    run = _current_runs([session.pk]).get(session.pk) or 1
+    result = dict(
+        SessionActiveTime.objects.filter(session_id=session.pk, run=run).values_list('stage', 'active_seconds')
+    )
+    for stage, seconds in heartbeat_buffer.pending_seconds(session.pk).items():
+        result[stage] = result.get(stage, 0.0) + seconds
+    return result
+
+
+def active_revision(session_id):
+    """有效时长的修订号：已写库与本进程缓冲区中的心跳次数之和，每计入一次心跳就变化（用于 ETag）"""
+    written = SessionActiveTime.objects.filter(session_id=session_id).aggregate(total=Sum('heartbeats'))['total']
+    return (written or 0) + heartbeat_buffer.pending_beats(session_id)
+
+
+def active_revisions(session_ids):
+    """批量版本：一次 GROUP BY 查询返回 {session_id: 修订号}"""
+    rows = (
+        SessionActiveTime.objects.filter(session_id__in=session_ids)
+        .values('session_id').annotate(total=Sum('heartbeats')).order_by()
+    )
+    written = {row['session_id']: row['total'] or 0 for row in rows}
+    return {session_id: written.get(session_id, 0) + heartbeat_buffer.pending_beats(session_id) for session_id in session_ids}
@@ -0,0 +1,109 @@
+"""
+诊断渐进式提示阶梯
+诊断选项保存/删除时为每个病例预先生成各尝试级别、各错误模式的提示文本，
+存入 ClinicalCase.diagnosis_hint_ladder；提交诊断时只需字典查找，不再额外查询和拼接
+阶梯只用于提示文本：评分所用的正确诊断每次直接查询 DiagnosisOption；
+阶梯中的 correct_ids 与之不一致（批量 update、raw 导入等绕过了信号）时现场重建
+
+阶梯结构：
+{
+    "version": 1,
+    "correct_ids": [正确诊断 id, ...],
+    "partial": {            # 部分正确（选中了至少一个正确诊断）
+        "2": [[选项id, 提示行], ...],   # 第2次：错选项的轻度提示（按所选错项过滤）
+        "3": [[选项id, 提示行], ...],   # 第3次：错选项的中度提示
+        "4": "提示文本"                  # 第4次及以上：全部选项的强提示
+    },
+    "none": {               # 完全错误
+        "2": "提示文本",                 # 第2次：正确诊断的轻度提示
+        "3": "提示文本"                  # 第3次及以上：正确诊断的详细提示
+    }
+}
+"""
+from .models import ClinicalCase, DiagnosisOption
+
+
+HINT_LADDER_VERSION = 1
+
+
+def build_diagnosis_hint_ladder(options):
+    """根据病例的诊断选项（按 display_order, -probability_score 排好序）生成提示阶梯"""
+    options = list(options)
+    wrong_options = [o for o in options if not o.is_correct_diagnosis]
+    correct_options = [o for o in options if o.is_correct_diagnosis]
+
+    strong_hint = ''
+    for option in options:
+        if option.is_correct_diagnosis:
+            strong_hint += f"\n✓ {option.diagnosis_name}: 这是正确的诊断"
+        elif option.hint_level_3:
+            strong_hint += f"\n✗ {option.diagnosis_name}: {option.hint_level_3}"
+
+    detailed_hint = ''
+    for option in correct_options:
+        detailed_hint += f"\n✓ {option.diagnosis_name}: "
+        detailed_hint += option.hint_level_2 or "这是正确的鉴别诊断选项"
+
+    return {
+        'version': HINT_LADDER_VERSION,
+        'correct_ids': [o.id for o in correct_options],
+        'partial': {
+            '2': [[o.id, f"\n关于{o.diagnosis_name}: {o.hint_level_1}"] for o in wrong_options if o.hint_level_1],
+            '3': [[o.id, f"\n{o.diagnosis_name}: {o.hint_level_2}"] for o in wrong_options if o.hint_level_2],
+            '4': strong_hint,
+        },
+        'none': {
+            '2': ''.join(f"\n• {o.diagnosis_name}: {o.hint_level_1}" for o in correct_options if o.hint_level_1),
+            '3': detailed_hint,
+        },
+    }
+
+
+def rebuild_diagnosis_hint_ladder(clinical_case_id):
+    """重新生成并保存病例的提示阶梯（用 update 写入，不触发 updated_at 和保存信号）"""
+    options = DiagnosisOption.objects.filter(clinical_case_id=clinical_case_id).order_by(
+        'display_order', '-probability_score'
+    )
+    ladder = build_diagnosis_hint_ladder(options)
+    ClinicalCase.objects.filter(pk=clinical_case_id).update(diagnosis_hint_ladder=ladder)
+    return ladder
+
+
+def get_diagnosis_hint_ladder(clinical_case, correct_ids=None):
+    """
+    获取病例的提示阶梯，缺失、版本过旧或与当前正确诊断不一致时现场生成
+
+    Args:
+        correct_ids: 当前正确诊断 id 集合（由调用方查询）；给出时用于校验阶梯是否过期
+    """
+    ladder = clinical_case.diagnosis_hint_ladder
+    if (
+        not ladder
+        or ladder.get('version') != HINT_LADDER_VERSION
+        or (correct_ids is not None and set(ladder.get('correct_ids', ())) != set(correct_ids))
+    ):
+        ladder = rebuild_diagnosis_hint_ladder(clinical_case.pk)
+        clinical_case.diagnosis_hint_ladder = ladder
+    return ladder
+
+
+def ladder_guidance(ladder, pattern, attempt_count, selected_ids=()):
+    """
+    查找提示文本
+
+    Args:
+        ladder: 提示阶梯
+        pattern: 'partial'（部分正确）或 'none'（完全错误）
+        attempt_count: 当前尝试次数（>= 2 时才有提示）
+        selected_ids: 学生本次选择的诊断 id（部分正确的第2、3级只提示所选的错误项）
+    """
+    if pattern == 'partial':
+        level = str(min(attempt_count, 4))
+        rungs = ladder['partial'].get(level, '')
+        if isinstance(rungs, str):
+            return rungs
+        selected = {str(i) for i in selected_ids}
+        return ''.join(line for option_id, line in rungs if str(option_id) in selected)
+
+    level = str(min(attempt_count, 3))
+    return ladder['none'].get(level, '')
@@ -0,0 +1,295 @@
+"""
+选项作答分布与干扰项分析
+- 获取选项的 GET 接口把本次展示的选项 id 暂存到 request.session；展示的选项与上次相同时不改动 session，
+  诊断/治疗选项固定，只有首次展示会写 session 表，检查阶段重新抽取干扰项时才再次写入
+- 提交接口用一次 bulk_create 写入 OptionExposure（每个展示过的选项一行，标记是否选中）
+- compute_item_statistics() 由管理命令批量调用，用 NumPy 向量化聚合出每个选项的
+  选择率、区分度和点二列相关，写入 OptionItemStats；请求中只读取结果
+"""
+import logging
+
+from django.db import DatabaseError, transaction
+from django.utils import timezone
+
+from .live_monitor import publish_attempt
+from .models import (
+    DiagnosisOption, ExaminationOption, OptionExposure, OptionItemStats,
+    StudentClinicalSession, TreatmentOption,
+)
+
+
+logger = logging.getLogger(__name__)
+
+EXPOSURE_SESSION_KEY = 'option_exposures'
+
+OPTION_MODELS = {
+    'examination': (ExaminationOption, 'examination_name'),
+    'diagnosis': (DiagnosisOption, 'diagnosis_name'),
+    'treatment': (TreatmentOption, 'treatment_name'),
+}
+
+# 区分度分组比例（经典题目分析取高低各27%）
+DISCRIMINATION_GROUP_RATIO = 0.27
+
+
+def _as_int_ids(ids):
+    """过滤出整数 id（忽略 'physical_exam' 等特殊选项）"""
+    result = []
+    for value in ids or []:
+        try:
+            result.append(int(value))
+        except (TypeError, ValueError):
+            continue
+    return result
+
+
+def _stash_key(kind, clinical_case):
+    return f'{kind}:{clinical_case.pk}'
+
+
+def stash_option_exposure(request, clinical_case, kind, options):
+    """GET 选项接口调用：记录本次展示给学生的选项（不写业务表）"""
+    stash = request.session.get(EXPOSURE_SESSION_KEY) or {}
+    key = _stash_key(kind, clinical_case)
+    previous = stash.get(key) or {}
+    entry = {
+        'shown': [option.id for option in options],
+        'distractors': [option.id for option in options if option.clinical_case_id != clinical_case.pk],
+        'attempts': previous.get('attempts', 0),
+    }
+    if entry == previous:
+        # 重复展示相同选项（刷新页面）时不标记 session 已修改，读接口不产生 session 表写入
+        return
+    stash[key] = entry
+    request.session[EXPOSURE_SESSION_KEY] = stash
+
+
+def record_option_exposures(request, session, kind, selected_ids, key_ids, attempt=None):
+    """
+    提交接口调用：一次 bulk_create 写入本次提交的曝光/选择记录
+
+    Args:
+        request: 用于读取 GET 接口暂存的展示选项
+        session: StudentClinicalSession
+        kind: 'examination' / 'diagnosis' / 'treatment'
+        selected_ids: 学生选中的选项 id
+        key_ids: 本病例的标准答案 id（必选检查/正确诊断/最佳治疗）
+        attempt: 第几次提交，缺省按暂存计数自增
+    """
+    stash = request.session.get(EXPOSURE_SESSION_KEY) or {}
+    entry = stash.get(_stash_key(kind, session.clinical_case)) or {}
+    attempts = entry.get('attempts', 0) + 1
+    if attempt is None:
+        attempt = attempts
+
+    selected = set(_as_int_ids(selected_ids))
+    keys = set(_as_int_ids(key_ids))
+    distractors = set(entry.get('distractors') or [])
+    # 未经 GET 接口展示（旧页面流程）时，至少记录选中项和标准答案
+    shown = list(dict.fromkeys(list(entry.get('shown') or []) + sorted(selected | keys)))
+
+    try:
+        # 保存点：写入失败时不破坏调用方所在的事务
+        with transaction.atomic():
+            OptionExposure.objects.bulk_create([
+                OptionExposure(
+                    student_id=session.student_id,
+                    clinical_case_id=session.clinical_case_id,
+                    session=session,
+                    option_kind=kind,
+                    option_id=option_id,
+                    is_key=option_id in keys,
+                    is_distractor=option_id in distractors,
+                    selected=option_id in selected,
+                    attempt=attempt,
+                )
+                for option_id in shown
+            ])
+    except DatabaseError:
+        # 作答统计不影响提交流程，但需要留下记录
+        logger.exception('写入选项作答记录失败（session=%s, kind=%s）', session.pk, kind)
+    publish_attempt(session, kind, attempt)
+
+    if entry:
+        entry['attempts'] = attempts
+        request.session[EXPOSURE_SESSION_KEY] = stash
+
+
+def compute_item_statistics(first_attempt_only=True, case_ids=None):
+    """
+    批量计算选项题目分析并整表写入 OptionItemStats
+
+    ability（能力分）取学生在该案例已完成会话的总体得分；未完成的会话只计入选择率，
+    不参与高低分组和点二列相关
+
+    Returns:
+        int: 写入的统计行数
+    """
+    import numpy as np
+
+    exposures = OptionExposure.objects.all()
+    if first_attempt_only:
+        exposures = exposures.filter(attempt=1)
+    if case_ids is not None:
+        exposures = exposures.filter(clinical_case_id__in=case_ids)
+
+    rows = list(exposures.values_list(
+        'clinical_case_id', 'option_kind', 'option_id', 'student_id', 'selected', 'is_key', 'is_distractor'
+    ))
+    if not rows:
+        with transaction.atomic():
+            stale = OptionItemStats.objects.all()
+            if case_ids is not None:
+                stale = stale.filter(clinical_case_id__in=case_ids)
+            stale.delete()
+        return 0
+
+    kinds = list(OPTION_MODELS)
+    kind_index = {kind: i for i, kind in enumerate(kinds)}
+    case_arr = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+    kind_arr = np.fromiter((kind_index[r[1]] for r in rows), dtype=np.int64, count=len(rows))
+    option_arr = np.fromiter((r[2] for r in rows), dtype=np.int64, count=len(rows))
+    student_arr = np.fromiter((r[3] for r in rows), dtype=np.int64, count=len(rows))
+    selected_arr = np.fromiter((r[4] for r in rows), dtype=bool, count=len(rows)).astype(float)
+    key_arr = np.fromiter((r[5] for r in rows), dtype=bool, count=len(rows))
+    distractor_arr = np.fromiter((r[6] for r in rows), dtype=bool, count=len(rows))
+
+    # 能力分：已完成会话的总体得分（未完成为 NaN）
+    score_lookup = {
+        (student_id, case_id): score
+        for student_id, case_id, score in StudentClinicalSession.objects.filter(
+            clinical_case_id__in=set(case_arr.tolist()), completed_at__isnull=False
+        ).values_list('student_id', 'clinical_case_id', 'overall_score')
+    }
+    ability = np.array(
+        [score_lookup.get((s, c), np.nan) for s, c in zip(student_arr.tolist(), case_arr.tolist())],
+        dtype=float,
+    )
+    has_ability = ~np.isnan(ability)
+
+    # 每个案例的高低分组阈值（按学生去重后取分位数）
+    upper = np.zeros(len(rows), dtype=bool)
+    lower = np.zeros(len(rows), dtype=bool)
+    for case_id in np.unique(case_arr[has_ability]):
+        case_scores = np.array([
+            score for (_, c), score in score_lookup.items() if c == case_id
+        ], dtype=float)
+        if case_scores.size < 2:
+            continue
+        low_cut, high_cut = np.quantile(case_scores, [DISCRIMINATION_GROUP_RATIO, 1 - DISCRIMINATION_GROUP_RATIO])
+        in_case = (case_arr == case_id) & has_ability
+        lower |= in_case & (ability <= low_cut)
+        upper |= in_case & (ability >= high_cut)
+
+    # 按 (案例, 类别, 选项) 分组
+    group_keys = np.stack([case_arr, kind_arr, option_arr], axis=1)
+    unique_keys, inverse = np.unique(group_keys, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    n_groups = len(unique_keys)
+
+    def group_sum(weights):
+        return np.bincount(inverse, weights=weights, minlength=n_groups)
+
+    def ratio(numerator, denominator):
+        out = np.full(n_groups, np.nan)
+        np.divide(numerator, denominator, out=out, where=denominator > 0)
+        return out
+
+    exposures_n = group_sum(np.ones(len(rows)))
+    selections_n = group_sum(selected_arr)
+    upper_rate = ratio(group_sum(selected_arr * upper), group_sum(upper.astype(float)))
+    lower_rate = ratio(group_sum(selected_arr * lower), group_sum(lower.astype(float)))
+    discrimination = upper_rate - lower_rate
+
+    # 点二列相关 r = (M1 - M0) / s * sqrt(p * q)，只使用有能力分的记录
+    x = np.where(has_ability, ability, 0.0)
+    w = has_ability.astype(float)
+    n = group_sum(w)
+    n1 = group_sum(w * selected_arr)
+    sum_x = group_sum(x)
+    sum_x2 = group_sum(x * x)
+    sum_x1 = group_sum(x * selected_arr)
+    mean_1 = ratio(sum_x1, n1)
+    mean_0 = ratio(sum_x - sum_x1, n - n1)
+    variance = ratio(sum_x2, n) - ratio(sum_x, n) ** 2
+    std = np.sqrt(np.clip(variance, 0, None))
+    p = ratio(n1, n)
+    point_biserial = ratio((mean_1 - mean_0) * np.sqrt(p * (1 - p)), std)
+
+    is_key = group_sum(key_arr.astype(float)) > 0
+    is_distractor = group_sum(distractor_arr.astype(float)) > 0
+
+    def as_optional(value):
+        return None if np.isnan(value) else float(value)
+
+    now = timezone.now()
+    stats = [
+        OptionItemStats(
+            clinical_case_id=int(unique_keys[i, 0]),
+            option_kind=kinds[int(unique_keys[i, 1])],
+            option_id=int(unique_keys[i, 2]),
+            is_key=bool(is_key[i]),
+            is_distractor=bool(is_distractor[i]),
+            exposures=int(exposures_n[i]),
+            selections=int(selections_n[i]),
+            selection_rate=float(selections_n[i] / exposures_n[i]),
+            upper_rate=as_optional(upper_rate[i]),
+            lower_rate=as_optional(lower_rate[i]),
+            discrimination=as_optional(discrimination[i]),
+            point_biserial=as_optional(point_biserial[i]),
+            computed_at=now,
+        )
+        for i in range(n_groups)
+    ]
+
+    with transaction.atomic():
+        stale = OptionItemStats.objects.all()
+        if case_ids is not None:
+            stale = stale.filter(clinical_case_id__in=case_ids)
+        stale.delete()
+        OptionItemStats.objects.bulk_create(stats, batch_size=500)
+    return len(stats)
+
+
+def _item_flags(stat, min_exposures):
+    """给教师的修剪建议"""
+    flags = []
+    if stat.exposures < min_exposures:
+        return ['样本不足']
+    if not stat.is_key:
+        if stat.selection_rate < 0.05:
+            flags.append('几乎无人选择，可考虑替换')
+        if stat.discrimination is not None and stat.discrimination > 0:
+            flags.append('高分组更易误选，请检查选项表述')
+    else:
+        if stat.discrimination is not None and stat.discrimination < 0:
+            flags.append('低分组反而更易选对，请检查答案设置')
+    return flags
+
+
+def case_item_analysis(clinical_case, min_exposures=10):
+    """读取某个病例的题目分析结果（附选项名称与修剪建议）"""
+    stats = list(OptionItemStats.objects.filter(clinical_case=clinical_case))
+
+    names = {}
+    for kind, (model, name_field) in OPTION_MODELS.items():
+        option_ids = [s.option_id for s in stats if s.option_kind == kind]
+        if option_ids:
+            names[kind] = dict(model.objects.filter(id__in=option_ids).values_list('id', name_field))
+
+    return [{
+        'kind': stat.option_kind,
+        'option_id': stat.option_id,
+        'name': names.get(stat.option_kind, {}).get(stat.option_id, '（已删除）'),
+        'is_key': stat.is_key,
+        'is_distractor': stat.is_distractor,
+        'exposures': stat.exposures,
+        'selections': stat.selections,
+        'selection_rate': round(stat.selection_rate, 4),
+        'upper_rate': stat.upper_rate,
+        'lower_rate': stat.lower_rate,
+        'discrimination': stat.discrimination,
+        'point_biserial': stat.point_biserial,
+        'flags': _item_flags(stat, min_exposures),
+        'computed_at': stat.computed_at.isoformat(),
+    } for stat in stats]
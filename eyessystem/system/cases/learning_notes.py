@@ -0,0 +1,110 @@
+"""
+学习笔记的增量保存
+- 前端只提交 {base_revision, ops}，ops 为依次应用的文本操作
+  {'pos': 起始位置, 'delete': 删除字符数, 'insert': 插入文本}
+- 每个被接受的补丁立即落库：以 revision 做比较并交换，只更新 content / revision / updated_at 三列；
+  不在进程内缓存中暂存，重启或多进程部署都不会丢失笔记（前端自身已对输入做防抖）
+- base_revision 与当前版本不一致时抛出 NoteRevisionConflict，前端用返回的全文重新同步
+"""
+from django.utils import timezone
+
+from .models import LearningNote
+
+
+MAX_NOTE_LENGTH = 100_000
+
+
+class NotePatchError(ValueError):
+    """补丁格式错误或越界"""
+
+
+class NoteRevisionConflict(Exception):
+    """补丁基于的版本已过期"""
+
+    def __init__(self, revision, content):
+        self.revision = revision
+        self.content = content
+        super().__init__(f'笔记已更新到版本 {revision}，请同步后重试')
+
+
+def apply_ops(text, ops):
+    """依次应用文本操作，返回新文本"""
+    if not isinstance(ops, list):
+        raise NotePatchError('ops 必须为列表')
+    for op in ops:
+        if not isinstance(op, dict):
+            raise NotePatchError('补丁操作格式错误')
+        try:
+            pos = int(op.get('pos', 0))
+            delete = int(op.get('delete', 0))
+        except (TypeError, ValueError):
+            raise NotePatchError('补丁位置必须为整数')
+        insert = op.get('insert') or ''
+        if not isinstance(insert, str):
+            raise NotePatchError('插入内容必须为字符串')
+        if pos < 0 or delete < 0 or pos + delete > len(text):
+            raise NotePatchError('补丁位置超出笔记范围')
+        text = text[:pos] + insert + text[pos + delete:]
+    if len(text) > MAX_NOTE_LENGTH:
+        raise NotePatchError(f'笔记长度不能超过 {MAX_NOTE_LENGTH} 字')
+    return text
+
+
+def replace_ops(old_text, new_text):
+    """由旧/新全文生成单个替换操作（兼容整篇提交的旧接口）"""
+    prefix = 0
+    limit = min(len(old_text), len(new_text))
+    while prefix < limit and old_text[prefix] == new_text[prefix]:
+        prefix += 1
+    suffix = 0
+    while (suffix < limit - prefix
+           and old_text[len(old_text) - 1 - suffix] == new_text[len(new_text) - 1 - suffix]):
+        suffix += 1
+    return [{
+        'pos': prefix,
+        'delete': len(old_text) - prefix - suffix,
+        'insert': new_text[prefix:len(new_text) - suffix],
+    }]
+
+
+def _persist(note, content, revision):
+    """比较并交换写入，只更新三列"""
+    now = timezone.now()
+    updated = LearningNote.objects.filter(pk=note.pk, revision=note.revision).update(
+        content=content, revision=revision, updated_at=now,
+    )
+    if not updated:
+        note.refresh_from_db(fields=['content', 'revision', 'updated_at'])
+        raise NoteRevisionConflict(note.revision, note.content)
+    note.content, note.revision, note.updated_at = content, revision, now
+    return note
+
+
+def get_note(student, clinical_case):
+    """读取笔记；没有笔记时返回 None"""
+    return LearningNote.objects.filter(student=student, clinical_case=clinical_case).first()
+
+
+def patch_note(student, clinical_case, base_revision, ops):
+    """
+    应用一次补丁并落库
+
+    Returns:
+        dict: {'note', 'content', 'revision'}
+
+    Raises:
+        NotePatchError: 补丁无效
+        NoteRevisionConflict: base_revision 已过期（包括并发请求先一步落库）
+    """
+    try:
+        base_revision = int(base_revision)
+    except (TypeError, ValueError):
+        raise NotePatchError('缺少有效的 base_revision')
+    note, _ = LearningNote.objects.get_or_create(student=student, clinical_case=clinical_case)
+    if base_revision != note.revision:
+        raise NoteRevisionConflict(note.revision, note.content)
+
+    new_content = apply_ops(note.content, ops)
+    if new_content != note.content:
+        _persist(note, new_content, note.revision + 1)
+    return {'note': note, 'content': note.content, 'revision': note.revision}
@@ -0,0 +1,181 @@
+"""
+学生纵向学习画像（StudentLearningProfile）
+- 归档：archive_run 写入 SessionRun 时一并记下本轮的检查/治疗提交次数与诊断指导级别（见 run_profile_fields）
+- 增量：完成的轮次归档后 record_profile_run() 用一次 get_or_create + 一次 F() UPDATE 累加到该学生的画像，
+  不回扫历史会话；写入失败不影响学习请求，由 rebuild_learning_profiles 命令重算修正
+- 修正：rebuild_learning_profiles() 按 SessionRun（end_reason=completed，按归档先后）重算，
+  与增量累加使用同一套计数规则
+"""
+import logging
+from collections import defaultdict
+
+from django.db import DatabaseError, transaction
+from django.db.models import Case, Count, DateTimeField, F, Value, When
+from django.db.models.functions import Coalesce, Greatest
+
+from .models import LEARNING_PROFILE_STAGES, OptionExposure, SessionRun, StudentLearningProfile
+
+
+logger = logging.getLogger(__name__)
+
+# 得分滑动平均的权重（越大越偏重最近几轮）
+PROFILE_EWMA_ALPHA = 0.3
+
+_STAGE_ATTEMPT_FIELDS = {
+    'examination': 'examination_attempt_count',
+    'diagnosis': 'diagnosis_attempt_count',
+    'treatment': 'treatment_attempt_count',
+}
+_RUN_FIELDS = (
+    'student_id', 'overall_score', 'diagnosis_guidance_level', 'completed_at', *_STAGE_ATTEMPT_FIELDS.values(),
+)
+
+
+def _submission_counts(session):
+    """本轮各类选项的提交次数：OptionExposure 中不同 attempt 的个数（一次查询）"""
+    exposures = OptionExposure.objects.filter(session=session, option_kind__in=('examination', 'treatment'))
+    if session.run_started_at is not None:
+        exposures = exposures.filter(created_at__gte=session.run_started_at)
+    rows = exposures.values('option_kind').annotate(n=Count('attempt', distinct=True)).order_by()
+    return {row['option_kind']: row['n'] for row in rows}
+
+
+def run_profile_fields(session):
+    """
+    归档时记入 SessionRun 的画像字段（archive_run 调用），提交次数未知为 None
+    - 检查：session_data 中检查通过时的 final_attempt，没有时按提交记录计数
+    - 治疗：按提交记录计数
+    - 诊断指导级别：每答错一次升一级（最高 3 级），答对后会话上的级别可能已被清零，取两者较大值
+    """
+    counts = _submission_counts(session)
+    success = (session.session_data or {}).get('examination_selection_success') or {}
+    examination = success.get('final_attempt')
+    if not isinstance(examination, int) or examination < 1:
+        examination = counts.get('examination')
+    attempts = session.diagnosis_attempt_count or 0
+    return {
+        'examination_attempt_count': examination or None,
+        'treatment_attempt_count': counts.get('treatment') or None,
+        'diagnosis_guidance_level': max(session.diagnosis_guidance_level or 0, min(max(attempts - 1, 0), 3)),
+    }
+
+
+def _run_deltas(run):
+    """一轮完成记录（SessionRun 字段字典）-> 画像计数字段的增量"""
+    deltas = defaultdict(int)
+    for stage in LEARNING_PROFILE_STAGES:
+        attempts = run[_STAGE_ATTEMPT_FIELDS[stage]]
+        if not attempts or attempts < 1:
+            continue
+        deltas[f'{stage}_runs'] += 1
+        deltas[f'{stage}_attempts'] += attempts
+        deltas[f'{stage}_first_try'] += attempts == 1
+    if deltas['diagnosis_runs']:
+        level = run['diagnosis_guidance_level'] or 0
+        deltas['hinted_runs'] += level > 0
+        deltas['guidance_level_sum'] += level
+    return deltas
+
+
+def record_profile_run(run):
+    """完成的轮次归档后调用（中途重置的轮次不计入）"""
+    if run is None or run.end_reason != 'completed':
+        return
+    values = {name: getattr(run, name) for name in _RUN_FIELDS}
+    score = float(values['overall_score'] or 0)
+    completed_at = values['completed_at']
+    updates = {name: F(name) + value for name, value in _run_deltas(values).items() if value}
+    updates.update(
+        runs_completed=F('runs_completed') + 1,
+        score_sum=F('score_sum') + score,
+        # UPDATE 中的 runs_completed 取更新前的值，本轮序号为其 +1
+        score_xy_sum=F('score_xy_sum') + (F('runs_completed') + 1) * score,
+        score_ewma=Case(
+            When(runs_completed=0, then=Value(score)),
+            default=F('score_ewma') * (1 - PROFILE_EWMA_ALPHA) + score * PROFILE_EWMA_ALPHA,
+        ),
+        last_score=score,
+        best_score=Greatest('best_score', Value(score)),
+    )
+    if completed_at is not None:
+        updates.update(
+            first_completed_at=Coalesce('first_completed_at', Value(completed_at, output_field=DateTimeField())),
+            last_completed_at=completed_at,
+        )
+    try:
+        with transaction.atomic():
+            StudentLearningProfile.objects.get_or_create(student_id=run.student_id)
+            StudentLearningProfile.objects.filter(student_id=run.student_id).update(**updates)
+    except DatabaseError:
+        logger.exception('学习画像更新失败（student=%s, run=%s）', run.student_id, run.pk)
+
+
+def rebuild_learning_profiles(student_ids=None):
+    """
+    按 SessionRun 重算学习画像（缺省为全部学生）
+
+    Args:
+        student_ids: 只重算这些学生
+
+    Returns:
+        int: 写入的画像行数
+    """
+    runs = SessionRun.objects.filter(end_reason='completed')
+    if student_ids is not None:
+        runs = runs.filter(student_id__in=student_ids)
+
+    profiles = {}
+    for run in runs.order_by('student_id', 'created_at', 'id').values(*_RUN_FIELDS).iterator(chunk_size=2000):
+        profile = profiles.get(run['student_id'])
+        if profile is None:
+            profile = profiles[run['student_id']] = StudentLearningProfile(student_id=run['student_id'])
+        score = float(run['overall_score'] or 0)
+        for name, value in _run_deltas(run).items():
+            setattr(profile, name, getattr(profile, name) + value)
+        profile.runs_completed += 1
+        profile.score_sum += score
+        profile.score_xy_sum += profile.runs_completed * score
+        profile.score_ewma = score if profile.runs_completed == 1 else (
+            profile.score_ewma * (1 - PROFILE_EWMA_ALPHA) + score * PROFILE_EWMA_ALPHA
+        )
+        profile.last_score = score
+        profile.best_score = max(profile.best_score, score)
+        if run['completed_at'] is not None:
+            profile.first_completed_at = profile.first_completed_at or run['completed_at']
+            profile.last_completed_at = run['completed_at']
+
+    with transaction.atomic():
+        stale = StudentLearningProfile.objects.all()
+        if student_ids is not None:
+            stale = stale.filter(student_id__in=student_ids)
+        stale.delete()
+        StudentLearningProfile.objects.bulk_create(profiles.values(), batch_size=500)
+    return len(profiles)
+
+
+def _round(value, digits=2):
+    return round(value, digits) if value is not None else None
+
+
+def profile_summary(profile):
+    """画像 -> 教师端页面与接口使用的字典"""
+    student = profile.student
+    return {
+        'student_id': profile.student_id,
+        'student': student.username,
+        'student_name': f'{student.first_name} {student.last_name}'.strip(),
+        'runs_completed': profile.runs_completed,
+        'average_score': _round(profile.average_score, 1),
+        'score_trend': _round(profile.score_trend),
+        'score_ewma': _round(profile.score_ewma, 1),
+        'last_score': _round(profile.last_score, 1),
+        'best_score': _round(profile.best_score, 1),
+        'stages': {
+            stage: dict(summary, average_attempts=_round(summary['average_attempts']))
+            for stage, summary in ((stage, profile.stage_summary(stage)) for stage in LEARNING_PROFILE_STAGES)
+        },
+        'hint_rate': profile.hint_rate,
+        'average_guidance_level': _round(profile.average_guidance_level),
+        'first_completed_at': profile.first_completed_at,
+        'last_completed_at': profile.last_completed_at,
+    }
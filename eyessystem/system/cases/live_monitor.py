@@ -0,0 +1,375 @@
+"""
+课堂实时监控（教师端，Server-Sent Events）
+- 会话阶段切换、得分/诊断次数写入、检查/治疗提交时，在事务提交后向进程内的 monitor_hub 发布事件
+  （会话事件由 signals 发布，提交事件由 record_option_exposures 发布），事件内容直接取自刚保存的会话对象
+- 每个 SSE 连接订阅一个有界队列：先发一次快照（一次会话查询 + 一次提交次数查询），
+  之后只转发 hub 推送的事件，连接期间不再查询数据库；队列满（浏览器读得太慢）时发送 resync，
+  前端重连后重新取快照
+- ASGI 下连接由事件循环上的 asyncio 队列承载，不占线程；WSGI（runserver）下退化为阻塞队列，
+  每个连接在整个连接期间占用一个工作线程，因此同时打开的同步连接数以 MONITOR_MAX_SYNC_STREAMS 为上限，
+  超出时视图返回 503，前端稍后重试
+- hub 只在本进程内广播：多进程部署时，教师只能看到与其连接在同一进程中处理的学生请求
+"""
+import asyncio
+import json
+import queue
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import F, Max, Q
+from django.utils import timezone
+
+from .models import ClinicalCase, OptionExposure, StudentClinicalSession
+from .state_machine import STAGE_LABELS
+
+
+# 快照只包含最近有活动的会话
+MONITOR_WINDOW = timedelta(hours=3)
+MONITOR_QUEUE_SIZE = 500
+# 学生/病例显示名缓存的条目上限（LRU）
+MONITOR_LABEL_CACHE_SIZE = 4096
+MONITOR_KEEPALIVE_SECONDS = 15
+# 单个连接的最长时长，到期后由浏览器自动重连（旧版 Django 不感知客户端断开，避免连接永久挂起）
+MONITOR_STREAM_SECONDS = 30 * 60
+MONITOR_RETRY_MS = 3000
+# WSGI 下同时打开的监控连接上限（每个连接占用一个线程，最长 MONITOR_STREAM_SECONDS）
+MONITOR_MAX_SYNC_STREAMS = 4
+MONITOR_BUSY_RETRY_SECONDS = 30
+
+# 影响监控内容的会话字段（save_session 写入这些字段时发布事件）
+MONITOR_FIELDS = frozenset({
+    'session_status', 'stage_entered_at', 'run_started_at', 'completed_at', 'diagnosis_attempt_count',
+    'examination_score', 'diagnosis_score', 'treatment_score', 'overall_score',
+})
+# 按提交次数计数的选项类别（诊断次数直接取会话上的 diagnosis_attempt_count）
+ATTEMPT_KINDS = ('examination', 'treatment')
+
+_SNAPSHOT_FIELDS = (
+    'id', 'version', 'student_id', 'clinical_case_id', 'session_status', 'stage_entered_at', 'run_started_at',
+    'completed_at', 'diagnosis_attempt_count', 'overall_score', 'last_activity',
+    'student__username', 'student__first_name', 'student__last_name',
+    'clinical_case__case_id', 'clinical_case__title',
+)
+
+
+class MonitorBusy(Exception):
+    """同步监控连接数已达上限"""
+
+
+class _Subscription:
+    """单个监控连接；case_pk 不为空时只接收该病例的事件"""
+
+    def __init__(self, case_pk=None, maxsize=MONITOR_QUEUE_SIZE):
+        self.case_pk = case_pk
+        # 队列容量至少为 1：queue.Queue(0) / asyncio.Queue(0) 是无界队列
+        self.maxsize = max(int(maxsize), 1)
+        self.lagged = False
+
+    def wants(self, event):
+        return self.case_pk is None or event.get('case_pk') == self.case_pk
+
+
+class Subscription(_Subscription):
+    """阻塞队列（WSGI 线程中使用）"""
+
+    def __init__(self, case_pk=None, maxsize=MONITOR_QUEUE_SIZE):
+        super().__init__(case_pk, maxsize)
+        self._queue = queue.Queue(self.maxsize)
+
+    def deliver(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.lagged = True
+
+    def get(self, timeout):
+        """取下一条事件，超时返回 None"""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class AsyncSubscription(_Subscription):
+    """asyncio 队列（ASGI 事件循环中创建）；发布方在任意线程中经 call_soon_threadsafe 投递"""
+
+    def __init__(self, case_pk=None, maxsize=MONITOR_QUEUE_SIZE):
+        super().__init__(case_pk, maxsize)
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(self.maxsize)
+
+    def deliver(self, event):
+        self._loop.call_soon_threadsafe(self._put, event)
+
+    def _put(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.lagged = True
+
+    async def get(self, timeout):
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class MonitorHub:
+    """进程内发布/订阅"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = set()
+        self._sync_streams = 0
+        # 学生/病例显示名缓存（LRU，最多 MONITOR_LABEL_CACHE_SIZE 条），发布事件时不必每次查询
+        self._labels = OrderedDict()
+
+    def subscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def acquire_sync_stream(self):
+        """占用一个同步连接名额，已达上限时返回 False"""
+        with self._lock:
+            if self._sync_streams >= MONITOR_MAX_SYNC_STREAMS:
+                return False
+            self._sync_streams += 1
+            return True
+
+    def release_sync_stream(self):
+        with self._lock:
+            self._sync_streams -= 1
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscriptions)
+
+    def publish(self, event):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            if not subscription.wants(event):
+                continue
+            try:
+                subscription.deliver(event)
+            except RuntimeError:
+                # 连接所在的事件循环已关闭
+                self.unsubscribe(subscription)
+
+    def publish_on_commit(self, event):
+        """当前事务提交后发布（无订阅者时不构造回调）"""
+        if self._subscriptions:
+            transaction.on_commit(lambda: self.publish(event))
+
+    def label(self, kind, pk, loader):
+        key = (kind, pk)
+        with self._lock:
+            value = self._labels.get(key)
+            if value is not None:
+                self._labels.move_to_end(key)
+                return value
+        # 查询不持锁，并发未命中时最多重复加载一次
+        value = loader()
+        with self._lock:
+            self._labels[key] = value
+            self._labels.move_to_end(key)
+            while len(self._labels) > MONITOR_LABEL_CACHE_SIZE:
+                self._labels.popitem(last=False)
+        return value
+
+    def forget_label(self, kind, pk):
+        with self._lock:
+            self._labels.pop((kind, pk), None)
+
+
+monitor_hub = MonitorHub()
+
+
+def _full_name(first_name, last_name):
+    return f'{first_name} {last_name}'.strip()
+
+
+def _student_label(session):
+    def load():
+        if StudentClinicalSession.student.is_cached(session):
+            student = session.student
+            return student.username, _full_name(student.first_name, student.last_name)
+        row = User.objects.filter(pk=session.student_id).values_list('username', 'first_name', 'last_name').first()
+        return (row[0], _full_name(row[1], row[2])) if row else (f'#{session.student_id}', '')
+    return monitor_hub.label('student', session.student_id, load)
+
+
+def _case_label(session):
+    def load():
+        if StudentClinicalSession.clinical_case.is_cached(session):
+            return session.clinical_case.case_id, session.clinical_case.title
+        row = ClinicalCase.objects.filter(pk=session.clinical_case_id).values_list('case_id', 'title').first()
+        return tuple(row) if row else ('', '')
+    return monitor_hub.label('case', session.clinical_case_id, load)
+
+
+def _row(values, student, case):
+    """会话字段字典 -> 监控行"""
+    return {
+        'session_id': values['id'],
+        'version': values['version'],
+        'student_id': values['student_id'],
+        'student': student[0],
+        'student_name': student[1],
+        'case_pk': values['clinical_case_id'],
+        'case_id': case[0],
+        'case_title': case[1],
+        'stage': values['session_status'],
+        'stage_label': STAGE_LABELS.get(values['session_status'], values['session_status']),
+        'stage_entered_at': values['stage_entered_at'],
+        'run_started_at': values['run_started_at'],
+        'completed': values['completed_at'] is not None,
+        'overall_score': values['overall_score'],
+        'attempts': {'diagnosis': values['diagnosis_attempt_count']},
+        'last_activity': values['last_activity'],
+    }
+
+
+def session_event(session):
+    """由刚保存的会话对象构造 session 事件（不查询会话表）"""
+    values = {name: getattr(session, name) for name in _SNAPSHOT_FIELDS if '__' not in name}
+    return dict(_row(values, _student_label(session), _case_label(session)), type='session')
+
+
+def publish_session(session):
+    if monitor_hub.subscriber_count:
+        monitor_hub.publish_on_commit(session_event(session))
+
+
+def publish_session_removed(session):
+    monitor_hub.publish_on_commit({'type': 'removed', 'session_id': session.pk, 'case_pk': session.clinical_case_id})
+
+
+def publish_attempt(session, kind, attempt):
+    """检查/治疗提交后发布提交次数"""
+    if kind not in ATTEMPT_KINDS:
+        return
+    monitor_hub.publish_on_commit({
+        'type': 'attempt', 'session_id': session.pk, 'case_pk': session.clinical_case_id,
+        'kind': kind, 'attempt': attempt, 'run_started_at': session.run_started_at,
+    })
+
+
+def build_snapshot(case_pk=None):
+    """连接建立时的快照：最近有活动的会话（一次查询）及其本轮的检查/治疗提交次数（一次查询）"""
+    now = timezone.now()
+    since = now - MONITOR_WINDOW
+    sessions = StudentClinicalSession.objects.filter(last_activity__gte=since)
+    exposures = OptionExposure.objects.filter(
+        Q(session__run_started_at__isnull=True) | Q(created_at__gte=F('session__run_started_at')),
+        session__last_activity__gte=since, option_kind__in=ATTEMPT_KINDS,
+    )
+    if case_pk:
+        sessions = sessions.filter(clinical_case_id=case_pk)
+        exposures = exposures.filter(clinical_case_id=case_pk)
+
+    attempts = {}
+    for row in exposures.values('session_id', 'option_kind').annotate(attempt=Max('attempt')).order_by():
+        attempts.setdefault(row['session_id'], {})[row['option_kind']] = row['attempt']
+
+    rows = []
+    for values in sessions.order_by('-last_activity').values(*_SNAPSHOT_FIELDS):
+        row = _row(
+            values,
+            (values['student__username'], _full_name(values['student__first_name'], values['student__last_name'])),
+            (values['clinical_case__case_id'], values['clinical_case__title']),
+        )
+        row['attempts'].update(attempts.get(values['id'], {}))
+        rows.append(row)
+    return {'now': now, 'window_minutes': int(MONITOR_WINDOW.total_seconds() // 60), 'sessions': rows}
+
+
+def sse_message(data, event=None):
+    """编码一条 SSE 消息"""
+    lines = [f'event: {event}'] if event else []
+    lines.append('data: ' + json.dumps(data, ensure_ascii=False, cls=DjangoJSONEncoder))
+    return '\n'.join(lines) + '\n\n'
+
+
+_KEEPALIVE = ': keepalive\n\n'
+
+
+def _live_message(event):
+    if event is None:
+        return _KEEPALIVE
+    return sse_message(event, event['type'])
+
+
+def stream_events(case_pk=None):
+    """同步事件流（WSGI）：先订阅再取快照，快照与订阅之间的事件不会丢失（重复的事件前端按版本号忽略）"""
+    subscription = monitor_hub.subscribe(Subscription(case_pk))
+    try:
+        yield f'retry: {MONITOR_RETRY_MS}\n\n'
+        yield sse_message(build_snapshot(case_pk), 'snapshot')
+        deadline = time.monotonic() + MONITOR_STREAM_SECONDS
+        while time.monotonic() < deadline:
+            event = subscription.get(MONITOR_KEEPALIVE_SECONDS)
+            if subscription.lagged:
+                yield sse_message({}, 'resync')
+                return
+            yield _live_message(event)
+    finally:
+        monitor_hub.unsubscribe(subscription)
+
+
+class _SyncStream:
+    """占用一个同步连接名额的事件流；响应关闭时（包括尚未开始迭代时）归还名额"""
+
+    def __init__(self, events):
+        self._events = events
+        self._released = False
+
+    def __iter__(self):
+        return self._events
+
+    def close(self):
+        self._events.close()
+        if not self._released:
+            self._released = True
+            monitor_hub.release_sync_stream()
+
+
+def open_sync_stream(case_pk=None):
+    """
+    WSGI 下的监控连接（StreamingHttpResponse 关闭时调用 close 归还名额）
+
+    Raises:
+        MonitorBusy: 同时打开的同步连接已达 MONITOR_MAX_SYNC_STREAMS
+    """
+    if not monitor_hub.acquire_sync_stream():
+        raise MonitorBusy(f'实时监控连接已满（最多 {MONITOR_MAX_SYNC_STREAMS} 个），请稍后重试')
+    return _SyncStream(stream_events(case_pk))
+
+
+async def astream_events(case_pk=None):
+    """异步事件流（ASGI）：等待事件时不占用线程"""
+    from asgiref.sync import sync_to_async
+
+    subscription = monitor_hub.subscribe(AsyncSubscription(case_pk))
+    try:
+        yield f'retry: {MONITOR_RETRY_MS}\n\n'
+        yield sse_message(await sync_to_async(build_snapshot)(case_pk), 'snapshot')
+        deadline = time.monotonic() + MONITOR_STREAM_SECONDS
+        while time.monotonic() < deadline:
+            event = await subscription.get(MONITOR_KEEPALIVE_SECONDS)
+            if subscription.lagged:
+                yield sse_message({}, 'resync')
+                return
+            yield _live_message(event)
+    finally:
+        monitor_hub.unsubscribe(subscription)
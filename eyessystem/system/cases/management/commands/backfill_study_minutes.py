@@ -0,0 +1,66 @@
+"""
+Django管理命令：回填会话学习时长字段
+使用方法：python manage.py backfill_study_minutes [--all] [--batch-size 500] [--dry-run]
+
+按统一口径（本轮起点 → max(completed_at, last_activity)，超过24小时不记录）计算学习时长和各阶段用时；
+已有数据由 0036 迁移回填，新完成的会话在完成时写入、完成后继续活动时刷新；
+本命令用于修改计时口径后按 TimingEngine 重新计算（--all）
+"""
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from cases.models import StudentClinicalSession
+from cases.timing import STUDY_MINUTES_FIELDS, study_minutes_values, timing_engine
+
+
+class Command(BaseCommand):
+    help = '为历史已完成会话回填学习时长（study_minutes）及各阶段用时字段'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='重新计算所有已完成会话（默认只处理尚未写入的）')
+        parser.add_argument('--batch-size', type=int, default=500, help='每批处理的会话数')
+        parser.add_argument('--dry-run', action='store_true', help='只统计不写入')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        sessions = StudentClinicalSession.objects.filter(
+            Q(session_status='completed') | Q(completed_at__isnull=False)
+        )
+        if not options['all']:
+            sessions = sessions.filter(study_minutes__isnull=True)
+
+        total = sessions.count()
+        self.stdout.write(f'待处理会话 {total} 个...')
+
+        updated = 0
+        skipped = 0
+        batch = []
+        for session in sessions.order_by('id').iterator(chunk_size=batch_size):
+            batch.append(session)
+            if len(batch) >= batch_size:
+                u, s = self._process(batch, options['dry_run'])
+                updated += u
+                skipped += s
+                batch = []
+        if batch:
+            u, s = self._process(batch, options['dry_run'])
+            updated += u
+            skipped += s
+
+        prefix = '[dry-run] ' if options['dry_run'] else ''
+        self.stdout.write(self.style.SUCCESS(
+            f'{prefix}✓ 写入 {updated} 个会话，{skipped} 个会话计时异常（非正或超过24小时）未记录总时长'
+        ))
+
+    def _process(self, batch, dry_run):
+        timings = timing_engine.bulk(batch)
+        skipped = 0
+        for session in batch:
+            values = study_minutes_values(timings[session.pk])
+            if values['study_minutes'] is None:
+                skipped += 1
+            for field, value in values.items():
+                setattr(session, field, value)
+        if not dry_run:
+            StudentClinicalSession.objects.bulk_update(batch, STUDY_MINUTES_FIELDS)
+        return len(batch), skipped
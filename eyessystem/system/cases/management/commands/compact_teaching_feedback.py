@@ -0,0 +1,143 @@
+"""
+Django管理命令：压缩教学反馈表
+使用方法：python manage.py compact_teaching_feedback [--days 30] [--dry-run] [--vacuum]
+
+1. 旧数据驻留：把完整文本存储的历史反馈转为模板引用，清空原文字段
+2. 合并重复：同一会话同一阶段连续相同的反馈合并为一行，累加 repeat_count
+3. 保留策略：超过保留期的会话，每个阶段只保留最后一条反馈
+4. 清理不再被引用的反馈模板
+"""
+from datetime import timedelta
+from itertools import groupby
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from cases.feedback import escape_template_text, intern_feedback_template
+from cases.models import FeedbackTemplate, TeachingFeedback
+
+
+class Command(BaseCommand):
+    help = '将教学反馈转为模板驻留存储，合并重复行并按保留期压缩历史会话'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=30, help='超过该天数未活动的会话每阶段只保留最后一条反馈（默认30，0表示不按保留期压缩）')
+        parser.add_argument('--batch-size', type=int, default=500, help='批量更新的行数')
+        parser.add_argument('--dry-run', action='store_true', help='只统计不写入')
+        parser.add_argument('--vacuum', action='store_true', help='完成后对 SQLite 执行 VACUUM 回收空间')
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        batch_size = options['batch_size']
+        cutoff = timezone.now() - timedelta(days=options['days']) if options['days'] > 0 else None
+
+        self.stdout.write(f'压缩前反馈行数：{TeachingFeedback.objects.count()}，模板数：{FeedbackTemplate.objects.count()}')
+
+        with transaction.atomic():
+            interned = self._intern_legacy_rows(batch_size)
+            merged, expired = self._collapse_rows(cutoff, batch_size)
+            orphan_count, _ = FeedbackTemplate.objects.filter(feedbacks__isnull=True).delete()
+            remaining_rows = TeachingFeedback.objects.count()
+            remaining_templates = FeedbackTemplate.objects.count()
+            if dry_run:
+                # 完整执行一遍后回滚，统计结果与实际运行一致
+                transaction.set_rollback(True)
+
+        if options['vacuum'] and not dry_run and connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('VACUUM')
+
+        prefix = '[dry-run] ' if dry_run else ''
+        self.stdout.write(self.style.SUCCESS(
+            f'{prefix}✓ 驻留旧数据 {interned} 行，合并重复 {merged} 行，'
+            f'按保留期压缩 {expired} 行，清理模板 {orphan_count} 个'
+        ))
+        self.stdout.write(f'压缩后反馈行数：{remaining_rows}，模板数：{remaining_templates}')
+
+    def _intern_legacy_rows(self, batch_size):
+        """将 feedback_content 中的完整文本转为模板引用"""
+        legacy = TeachingFeedback.objects.filter(template__isnull=True).exclude(feedback_content='')
+        count = 0
+        pending = []
+        for feedback in legacy.only('id', 'feedback_content').iterator(chunk_size=batch_size):
+            count += 1
+            feedback.template = intern_feedback_template(escape_template_text(feedback.feedback_content))
+            feedback.feedback_content = ''
+            pending.append(feedback)
+            if len(pending) >= batch_size:
+                TeachingFeedback.objects.bulk_update(pending, ['template', 'feedback_content'])
+                pending = []
+        if pending:
+            TeachingFeedback.objects.bulk_update(pending, ['template', 'feedback_content'])
+        return count
+
+    def _collapse_rows(self, cutoff, batch_size):
+        """合并连续重复行；超过保留期的会话每阶段只保留最后一行"""
+        rows = (
+            TeachingFeedback.objects
+            .order_by('student_session_id', 'feedback_stage', 'id')
+            .values_list(
+                'id', 'student_session_id', 'feedback_stage', 'feedback_type',
+                'template_id', 'feedback_content', 'params', 'repeat_count',
+                'created_at', 'last_seen_at', 'student_session__last_activity',
+            )
+        )
+
+        merged = expired = 0
+        delete_ids = []
+        updates = {}  # 保留行 id -> (repeat_count, last_seen_at)
+
+        for _, group in groupby(rows.iterator(chunk_size=batch_size), key=lambda r: (r[1], r[2])):
+            group = list(group)
+            expire_all = cutoff is not None and group[-1][10] is not None and group[-1][10] < cutoff
+            keeper = None
+            for row in group:
+                row_id, _, _, feedback_type, template_id, content, params, repeat_count, created_at, last_seen_at, _ = row
+                seen_at = last_seen_at or created_at
+                same_as_keeper = keeper is not None and (
+                    expire_all
+                    or keeper['signature'] == (feedback_type, template_id, content, params or {})
+                )
+                if same_as_keeper:
+                    delete_ids.append(keeper['id'] if expire_all else row_id)
+                    if expire_all:
+                        expired += 1
+                        # 保留最后一行：计数累加到当前行
+                        keeper = {
+                            'id': row_id,
+                            'signature': None,
+                            'repeat_count': keeper['repeat_count'] + repeat_count,
+                            'last_seen_at': max(keeper['last_seen_at'], seen_at),
+                            'changed': True,
+                        }
+                    else:
+                        merged += 1
+                        keeper['repeat_count'] += repeat_count
+                        keeper['last_seen_at'] = max(keeper['last_seen_at'], seen_at)
+                        keeper['changed'] = True
+                    continue
+                if keeper is not None and keeper['changed']:
+                    updates[keeper['id']] = (keeper['repeat_count'], keeper['last_seen_at'])
+                keeper = {
+                    'id': row_id,
+                    'signature': (feedback_type, template_id, content, params or {}),
+                    'repeat_count': repeat_count,
+                    'last_seen_at': seen_at,
+                    'changed': False,
+                }
+            if keeper is not None and keeper['changed']:
+                updates[keeper['id']] = (keeper['repeat_count'], keeper['last_seen_at'])
+
+        pending = []
+        for row_id, (repeat_count, last_seen_at) in updates.items():
+            pending.append(TeachingFeedback(id=row_id, repeat_count=repeat_count, last_seen_at=last_seen_at))
+            if len(pending) >= batch_size:
+                TeachingFeedback.objects.bulk_update(pending, ['repeat_count', 'last_seen_at'])
+                pending = []
+        if pending:
+            TeachingFeedback.objects.bulk_update(pending, ['repeat_count', 'last_seen_at'])
+        for start in range(0, len(delete_ids), batch_size):
+            TeachingFeedback.objects.filter(id__in=delete_ids[start:start + batch_size]).delete()
+
+        return merged, expired
@@ -0,0 +1,36 @@
+"""
+Django管理命令：计算选项题目分析（选择率 / 区分度 / 点二列相关）
+使用方法：python manage.py compute_item_analysis [--all-attempts] [--case CASE_ID ...]
+建议通过定时任务每日运行一次，接口只读取计算结果
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from cases.item_analysis import compute_item_statistics
+from cases.models import ClinicalCase, OptionExposure
+
+
+class Command(BaseCommand):
+    help = '根据选项作答记录批量计算每个选项的选择率、区分度和点二列相关（需要 numpy）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all-attempts', action='store_true', help='统计所有提交（默认只统计每个阶段的首次提交）')
+        parser.add_argument('--case', nargs='*', dest='case_ids', help='只重新计算指定病例（case_id）')
+
+    def handle(self, *args, **options):
+        try:
+            import numpy  # noqa: F401
+        except ImportError:
+            raise CommandError('需要安装 numpy：pip install numpy')
+
+        case_pks = None
+        if options['case_ids']:
+            case_pks = list(ClinicalCase.objects.filter(case_id__in=options['case_ids']).values_list('id', flat=True))
+            if not case_pks:
+                raise CommandError('未找到指定的病例')
+
+        self.stdout.write(f'作答记录共 {OptionExposure.objects.count()} 条，开始计算...')
+        count = compute_item_statistics(
+            first_attempt_only=not options['all_attempts'],
+            case_ids=case_pks,
+        )
+        self.stdout.write(self.style.SUCCESS(f'✓ 选项分析完成：写入 {count} 条统计'))
@@ -0,0 +1,25 @@
+"""
+Django管理命令：按病例完整重算病例计数器（CaseCounters）
+使用方法：python manage.py rebuild_case_counters [--case 病例编号 ...]
+会话计数平时随新建/删除/完成/得分变化增减，增量漏掉（如直接改库）或出现偏差时运行本命令修正
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from cases.case_counters import rebuild_case_counters
+from cases.models import ClinicalCase
+
+
+class Command(BaseCommand):
+    help = '按选项与会话重新统计病例计数器'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--case', nargs='+', metavar='CASE_ID', help='只重算这些病例（默认全部）')
+
+    def handle(self, *args, **options):
+        case_ids = None
+        if options['case']:
+            case_ids = list(ClinicalCase.objects.filter(case_id__in=options['case']).values_list('pk', flat=True))
+            if not case_ids:
+                raise CommandError('未找到指定的病例')
+        count = rebuild_case_counters(case_ids)
+        self.stdout.write(self.style.SUCCESS(f'✓ 病例计数器重算完成：{count} 个病例'))
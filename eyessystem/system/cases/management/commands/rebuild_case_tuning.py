@@ -0,0 +1,25 @@
+"""
+Django管理命令：按已归档的轮次重算病例调优摘要（CaseTuningSummary）
+使用方法：python manage.py rebuild_case_tuning [--case 病例编号 ...]
+摘要平时随每轮完成增量累加，增量写入失败或修改分档规则后运行本命令修正
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from cases.case_tuning import rebuild_case_tuning
+from cases.models import ClinicalCase
+
+
+class Command(BaseCommand):
+    help = '按 SessionRun 重算病例得分与提交次数直方图'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--case', nargs='+', metavar='CASE_ID', help='只重算这些病例（默认全部）')
+
+    def handle(self, *args, **options):
+        case_ids = None
+        if options['case']:
+            case_ids = list(ClinicalCase.objects.filter(case_id__in=options['case']).values_list('id', flat=True))
+            if not case_ids:
+                raise CommandError('未找到指定的病例')
+        count = rebuild_case_tuning(case_ids)
+        self.stdout.write(self.style.SUCCESS(f'✓ 调优摘要重算完成：写入 {count} 个病例'))
@@ -0,0 +1,33 @@
+"""
+Django管理命令：按原始数据重算每日汇总（DailyCaseStats / DailyStudentStats）
+使用方法：python manage.py rebuild_daily_stats [--days N] [--all]
+建议每晚运行一次（默认重算昨天和今天），修正增量累加中写入失败的部分
+"""
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from cases.rollups import ROLLUP_TZ, rebuild_daily_stats
+
+
+class Command(BaseCommand):
+    help = '按会话事件、历史轮次和心跳记录重算教师端每日汇总'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=2, help='重算最近 N 天（含今天，默认 2）')
+        parser.add_argument('--all', action='store_true', help='重算全部历史')
+
+    def handle(self, *args, **options):
+        if options['all']:
+            count = rebuild_daily_stats()
+            self.stdout.write(self.style.SUCCESS(f'✓ 全部历史重算完成：写入 {count} 行汇总'))
+            return
+
+        days = options['days']
+        if days < 1:
+            raise CommandError('--days 至少为 1')
+        end = timezone.localtime(timezone.now(), ROLLUP_TZ).date()
+        start = end - timedelta(days=days - 1)
+        count = rebuild_daily_stats(start, end)
+        self.stdout.write(self.style.SUCCESS(f'✓ {start} ~ {end} 重算完成：写入 {count} 行汇总'))
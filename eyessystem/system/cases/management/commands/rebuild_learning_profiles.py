@@ -0,0 +1,25 @@
+"""
+Django管理命令：按已归档的轮次重算学生学习画像（StudentLearningProfile）
+使用方法：python manage.py rebuild_learning_profiles [--student 用户名 ...]
+画像平时随每轮完成增量累加，增量写入失败或修改计数规则后运行本命令修正
+"""
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from cases.learning_profiles import rebuild_learning_profiles
+
+
+class Command(BaseCommand):
+    help = '按 SessionRun 重算学生学习画像'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--student', nargs='+', metavar='USERNAME', help='只重算这些学生（默认全部）')
+
+    def handle(self, *args, **options):
+        student_ids = None
+        if options['student']:
+            student_ids = list(User.objects.filter(username__in=options['student']).values_list('id', flat=True))
+            if not student_ids:
+                raise CommandError('未找到指定的学生')
+        count = rebuild_learning_profiles(student_ids)
+        self.stdout.write(self.style.SUCCESS(f'✓ 学习画像重算完成：写入 {count} 个学生'))
@@ -0,0 +1,22 @@
+"""
+Django管理命令：重建治疗干扰项池
+使用方法：python manage.py rebuild_treatment_distractors
+"""
+
+from django.core.management.base import BaseCommand
+from cases.distractors import rebuild_treatment_distractors
+from cases.models import TreatmentDistractor
+
+
+class Command(BaseCommand):
+    help = '按治疗类型/难度重建最佳治疗干扰项池（同名去重）'
+
+    def handle(self, *args, **options):
+        self.stdout.write('开始重建治疗干扰项池...')
+        name_count = rebuild_treatment_distractors()
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'✓ 干扰项池重建完成：{name_count} 个治疗名称，'
+                f'当前共 {TreatmentDistractor.objects.count()} 条'
+            )
+        )
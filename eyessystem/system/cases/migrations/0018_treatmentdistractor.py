@@ -0,0 +1,54 @@
+# Generated by Django 5.2.6 on 2026-10-19 01:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_treatment_distractors(apps, schema_editor):
+    """按名称去重回填最佳治疗干扰项池（同名取 id 最小者为代表）"""
+    TreatmentOption = apps.get_model('cases', 'TreatmentOption')
+    TreatmentDistractor = apps.get_model('cases', 'TreatmentDistractor')
+
+    seen_names = set()
+    entries = []
+    for option in TreatmentOption.objects.filter(is_optimal=True).order_by('id'):
+        if option.treatment_name in seen_names:
+            continue
+        seen_names.add(option.treatment_name)
+        entries.append(TreatmentDistractor(
+            treatment_name=option.treatment_name,
+            treatment_type=option.treatment_type,
+            difficulty_level=option.difficulty_level,
+            treatment_id=option.id,
+            clinical_case_id=option.clinical_case_id,
+        ))
+    TreatmentDistractor.objects.bulk_create(entries)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cases', '0017_treatmentoption_correct_rationale_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TreatmentDistractor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('treatment_name', models.CharField(max_length=200, unique=True, verbose_name='治疗方案名称')),
+                ('treatment_type', models.CharField(max_length=50, verbose_name='治疗类型')),
+                ('difficulty_level', models.CharField(max_length=20, verbose_name='难度等级')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+                ('clinical_case', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='cases.clinicalcase', verbose_name='来源案例')),
+                ('treatment', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='distractor_entry', to='cases.treatmentoption', verbose_name='代表治疗选项')),
+            ],
+            options={
+                'verbose_name': '治疗干扰项池',
+                'verbose_name_plural': '治疗干扰项池',
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['treatment_type', 'difficulty_level'], name='treat_pool_bucket_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_treatment_distractors, migrations.RunPython.noop),
+    ]
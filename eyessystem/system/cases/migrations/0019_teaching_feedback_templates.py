@@ -0,0 +1,56 @@
+# Generated by Django 5.2.6 on 2026-10-19 01:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cases', '0018_treatmentdistractor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeedbackTemplate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_hash', models.CharField(max_length=40, unique=True, verbose_name='内容哈希')),
+                ('template_text', models.TextField(verbose_name='模板文本')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+            ],
+            options={
+                'verbose_name': '反馈模板',
+                'verbose_name_plural': '反馈模板',
+            },
+        ),
+        migrations.AddField(
+            model_name='teachingfeedback',
+            name='last_seen_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='最近一次出现时间'),
+        ),
+        migrations.AddField(
+            model_name='teachingfeedback',
+            name='params',
+            field=models.JSONField(blank=True, null=True, verbose_name='模板参数'),
+        ),
+        migrations.AddField(
+            model_name='teachingfeedback',
+            name='repeat_count',
+            field=models.PositiveIntegerField(default=1, help_text='连续相同反馈合并为一行时累计', verbose_name='重复次数'),
+        ),
+        migrations.AlterField(
+            model_name='teachingfeedback',
+            name='feedback_content',
+            field=models.TextField(blank=True, help_text='旧数据的完整文本；新数据通过模板+参数渲染', verbose_name='反馈内容'),
+        ),
+        migrations.AddIndex(
+            model_name='teachingfeedback',
+            index=models.Index(fields=['student_session', 'feedback_stage', '-id'], name='feedback_session_stage_idx'),
+        ),
+        migrations.AddField(
+            model_name='teachingfeedback',
+            name='template',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='feedbacks', to='cases.feedbacktemplate', verbose_name='反馈模板'),
+        ),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 5.2.6 on 2026-10-19 01:49
+
+from django.db import migrations, models
+
+
+def build_diagnosis_hint_ladder(options):
+    """提示阶梯（第 1 版结构的固定副本，不随 cases.hints 的修改而变化）"""
+    options = list(options)
+    wrong_options = [o for o in options if not o.is_correct_diagnosis]
+    correct_options = [o for o in options if o.is_correct_diagnosis]
+
+    strong_hint = ''
+    for option in options:
+        if option.is_correct_diagnosis:
+            strong_hint += f"\n✓ {option.diagnosis_name}: 这是正确的诊断"
+        elif option.hint_level_3:
+            strong_hint += f"\n✗ {option.diagnosis_name}: {option.hint_level_3}"
+
+    detailed_hint = ''
+    for option in correct_options:
+        detailed_hint += f"\n✓ {option.diagnosis_name}: "
+        detailed_hint += option.hint_level_2 or "这是正确的鉴别诊断选项"
+
+    return {
+        'version': 1,
+        'correct_ids': [o.id for o in correct_options],
+        'partial': {
+            '2': [[o.id, f"\n关于{o.diagnosis_name}: {o.hint_level_1}"] for o in wrong_options if o.hint_level_1],
+            '3': [[o.id, f"\n{o.diagnosis_name}: {o.hint_level_2}"] for o in wrong_options if o.hint_level_2],
+            '4': strong_hint,
+        },
+        'none': {
+            '2': ''.join(f"\n• {o.diagnosis_name}: {o.hint_level_1}" for o in correct_options if o.hint_level_1),
+            '3': detailed_hint,
+        },
+    }
+
+
+def backfill_diagnosis_hint_ladders(apps, schema_editor):
+    """为已有病例生成诊断提示阶梯"""
+    ClinicalCase = apps.get_model('cases', 'ClinicalCase')
+    DiagnosisOption = apps.get_model('cases', 'DiagnosisOption')
+
+    for case_id in ClinicalCase.objects.values_list('id', flat=True):
+        options = DiagnosisOption.objects.filter(clinical_case_id=case_id).order_by('display_order', '-probability_score')
+        ClinicalCase.objects.filter(pk=case_id).update(diagnosis_hint_ladder=build_diagnosis_hint_ladder(options))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cases', '0019_teaching_feedback_templates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='clinicalcase',
+            name='diagnosis_hint_ladder',
+            field=models.JSONField(blank=True, editable=False, null=True, verbose_name='诊断提示阶梯'),
+        ),
+        migrations.RunPython(backfill_diagnosis_hint_ladders, migrations.RunPython.noop),
+    ]
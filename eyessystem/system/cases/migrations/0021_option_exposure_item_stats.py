@@ -0,0 +1,62 @@
+# Generated by Django 5.2.6 on 2026-10-19 01:52
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('cases', '0020_clinicalcase_diagnosis_hint_ladder'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OptionItemStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('option_kind', models.CharField(choices=[('examination', '检查'), ('diagnosis', '诊断'), ('treatment', '治疗')], max_length=20, verbose_name='选项类别')),
+                ('option_id', models.PositiveIntegerField(verbose_name='选项ID')),
+                ('is_key', models.BooleanField(default=False, verbose_name='是否标准答案')),
+                ('is_distractor', models.BooleanField(default=False, verbose_name='是否干扰项')),
+                ('exposures', models.PositiveIntegerField(default=0, verbose_name='展示次数')),
+                ('selections', models.PositiveIntegerField(default=0, verbose_name='选择次数')),
+                ('selection_rate', models.FloatField(default=0.0, verbose_name='选择率')),
+                ('upper_rate', models.FloatField(blank=True, null=True, verbose_name='高分组选择率')),
+                ('lower_rate', models.FloatField(blank=True, null=True, verbose_name='低分组选择率')),
+                ('discrimination', models.FloatField(blank=True, null=True, verbose_name='区分度')),
+                ('point_biserial', models.FloatField(blank=True, null=True, verbose_name='点二列相关')),
+                ('computed_at', models.DateTimeField(verbose_name='计算时间')),
+                ('clinical_case', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='option_item_stats', to='cases.clinicalcase', verbose_name='临床案例')),
+            ],
+            options={
+                'verbose_name': '选项题目分析',
+                'verbose_name_plural': '选项题目分析',
+                'ordering': ['clinical_case', 'option_kind', '-selection_rate'],
+                'unique_together': {('clinical_case', 'option_kind', 'option_id')},
+            },
+        ),
+        migrations.CreateModel(
+            name='OptionExposure',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('option_kind', models.CharField(choices=[('examination', '检查'), ('diagnosis', '诊断'), ('treatment', '治疗')], max_length=20, verbose_name='选项类别')),
+                ('option_id', models.PositiveIntegerField(verbose_name='选项ID')),
+                ('is_key', models.BooleanField(default=False, help_text='必选检查/正确诊断/最佳治疗', verbose_name='是否标准答案')),
+                ('is_distractor', models.BooleanField(default=False, help_text='来自其他病例的选项', verbose_name='是否干扰项')),
+                ('selected', models.BooleanField(default=False, verbose_name='是否被选中')),
+                ('attempt', models.PositiveSmallIntegerField(default=1, verbose_name='第几次提交')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='记录时间')),
+                ('clinical_case', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='option_exposures', to='cases.clinicalcase', verbose_name='临床案例')),
+                ('session', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='option_exposures', to='cases.studentclinicalsession', verbose_name='学生会话')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='option_exposures', to=settings.AUTH_USER_MODEL, verbose_name='学生')),
+            ],
+            options={
+                'verbose_name': '选项作答记录',
+                'verbose_name_plural': '选项作答记录',
+                'indexes': [models.Index(fields=['clinical_case', 'option_kind', 'option_id'], name='exposure_case_option_idx'), models.Index(fields=['created_at'], name='exposure_created_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,151 @@
+# Generated by Django 5.2.6 on 2026-10-19 01:54
+
+import re
+from datetime import datetime
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.utils import timezone
+
+
+# 以下常量与转换函数是 cases.stage_events 写入本迁移时的固定副本，不随应用模块的修改而变化
+LEGACY_TIMING_KEYS = ('run_started_at', 'stage_start_times', 'stage_times')
+ARCHIVE_KEY = 'timing_archives'
+FIRST_STAGE = 'case_presentation'
+EVENT_RUN_START = 'run_start'
+EVENT_STAGE_ENTER = 'stage_enter'
+EVENT_TRANSITION = 'transition'
+
+_TRANSITION_KEY_RE = re.compile(r'^(.+)_to_(.+)$')
+
+
+def _parse_iso_ms(value):
+    if not value:
+        return None
+    try:
+        dt = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+        if timezone.is_naive(dt):
+            dt = timezone.make_aware(dt, timezone.get_current_timezone())
+        return int(dt.timestamp() * 1000)
+    except Exception:
+        return None
+
+
+def events_from_session_data(session_data):
+    """把 session_data 中的旧计时（timing_archives + 本轮）转换为事件元组 (run, stage, from_stage, event_type, ts)"""
+    if not isinstance(session_data, dict):
+        return []
+
+    snapshots = [a for a in (session_data.get(ARCHIVE_KEY) or []) if isinstance(a, dict)]
+    snapshots.append({key: session_data.get(key) for key in LEGACY_TIMING_KEYS})
+
+    events = []
+    run = 0
+    for snapshot in snapshots:
+        sst = snapshot.get('stage_start_times') if isinstance(snapshot.get('stage_start_times'), dict) else {}
+        st = snapshot.get('stage_times') if isinstance(snapshot.get('stage_times'), dict) else {}
+        run_started_ms = _parse_iso_ms(snapshot.get('run_started_at'))
+        if run_started_ms is None and not sst and not st:
+            continue
+
+        run += 1
+        run_events = []
+        for stage, value in sst.items():
+            ts = _parse_iso_ms(value)
+            if ts is not None:
+                run_events.append((run, str(stage), '', EVENT_STAGE_ENTER, ts))
+        for key, value in st.items():
+            match = _TRANSITION_KEY_RE.match(str(key))
+            ts = _parse_iso_ms(value)
+            if match and ts is not None:
+                run_events.append((run, match.group(2), match.group(1), EVENT_TRANSITION, ts))
+
+        # 缺少 run_started_at 的旧数据不补造，读取方仍按原口径兜底
+        if run_started_ms is not None:
+            events.append((run, FIRST_STAGE, '', EVENT_RUN_START, run_started_ms))
+        events.extend(sorted(run_events, key=lambda e: e[4]))
+    return events
+
+
+def backfill_stage_events(apps, schema_editor):
+    """把 session_data 中的计时字段（含 timing_archives）转为事件行，并从 JSON 中移除"""
+    StudentClinicalSession = apps.get_model('cases', 'StudentClinicalSession')
+    SessionStageEvent = apps.get_model('cases', 'SessionStageEvent')
+
+    for session in StudentClinicalSession.objects.only('id', 'session_data').iterator():
+        session_data = session.session_data
+        if not isinstance(session_data, dict):
+            continue
+        if not any(key in session_data for key in LEGACY_TIMING_KEYS + (ARCHIVE_KEY,)):
+            continue
+        SessionStageEvent.objects.bulk_create([
+            SessionStageEvent(session_id=session.id, run=run, stage=stage, from_stage=from_stage, event_type=event_type, ts=ts)
+            for run, stage, from_stage, event_type, ts in events_from_session_data(session_data)
+        ])
+        for key in LEGACY_TIMING_KEYS + (ARCHIVE_KEY,):
+            session_data.pop(key, None)
+        StudentClinicalSession.objects.filter(pk=session.id).update(session_data=session_data)
+
+
+def restore_session_data_timing(apps, schema_editor):
+    """回滚：按轮次把事件还原为 session_data 计时字段（旧轮次写回 timing_archives）"""
+    from datetime import timezone as dt_timezone
+
+    StudentClinicalSession = apps.get_model('cases', 'StudentClinicalSession')
+    SessionStageEvent = apps.get_model('cases', 'SessionStageEvent')
+
+    def iso(ms):
+        return datetime.fromtimestamp(ms / 1000, tz=dt_timezone.utc).isoformat()
+
+    runs_by_session = {}
+    for session_id, run, stage, from_stage, event_type, ts in SessionStageEvent.objects.order_by(
+        'session_id', 'run', 'ts', 'id'
+    ).values_list('session_id', 'run', 'stage', 'from_stage', 'event_type', 'ts'):
+        timing = runs_by_session.setdefault(session_id, {}).setdefault(
+            run, {'run_started_at': None, 'stage_start_times': {}, 'stage_times': {}}
+        )
+        if event_type == 'run_start':
+            timing['run_started_at'] = timing['run_started_at'] or iso(ts)
+        elif event_type == 'stage_enter':
+            timing['stage_start_times'].setdefault(stage, iso(ts))
+        elif event_type == 'transition':
+            timing['stage_times'][f'{from_stage}_to_{stage}'] = iso(ts)
+
+    for session_id, runs in runs_by_session.items():
+        session = StudentClinicalSession.objects.filter(pk=session_id).only('id', 'session_data').first()
+        if session is None:
+            continue
+        session_data = session.session_data if isinstance(session.session_data, dict) else {}
+        ordered = [runs[run] for run in sorted(runs)]
+        session_data.update(ordered[-1])
+        if len(ordered) > 1:
+            session_data[ARCHIVE_KEY] = ordered[:-1]
+        StudentClinicalSession.objects.filter(pk=session_id).update(session_data=session_data)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cases', '0021_option_exposure_item_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SessionStageEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run', models.PositiveIntegerField(default=1, verbose_name='轮次')),
+                ('stage', models.CharField(max_length=30, verbose_name='阶段')),
+                ('from_stage', models.CharField(blank=True, help_text='仅阶段切换事件记录', max_length=30, verbose_name='来源阶段')),
+                ('event_type', models.CharField(choices=[('run_start', '开始新一轮'), ('stage_enter', '首次进入阶段'), ('transition', '阶段切换')], max_length=20, verbose_name='事件类型')),
+                ('ts', models.BigIntegerField(verbose_name='时间戳（毫秒）')),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stage_events', to='cases.studentclinicalsession', verbose_name='学生会话')),
+            ],
+            options={
+                'verbose_name': '会话阶段事件',
+                'verbose_name_plural': '会话阶段事件',
+                'indexes': [models.Index(fields=['session', 'run', 'ts'], name='stage_event_session_run_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_stage_events, restore_session_data_timing),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.6 on 2026-10-19 01:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cases', '0022_session_stage_event'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='studentclinicalsession',
+            name='case_presentation_minutes',
+            field=models.FloatField(blank=True, null=True, verbose_name='病例呈现用时（分钟）'),
+        ),
+        migrations.AddField(
+            model_name='studentclinicalsession',
+            name='diagnosis_minutes',
+            field=models.FloatField(blank=True, null=True, verbose_name='诊断推理用时（分钟）'),
+        ),
+        migrations.AddField(
+            model_name='studentclinicalsession',
+            name='examination_minutes',
+            field=models.FloatField(blank=True, null=True, verbose_name='检查选择用时（分钟）'),
+        ),
+        migrations.AddField(
+            model_name='studentclinicalsession',
+            name='feedback_minutes',
+            field=models.FloatField(blank=True, null=True, verbose_name='学习反馈用时（分钟）'),
+        ),
+        migrations.AddField(
+            model_name='studentclinicalsession',
+            name='study_minutes',
+            field=models.FloatField(blank=True, help_text='本轮开始至完成，非正或超过24小时不记录', null=True, verbose_name='学习时长（分钟）'),
+        ),
+        migrations.AddField(
+            model_name='studentclinicalsession',
+            name='treatment_minutes',
+            field=models.FloatField(blank=True, null=True, verbose_name='治疗选择用时（分钟）'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-19 02:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cases', '0023_session_study_minutes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='studentclinicalsession',
+            name='version',
+            field=models.PositiveIntegerField(default=0, help_text='每次写入 +1，用于检测并发覆盖', verbose_name='版本号'),
+        ),
+    ]
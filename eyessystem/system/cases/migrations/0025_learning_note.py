@@ -0,0 +1,66 @@
+# Generated by Django 5.2.6 on 2026-10-19 02:13
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def copy_session_notes(apps, schema_editor):
+    """把学生会话中的 learning_notes 迁入笔记表（更新时间沿用会话最后活动时间）"""
+    StudentClinicalSession = apps.get_model('cases', 'StudentClinicalSession')
+    LearningNote = apps.get_model('cases', 'LearningNote')
+
+    rows = list(
+        StudentClinicalSession.objects.exclude(learning_notes='')
+        .values_list('student_id', 'clinical_case_id', 'learning_notes', 'last_activity')
+    )
+    LearningNote.objects.bulk_create([
+        LearningNote(student_id=student_id, clinical_case_id=case_id, content=content, revision=1)
+        for student_id, case_id, content, _ in rows
+    ], batch_size=500)
+    # auto_now 会覆盖 bulk_create 的 updated_at，逐条回写原时间
+    for student_id, case_id, _, last_activity in rows:
+        LearningNote.objects.filter(student_id=student_id, clinical_case_id=case_id).update(updated_at=last_activity)
+
+
+def restore_session_notes(apps, schema_editor):
+    """回滚：把笔记写回学生会话"""
+    StudentClinicalSession = apps.get_model('cases', 'StudentClinicalSession')
+    LearningNote = apps.get_model('cases', 'LearningNote')
+
+    for student_id, case_id, content in LearningNote.objects.values_list('student_id', 'clinical_case_id', 'content'):
+        StudentClinicalSession.objects.filter(student_id=student_id, clinical_case_id=case_id).update(learning_notes=content)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('cases', '0024_session_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LearningNote',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content', models.TextField(blank=True, verbose_name='笔记内容')),
+                ('revision', models.PositiveIntegerField(default=0, help_text='每次应用补丁 +1', verbose_name='版本')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+                ('clinical_case', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='learning_notes', to='cases.clinicalcase', verbose_name='临床案例')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='learning_notes', to=settings.AUTH_USER_MODEL, verbose_name='学生')),
+            ],
+            options={
+                'verbose_name': '学习笔记',
+                'verbose_name_plural': '学习笔记',
+                'indexes': [models.Index(fields=['student', 'updated_at'], name='note_student_updated_idx')],
+                'unique_together': {('student', 'clinical_case')},
+            },
+        ),
+        migrations.RunPython(copy_session_notes, restore_session_notes),
+        migrations.RemoveField(
+            model_name='studentclinicalsession',
+            name='learning_notes',
+        ),
+    ]
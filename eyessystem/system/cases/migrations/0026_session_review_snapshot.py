@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-19 02:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cases', '0025_learning_note'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='studentclinicalsession',
+            name='review_snapshot',
+            field=models.JSONField(blank=True, help_text='完成时的检查/诊断/治疗与阶段用时，开始新一轮时清空', null=True, verbose_name='复盘快照'),
+        ),
+    ]
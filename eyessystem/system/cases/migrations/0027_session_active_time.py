@@ -0,0 +1,31 @@
+# Generated by Django 5.2.6 on 2026-10-19 02:18
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cases', '0026_session_review_snapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SessionActiveTime',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run', models.PositiveIntegerField(default=1, verbose_name='轮次')),
+                ('stage', models.CharField(max_length=30, verbose_name='阶段')),
+                ('active_seconds', models.FloatField(default=0.0, verbose_name='有效时长（秒）')),
+                ('heartbeats', models.PositiveIntegerField(default=0, verbose_name='心跳次数')),
+                ('last_heartbeat_at', models.DateTimeField(blank=True, null=True, verbose_name='最后心跳时间')),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='active_times', to='cases.studentclinicalsession', verbose_name='学生会话')),
+            ],
+            options={
+                'verbose_name': '会话有效学习时长',
+                'verbose_name_plural': '会话有效学习时长',
+                'unique_together': {('session', 'run', 'stage')},
+            },
+        ),
+    ]
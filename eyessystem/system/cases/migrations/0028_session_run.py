@@ -0,0 +1,83 @@
+# Generated by Django 5.2.6 on 2026-10-19 02:21
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+import django.db.models.deletion
+
+
+def archive_completed_runs(apps, schema_editor):
+    """为已完成的会话补一条当前轮次的归档（更早的轮次只有阶段事件，无法还原得分）"""
+    StudentClinicalSession = apps.get_model('cases', 'StudentClinicalSession')
+    SessionStageEvent = apps.get_model('cases', 'SessionStageEvent')
+    SessionRun = apps.get_model('cases', 'SessionRun')
+
+    runs = dict(
+        SessionStageEvent.objects.values('session_id').annotate(max_run=Max('run')).values_list('session_id', 'max_run')
+    )
+    batch = []
+    for session in StudentClinicalSession.objects.filter(completed_at__isnull=False).iterator(chunk_size=500):
+        review = session.review_snapshot if isinstance(session.review_snapshot, dict) else {}
+        batch.append(SessionRun(
+            student_id=session.student_id,
+            clinical_case_id=session.clinical_case_id,
+            session_id=session.pk,
+            run=runs.get(session.pk) or 1,
+            end_reason='completed',
+            examination_score=session.examination_score,
+            diagnosis_score=session.diagnosis_score,
+            treatment_score=session.treatment_score,
+            overall_score=session.overall_score,
+            diagnosis_attempt_count=session.diagnosis_attempt_count,
+            selected_examinations=session.selected_examinations or [],
+            selected_diagnoses=session.selected_diagnoses or [],
+            selected_treatments=session.selected_treatments or [],
+            study_minutes=session.study_minutes,
+            review=review,
+            started_at=session.started_at,
+            completed_at=session.completed_at,
+        ))
+    SessionRun.objects.bulk_create(batch, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('cases', '0027_session_active_time'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SessionRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run', models.PositiveIntegerField(default=1, verbose_name='轮次')),
+                ('end_reason', models.CharField(choices=[('completed', '完成'), ('reset', '中途重置')], default='completed', max_length=20, verbose_name='结束方式')),
+                ('examination_score', models.FloatField(default=0.0, verbose_name='检查选择得分')),
+                ('diagnosis_score', models.FloatField(default=0.0, verbose_name='诊断准确性得分')),
+                ('treatment_score', models.FloatField(default=0.0, verbose_name='治疗方案得分')),
+                ('overall_score', models.FloatField(default=0.0, verbose_name='总体得分')),
+                ('diagnosis_attempt_count', models.IntegerField(default=0, verbose_name='诊断尝试次数')),
+                ('selected_examinations', models.JSONField(default=list, verbose_name='已选检查项目')),
+                ('selected_diagnoses', models.JSONField(default=list, verbose_name='选中的诊断ID')),
+                ('selected_treatments', models.JSONField(default=list, verbose_name='已选治疗方案')),
+                ('study_minutes', models.FloatField(blank=True, null=True, verbose_name='学习时长（分钟）')),
+                ('review', models.JSONField(blank=True, default=dict, help_text='与 review_snapshot 相同：检查/诊断/治疗名称与阶段用时', verbose_name='复盘数据')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='本轮开始时间')),
+                ('completed_at', models.DateTimeField(blank=True, null=True, verbose_name='完成时间')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='归档时间')),
+                ('clinical_case', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='session_runs', to='cases.clinicalcase', verbose_name='临床案例')),
+                ('session', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='runs', to='cases.studentclinicalsession', verbose_name='学生会话')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='session_runs', to=settings.AUTH_USER_MODEL, verbose_name='学生')),
+            ],
+            options={
+                'verbose_name': '会话历史轮次',
+                'verbose_name_plural': '会话历史轮次',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['student', 'clinical_case', 'created_at'], name='run_student_case_idx'), models.Index(fields=['clinical_case', 'created_at'], name='run_case_created_idx')],
+                'unique_together': {('session', 'run')},
+            },
+        ),
+        migrations.RunPython(archive_completed_runs, migrations.RunPython.noop),
+    ]
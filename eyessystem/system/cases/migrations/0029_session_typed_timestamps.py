@@ -0,0 +1,76 @@
+# Generated by Django 5.2.6 on 2026-10-19 02:23
+
+from datetime import datetime, timezone as dt_timezone
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def from_ms(ms):
+    """毫秒时间戳 -> UTC datetime（cases.stage_events.from_ms 的固定副本）"""
+    return datetime.fromtimestamp(ms / 1000, tz=dt_timezone.utc)
+
+
+def backfill_event_columns(apps, schema_editor):
+    """由本轮阶段事件回填 run_started_at / stage_entered_at；没有事件的会话取 started_at"""
+    StudentClinicalSession = apps.get_model('cases', 'StudentClinicalSession')
+    SessionStageEvent = apps.get_model('cases', 'SessionStageEvent')
+
+    latest = {}
+    rows = SessionStageEvent.objects.order_by('session_id', 'run', 'ts', 'id').values_list(
+        'session_id', 'run', 'stage', 'event_type', 'ts'
+    )
+    for session_id, run, stage, event_type, ts in rows.iterator(chunk_size=2000):
+        entry = latest.get(session_id)
+        if entry is None or entry['run'] != run:
+            entry = latest[session_id] = {'run': run, 'run_start': None, 'enter': {}, 'transition': None}
+        if event_type == 'run_start':
+            if entry['run_start'] is None:
+                entry['run_start'] = ts
+        elif event_type == 'stage_enter':
+            entry['enter'].setdefault(stage, ts)
+        elif event_type == 'transition':
+            entry['transition'] = ts
+
+    batch = []
+    for session in StudentClinicalSession.objects.only('id', 'session_status', 'started_at').iterator(chunk_size=500):
+        entry = latest.get(session.pk)
+        run_start = entry and entry['run_start']
+        stage_ts = entry and (entry['transition'] or entry['enter'].get(session.session_status) or run_start)
+        session.run_started_at = from_ms(run_start) if run_start else session.started_at
+        session.stage_entered_at = from_ms(stage_ts) if stage_ts else None
+        batch.append(session)
+        if len(batch) >= 500:
+            StudentClinicalSession.objects.bulk_update(batch, ['run_started_at', 'stage_entered_at'])
+            batch = []
+    if batch:
+        StudentClinicalSession.objects.bulk_update(batch, ['run_started_at', 'stage_entered_at'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cases', '0028_session_run'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='studentclinicalsession',
+            name='run_started_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='本轮开始时间'),
+        ),
+        migrations.AddField(
+            model_name='studentclinicalsession',
+            name='stage_entered_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='进入当前阶段时间'),
+        ),
+        migrations.AddIndex(
+            model_name='studentclinicalsession',
+            index=models.Index(fields=['run_started_at'], name='session_run_started_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='studentclinicalsession',
+            index=models.Index(fields=['last_activity'], name='session_last_activity_idx'),
+        ),
+        migrations.RunPython(backfill_event_columns, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.6 on 2026-10-19 02:27
+
+from django.db import migrations
+
+
+# cases.state_machine.LEGACY_STAGE_ALIASES 写入本迁移时的固定副本
+LEGACY_STAGE_ALIASES = {
+    'history': 'case_presentation',
+    'in_progress': 'case_presentation',
+    'examination': 'examination_selection',
+    'diagnosis': 'diagnosis_reasoning',
+    'treatment': 'treatment_selection',
+    'feedback': 'learning_feedback',
+}
+
+
+def normalize_session_status(apps, schema_editor):
+    """把旧接口写入的非 choices 阶段名（feedback、diagnosis、in_progress 等）归一为会话阶段"""
+    StudentClinicalSession = apps.get_model('cases', 'StudentClinicalSession')
+    for legacy, stage in LEGACY_STAGE_ALIASES.items():
+        StudentClinicalSession.objects.filter(session_status=legacy).update(session_status=stage)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cases', '0029_session_typed_timestamps'),
+    ]
+
+    operations = [
+        migrations.RunPython(normalize_session_status, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.6 on 2026-10-19 02:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cases', '0030_normalize_session_status'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='clinicalcase',
+            index=models.Index(fields=['is_active', 'created_at', 'id'], name='case_active_created_idx'),
+        ),
+    ]
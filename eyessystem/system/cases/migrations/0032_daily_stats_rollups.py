@@ -0,0 +1,122 @@
+# Generated by Django 5.2.6 on 2026-10-19 02:35
+
+from collections import defaultdict
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+import django.db.models.deletion
+
+
+# 以下口径是 cases.rollups 写入本迁移时的固定副本，不随应用模块的修改而变化
+ROLLUP_TZ = ZoneInfo('Asia/Shanghai')
+ROLLUP_FIELDS = ('sessions_started', 'sessions_completed', 'score_sum', 'score_count', 'active_seconds')
+EVENT_RUN_START = 'run_start'
+
+
+def rollup_date(dt):
+    return timezone.localtime(dt, ROLLUP_TZ).date()
+
+
+def backfill_daily_stats(apps, schema_editor):
+    """按已有的阶段事件、历史轮次和心跳记录生成全部历史的每日汇总"""
+    StudentClinicalSession = apps.get_model('cases', 'StudentClinicalSession')
+    SessionStageEvent = apps.get_model('cases', 'SessionStageEvent')
+    SessionActiveTime = apps.get_model('cases', 'SessionActiveTime')
+    SessionRun = apps.get_model('cases', 'SessionRun')
+    CaseStats = apps.get_model('cases', 'DailyCaseStats')
+    StudentStats = apps.get_model('cases', 'DailyStudentStats')
+
+    totals = defaultdict(lambda: dict.fromkeys(ROLLUP_FIELDS, 0))
+    events = SessionStageEvent.objects.filter(event_type=EVENT_RUN_START)
+    for case_id, student_id, ts in events.values_list('session__clinical_case_id', 'session__student_id', 'ts'):
+        day = rollup_date(datetime.fromtimestamp(ts / 1000, tz=ROLLUP_TZ))
+        totals[(case_id, student_id, day)]['sessions_started'] += 1
+    # 从未写过 run_start 事件的会话按 started_at 计一次
+    sessions = StudentClinicalSession.objects.filter(
+        ~Exists(SessionStageEvent.objects.filter(session_id=OuterRef('pk'), event_type=EVENT_RUN_START))
+    )
+    for case_id, student_id, started_at in sessions.values_list('clinical_case_id', 'student_id', 'started_at'):
+        totals[(case_id, student_id, rollup_date(started_at))]['sessions_started'] += 1
+    runs = SessionRun.objects.filter(end_reason='completed', completed_at__isnull=False)
+    for case_id, student_id, completed_at, score in runs.values_list(
+        'clinical_case_id', 'student_id', 'completed_at', 'overall_score'
+    ):
+        row = totals[(case_id, student_id, rollup_date(completed_at))]
+        row['sessions_completed'] += 1
+        if (score or 0) > 0:
+            row['score_sum'] += score
+            row['score_count'] += 1
+    active = SessionActiveTime.objects.filter(last_heartbeat_at__isnull=False)
+    for case_id, student_id, at, seconds in active.values_list(
+        'session__clinical_case_id', 'session__student_id', 'last_heartbeat_at', 'active_seconds'
+    ):
+        totals[(case_id, student_id, rollup_date(at))]['active_seconds'] += seconds or 0
+
+    case_rows = defaultdict(lambda: dict.fromkeys(ROLLUP_FIELDS, 0))
+    student_rows = defaultdict(lambda: dict.fromkeys(ROLLUP_FIELDS, 0))
+    for (case_id, student_id, day), values in totals.items():
+        for name, value in values.items():
+            case_rows[(case_id, day)][name] += value
+            student_rows[(student_id, day)][name] += value
+    CaseStats.objects.bulk_create(
+        [CaseStats(clinical_case_id=case_id, date=day, **values) for (case_id, day), values in case_rows.items()],
+        batch_size=500,
+    )
+    StudentStats.objects.bulk_create(
+        [StudentStats(student_id=student_id, date=day, **values) for (student_id, day), values in student_rows.items()],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('cases', '0031_case_library_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyStudentStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='日期')),
+                ('sessions_started', models.PositiveIntegerField(default=0, verbose_name='开始学习轮次')),
+                ('sessions_completed', models.PositiveIntegerField(default=0, verbose_name='完成学习轮次')),
+                ('score_sum', models.FloatField(default=0.0, help_text='完成且得分大于 0 的轮次', verbose_name='得分合计')),
+                ('score_count', models.PositiveIntegerField(default=0, verbose_name='计分轮次')),
+                ('active_seconds', models.FloatField(default=0.0, verbose_name='有效学习时长（秒）')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_clinical_stats', to=settings.AUTH_USER_MODEL, verbose_name='学生')),
+            ],
+            options={
+                'verbose_name': '学生每日统计',
+                'verbose_name_plural': '学生每日统计',
+                'indexes': [models.Index(fields=['date'], name='daily_student_date_idx')],
+                'unique_together': {('student', 'date')},
+            },
+        ),
+        migrations.CreateModel(
+            name='DailyCaseStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='日期')),
+                ('sessions_started', models.PositiveIntegerField(default=0, verbose_name='开始学习轮次')),
+                ('sessions_completed', models.PositiveIntegerField(default=0, verbose_name='完成学习轮次')),
+                ('score_sum', models.FloatField(default=0.0, help_text='完成且得分大于 0 的轮次', verbose_name='得分合计')),
+                ('score_count', models.PositiveIntegerField(default=0, verbose_name='计分轮次')),
+                ('active_seconds', models.FloatField(default=0.0, verbose_name='有效学习时长（秒）')),
+                ('clinical_case', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_stats', to='cases.clinicalcase', verbose_name='临床案例')),
+            ],
+            options={
+                'verbose_name': '病例每日统计',
+                'verbose_name_plural': '病例每日统计',
+                'indexes': [models.Index(fields=['date'], name='daily_case_date_idx')],
+                'unique_together': {('clinical_case', 'date')},
+            },
+        ),
+        migrations.RunPython(backfill_daily_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 5.2.6 on 2026-10-19 02:38
+
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+import django.db.models.deletion
+
+
+def backfill_case_counters(apps, schema_editor):
+    """为已有病例创建计数器并完整统计（按病例分组各统计一次，口径同写入本迁移时的 cases.case_counters）"""
+    ClinicalCase = apps.get_model('cases', 'ClinicalCase')
+    CaseCounters = apps.get_model('cases', 'CaseCounters')
+
+    counters = {
+        case_id: CaseCounters(clinical_case_id=case_id)
+        for case_id in ClinicalCase.objects.values_list('id', flat=True)
+    }
+    for model_name, field in (('ExaminationOption', 'examination_count'),
+                              ('DiagnosisOption', 'diagnosis_count'),
+                              ('TreatmentOption', 'treatment_count')):
+        rows = apps.get_model('cases', model_name).objects.values('clinical_case_id').annotate(n=Count('id'))
+        for row in rows:
+            setattr(counters[row['clinical_case_id']], field, row['n'])
+
+    scored = Q(overall_score__gt=0)
+    rows = apps.get_model('cases', 'StudentClinicalSession').objects.values('clinical_case_id').annotate(
+        session_count=Count('id'),
+        completed_count=Count('id', filter=Q(completed_at__isnull=False)),
+        score_sum=Sum('overall_score', filter=scored),
+        score_count=Count('id', filter=scored),
+    )
+    for row in rows:
+        counter = counters[row.pop('clinical_case_id')]
+        row['score_sum'] = row['score_sum'] or 0.0
+        for field, value in row.items():
+            setattr(counter, field, value)
+
+    CaseCounters.objects.bulk_create(counters.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cases', '0032_daily_stats_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CaseCounters',
+            fields=[
+                ('clinical_case', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='counters', serialize=False, to='cases.clinicalcase', verbose_name='临床案例')),
+                ('examination_count', models.PositiveIntegerField(default=0, verbose_name='检查选项数')),
+                ('diagnosis_count', models.PositiveIntegerField(default=0, verbose_name='诊断选项数')),
+                ('treatment_count', models.PositiveIntegerField(default=0, verbose_name='治疗选项数')),
+                ('session_count', models.PositiveIntegerField(default=0, verbose_name='学习会话数')),
+                ('completed_count', models.PositiveIntegerField(default=0, verbose_name='已完成会话数')),
+                ('score_sum', models.FloatField(default=0.0, help_text='得分大于 0 的会话', verbose_name='得分合计')),
+                ('score_count', models.PositiveIntegerField(default=0, verbose_name='计分会话数')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+            ],
+            options={
+                'verbose_name': '病例计数器',
+                'verbose_name_plural': '病例计数器',
+            },
+        ),
+        migrations.RunPython(backfill_case_counters, migrations.RunPython.noop),
+    ]
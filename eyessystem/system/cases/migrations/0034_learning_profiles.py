@@ -0,0 +1,130 @@
+# Generated by Django 5.2.6 on 2026-10-19 02:59
+
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F, Value
+from django.db.models.functions import Least
+import django.db.models.deletion
+
+
+# 以下常量与计数规则是 cases.learning_profiles 写入本迁移时的固定副本，不随应用模块的修改而变化
+PROFILE_EWMA_ALPHA = 0.3
+LEARNING_PROFILE_STAGES = ('examination', 'diagnosis', 'treatment')
+STAGE_ATTEMPT_FIELDS = {
+    'examination': 'examination_attempt_count',
+    'diagnosis': 'diagnosis_attempt_count',
+    'treatment': 'treatment_attempt_count',
+}
+RUN_FIELDS = (
+    'student_id', 'overall_score', 'diagnosis_guidance_level', 'completed_at', *STAGE_ATTEMPT_FIELDS.values(),
+)
+
+
+def _run_deltas(run):
+    """一轮完成记录 -> 画像计数字段的增量"""
+    deltas = defaultdict(int)
+    for stage in LEARNING_PROFILE_STAGES:
+        attempts = run[STAGE_ATTEMPT_FIELDS[stage]]
+        if not attempts or attempts < 1:
+            continue
+        deltas[f'{stage}_runs'] += 1
+        deltas[f'{stage}_attempts'] += attempts
+        deltas[f'{stage}_first_try'] += attempts == 1
+    if deltas['diagnosis_runs']:
+        level = run['diagnosis_guidance_level'] or 0
+        deltas['hinted_runs'] += level > 0
+        deltas['guidance_level_sum'] += level
+    return deltas
+
+
+def backfill_learning_profiles(apps, schema_editor):
+    """
+    按已归档的轮次生成学习画像
+    旧轮次没有检查/治疗提交次数，只计入诊断与得分；诊断指导级别按答错次数推算（每错一次升一级，最高 3 级）
+    """
+    SessionRun = apps.get_model('cases', 'SessionRun')
+    Profile = apps.get_model('cases', 'StudentLearningProfile')
+    SessionRun.objects.filter(diagnosis_attempt_count__gt=1).update(
+        diagnosis_guidance_level=Least(F('diagnosis_attempt_count') - 1, Value(3))
+    )
+
+    profiles = {}
+    runs = SessionRun.objects.filter(end_reason='completed').order_by('student_id', 'created_at', 'id')
+    for run in runs.values(*RUN_FIELDS).iterator(chunk_size=2000):
+        profile = profiles.get(run['student_id'])
+        if profile is None:
+            profile = profiles[run['student_id']] = Profile(student_id=run['student_id'])
+        score = float(run['overall_score'] or 0)
+        for name, value in _run_deltas(run).items():
+            setattr(profile, name, getattr(profile, name) + value)
+        profile.runs_completed += 1
+        profile.score_sum += score
+        profile.score_xy_sum += profile.runs_completed * score
+        profile.score_ewma = score if profile.runs_completed == 1 else (
+            profile.score_ewma * (1 - PROFILE_EWMA_ALPHA) + score * PROFILE_EWMA_ALPHA
+        )
+        profile.last_score = score
+        profile.best_score = max(profile.best_score, score)
+        if run['completed_at'] is not None:
+            profile.first_completed_at = profile.first_completed_at or run['completed_at']
+            profile.last_completed_at = run['completed_at']
+    Profile.objects.bulk_create(profiles.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('cases', '0033_case_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StudentLearningProfile',
+            fields=[
+                ('student', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='learning_profile', serialize=False, to=settings.AUTH_USER_MODEL, verbose_name='学生')),
+                ('runs_completed', models.PositiveIntegerField(default=0, verbose_name='完成轮次')),
+                ('examination_runs', models.PositiveIntegerField(default=0, verbose_name='检查记录轮次')),
+                ('examination_attempts', models.PositiveIntegerField(default=0, verbose_name='检查提交次数合计')),
+                ('examination_first_try', models.PositiveIntegerField(default=0, verbose_name='检查首次通过轮次')),
+                ('diagnosis_runs', models.PositiveIntegerField(default=0, verbose_name='诊断记录轮次')),
+                ('diagnosis_attempts', models.PositiveIntegerField(default=0, verbose_name='诊断尝试次数合计')),
+                ('diagnosis_first_try', models.PositiveIntegerField(default=0, verbose_name='诊断首次正确轮次')),
+                ('treatment_runs', models.PositiveIntegerField(default=0, verbose_name='治疗记录轮次')),
+                ('treatment_attempts', models.PositiveIntegerField(default=0, verbose_name='治疗提交次数合计')),
+                ('treatment_first_try', models.PositiveIntegerField(default=0, verbose_name='治疗首次通过轮次')),
+                ('hinted_runs', models.PositiveIntegerField(default=0, verbose_name='使用提示轮次')),
+                ('guidance_level_sum', models.PositiveIntegerField(default=0, verbose_name='提示级别合计')),
+                ('score_sum', models.FloatField(default=0.0, verbose_name='总分合计')),
+                ('score_xy_sum', models.FloatField(default=0.0, help_text='用于计算得分趋势斜率', verbose_name='序号×总分合计')),
+                ('score_ewma', models.FloatField(default=0.0, verbose_name='总分滑动平均')),
+                ('last_score', models.FloatField(default=0.0, verbose_name='最近一轮总分')),
+                ('best_score', models.FloatField(default=0.0, verbose_name='最高总分')),
+                ('first_completed_at', models.DateTimeField(blank=True, null=True, verbose_name='首次完成时间')),
+                ('last_completed_at', models.DateTimeField(blank=True, null=True, verbose_name='最近完成时间')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+            ],
+            options={
+                'verbose_name': '学生学习画像',
+                'verbose_name_plural': '学生学习画像',
+            },
+        ),
+        migrations.AddField(
+            model_name='sessionrun',
+            name='diagnosis_guidance_level',
+            field=models.IntegerField(default=0, help_text='本轮结束时达到的提示级别', verbose_name='诊断指导级别'),
+        ),
+        migrations.AddField(
+            model_name='sessionrun',
+            name='examination_attempt_count',
+            field=models.PositiveIntegerField(blank=True, help_text='检查选择通过时的提交次数，未知为空', null=True, verbose_name='检查提交次数'),
+        ),
+        migrations.AddField(
+            model_name='sessionrun',
+            name='treatment_attempt_count',
+            field=models.PositiveIntegerField(blank=True, help_text='本轮治疗方案的提交次数，未知为空', null=True, verbose_name='治疗提交次数'),
+        ),
+        migrations.RunPython(backfill_learning_profiles, migrations.RunPython.noop),
+    ]
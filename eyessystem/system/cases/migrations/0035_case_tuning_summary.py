@@ -0,0 +1,78 @@
+# Generated by Django 5.2.6 on 2026-10-19 03:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# 以下分档规则是 cases.case_tuning 写入本迁移时的固定副本，不随应用模块的修改而变化
+TUNING_SCORE_FIELDS = ('examination_score', 'diagnosis_score', 'treatment_score')
+TUNING_ATTEMPT_FIELDS = {
+    'examination_attempts': 'examination_attempt_count',
+    'diagnosis_attempts': 'diagnosis_attempt_count',
+}
+SCORE_BIN_WIDTH = 10
+SCORE_BINS = 10
+ATTEMPT_BINS = 5
+RUN_FIELDS = ('clinical_case_id', *TUNING_SCORE_FIELDS, *TUNING_ATTEMPT_FIELDS.values())
+
+
+def _empty_histograms():
+    histograms = {field: [0] * SCORE_BINS for field in TUNING_SCORE_FIELDS}
+    histograms.update({name: [0] * ATTEMPT_BINS for name in TUNING_ATTEMPT_FIELDS})
+    return histograms
+
+
+def _add_run(histograms, sums, run):
+    for field in TUNING_SCORE_FIELDS:
+        score = float(run[field] or 0)
+        histograms[field][min(max(int(score // SCORE_BIN_WIDTH), 0), SCORE_BINS - 1)] += 1
+        sums[field] = sums.get(field, 0) + score
+    for name, field in TUNING_ATTEMPT_FIELDS.items():
+        attempts = run[field]
+        if not attempts or attempts < 1:
+            continue
+        histograms[name][min(attempts, ATTEMPT_BINS) - 1] += 1
+        sums[name] = sums.get(name, 0) + attempts
+
+
+def backfill_case_tuning(apps, schema_editor):
+    """按已归档的轮次生成调优摘要"""
+    SessionRun = apps.get_model('cases', 'SessionRun')
+    Summary = apps.get_model('cases', 'CaseTuningSummary')
+
+    summaries = {}
+    runs = SessionRun.objects.filter(end_reason='completed').order_by('clinical_case_id', 'id')
+    for run in runs.values(*RUN_FIELDS).iterator(chunk_size=2000):
+        summary = summaries.get(run['clinical_case_id'])
+        if summary is None:
+            summary = summaries[run['clinical_case_id']] = Summary(
+                clinical_case_id=run['clinical_case_id'], histograms=_empty_histograms(), sums={},
+            )
+        _add_run(summary.histograms, summary.sums, run)
+        summary.runs_completed += 1
+    Summary.objects.bulk_create(summaries.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cases', '0034_learning_profiles'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CaseTuningSummary',
+            fields=[
+                ('clinical_case', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='tuning_summary', serialize=False, to='cases.clinicalcase', verbose_name='临床案例')),
+                ('runs_completed', models.PositiveIntegerField(default=0, verbose_name='完成轮次')),
+                ('histograms', models.JSONField(default=dict, help_text='各项得分（每 10 分一档）与提交次数（1~5+ 次）的轮次计数', verbose_name='直方图')),
+                ('sums', models.JSONField(default=dict, help_text='与直方图同名的数值合计，用于计算平均值', verbose_name='合计')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+            ],
+            options={
+                'verbose_name': '病例调优摘要',
+                'verbose_name_plural': '病例调优摘要',
+            },
+        ),
+        migrations.RunPython(backfill_case_tuning, migrations.RunPython.noop),
+    ]
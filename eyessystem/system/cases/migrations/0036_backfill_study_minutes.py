@@ -0,0 +1,126 @@
+# Generated by Django 5.2.6 on 2026-10-19 03:24
+
+from django.db import migrations
+
+
+# 以下口径是 cases.timing 写入本迁移时的固定副本，不随应用模块的修改而变化：
+# 学习时长 = 本轮起点 → max(completed_at, last_activity)，非正或超过 24 小时不记录；
+# 阶段开始取首次进入事件，其次首次切换到该阶段的事件，病例呈现缺失时用本轮起点；
+# 阶段结束取之后最近的其他阶段开始或会话结束；有心跳记录时以有效学习时长为准
+MAJOR_STAGES = ('case_presentation', 'examination_selection', 'diagnosis_reasoning', 'treatment_selection', 'learning_feedback')
+STAGE_MINUTES_FIELDS = {
+    'case_presentation': 'case_presentation_minutes',
+    'examination_selection': 'examination_minutes',
+    'diagnosis_reasoning': 'diagnosis_minutes',
+    'treatment_selection': 'treatment_minutes',
+    'learning_feedback': 'feedback_minutes',
+}
+STUDY_MINUTES_FIELDS = ('study_minutes',) + tuple(STAGE_MINUTES_FIELDS.values())
+MAX_DURATION_MS = 24 * 60 * 60 * 1000
+BATCH_SIZE = 500
+
+
+def _ms(dt):
+    return int(dt.timestamp() * 1000) if dt is not None else None
+
+
+def _stage_starts(events, run_start_ms):
+    """本轮事件（按 ts 升序的 (stage, event_type, ts)）-> {阶段: 开始毫秒}"""
+    entered = {}
+    inferred = {}
+    for stage, event_type, ts in events:
+        if event_type == 'stage_enter':
+            entered.setdefault(stage, ts)
+        elif event_type == 'transition':
+            inferred.setdefault(stage, ts)
+    starts = {stage: entered.get(stage, inferred.get(stage)) for stage in MAJOR_STAGES}
+    if starts['case_presentation'] is None:
+        starts['case_presentation'] = run_start_ms
+    return starts
+
+
+def _minutes_values(session, events, active):
+    end_candidates = [dt for dt in (session.completed_at, session.last_activity) if dt is not None]
+    end_ms = _ms(max(end_candidates)) if end_candidates else None
+    start_ms = _ms(session.run_started_at or session.started_at)
+
+    values = {'study_minutes': None}
+    if start_ms is not None and end_ms is not None and 0 < end_ms - start_ms <= MAX_DURATION_MS:
+        values['study_minutes'] = (end_ms - start_ms) / 60000
+
+    starts = _stage_starts(events, start_ms)
+    known = [ms for ms in starts.values() if ms is not None]
+    for stage, field in STAGE_MINUTES_FIELDS.items():
+        values[field] = None
+        start = starts[stage]
+        if start is None:
+            continue
+        candidates = [ms for ms in known if ms > start]
+        if end_ms is not None and end_ms > start:
+            candidates.append(end_ms)
+        end = min(candidates) if candidates else end_ms
+        if end is not None and 0 <= end - start <= MAX_DURATION_MS:
+            values[field] = (end - start) / 60000
+
+    if active:
+        values['study_minutes'] = sum(active.values()) / 60
+        for stage, field in STAGE_MINUTES_FIELDS.items():
+            values[field] = active[stage] / 60 if stage in active else None
+    return values
+
+
+def _backfill_batch(apps, batch):
+    SessionStageEvent = apps.get_model('cases', 'SessionStageEvent')
+    SessionActiveTime = apps.get_model('cases', 'SessionActiveTime')
+    StudentClinicalSession = apps.get_model('cases', 'StudentClinicalSession')
+
+    session_ids = [session.pk for session in batch]
+    events = {}
+    for session_id, run, stage, event_type, ts in SessionStageEvent.objects.filter(
+        session_id__in=session_ids
+    ).order_by('session_id', 'run', 'ts', 'id').values_list('session_id', 'run', 'stage', 'event_type', 'ts'):
+        current = events.get(session_id)
+        if current is None or current[0] != run:
+            current = events[session_id] = (run, [])
+        current[1].append((stage, event_type, ts))
+
+    active = {}
+    for session_id, run, stage, seconds in SessionActiveTime.objects.filter(
+        session_id__in=session_ids
+    ).values_list('session_id', 'run', 'stage', 'active_seconds'):
+        if run == events.get(session_id, (1,))[0]:
+            active.setdefault(session_id, {})[stage] = seconds
+
+    for session in batch:
+        values = _minutes_values(session, events.get(session.pk, (1, []))[1], active.get(session.pk))
+        for field, value in values.items():
+            setattr(session, field, value)
+    StudentClinicalSession.objects.bulk_update(batch, STUDY_MINUTES_FIELDS)
+
+
+def backfill_study_minutes(apps, schema_editor):
+    """为已完成但尚未写入学习时长的会话计算 study_minutes 及各阶段用时"""
+    StudentClinicalSession = apps.get_model('cases', 'StudentClinicalSession')
+    sessions = StudentClinicalSession.objects.filter(
+        completed_at__isnull=False, study_minutes__isnull=True,
+    ).only('id', 'started_at', 'completed_at', 'last_activity', 'run_started_at', *STUDY_MINUTES_FIELDS)
+
+    batch = []
+    for session in sessions.order_by('id').iterator(chunk_size=BATCH_SIZE):
+        batch.append(session)
+        if len(batch) >= BATCH_SIZE:
+            _backfill_batch(apps, batch)
+            batch = []
+    if batch:
+        _backfill_batch(apps, batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cases', '0035_case_tuning_summary'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_study_minutes, migrations.RunPython.noop),
+    ]
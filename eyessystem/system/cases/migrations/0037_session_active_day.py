@@ -0,0 +1,55 @@
+# Generated by Django 5.2.6 on 2026-10-19 03:38
+
+from collections import defaultdict
+from zoneinfo import ZoneInfo
+
+from django.db import migrations, models
+from django.utils import timezone
+import django.db.models.deletion
+
+
+ROLLUP_TZ = ZoneInfo('Asia/Shanghai')
+
+
+def backfill_active_days(apps, schema_editor):
+    """已有的累计有效时长无法拆分到各天，整体计入最后一次心跳所在日期（与此前每日汇总重算的口径相同）"""
+    SessionActiveTime = apps.get_model('cases', 'SessionActiveTime')
+    SessionActiveDay = apps.get_model('cases', 'SessionActiveDay')
+
+    days = defaultdict(float)
+    rows = SessionActiveTime.objects.filter(last_heartbeat_at__isnull=False)
+    for session_id, at, seconds in rows.values_list(
+        'session_id', 'last_heartbeat_at', 'active_seconds'
+    ).iterator(chunk_size=2000):
+        days[(session_id, timezone.localtime(at, ROLLUP_TZ).date())] += seconds or 0
+    SessionActiveDay.objects.bulk_create(
+        [SessionActiveDay(session_id=session_id, date=day, active_seconds=seconds)
+         for (session_id, day), seconds in days.items()],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cases', '0036_backfill_study_minutes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SessionActiveDay',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='日期')),
+                ('active_seconds', models.FloatField(default=0.0, verbose_name='有效时长（秒）')),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='active_days', to='cases.studentclinicalsession', verbose_name='学生会话')),
+            ],
+            options={
+                'verbose_name': '会话每日有效学习时长',
+                'verbose_name_plural': '会话每日有效学习时长',
+                'indexes': [models.Index(fields=['date'], name='active_day_date_idx')],
+                'unique_together': {('session', 'date')},
+            },
+        ),
+        migrations.RunPython(backfill_active_days, migrations.RunPython.noop),
+    ]
@@ -3,8 +3,11 @@ from django.contrib.auth.models import User
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.utils import timezone
 from django.db.models import SET_NULL
+import copy
 import json
 
+from .scoring import overall_score
+
 
 class Case(models.Model):
     """眼科病例模型"""
@@ -375,10 +378,17 @@ class ClinicalCase(models.Model):
     # 案例图片
     case_images = models.JSONField(blank=True, null=True, verbose_name="案例图片", help_text="存储图片路径的JSON数组")
     
+    # 诊断提示阶梯（由诊断选项变更时自动生成，见 cases/hints.py）
+    diagnosis_hint_ladder = models.JSONField(blank=True, null=True, editable=False, verbose_name="诊断提示阶梯")
+    
     class Meta:
         verbose_name = "临床案例"
         verbose_name_plural = "临床案例"
         ordering = ['-created_at']
+        indexes = [
+            # 学生端案例库按 (created_at, id) 游标分页
+            models.Index(fields=['is_active', 'created_at', 'id'], name='case_active_created_idx'),
+        ]
     
     def __str__(self):
         return f"{self.case_id} - {self.title}"
@@ -578,6 +588,25 @@ class DiagnosisOption(models.Model):
         return f"{self.clinical_case.case_id} - {self.diagnosis_name}"
 
 
+# 影响治疗干扰项池的字段
+TREATMENT_POOL_FIELDS = frozenset({'treatment_name', 'is_optimal', 'treatment_type', 'difficulty_level', 'clinical_case', 'clinical_case_id'})
+
+
+class TreatmentOptionQuerySet(models.QuerySet):
+    """queryset.update()（含 bulk_update）不发 post_save 信号，在这里同步干扰项池"""
+
+    def update(self, **kwargs):
+        if not TREATMENT_POOL_FIELDS & kwargs.keys():
+            return super().update(**kwargs)
+        from .distractors import sync_treatment_distractor_names
+
+        old = dict(self.values_list('pk', 'treatment_name'))
+        rows = super().update(**kwargs)
+        new_names = TreatmentOption.objects.filter(pk__in=old).values_list('treatment_name', flat=True)
+        sync_treatment_distractor_names(old.values(), set(new_names))
+        return rows
+
+
 class TreatmentOption(models.Model):
     """
     治疗选项模型 - 治疗方案的候选项
@@ -646,6 +675,8 @@ class TreatmentOption(models.Model):
     )
     
     display_order = models.IntegerField(default=0, verbose_name="显示顺序")
+
+    objects = TreatmentOptionQuerySet.as_manager()
     
     class Meta:
         verbose_name = "治疗选项"
@@ -656,6 +687,31 @@ class TreatmentOption(models.Model):
         return f"{self.clinical_case.case_id} - {self.treatment_name}"
 
 
+class TreatmentDistractor(models.Model):
+    """
+    治疗干扰项池 - 所有病例“最佳治疗”的去重索引
+    按治疗类型和难度分桶，写入时按名称去重（同名只保留一个代表选项），
+    抽样时只读取池中条目（不同名称数），耗时不随治疗选项总数增长
+    """
+    treatment_name = models.CharField(max_length=200, unique=True, verbose_name="治疗方案名称")
+    treatment_type = models.CharField(max_length=50, verbose_name="治疗类型")
+    difficulty_level = models.CharField(max_length=20, verbose_name="难度等级")
+    treatment = models.OneToOneField(TreatmentOption, on_delete=models.CASCADE, related_name='distractor_entry', verbose_name="代表治疗选项")
+    clinical_case = models.ForeignKey(ClinicalCase, on_delete=models.CASCADE, related_name='+', verbose_name="来源案例")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新时间")
+
+    class Meta:
+        verbose_name = "治疗干扰项池"
+        verbose_name_plural = "治疗干扰项池"
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['treatment_type', 'difficulty_level'], name='treat_pool_bucket_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.treatment_type}/{self.difficulty_level} - {self.treatment_name}"
+
+
 class StudentClinicalSession(models.Model):
     """
     学生临床推理会话模型 - 跟踪学生的学习过程
@@ -719,9 +775,27 @@ class StudentClinicalSession(models.Model):
     started_at = models.DateTimeField(auto_now_add=True, verbose_name="开始时间")
     completed_at = models.DateTimeField(blank=True, null=True, verbose_name="完成时间")
     last_activity = models.DateTimeField(auto_now=True, verbose_name="最后活动时间")
+    # 本轮开始/进入当前阶段的时间（与 SessionStageEvent 同步写入，供 SQL 排序筛选）
+    run_started_at = models.DateTimeField(default=timezone.now, verbose_name="本轮开始时间")
+    stage_entered_at = models.DateTimeField(null=True, blank=True, verbose_name="进入当前阶段时间")
+
+    # 学习时长（本轮完成时写入，统计时直接 Sum 聚合）
+    study_minutes = models.FloatField(null=True, blank=True, verbose_name="学习时长（分钟）",
+                                      help_text="本轮开始至完成，非正或超过24小时不记录")
+    case_presentation_minutes = models.FloatField(null=True, blank=True, verbose_name="病例呈现用时（分钟）")
+    examination_minutes = models.FloatField(null=True, blank=True, verbose_name="检查选择用时（分钟）")
+    diagnosis_minutes = models.FloatField(null=True, blank=True, verbose_name="诊断推理用时（分钟）")
+    treatment_minutes = models.FloatField(null=True, blank=True, verbose_name="治疗选择用时（分钟）")
+    feedback_minutes = models.FloatField(null=True, blank=True, verbose_name="学习反馈用时（分钟）")
+
+    # 复盘快照（本轮完成时计算一次，get-progress 直接读取）
+    review_snapshot = models.JSONField(null=True, blank=True, verbose_name="复盘快照",
+                                       help_text="完成时的检查/诊断/治疗与阶段用时，开始新一轮时清空")
+
+    # 乐观并发控制：cases.concurrency.save_session 按 version 比较并交换
+    version = models.PositiveIntegerField(default=0, verbose_name="版本号", help_text="每次写入 +1，用于检测并发覆盖")
     
-    # 学习成果
-    learning_notes = models.TextField(blank=True, verbose_name="学习笔记")
+    # 学习成果（学习笔记见 LearningNote）
     reflection = models.TextField(blank=True, verbose_name="学习反思")
     
     # 会话数据存储 - 用于保存检查顺序等临时数据
@@ -733,25 +807,437 @@ class StudentClinicalSession(models.Model):
         verbose_name_plural = "学生临床会话"
         ordering = ['-started_at']
         unique_together = ['student', 'clinical_case']
+        indexes = [
+            models.Index(fields=['run_started_at'], name='session_run_started_idx'),
+            models.Index(fields=['last_activity'], name='session_last_activity_idx'),
+        ]
     
     def __str__(self):
         return f"{self.student.username} - {self.clinical_case.title} - {self.session_status}"
-    
-    def calculate_overall_score(self):
-        """计算总体得分"""
-        weights = {
-            'examination': 0.3,  # 30%
-            'diagnosis': 0.5,    # 50% (修正：原来是0.4)
-            'treatment': 0.2     # 20% (修正：原来是0.3)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # 并发合并基线直接引用载入的值；JSON 字段先移出 __dict__ 只留在基线里，
+        # 首次读取时才拷贝一份给调用方（见 refresh_from_db），只读的请求不必深拷贝 session_data 等大字段
+        data = instance.__dict__
+        instance._loaded_values = {
+            field.attname: data.pop(field.attname) if isinstance(field, models.JSONField) else data[field.attname]
+            for field in cls._meta.concrete_fields
+            if field.attname in data
         }
-        self.overall_score = (
-            self.examination_score * weights['examination'] +
-            self.diagnosis_score * weights['diagnosis'] +
-            self.treatment_score * weights['treatment']
+        return instance
+
+    def unread_json_fields(self):
+        """载入后尚未读取（也未赋值）的 JSON 字段，其值与基线相同"""
+        loaded = self.__dict__.get('_loaded_values', {})
+        return {
+            field.attname for field in self._meta.concrete_fields
+            if isinstance(field, models.JSONField) and field.attname in loaded and field.attname not in self.__dict__
+        }
+
+    def get_deferred_fields(self):
+        return super().get_deferred_fields() - self.unread_json_fields()
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        # 读取未拷贝的 JSON 字段时 Django 按延迟字段调用 refresh_from_db(fields=[...])，这里从基线拷贝，不查库
+        if fields is not None:
+            unread = self.unread_json_fields()
+            fields = list(fields)
+            for name in fields:
+                if name in unread:
+                    self.__dict__[name] = copy.deepcopy(self._loaded_values[name])
+            fields = [name for name in fields if name not in unread]
+            if not fields:
+                return
+        super().refresh_from_db(using=using, fields=fields, **kwargs)
+
+    def remember_loaded_values(self):
+        """记录保存后的字段值，作为并发合并的基线；未读取过的 JSON 字段沿用原基线"""
+        loaded = self.__dict__.get('_loaded_values', {})
+        baseline = {name: loaded[name] for name in self.unread_json_fields()}
+        baseline.update(
+            (field.attname, copy.deepcopy(self.__dict__[field.attname]))
+            for field in self._meta.concrete_fields
+            if field.attname in self.__dict__
         )
+        self._loaded_values = baseline
+
+    def save(self, *args, **kwargs):
+        # 普通 save() 写全部字段且不比较版本号，只用于新建会话与后台管理；已载入的会话一律经 concurrency.save_session 写入。
+        # 这里同样递增版本号，使并发中的 save_session 能发现这次写入
+        if not self._state.adding:
+            self.version = (self.version or 0) + 1
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None:
+                kwargs['update_fields'] = set(update_fields) | {'version'}
+        super().save(*args, **kwargs)
+        self.remember_loaded_values()
+    
+    def calculate_overall_score(self):
+        """计算总体得分（检查30% + 诊断50% + 治疗20%，见 cases.scoring.core.OVERALL_WEIGHTS）"""
+        self.overall_score = overall_score(self.examination_score, self.diagnosis_score, self.treatment_score)
         return self.overall_score
 
 
+STAGE_EVENT_TYPE_CHOICES = [
+    ('run_start', '开始新一轮'),
+    ('stage_enter', '首次进入阶段'),
+    ('transition', '阶段切换'),
+]
+
+
+class SessionStageEvent(models.Model):
+    """
+    会话阶段事件日志（只追加）
+    每次阶段切换/首次进入/开始新一轮各写一行，时间戳为毫秒整数；
+    run 为会话内第几轮学习（重新开始时 +1），取代 session_data 中的计时字段
+    """
+    session = models.ForeignKey(StudentClinicalSession, on_delete=models.CASCADE, related_name='stage_events', verbose_name="学生会话")
+    run = models.PositiveIntegerField(default=1, verbose_name="轮次")
+    stage = models.CharField(max_length=30, verbose_name="阶段")
+    from_stage = models.CharField(max_length=30, blank=True, verbose_name="来源阶段", help_text="仅阶段切换事件记录")
+    event_type = models.CharField(max_length=20, choices=STAGE_EVENT_TYPE_CHOICES, verbose_name="事件类型")
+    ts = models.BigIntegerField(verbose_name="时间戳（毫秒）")
+
+    class Meta:
+        verbose_name = "会话阶段事件"
+        verbose_name_plural = "会话阶段事件"
+        indexes = [
+            models.Index(fields=['session', 'run', 'ts'], name='stage_event_session_run_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.session_id} - 第{self.run}轮 - {self.event_type}:{self.stage}"
+
+
+class SessionActiveTime(models.Model):
+    """
+    会话各阶段的有效学习时长（由前端心跳汇总）
+    心跳先在进程内按 (会话, 阶段) 累加，定期批量写入；只统计页面可见且有操作的时间
+    """
+    session = models.ForeignKey(StudentClinicalSession, on_delete=models.CASCADE, related_name='active_times', verbose_name="学生会话")
+    run = models.PositiveIntegerField(default=1, verbose_name="轮次")
+    stage = models.CharField(max_length=30, verbose_name="阶段")
+    active_seconds = models.FloatField(default=0.0, verbose_name="有效时长（秒）")
+    heartbeats = models.PositiveIntegerField(default=0, verbose_name="心跳次数")
+    last_heartbeat_at = models.DateTimeField(null=True, blank=True, verbose_name="最后心跳时间")
+
+    class Meta:
+        verbose_name = "会话有效学习时长"
+        verbose_name_plural = "会话有效学习时长"
+        unique_together = ['session', 'run', 'stage']
+
+    def __str__(self):
+        return f"{self.session_id} - 第{self.run}轮 - {self.stage}: {self.active_seconds:.0f}s"
+
+
+class SessionActiveDay(models.Model):
+    """
+    会话每天的有效学习时长（心跳写库时按心跳日期累加，日期按北京时间划分）
+    SessionActiveTime 只记累计值，跨天的学习无法拆回各天；教师端每日汇总按本表重算
+    """
+    session = models.ForeignKey(StudentClinicalSession, on_delete=models.CASCADE, related_name='active_days', verbose_name="学生会话")
+    date = models.DateField(verbose_name="日期")
+    active_seconds = models.FloatField(default=0.0, verbose_name="有效时长（秒）")
+
+    class Meta:
+        verbose_name = "会话每日有效学习时长"
+        verbose_name_plural = "会话每日有效学习时长"
+        unique_together = ['session', 'date']
+        indexes = [
+            models.Index(fields=['date'], name='active_day_date_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.session_id} - {self.date}: {self.active_seconds:.0f}s"
+
+
+RUN_END_REASON_CHOICES = [
+    ('completed', '完成'),
+    ('reset', '中途重置'),
+]
+
+
+class SessionRun(models.Model):
+    """
+    会话的历史轮次（每轮结束时写入一次，之后不再修改）
+    完成或重新开始时把本轮得分、选择、计时汇总归档到这里，会话行只保留当前一轮；
+    重置进度删除会话后归档仍然保留（session 置空）
+    """
+    student = models.ForeignKey(User, on_delete=models.CASCADE, related_name='session_runs', verbose_name="学生")
+    clinical_case = models.ForeignKey(ClinicalCase, on_delete=models.CASCADE, related_name='session_runs', verbose_name="临床案例")
+    session = models.ForeignKey(StudentClinicalSession, on_delete=models.SET_NULL, null=True, blank=True, related_name='runs', verbose_name="学生会话")
+    run = models.PositiveIntegerField(default=1, verbose_name="轮次")
+    end_reason = models.CharField(max_length=20, choices=RUN_END_REASON_CHOICES, default='completed', verbose_name="结束方式")
+
+    examination_score = models.FloatField(default=0.0, verbose_name="检查选择得分")
+    diagnosis_score = models.FloatField(default=0.0, verbose_name="诊断准确性得分")
+    treatment_score = models.FloatField(default=0.0, verbose_name="治疗方案得分")
+    overall_score = models.FloatField(default=0.0, verbose_name="总体得分")
+    diagnosis_attempt_count = models.IntegerField(default=0, verbose_name="诊断尝试次数")
+    diagnosis_guidance_level = models.IntegerField(default=0, verbose_name="诊断指导级别", help_text="本轮结束时达到的提示级别")
+    examination_attempt_count = models.PositiveIntegerField(null=True, blank=True, verbose_name="检查提交次数", help_text="检查选择通过时的提交次数，未知为空")
+    treatment_attempt_count = models.PositiveIntegerField(null=True, blank=True, verbose_name="治疗提交次数", help_text="本轮治疗方案的提交次数，未知为空")
+
+    selected_examinations = models.JSONField(default=list, verbose_name="已选检查项目")
+    selected_diagnoses = models.JSONField(default=list, verbose_name="选中的诊断ID")
+    selected_treatments = models.JSONField(default=list, verbose_name="已选治疗方案")
+
+    study_minutes = models.FloatField(null=True, blank=True, verbose_name="学习时长（分钟）")
+    review = models.JSONField(default=dict, blank=True, verbose_name="复盘数据",
+                              help_text="与 review_snapshot 相同：检查/诊断/治疗名称与阶段用时")
+
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name="本轮开始时间")
+    completed_at = models.DateTimeField(null=True, blank=True, verbose_name="完成时间")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="归档时间")
+
+    class Meta:
+        verbose_name = "会话历史轮次"
+        verbose_name_plural = "会话历史轮次"
+        ordering = ['-created_at']
+        unique_together = ['session', 'run']
+        indexes = [
+            models.Index(fields=['student', 'clinical_case', 'created_at'], name='run_student_case_idx'),
+            models.Index(fields=['clinical_case', 'created_at'], name='run_case_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.student_id} - {self.clinical_case_id} - 第{self.run}轮 - {self.get_end_reason_display()}"
+
+
+class DailyStatsBase(models.Model):
+    """
+    按天汇总的学习统计（日期按北京时间划分）
+    学习过程中由开始新一轮/完成/心跳写库增量累加，每晚由 rebuild_daily_stats 命令按原始数据重算修正
+    """
+    date = models.DateField(verbose_name="日期")
+    sessions_started = models.PositiveIntegerField(default=0, verbose_name="开始学习轮次")
+    sessions_completed = models.PositiveIntegerField(default=0, verbose_name="完成学习轮次")
+    score_sum = models.FloatField(default=0.0, verbose_name="得分合计", help_text="完成且得分大于 0 的轮次")
+    score_count = models.PositiveIntegerField(default=0, verbose_name="计分轮次")
+    active_seconds = models.FloatField(default=0.0, verbose_name="有效学习时长（秒）")
+
+    class Meta:
+        abstract = True
+
+    @property
+    def average_score(self):
+        return self.score_sum / self.score_count if self.score_count else 0
+
+    @property
+    def active_minutes(self):
+        return int(round(self.active_seconds / 60))
+
+
+class DailyCaseStats(DailyStatsBase):
+    """病例每日学习统计"""
+    clinical_case = models.ForeignKey(ClinicalCase, on_delete=models.CASCADE, related_name='daily_stats', verbose_name="临床案例")
+
+    class Meta:
+        verbose_name = "病例每日统计"
+        verbose_name_plural = "病例每日统计"
+        unique_together = ['clinical_case', 'date']
+        indexes = [
+            models.Index(fields=['date'], name='daily_case_date_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.date} - {self.clinical_case_id}"
+
+
+class DailyStudentStats(DailyStatsBase):
+    """学生每日学习统计"""
+    student = models.ForeignKey(User, on_delete=models.CASCADE, related_name='daily_clinical_stats', verbose_name="学生")
+
+    class Meta:
+        verbose_name = "学生每日统计"
+        verbose_name_plural = "学生每日统计"
+        unique_together = ['student', 'date']
+        indexes = [
+            models.Index(fields=['date'], name='daily_student_date_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.date} - {self.student_id}"
+
+
+class CaseCounters(models.Model):
+    """
+    病例计数器（每个病例一行，教师端病例列表直接读取）
+    选项增删时由 signals 按该病例重新计数；会话新建/删除/完成/得分变化时按差值增减（rebuild_case_counters 命令重算）
+    """
+    clinical_case = models.OneToOneField(ClinicalCase, on_delete=models.CASCADE, primary_key=True, related_name='counters', verbose_name="临床案例")
+    examination_count = models.PositiveIntegerField(default=0, verbose_name="检查选项数")
+    diagnosis_count = models.PositiveIntegerField(default=0, verbose_name="诊断选项数")
+    treatment_count = models.PositiveIntegerField(default=0, verbose_name="治疗选项数")
+    session_count = models.PositiveIntegerField(default=0, verbose_name="学习会话数")
+    completed_count = models.PositiveIntegerField(default=0, verbose_name="已完成会话数")
+    score_sum = models.FloatField(default=0.0, verbose_name="得分合计", help_text="得分大于 0 的会话")
+    score_count = models.PositiveIntegerField(default=0, verbose_name="计分会话数")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新时间")
+
+    class Meta:
+        verbose_name = "病例计数器"
+        verbose_name_plural = "病例计数器"
+
+    def __str__(self):
+        return f"{self.clinical_case_id} - {self.session_count} 个会话"
+
+    @property
+    def completion_rate(self):
+        return round(self.completed_count / self.session_count * 100, 1) if self.session_count else 0
+
+    @property
+    def average_score(self):
+        return self.score_sum / self.score_count if self.score_count else 0
+
+
+class CaseTuningSummary(models.Model):
+    """
+    病例调优摘要（每个病例一行，教师端调优页直接读取）
+    每完成一轮由 case_tuning.record_tuning_run 把本轮得分与提交次数计入直方图；
+    rebuild_case_tuning 命令按 SessionRun 重算
+    """
+    clinical_case = models.OneToOneField(ClinicalCase, on_delete=models.CASCADE, primary_key=True, related_name='tuning_summary', verbose_name="临床案例")
+    runs_completed = models.PositiveIntegerField(default=0, verbose_name="完成轮次")
+    histograms = models.JSONField(default=dict, verbose_name="直方图", help_text="各项得分（每 10 分一档）与提交次数（1~5+ 次）的轮次计数")
+    sums = models.JSONField(default=dict, verbose_name="合计", help_text="与直方图同名的数值合计，用于计算平均值")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新时间")
+
+    class Meta:
+        verbose_name = "病例调优摘要"
+        verbose_name_plural = "病例调优摘要"
+
+    def __str__(self):
+        return f"{self.clinical_case_id} - {self.runs_completed} 轮"
+
+
+LEARNING_PROFILE_STAGES = ('examination', 'diagnosis', 'treatment')
+
+
+class StudentLearningProfile(models.Model):
+    """
+    学生纵向学习画像（每个学生一行，跨病例）
+    每完成一轮由 learning_profiles.record_profile_run 以一次 UPDATE 累加，不回扫历史会话；
+    rebuild_learning_profiles 命令按 SessionRun 重算修正
+    - 各阶段：有记录的轮次数、提交次数合计、首次即通过的轮次数
+    - 提示依赖：诊断阶段用到提示的轮次数与提示级别合计
+    - 得分趋势：第 k 次完成记 x=k，保存 Σy、Σxy 即可得到最小二乘斜率；另存指数滑动平均
+    """
+    student = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='learning_profile', verbose_name="学生")
+    runs_completed = models.PositiveIntegerField(default=0, verbose_name="完成轮次")
+
+    examination_runs = models.PositiveIntegerField(default=0, verbose_name="检查记录轮次")
+    examination_attempts = models.PositiveIntegerField(default=0, verbose_name="检查提交次数合计")
+    examination_first_try = models.PositiveIntegerField(default=0, verbose_name="检查首次通过轮次")
+    diagnosis_runs = models.PositiveIntegerField(default=0, verbose_name="诊断记录轮次")
+    diagnosis_attempts = models.PositiveIntegerField(default=0, verbose_name="诊断尝试次数合计")
+    diagnosis_first_try = models.PositiveIntegerField(default=0, verbose_name="诊断首次正确轮次")
+    treatment_runs = models.PositiveIntegerField(default=0, verbose_name="治疗记录轮次")
+    treatment_attempts = models.PositiveIntegerField(default=0, verbose_name="治疗提交次数合计")
+    treatment_first_try = models.PositiveIntegerField(default=0, verbose_name="治疗首次通过轮次")
+
+    hinted_runs = models.PositiveIntegerField(default=0, verbose_name="使用提示轮次")
+    guidance_level_sum = models.PositiveIntegerField(default=0, verbose_name="提示级别合计")
+
+    score_sum = models.FloatField(default=0.0, verbose_name="总分合计")
+    score_xy_sum = models.FloatField(default=0.0, verbose_name="序号×总分合计", help_text="用于计算得分趋势斜率")
+    score_ewma = models.FloatField(default=0.0, verbose_name="总分滑动平均")
+    last_score = models.FloatField(default=0.0, verbose_name="最近一轮总分")
+    best_score = models.FloatField(default=0.0, verbose_name="最高总分")
+
+    first_completed_at = models.DateTimeField(null=True, blank=True, verbose_name="首次完成时间")
+    last_completed_at = models.DateTimeField(null=True, blank=True, verbose_name="最近完成时间")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新时间")
+
+    class Meta:
+        verbose_name = "学生学习画像"
+        verbose_name_plural = "学生学习画像"
+
+    def __str__(self):
+        return f"{self.student_id} - {self.runs_completed} 轮"
+
+    @property
+    def average_score(self):
+        return self.score_sum / self.runs_completed if self.runs_completed else 0
+
+    @property
+    def score_trend(self):
+        """总分随完成次序的最小二乘斜率（每轮变化的分数），不足两轮为 None"""
+        n = self.runs_completed
+        if n < 2:
+            return None
+        sum_x = n * (n + 1) / 2
+        sum_xx = n * (n + 1) * (2 * n + 1) / 6
+        return (n * self.score_xy_sum - sum_x * self.score_sum) / (n * sum_xx - sum_x * sum_x)
+
+    @property
+    def hint_rate(self):
+        return round(self.hinted_runs / self.diagnosis_runs * 100, 1) if self.diagnosis_runs else 0
+
+    @property
+    def average_guidance_level(self):
+        return self.guidance_level_sum / self.diagnosis_runs if self.diagnosis_runs else 0
+
+    def stage_summary(self, stage):
+        """某阶段的平均提交次数与首次通过率"""
+        runs = getattr(self, f'{stage}_runs')
+        return {
+            'runs': runs,
+            'average_attempts': getattr(self, f'{stage}_attempts') / runs if runs else None,
+            'first_try_rate': round(getattr(self, f'{stage}_first_try') / runs * 100, 1) if runs else None,
+        }
+
+
+class LearningNote(models.Model):
+    """
+    学生临床笔记（每个学生每个病例一份）
+    前端自动保存按 revision 提交增量补丁，服务端合并短时间内的连续补丁后再落库，
+    落库只更新 content / revision / updated_at，不再整行改写学生会话
+    """
+    student = models.ForeignKey(User, on_delete=models.CASCADE, related_name='learning_notes', verbose_name="学生")
+    clinical_case = models.ForeignKey(ClinicalCase, on_delete=models.CASCADE, related_name='learning_notes', verbose_name="临床案例")
+    content = models.TextField(blank=True, verbose_name="笔记内容")
+    revision = models.PositiveIntegerField(default=0, verbose_name="版本", help_text="每次应用补丁 +1")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="创建时间")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新时间")
+
+    class Meta:
+        verbose_name = "学习笔记"
+        verbose_name_plural = "学习笔记"
+        unique_together = ['student', 'clinical_case']
+        indexes = [
+            models.Index(fields=['student', 'updated_at'], name='note_student_updated_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.student_id} - {self.clinical_case_id} - r{self.revision}"
+
+
+class FeedbackTemplate(models.Model):
+    """
+    反馈模板（驻留表）- 相同的反馈文本/提示组合只存一份
+    文本中可包含 {name} 形式的占位符，由 TeachingFeedback.params 在读取时填充
+    """
+    content_hash = models.CharField(max_length=40, unique=True, verbose_name="内容哈希")
+    template_text = models.TextField(verbose_name="模板文本")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="创建时间")
+
+    class Meta:
+        verbose_name = "反馈模板"
+        verbose_name_plural = "反馈模板"
+
+    def __str__(self):
+        return self.template_text[:50]
+
+    def render(self, params=None):
+        """用参数渲染模板文本"""
+        if not params:
+            return self.template_text.format()
+        return self.template_text.format(**params)
+
+
 class TeachingFeedback(models.Model):
     """
     教学反馈模型 - 智能化教学指导
@@ -782,7 +1268,10 @@ class TeachingFeedback(models.Model):
         verbose_name="反馈类型"
     )
     
-    feedback_content = models.TextField(verbose_name="反馈内容")
+    feedback_content = models.TextField(blank=True, verbose_name="反馈内容", help_text="旧数据的完整文本；新数据通过模板+参数渲染")
+    template = models.ForeignKey(FeedbackTemplate, on_delete=models.PROTECT, null=True, blank=True, related_name='feedbacks', verbose_name="反馈模板")
+    params = models.JSONField(blank=True, null=True, verbose_name="模板参数")
+    repeat_count = models.PositiveIntegerField(default=1, verbose_name="重复次数", help_text="连续相同反馈合并为一行时累计")
     improvement_suggestions = models.TextField(blank=True, verbose_name="改进建议")
     
     # 相关资源
@@ -791,15 +1280,95 @@ class TeachingFeedback(models.Model):
     # 反馈元数据
     is_automated = models.BooleanField(default=True, verbose_name="是否自动生成")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="创建时间")
+    last_seen_at = models.DateTimeField(null=True, blank=True, verbose_name="最近一次出现时间")
     
     class Meta:
         verbose_name = "教学反馈"
         verbose_name_plural = "教学反馈"
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['student_session', 'feedback_stage', '-id'], name='feedback_session_stage_idx'),
+        ]
     
     def __str__(self):
         return f"{self.student_session.student.username} - {self.feedback_stage} - {self.feedback_type}"
 
+    @property
+    def content(self):
+        """反馈文本（模板数据延迟渲染，旧数据直接返回原文）"""
+        if self.template_id:
+            return self.template.render(self.params)
+        return self.feedback_content
+
+
+# ================== 选项作答分布（干扰项分析） ==================
+
+OPTION_KIND_CHOICES = [
+    ('examination', '检查'),
+    ('diagnosis', '诊断'),
+    ('treatment', '治疗'),
+]
+
+
+class OptionExposure(models.Model):
+    """
+    选项曝光/选择事实表（只追加）
+    每次提交时，为展示给学生的每个选项写一行，记录是否被选中；
+    会话被重置删除时保留记录，用于干扰项的难度与区分度分析
+    """
+    student = models.ForeignKey(User, on_delete=models.CASCADE, related_name='option_exposures', verbose_name="学生")
+    clinical_case = models.ForeignKey(ClinicalCase, on_delete=models.CASCADE, related_name='option_exposures', verbose_name="临床案例")
+    session = models.ForeignKey(StudentClinicalSession, on_delete=models.SET_NULL, null=True, blank=True, related_name='option_exposures', verbose_name="学生会话")
+    option_kind = models.CharField(max_length=20, choices=OPTION_KIND_CHOICES, verbose_name="选项类别")
+    option_id = models.PositiveIntegerField(verbose_name="选项ID")
+    is_key = models.BooleanField(default=False, verbose_name="是否标准答案", help_text="必选检查/正确诊断/最佳治疗")
+    is_distractor = models.BooleanField(default=False, verbose_name="是否干扰项", help_text="来自其他病例的选项")
+    selected = models.BooleanField(default=False, verbose_name="是否被选中")
+    attempt = models.PositiveSmallIntegerField(default=1, verbose_name="第几次提交")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="记录时间")
+
+    class Meta:
+        verbose_name = "选项作答记录"
+        verbose_name_plural = "选项作答记录"
+        indexes = [
+            models.Index(fields=['clinical_case', 'option_kind', 'option_id'], name='exposure_case_option_idx'),
+            models.Index(fields=['created_at'], name='exposure_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.clinical_case_id} - {self.option_kind}#{self.option_id} - {'选中' if self.selected else '未选'}"
+
+
+class OptionItemStats(models.Model):
+    """
+    选项题目分析结果（由 compute_item_analysis 命令批量生成，请求中只读不算）
+    - selection_rate: 选择率（标准答案即难度指数 P，干扰项即吸引率）
+    - discrimination: 区分度 D = 高分组选择率 - 低分组选择率（高低分组各取27%）
+    - point_biserial: 是否选择与案例总分的点二列相关
+    """
+    clinical_case = models.ForeignKey(ClinicalCase, on_delete=models.CASCADE, related_name='option_item_stats', verbose_name="临床案例")
+    option_kind = models.CharField(max_length=20, choices=OPTION_KIND_CHOICES, verbose_name="选项类别")
+    option_id = models.PositiveIntegerField(verbose_name="选项ID")
+    is_key = models.BooleanField(default=False, verbose_name="是否标准答案")
+    is_distractor = models.BooleanField(default=False, verbose_name="是否干扰项")
+    exposures = models.PositiveIntegerField(default=0, verbose_name="展示次数")
+    selections = models.PositiveIntegerField(default=0, verbose_name="选择次数")
+    selection_rate = models.FloatField(default=0.0, verbose_name="选择率")
+    upper_rate = models.FloatField(null=True, blank=True, verbose_name="高分组选择率")
+    lower_rate = models.FloatField(null=True, blank=True, verbose_name="低分组选择率")
+    discrimination = models.FloatField(null=True, blank=True, verbose_name="区分度")
+    point_biserial = models.FloatField(null=True, blank=True, verbose_name="点二列相关")
+    computed_at = models.DateTimeField(verbose_name="计算时间")
+
+    class Meta:
+        verbose_name = "选项题目分析"
+        verbose_name_plural = "选项题目分析"
+        unique_together = ['clinical_case', 'option_kind', 'option_id']
+        ordering = ['clinical_case', 'option_kind', '-selection_rate']
+
+    def __str__(self):
+        return f"{self.clinical_case_id} - {self.option_kind}#{self.option_id} - P={self.selection_rate:.2f}"
+
 
 # ================== 问诊聊天系统模型 ==================
 
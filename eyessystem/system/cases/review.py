@@ -0,0 +1,144 @@
+"""
+学生端复盘数据（get-progress 的 review 部分）
+- build_review(session): 现场计算检查/治疗名称、阶段用时等
+- 本轮完成时 apply_review_snapshot() 计算一次写入 review_snapshot，之后直接读取；
+  开始新一轮时 clear_review_snapshot() 清空
+- session_review(session): 已完成且有快照时返回快照，否则现场计算
+"""
+from .heartbeat import active_seconds
+from .models import ExaminationOption, TreatmentOption
+from .stage_events import timing_session_data, typed_timing
+from .timing import parse_timing, stage_windows, timing_engine
+
+
+EMPTY_REVIEW = {
+    'selected_examinations': [],
+    'diagnosis': None,
+    'selected_treatments': [],
+    'treatment': None,
+    'stage_times': None,
+    'stage_start_times': None,
+    'session_started_at': None,
+    'session_completed_at': None,
+    'session_last_activity_at': None,
+    'session_total_ms': None,
+}
+
+
+def _completion_timing(session, end_time):
+    """按完成时刻重新解析计时（不走 TimingEngine 缓存：结束时间取完成时刻而非 last_activity）"""
+    timing = parse_timing(
+        timing_session_data(session),
+        started_at=getattr(session, 'started_at', None),
+        completed_at=getattr(session, 'completed_at', None),
+        last_activity=end_time,
+        typed=typed_timing(session),
+    )
+    timing.update(stage_windows(timing['stage_start_dt'], timing['end_time'], timing['session_total_ms']))
+    return timing
+
+
+def build_review(session, timing=None):
+    """现场构造复盘数据；部分字段异常时返回默认值，不让接口 500"""
+    try:
+        session_data = getattr(session, 'session_data', None) or {}
+        if timing is None:
+            timing = timing_engine.timing(session)
+
+        # selected_examinations 可能是 list(JSONField) 或 M2M manager，做兼容读取
+        selected_exam_ids = []
+        try:
+            selected_exams_obj = getattr(session, 'selected_examinations', None)
+            if hasattr(selected_exams_obj, 'values_list'):
+                selected_exam_ids = list(selected_exams_obj.values_list('id', flat=True))
+            else:
+                selected_exam_ids = list(selected_exams_obj or [])
+        except Exception:
+            selected_exam_ids = []
+
+        selected_exam_details = []
+        if selected_exam_ids:
+            try:
+                exam_rows = list(ExaminationOption.objects.filter(id__in=selected_exam_ids).values('id', 'examination_name'))
+                id_to_name = {row['id']: row.get('examination_name') for row in exam_rows}
+                selected_exam_details = [
+                    {'id': int(exam_id), 'name': id_to_name.get(int(exam_id)) or f'检查#{exam_id}'}
+                    for exam_id in selected_exam_ids
+                ]
+            except Exception:
+                selected_exam_details = [{'id': int(exam_id), 'name': f'检查#{exam_id}'} for exam_id in selected_exam_ids]
+
+        diagnosis_record = session_data.get('diagnosis')
+        treatment_record = session_data.get('treatment')
+
+        # selected_treatments 可能来自 session_data['treatment'] 或 M2M/list
+        selected_treatment_ids = []
+        try:
+            selected_treats_obj = getattr(session, 'selected_treatments', None)
+            if isinstance(treatment_record, dict) and treatment_record.get('treatment_ids'):
+                selected_treatment_ids = list(treatment_record.get('treatment_ids') or [])
+            elif hasattr(selected_treats_obj, 'values_list'):
+                selected_treatment_ids = list(selected_treats_obj.values_list('id', flat=True))
+            else:
+                selected_treatment_ids = list(selected_treats_obj or [])
+        except Exception:
+            selected_treatment_ids = []
+
+        selected_treatment_details = []
+        if selected_treatment_ids:
+            try:
+                rows = list(TreatmentOption.objects.filter(id__in=selected_treatment_ids).values('id', 'treatment_name'))
+                id_to_name = {row['id']: row.get('treatment_name') for row in rows}
+                selected_treatment_details = [
+                    {'id': int(tid), 'name': id_to_name.get(int(tid)) or f'治疗#{tid}'}
+                    for tid in selected_treatment_ids
+                ]
+            except Exception:
+                selected_treatment_details = [{'id': int(tid), 'name': f'治疗#{tid}'} for tid in selected_treatment_ids]
+
+        return {
+            'selected_examinations': selected_exam_details,
+            'diagnosis': diagnosis_record,
+            'selected_treatments': selected_treatment_details,
+            'treatment': treatment_record,
+            # 后端权威口径：各主阶段用时（毫秒），前端不再兜底/估算
+            'stage_times': timing['stage_times'],
+            'stage_start_times': timing['stage_start_times'],
+            'stage_durations_ms': timing['stage_durations_ms'],
+            'session_started_at': timing['session_started_at'].isoformat() if timing['session_started_at'] else None,
+            'session_completed_at': session.completed_at.isoformat() if session.completed_at else None,
+            'session_last_activity_at': session.last_activity.isoformat() if session.last_activity else None,
+            'session_total_ms': timing['session_total_ms'],
+            # 心跳统计的各阶段有效学习时长（秒），没有心跳记录时为 None
+            'stage_active_seconds': active_seconds(session) or None,
+        }
+    except Exception:
+        return dict(EMPTY_REVIEW)
+
+
+def apply_review_snapshot(session, end_time):
+    """
+    本轮完成时调用（保存前）：计算一次复盘数据写入 review_snapshot
+
+    Returns:
+        tuple: 被修改的字段名
+    """
+    session.review_snapshot = build_review(session, _completion_timing(session, end_time))
+    return ('review_snapshot',)
+
+
+def clear_review_snapshot(session):
+    """开始新一轮时清空上一轮的复盘快照"""
+    session.review_snapshot = None
+    return ('review_snapshot',)
+
+
+def session_review(session):
+    """已完成的会话直接读取快照（完成/最后活动时间取当前值），否则现场计算"""
+    snapshot = getattr(session, 'review_snapshot', None)
+    if session.completed_at is None or not isinstance(snapshot, dict):
+        return build_review(session)
+    review = dict(snapshot)
+    review['session_completed_at'] = session.completed_at.isoformat()
+    review['session_last_activity_at'] = session.last_activity.isoformat() if session.last_activity else None
+    return review
@@ -0,0 +1,176 @@
+"""
+教师端每日汇总（DailyCaseStats / DailyStudentStats，日期按北京时间划分）
+- 增量：开始新一轮（write_events 写入 run_start 事件）、本轮完成（archive_run 归档）、
+  心跳写库时累加到当天的汇总行；汇总写入失败不影响学习请求，由夜间重算修正
+- 修正：rebuild_daily_stats() 按原始数据重算指定日期范围（rebuild_daily_stats 命令每晚执行）
+  * 开始轮次：run_start 事件；从未写过 run_start 事件的会话按 started_at 计一次
+  * 完成轮次/得分：SessionRun 中 end_reason=completed 的归档，按 completed_at
+  * 有效学习时长：SessionActiveDay（心跳写库时按心跳日期记录，与增量累加同一天）
+- 读取：rollup_totals() 对汇总表做一次聚合，仪表板不再扫描会话表
+"""
+import logging
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from zoneinfo import ZoneInfo
+
+from django.db import DatabaseError, transaction
+from django.db.models import Exists, F, OuterRef, Sum
+from django.utils import timezone
+
+from .models import (
+    DailyCaseStats, DailyStudentStats, SessionActiveDay, SessionRun, SessionStageEvent, StudentClinicalSession,
+)
+from .stage_events import EVENT_RUN_START, to_ms
+
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_TZ = ZoneInfo('Asia/Shanghai')
+
+ROLLUP_FIELDS = ('sessions_started', 'sessions_completed', 'score_sum', 'score_count', 'active_seconds')
+
+
+def rollup_date(dt):
+    """datetime -> 北京时间日期"""
+    return timezone.localtime(dt, ROLLUP_TZ).date()
+
+
+def _day_bounds(start, end):
+    """[start, end] 日期范围 -> [起始时刻, 结束后一天零点)"""
+    return (
+        datetime.combine(start, time.min, tzinfo=ROLLUP_TZ),
+        datetime.combine(end + timedelta(days=1), time.min, tzinfo=ROLLUP_TZ),
+    )
+
+
+def _apply(deltas):
+    """
+    累加一批增量 {(case_id, student_id, date): {字段: 增量}}
+
+    汇总行不存在时先插入（并发插入忽略冲突），再用 F() 原地累加
+    """
+    try:
+        with transaction.atomic():
+            for (case_id, student_id, day), values in deltas.items():
+                increments = {name: F(name) + value for name, value in values.items() if value}
+                if not increments:
+                    continue
+                for model, owner in ((DailyCaseStats, {'clinical_case_id': case_id}),
+                                     (DailyStudentStats, {'student_id': student_id})):
+                    model.objects.bulk_create([model(date=day, **owner)], ignore_conflicts=True)
+                    model.objects.filter(date=day, **owner).update(**increments)
+    except DatabaseError:
+        logger.exception('增量汇总写入失败（%d 行）', len(deltas))
+
+
+def record_run_starts(session, started_at_list):
+    """会话开始新一轮（run_start 事件写入后调用）"""
+    deltas = defaultdict(lambda: defaultdict(int))
+    for started_at in started_at_list:
+        deltas[(session.clinical_case_id, session.student_id, rollup_date(started_at))]['sessions_started'] += 1
+    _apply(deltas)
+
+
+def record_run_completed(run):
+    """完成的轮次归档后调用（中途重置的轮次不计入）"""
+    if run is None or run.end_reason != 'completed' or run.completed_at is None:
+        return
+    values = {'sessions_completed': 1}
+    if (run.overall_score or 0) > 0:
+        values.update(score_sum=run.overall_score, score_count=1)
+    _apply({(run.clinical_case_id, run.student_id, rollup_date(run.completed_at)): values})
+
+
+def record_active_seconds(entries):
+    """心跳写库后调用；entries 为 (case_id, student_id, 心跳时刻, 秒数)"""
+    deltas = defaultdict(lambda: defaultdict(float))
+    for case_id, student_id, at, seconds in entries:
+        deltas[(case_id, student_id, rollup_date(at or timezone.now()))]['active_seconds'] += seconds
+    _apply(deltas)
+
+
+def rebuild_daily_stats(start=None, end=None):
+    """
+    按原始数据重算 [start, end] 日期范围内的汇总行（缺省为全部历史）
+
+    Returns:
+        int: 写入的汇总行数（病例 + 学生）
+    """
+    events = SessionStageEvent.objects.filter(event_type=EVENT_RUN_START)
+    sessions = StudentClinicalSession.objects.filter(
+        ~Exists(SessionStageEvent.objects.filter(session_id=OuterRef('pk'), event_type=EVENT_RUN_START))
+    )
+    runs = SessionRun.objects.filter(end_reason='completed', completed_at__isnull=False)
+    active = SessionActiveDay.objects.all()
+    if start is not None or end is not None:
+        start = start or end
+        end = end or start
+        lower, upper = _day_bounds(start, end)
+        events = events.filter(ts__gte=to_ms(lower), ts__lt=to_ms(upper))
+        sessions = sessions.filter(started_at__gte=lower, started_at__lt=upper)
+        runs = runs.filter(completed_at__gte=lower, completed_at__lt=upper)
+        active = active.filter(date__gte=start, date__lte=end)
+
+    totals = defaultdict(lambda: dict.fromkeys(ROLLUP_FIELDS, 0))
+    for case_id, student_id, ts in events.values_list('session__clinical_case_id', 'session__student_id', 'ts'):
+        day = rollup_date(datetime.fromtimestamp(ts / 1000, tz=ROLLUP_TZ))
+        totals[(case_id, student_id, day)]['sessions_started'] += 1
+    for case_id, student_id, started_at in sessions.values_list('clinical_case_id', 'student_id', 'started_at'):
+        totals[(case_id, student_id, rollup_date(started_at))]['sessions_started'] += 1
+    for case_id, student_id, completed_at, score in runs.values_list(
+        'clinical_case_id', 'student_id', 'completed_at', 'overall_score'
+    ):
+        row = totals[(case_id, student_id, rollup_date(completed_at))]
+        row['sessions_completed'] += 1
+        if (score or 0) > 0:
+            row['score_sum'] += score
+            row['score_count'] += 1
+    for case_id, student_id, day, seconds in active.values_list(
+        'session__clinical_case_id', 'session__student_id', 'date', 'active_seconds'
+    ):
+        totals[(case_id, student_id, day)]['active_seconds'] += seconds
+
+    case_rows = defaultdict(lambda: dict.fromkeys(ROLLUP_FIELDS, 0))
+    student_rows = defaultdict(lambda: dict.fromkeys(ROLLUP_FIELDS, 0))
+    for (case_id, student_id, day), values in totals.items():
+        for name, value in values.items():
+            case_rows[(case_id, day)][name] += value
+            student_rows[(student_id, day)][name] += value
+
+    with transaction.atomic():
+        for model in (DailyCaseStats, DailyStudentStats):
+            stale = model.objects.all()
+            if start is not None:
+                stale = stale.filter(date__gte=start, date__lte=end)
+            stale.delete()
+        DailyCaseStats.objects.bulk_create(
+            [DailyCaseStats(clinical_case_id=case_id, date=day, **values)
+             for (case_id, day), values in case_rows.items()],
+            batch_size=500,
+        )
+        DailyStudentStats.objects.bulk_create(
+            [DailyStudentStats(student_id=student_id, date=day, **values)
+             for (student_id, day), values in student_rows.items()],
+            batch_size=500,
+        )
+    return len(case_rows) + len(student_rows)
+
+
+def rollup_totals(model=DailyCaseStats, **filters):
+    """
+    汇总表上的一次聚合
+
+    Returns:
+        dict: sessions_started / sessions_completed / completion_rate（%）/ average_score / active_minutes
+    """
+    agg = model.objects.filter(**filters).aggregate(**{name: Sum(name) for name in ROLLUP_FIELDS})
+    started = agg['sessions_started'] or 0
+    completed = agg['sessions_completed'] or 0
+    score_count = agg['score_count'] or 0
+    return {
+        'sessions_started': started,
+        'sessions_completed': completed,
+        'completion_rate': min(100.0, round(completed / started * 100, 1)) if started else 0,
+        'average_score': (agg['score_sum'] or 0) / score_count if score_count else 0,
+        'active_minutes': int(round((agg['active_seconds'] or 0) / 60)),
+    }
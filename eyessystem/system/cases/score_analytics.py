@@ -0,0 +1,195 @@
+"""
+成绩分布分析（教师端分析页与 JSON 接口共用）
+- 范围：某个病例和/或某个学生分组（auth Group，即班级/批次），缺省为全系统
+- 一次 values_list 取出范围内已完成会话的各项得分，转成 NumPy 数组后向量化计算：
+  各项得分的分位数、直方图（0-100 每 10 分一档）、均值/标准差、总分频数表，
+  以及检查/诊断/治疗/总分之间的相关系数；缓存与接口默认只含这些汇总值
+- 各会话总分的百分位排名与 z 分数按页计算：数据库按总分排序取一页会话，
+  再用缓存的总分频数表换算，不在缓存里保存逐会话列表
+- 结果按“范围版本”缓存：会话得分/完成状态变化时 signals 递增所在病例与全局版本，
+  学生分组成员变化时递增分组版本；版本不变时直接读取缓存
+- 需要 numpy（与 compute_item_analysis 相同）；未安装时抛出 AnalyticsUnavailable
+"""
+import math
+from bisect import bisect_left
+from itertools import accumulate
+from urllib.parse import quote
+
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db.models import F
+
+from .models import StudentClinicalSession
+
+
+SCORE_FIELDS = ('examination_score', 'diagnosis_score', 'treatment_score', 'overall_score')
+SCORE_LABELS = {
+    'examination_score': '检查得分',
+    'diagnosis_score': '诊断得分',
+    'treatment_score': '治疗得分',
+    'overall_score': '总分',
+}
+PERCENTILES = (10, 25, 50, 75, 90)
+HISTOGRAM_EDGES = tuple(range(0, 101, 10))
+RANK_PAGE_SIZE = 50
+
+# 影响分析结果的会话字段
+ANALYTICS_FIELDS = frozenset({'completed_at', 'session_status', *SCORE_FIELDS})
+
+ANALYTICS_CACHE_TTL = 60 * 60
+
+_REVISION_KEY = 'score_analytics:revision:{scope}'
+_RESULT_KEY = 'score_analytics:{case}:{group}:{revision}'
+
+
+class AnalyticsUnavailable(Exception):
+    """未安装 numpy"""
+
+
+def _revision(scope):
+    key = _REVISION_KEY.format(scope=scope)
+    cache.add(key, 1, None)
+    return cache.get(key) or 1
+
+
+def _bump(scope):
+    key = _REVISION_KEY.format(scope=scope)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 2, None)
+
+
+def bump_score_revision(case_pk):
+    """会话得分/完成状态变化后调用"""
+    _bump(f'case:{case_pk}')
+    _bump('all')
+
+
+def bump_membership_revision():
+    """学生分组成员变化后调用"""
+    _bump('groups')
+
+
+def cohort_revision(case_pk=None, group=None):
+    """范围版本：病例（或全局）版本 + 分组成员版本"""
+    revision = str(_revision(f'case:{case_pk}' if case_pk else 'all'))
+    if group:
+        revision += f'.{_revision("groups")}'
+    return revision
+
+
+def _none_if_nan(value, digits=2):
+    value = float(value)
+    return None if math.isnan(value) else round(value, digits)
+
+
+def _scope_queryset(case_pk=None, group=None):
+    queryset = StudentClinicalSession.objects.filter(completed_at__isnull=False)
+    if case_pk:
+        queryset = queryset.filter(clinical_case_id=case_pk)
+    if group:
+        queryset = queryset.filter(student__groups__name=group)
+    return queryset
+
+
+def compute_score_analytics(case_pk=None, group=None):
+    """现场计算（一次查询）"""
+    try:
+        import numpy as np
+    except ImportError:
+        raise AnalyticsUnavailable('成绩分析需要安装 numpy：pip install numpy')
+
+    rows = list(_scope_queryset(case_pk, group).values_list(*SCORE_FIELDS))
+
+    result = {
+        'count': len(rows),
+        'percentiles': list(PERCENTILES),
+        'histogram_edges': list(HISTOGRAM_EDGES),
+        'distributions': {},
+        'correlations': {},
+        'overall_counts': [],
+    }
+    if not rows:
+        return result
+
+    scores = np.array(rows, dtype=float)
+    scores = np.nan_to_num(scores, nan=0.0)
+    edges = np.array(HISTOGRAM_EDGES, dtype=float)
+
+    means = scores.mean(axis=0)
+    stds = scores.std(axis=0)
+    quantiles = np.percentile(scores, PERCENTILES, axis=0)
+    for index, field in enumerate(SCORE_FIELDS):
+        column = scores[:, index]
+        counts, _ = np.histogram(np.clip(column, edges[0], edges[-1]), bins=edges)
+        result['distributions'][field] = {
+            'label': SCORE_LABELS[field],
+            'mean': _none_if_nan(means[index]),
+            'std': _none_if_nan(stds[index]),
+            'min': _none_if_nan(column.min()),
+            'max': _none_if_nan(column.max()),
+            'quantiles': [_none_if_nan(value) for value in quantiles[:, index]],
+            'histogram': counts.tolist(),
+        }
+
+    # 相关系数：某项得分全部相同（标准差为 0）时记为 None
+    if len(rows) > 1:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            corr = np.corrcoef(scores, rowvar=False)
+        for i, a in enumerate(SCORE_FIELDS):
+            result['correlations'][a] = {b: _none_if_nan(corr[i, j], 3) for j, b in enumerate(SCORE_FIELDS)}
+
+    # 总分频数表 [[分数, 会话数], ...]（按分数升序），用于按页换算百分位排名与 z 分数
+    values, counts = np.unique(scores[:, SCORE_FIELDS.index('overall_score')], return_counts=True)
+    result['overall_counts'] = [[value, count] for value, count in zip(values.tolist(), counts.tolist())]
+    return result
+
+
+def score_analytics(case_pk=None, group=None):
+    """读取缓存的分析结果；范围版本变化或未命中时重算"""
+    revision = cohort_revision(case_pk, group)
+    key = _RESULT_KEY.format(case=case_pk or 'all', group=quote(group or ''), revision=revision)
+    result = cache.get(key)
+    if result is None:
+        result = compute_score_analytics(case_pk, group)
+        result['revision'] = revision
+        cache.set(key, result, ANALYTICS_CACHE_TTL)
+    return result
+
+
+def _rank_item(session, values, below, counts, total, mean, std):
+    score = session['overall_score'] or 0.0
+    index = bisect_left(values, score)
+    equal = counts[index] if index < len(values) and values[index] == score else 0
+    # 百分位排名取中位定义：低于该分的比例 + 同分比例的一半
+    return {
+        'session_id': session['id'],
+        'student': session['student__username'],
+        'case_id': session['clinical_case__case_id'],
+        'overall_score': _none_if_nan(score),
+        'percentile_rank': _none_if_nan((below[index] + equal / 2) / total * 100, 1),
+        'z_score': _none_if_nan((score - mean) / std if std > 0 else 0.0, 3),
+    }
+
+
+def session_ranks_page(analytics, case_pk=None, group=None, page=None, page_size=RANK_PAGE_SIZE):
+    """
+    一页会话的总分百分位排名与 z 分数（按总分从高到低）
+
+    Returns:
+        tuple: (page_obj, 该页会话排名列表)
+    """
+    queryset = _scope_queryset(case_pk, group).order_by(F('overall_score').desc(nulls_last=True), 'id').values(
+        'id', 'student__username', 'clinical_case__case_id', 'overall_score',
+    )
+    page_obj = Paginator(queryset, page_size).get_page(page)
+    values = [value for value, _ in analytics['overall_counts']]
+    counts = [count for _, count in analytics['overall_counts']]
+    below = [0, *accumulate(counts)]
+    total = below[-1]
+    if not total:
+        return page_obj, []
+    mean = sum(value * count for value, count in zip(values, counts)) / total
+    std = math.sqrt(sum(count * (value - mean) ** 2 for value, count in zip(values, counts)) / total)
+    return page_obj, [_rank_item(session, values, below, counts, total, mean, std) for session in page_obj]
@@ -0,0 +1,19 @@
+"""
+临床推理评分模块
+- core: 单条提交的纯函数评分（视图调用）
+- batch: 基于 NumPy 的批量向量化评分（需要 numpy，按需导入 cases.scoring.batch）
+"""
+from .core import (
+    OVERALL_WEIGHTS,
+    attempt_penalty,
+    combine_choice_and_rationale,
+    diagnosis_attempt_score,
+    diagnosis_rationale_score,
+    diagnosis_set_score,
+    examination_efficiency,
+    examination_score,
+    overall_score,
+    treatment_flag_score,
+    treatment_rationale_score,
+    treatment_set_score,
+)
@@ -0,0 +1,200 @@
+"""
+批量评分 - NumPy 向量化实现
+用于重新评分、统计分析和模拟：一次对成千上万组（选择, 标准答案）计算得分
+
+选择与答案统一表示为布尔矩阵：每行是一次提交，每列是一个选项槽位。
+id 列表可通过 selection_matrix() 转换。结果与 cases.scoring.core 中的单条函数逐项一致。
+
+依赖 numpy（可选依赖，仅本模块需要）
+"""
+import numpy as np
+
+from .core import (
+    CHOICE_WEIGHT,
+    EXAM_EFFICIENCY_WEIGHT,
+    EXAM_REQUIRED_WEIGHT,
+    OVERALL_WEIGHTS,
+    RATIONALE_WEIGHT,
+    TREATMENT_FLAG_POINTS,
+)
+
+
+def selection_matrix(id_lists, columns=None):
+    """
+    将多组 id 列表转换为布尔矩阵
+
+    Args:
+        id_lists: [[id, ...], ...] 每组一行
+        columns: 列对应的 id 顺序；缺省时取所有出现过的 id 排序
+
+    Returns:
+        (matrix, columns): matrix 形状为 (len(id_lists), len(columns))
+    """
+    if columns is None:
+        columns = sorted({item for ids in id_lists for item in ids})
+    index = {item: col for col, item in enumerate(columns)}
+    matrix = np.zeros((len(id_lists), len(columns)), dtype=bool)
+    for row, ids in enumerate(id_lists):
+        cols = [index[item] for item in ids if item in index]
+        matrix[row, cols] = True
+    return matrix, list(columns)
+
+
+def _counts(selected, key):
+    selected = np.asarray(selected, dtype=bool)
+    key = np.asarray(key, dtype=bool)
+    hits = np.count_nonzero(selected & key, axis=-1)
+    extra = np.count_nonzero(selected & ~key, axis=-1)
+    missed = np.count_nonzero(~selected & key, axis=-1)
+    return hits, extra, missed
+
+
+def _safe_divide(numerator, denominator):
+    numerator = np.asarray(numerator, dtype=float)
+    denominator = np.asarray(denominator, dtype=float)
+    out = np.zeros(np.broadcast(numerator, denominator).shape, dtype=float)
+    np.divide(numerator, denominator, out=out, where=denominator > 0)
+    return out
+
+
+# ==================== 检查阶段 ====================
+
+def examination_efficiency(total_selected):
+    total_selected = np.asarray(total_selected, dtype=float)
+    efficiency = np.ones_like(total_selected)
+    efficiency = np.where(total_selected > 8, efficiency - (total_selected - 8) * 0.05, efficiency)
+    efficiency = np.where(total_selected < 2, efficiency - (2 - total_selected) * 0.2, efficiency)
+    return np.maximum(0, efficiency)
+
+
+def attempt_penalty(final_attempt):
+    final_attempt = np.asarray(final_attempt)
+    return np.select(
+        [final_attempt <= 1, final_attempt == 2, final_attempt == 3],
+        [0, 5, 10],
+        default=20,
+    )
+
+
+def examination_scores(selected, required, final_attempt=1, total_selected=None):
+    """
+    批量检查选择得分
+
+    Args:
+        selected / required: (n, k) 布尔矩阵
+        final_attempt: 标量或 (n,) 数组
+        total_selected: 提交的检查数量（含重复/未知 id 时传入），缺省为 selected 每行的 True 个数
+
+    Returns:
+        dict[str, ndarray]: 字段与 core.examination_score 相同
+    """
+    hits, _, missed = _counts(selected, required)
+    total_required = hits + missed
+    if total_selected is None:
+        total_selected = np.count_nonzero(np.asarray(selected, dtype=bool), axis=-1)
+    total_selected = np.asarray(total_selected)
+
+    required_score = np.where(total_required > 0, _safe_divide(hits, total_required), 1.0)
+    efficiency_score = examination_efficiency(total_selected)
+    base_score = (required_score * EXAM_REQUIRED_WEIGHT + efficiency_score * EXAM_EFFICIENCY_WEIGHT) * 100
+    penalty = attempt_penalty(final_attempt)
+    total_score = np.clip(base_score - penalty, 0, 100)
+
+    return {
+        'required_score': required_score,
+        'efficiency_score': efficiency_score,
+        'base_score': base_score,
+        'penalty': np.broadcast_to(penalty, base_score.shape),
+        'total_score': total_score,
+        'selected_required': hits,
+        'total_required': total_required,
+        'total_selected': np.broadcast_to(total_selected, base_score.shape),
+    }
+
+
+# ==================== 诊断阶段 ====================
+
+def diagnosis_set_scores(selected, correct):
+    """批量多选诊断得分（F1），字段与 core.diagnosis_set_score 相同"""
+    hits, extra, missed = _counts(selected, correct)
+    precision = _safe_divide(hits, hits + extra)
+    recall = _safe_divide(hits, hits + missed)
+    f1 = _safe_divide(2 * (precision * recall), precision + recall) * 100
+    is_correct = (missed == 0) & (extra == 0)
+    return {
+        'is_correct': is_correct,
+        'correctly_selected': hits,
+        'incorrectly_selected': extra,
+        'missed': missed,
+        'score': np.where(is_correct, 100.0, f1),
+    }
+
+
+def diagnosis_attempt_scores(attempt_count):
+    attempt_count = np.asarray(attempt_count)
+    return np.maximum(100 - (attempt_count - 1) * 10, 60)
+
+
+# ==================== 治疗阶段 ====================
+
+def treatment_set_scores(selected, optimal):
+    """批量多选治疗得分，字段与 core.treatment_set_score 相同"""
+    hits, extra, missed = _counts(selected, optimal)
+    total_optimal = hits + missed
+    correct_rate = _safe_divide(hits, total_optimal)
+    penalty = (extra + missed) * 0.1
+    score = np.where(total_optimal > 0, np.maximum(0, correct_rate - penalty) * 100, 0.0)
+    return {
+        'correct_count': hits,
+        'incorrect_count': extra,
+        'missed_count': missed,
+        'is_perfect': (hits == total_optimal) & (extra == 0),
+        'score': score,
+    }
+
+
+def treatment_flag_scores(selected, is_optimal, is_acceptable, is_contraindicated, selected_count=None):
+    """
+    批量逐项治疗得分
+
+    Args:
+        selected: (n, k) 布尔矩阵
+        is_optimal / is_acceptable / is_contraindicated: (k,) 或 (n, k) 选项标记
+        selected_count: 平均分的分母，缺省为每行选择数
+    """
+    selected = np.asarray(selected, dtype=bool)
+    is_optimal = np.asarray(is_optimal, dtype=bool)
+    is_acceptable = np.asarray(is_acceptable, dtype=bool) & ~is_optimal
+    is_contraindicated = np.asarray(is_contraindicated, dtype=bool) & ~is_optimal & ~is_acceptable
+    neutral = ~(is_optimal | is_acceptable | is_contraindicated)
+
+    points = (
+        is_optimal * TREATMENT_FLAG_POINTS['optimal'] +
+        is_acceptable * TREATMENT_FLAG_POINTS['acceptable'] +
+        is_contraindicated * TREATMENT_FLAG_POINTS['contraindicated'] +
+        neutral * TREATMENT_FLAG_POINTS['neutral']
+    )
+    total = np.sum(selected * points, axis=-1)
+    if selected_count is None:
+        selected_count = np.count_nonzero(selected, axis=-1)
+
+    return {
+        'score': _safe_divide(total, selected_count),
+        'optimal_count': np.count_nonzero(selected & is_optimal, axis=-1),
+        'acceptable_count': np.count_nonzero(selected & is_acceptable, axis=-1),
+        'contraindicated_count': np.count_nonzero(selected & is_contraindicated, axis=-1),
+    }
+
+
+# ==================== 合成 ====================
+
+def combine_choice_and_rationale(choice_score, rationale_score):
+    return np.asarray(choice_score, dtype=float) * CHOICE_WEIGHT + np.asarray(rationale_score, dtype=float) * RATIONALE_WEIGHT
+
+
+def overall_scores(examination, diagnosis, treatment):
+    return (
+        np.asarray(examination, dtype=float) * OVERALL_WEIGHTS['examination'] +
+        np.asarray(diagnosis, dtype=float) * OVERALL_WEIGHTS['diagnosis'] +
+        np.asarray(treatment, dtype=float) * OVERALL_WEIGHTS['treatment']
+    )
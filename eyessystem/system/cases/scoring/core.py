@@ -0,0 +1,268 @@
+"""
+评分核心 - 纯函数实现
+输入只有 id 集合、布尔标记和数字，不访问数据库、不修改会话，可直接复用、测试和基准测试
+"""
+import re
+from difflib import SequenceMatcher
+
+
+# 总体得分权重：检查30% + 诊断50% + 治疗20%
+OVERALL_WEIGHTS = {
+    'examination': 0.3,
+    'diagnosis': 0.5,
+    'treatment': 0.2,
+}
+
+# 检查选择：必选覆盖70% + 效率30%
+EXAM_REQUIRED_WEIGHT = 0.7
+EXAM_EFFICIENCY_WEIGHT = 0.3
+
+# 选择题得分与依据得分的合成比例（选择70% + 依据30%）
+CHOICE_WEIGHT = 0.7
+RATIONALE_WEIGHT = 0.3
+
+# 治疗方案逐项得分（submit_treatment_choices）
+TREATMENT_FLAG_POINTS = {
+    'optimal': 100,
+    'acceptable': 70,
+    'contraindicated': 0,
+    'neutral': 50,
+}
+
+
+# ==================== 检查阶段 ====================
+
+def examination_efficiency(total_selected):
+    """检查效率分（0-1）：最优2-8项，超过8项每项扣5%，少于2项每项扣20%"""
+    efficiency = 1.0
+    if total_selected > 8:
+        efficiency -= (total_selected - 8) * 0.05
+    elif total_selected < 2:
+        efficiency -= (2 - total_selected) * 0.2
+    return max(0, efficiency)
+
+
+def attempt_penalty(final_attempt):
+    """按检查选择的最终尝试次数扣分：第2次5分，第3次10分，第4次及以后20分"""
+    if final_attempt <= 1:
+        return 0
+    if final_attempt == 2:
+        return 5
+    if final_attempt == 3:
+        return 10
+    return 20
+
+
+def examination_score(selected_ids, required_ids, final_attempt=1):
+    """
+    检查选择得分
+
+    Args:
+        selected_ids: 学生选择的检查 id（可迭代，按提交原样计数）
+        required_ids: 病例必选检查 id
+        final_attempt: 检查选择通过时的尝试次数
+
+    Returns:
+        dict: required_score / efficiency_score 为 0-1 比例，其余为百分制
+    """
+    selected_ids = list(selected_ids)
+    required_ids = set(required_ids)
+    total_required = len(required_ids)
+    selected_required = len(required_ids & set(selected_ids))
+    total_selected = len(selected_ids)
+
+    required_score = selected_required / total_required if total_required > 0 else 1.0
+    efficiency_score = examination_efficiency(total_selected)
+    base_score = (required_score * EXAM_REQUIRED_WEIGHT + efficiency_score * EXAM_EFFICIENCY_WEIGHT) * 100
+    penalty = attempt_penalty(final_attempt)
+    total_score = max(0, min(100, max(0, base_score - penalty)))
+
+    return {
+        'required_score': required_score,
+        'efficiency_score': efficiency_score,
+        'base_score': base_score,
+        'penalty': penalty,
+        'total_score': total_score,
+        'selected_required': selected_required,
+        'total_required': total_required,
+        'total_selected': total_selected,
+    }
+
+
+# ==================== 诊断阶段 ====================
+
+def diagnosis_set_score(selected_ids, correct_ids):
+    """
+    多选诊断得分：完全正确100分，否则按 F1（精确率 × 召回率）给分
+
+    Returns:
+        dict: is_correct, correctly_selected, incorrectly_selected, missed, score
+    """
+    selected_ids = set(selected_ids)
+    correct_ids = set(correct_ids)
+    correctly_selected = len(selected_ids & correct_ids)
+    incorrectly_selected = len(selected_ids - correct_ids)
+    missed = len(correct_ids - selected_ids)
+
+    if missed == 0 and incorrectly_selected == 0:
+        score = 100
+        is_correct = True
+    else:
+        precision = correctly_selected / len(selected_ids) if selected_ids else 0
+        recall = correctly_selected / len(correct_ids) if correct_ids else 0
+        if precision + recall > 0:
+            score = 2 * (precision * recall) / (precision + recall) * 100
+        else:
+            score = 0
+        is_correct = False
+
+    return {
+        'is_correct': is_correct,
+        'correctly_selected': correctly_selected,
+        'incorrectly_selected': incorrectly_selected,
+        'missed': missed,
+        'score': score,
+    }
+
+
+def diagnosis_attempt_score(attempt_count):
+    """按尝试次数的诊断得分：第1次100分，之后每次减10分，最低60分"""
+    return max(100 - (attempt_count - 1) * 10, 60)
+
+
+def diagnosis_rationale_score(student_rationale, correct_rationale, key_points):
+    """
+    诊断依据得分（0-100）
+    文本相似度60分 + 关键点覆盖40分 + 字数奖励最多10分；无标准答案时按字数给基础分
+    """
+    word_count = len(student_rationale)
+    if not correct_rationale and not key_points:
+        if word_count >= 200:
+            return 80
+        elif word_count >= 100:
+            return 60
+        elif word_count >= 50:
+            return 40
+        return 20
+
+    score = 0
+    if correct_rationale:
+        score += SequenceMatcher(None, student_rationale, correct_rationale).ratio() * 60
+
+    if key_points:
+        if isinstance(key_points, str):
+            key_points = [kp.strip() for kp in re.split('[,，;；]', key_points) if kp.strip()]
+        if len(key_points) > 0:
+            lowered = student_rationale.lower()
+            matched_points = sum(1 for point in key_points if point.lower() in lowered)
+            score += matched_points / len(key_points) * 40
+
+    if word_count >= 200:
+        score += 10
+    elif word_count >= 100:
+        score += 5
+
+    return min(score, 100)
+
+
+# ==================== 治疗阶段 ====================
+
+def treatment_set_score(selected_ids, optimal_ids):
+    """
+    多选治疗得分：正确率 - 0.1 ×（错选数 + 漏选数），不低于0
+
+    Returns:
+        dict: correct_count, incorrect_count, missed_count, is_perfect, score
+    """
+    selected_ids = set(selected_ids)
+    optimal_ids = set(optimal_ids)
+    correct_count = len(selected_ids & optimal_ids)
+    incorrect_count = len(selected_ids - optimal_ids)
+    missed_count = len(optimal_ids - selected_ids)
+
+    if not optimal_ids:
+        score = 0
+    else:
+        correct_rate = correct_count / len(optimal_ids)
+        penalty = (incorrect_count + missed_count) * 0.1
+        score = max(0, correct_rate - penalty) * 100
+
+    return {
+        'correct_count': correct_count,
+        'incorrect_count': incorrect_count,
+        'missed_count': missed_count,
+        'is_perfect': correct_count == len(optimal_ids) and incorrect_count == 0,
+        'score': score,
+    }
+
+
+def treatment_flag_category(is_optimal, is_acceptable, is_contraindicated):
+    """治疗选项的得分类别（优先级：最佳 > 可接受 > 禁忌 > 中性）"""
+    if is_optimal:
+        return 'optimal'
+    if is_acceptable:
+        return 'acceptable'
+    if is_contraindicated:
+        return 'contraindicated'
+    return 'neutral'
+
+
+def treatment_flag_score(flags, selected_count=None):
+    """
+    按治疗选项标记逐项计分后取平均
+
+    Args:
+        flags: [(is_optimal, is_acceptable, is_contraindicated), ...]
+        selected_count: 平均分的分母（默认为 flags 数量，与提交的选择数一致）
+
+    Returns:
+        dict: score 及各类别数量
+    """
+    counts = {category: 0 for category in TREATMENT_FLAG_POINTS}
+    total = 0
+    for flag in flags:
+        category = treatment_flag_category(*flag)
+        counts[category] += 1
+        total += TREATMENT_FLAG_POINTS[category]
+
+    denominator = len(flags) if selected_count is None else selected_count
+    return {
+        'score': total / denominator if denominator > 0 else 0,
+        'optimal_count': counts['optimal'],
+        'acceptable_count': counts['acceptable'],
+        'contraindicated_count': counts['contraindicated'],
+    }
+
+
+def treatment_rationale_score(student_rationale, correct_rationale, key_points_text):
+    """治疗依据得分（0-100）：文本相似度60% + 关键点覆盖40%（关键点按行分隔）"""
+    if not correct_rationale:
+        return 50.0
+
+    lowered = student_rationale.lower()
+    similarity_score = SequenceMatcher(None, lowered, correct_rationale.lower()).ratio() * 60
+
+    key_points_score = 0
+    if key_points_text:
+        key_points = [kp.strip() for kp in key_points_text.split('\n') if kp.strip()]
+        if key_points:
+            matched_points = sum(1 for kp in key_points if kp.lower() in lowered)
+            key_points_score = (matched_points / len(key_points)) * 40
+
+    return round(similarity_score + key_points_score, 2)
+
+
+# ==================== 合成 ====================
+
+def combine_choice_and_rationale(choice_score, rationale_score):
+    """选择得分与依据得分按比例合成（选择70% + 依据30%）"""
+    return choice_score * CHOICE_WEIGHT + rationale_score * RATIONALE_WEIGHT
+
+
+def overall_score(examination, diagnosis, treatment):
+    """总体得分 = 检查×0.3 + 诊断×0.5 + 治疗×0.2"""
+    return (
+        examination * OVERALL_WEIGHTS['examination'] +
+        diagnosis * OVERALL_WEIGHTS['diagnosis'] +
+        treatment * OVERALL_WEIGHTS['treatment']
+    )
@@ -0,0 +1,115 @@
+"""
+会话历史轮次归档
+- 一轮结束时（完成、完成后开始新一轮、中途重置/删除会话）调用 archive_run() 写入一行 SessionRun
+- 同一会话同一轮只写一次：完成时已归档的轮次，之后重新开始或重置不会重复写入，
+  只在会话仍停留在该轮完成后的学习反馈期间，把继续累计（更长）的学习时长同步到已归档的行
+- 开始新一轮统一经 start_new_run()：先把未写库的心跳归入当前一轮，归档后构造新一轮的 run_start 事件
+- 会话行只保留当前一轮的数据；历史成绩通过 run_history() 按索引查询
+- 完成的轮次归档后累加到每日汇总、学生学习画像与病例调优摘要
+"""
+from django.db import IntegrityError, transaction
+
+from .case_tuning import record_tuning_run
+from .heartbeat import heartbeat_buffer
+from .learning_profiles import record_profile_run, run_profile_fields
+from .models import SessionRun
+from .review import clear_review_snapshot, session_review
+from .rollups import record_run_completed
+from .stage_events import EVENT_RUN_START, FIRST_STAGE, legacy_timing, new_event
+from .timing import clear_study_minutes, parse_iso
+
+
+def current_run(session):
+    """会话当前轮次编号（没有阶段事件的旧会话视为第 1 轮）"""
+    return legacy_timing(session).get('run') or 1
+
+
+def has_progress(session):
+    """本轮是否有值得归档的作答（刚进入病例呈现、什么都没做的轮次不归档）"""
+    return bool(
+        session.completed_at is not None
+        or session.session_status not in ('case_presentation', '')
+        or session.selected_examinations
+        or session.selected_diagnoses
+        or session.selected_treatments
+        or session.overall_score
+    )
+
+
+def archive_run(session):
+    """
+    把会话当前一轮写入 SessionRun（已归档则直接返回已有记录）；未完成的轮次记为中途重置
+
+    Returns:
+        SessionRun | None: 本轮没有作答时返回 None
+    """
+    run = current_run(session)
+    existing = SessionRun.objects.filter(session=session, run=run).first()
+    if existing is not None:
+        # completed_at 非空说明会话仍在该轮完成后的学习反馈期间；开始新一轮后清空的学习时长不回写
+        minutes = session.study_minutes
+        if (
+            existing.end_reason == 'completed' and session.completed_at is not None and minutes is not None
+            and (existing.study_minutes is None or minutes > existing.study_minutes)
+        ):
+            existing.study_minutes = minutes
+            existing.save(update_fields=['study_minutes'])
+        return existing
+    if not has_progress(session):
+        return None
+
+    review = session_review(session)
+    try:
+        with transaction.atomic():
+            archived = SessionRun.objects.create(
+                student_id=session.student_id,
+                clinical_case_id=session.clinical_case_id,
+                session=session,
+                run=run,
+                end_reason='completed' if session.completed_at else 'reset',
+                examination_score=session.examination_score or 0,
+                diagnosis_score=session.diagnosis_score or 0,
+                treatment_score=session.treatment_score or 0,
+                overall_score=session.overall_score or 0,
+                diagnosis_attempt_count=session.diagnosis_attempt_count or 0,
+                **run_profile_fields(session),
+                selected_examinations=list(session.selected_examinations or []),
+                selected_diagnoses=list(session.selected_diagnoses or []),
+                selected_treatments=list(session.selected_treatments or []),
+                study_minutes=session.study_minutes,
+                review=review,
+                started_at=parse_iso(review.get('session_started_at')) or session.started_at,
+                completed_at=session.completed_at,
+            )
+    except IntegrityError:
+        # 并发请求已归档同一轮
+        return SessionRun.objects.filter(session=session, run=run).first()
+    record_run_completed(archived)
+    record_profile_run(archived)
+    record_tuning_run(archived)
+    return archived
+
+
+def start_new_run(session, ts):
+    """
+    结束当前一轮并开始新一轮（只改会话对象，调用方在同一事务中 save_session 并 write_events）：
+    未写库的心跳先归入当前一轮，归档后清空完成标记、学习时长与复盘快照
+
+    Returns:
+        tuple: (新一轮的 run_start 事件, 被修改的字段名列表)
+    """
+    heartbeat_buffer.flush({session.pk})
+    archive_run(session)
+    run = (legacy_timing(session).get('run') or 0) + 1
+    fields = []
+    if session.completed_at is not None:
+        session.completed_at = None
+        fields.append('completed_at')
+        fields.extend(clear_study_minutes(session))
+        fields.extend(clear_review_snapshot(session))
+    return new_event(session, run, FIRST_STAGE, EVENT_RUN_START, ts), fields
+
+
+def run_history(student, clinical_case):
+    """某学生在某病例的全部历史轮次（按归档时间先后）"""
+    return SessionRun.objects.filter(student=student, clinical_case=clinical_case).order_by('created_at', 'id')
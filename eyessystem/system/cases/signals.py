@@ -0,0 +1,152 @@
+"""
+cases 应用的信号处理
+在 CasesConfig.ready() 中导入以完成注册
+"""
+from django.contrib.auth.models import User
+from django.db.models.signals import m2m_changed, post_save, post_delete
+from django.dispatch import receiver
+
+from .models import ClinicalCase, StudentClinicalSession, ExaminationOption, TreatmentOption, DiagnosisOption
+from .case_counters import SESSION_COUNTER_FIELDS, apply_session_delta, create_case_counters, refresh_case_counters
+from .case_library import bump_library_revision
+from .concurrency import session_fields_saved
+from .distractors import sync_treatment_distractor, sync_treatment_distractor_for_option
+from .hints import rebuild_diagnosis_hint_ladder
+from .live_monitor import MONITOR_FIELDS, monitor_hub, publish_session, publish_session_removed
+from .score_analytics import ANALYTICS_FIELDS, bump_membership_revision, bump_score_revision
+from .stats_snapshot import invalidate_stats_snapshot
+from .student_stats import STATS_FIELDS, invalidate_student_stats
+
+
+@receiver(post_save, sender=TreatmentOption)
+def treatment_option_saved(sender, instance, raw=False, **kwargs):
+    """治疗选项保存后同步干扰项池"""
+    if raw:
+        return
+    sync_treatment_distractor_for_option(instance)
+
+
+@receiver(post_delete, sender=TreatmentOption)
+def treatment_option_deleted(sender, instance, **kwargs):
+    """治疗选项删除后为同名治疗重新选择代表项"""
+    sync_treatment_distractor(instance.treatment_name)
+
+
+@receiver(post_save, sender=DiagnosisOption)
+@receiver(post_delete, sender=DiagnosisOption)
+def diagnosis_option_changed(sender, instance, raw=False, **kwargs):
+    """诊断选项变更后重新生成所属病例的提示阶梯"""
+    if raw:
+        return
+    rebuild_diagnosis_hint_ladder(instance.clinical_case_id)
+
+
+@receiver(post_save, sender=ClinicalCase)
+@receiver(post_delete, sender=ClinicalCase)
+def clinical_case_changed(sender, instance, raw=False, **kwargs):
+    """病例变更后递增案例库版本，使学生端案例卡片缓存失效"""
+    bump_library_revision()
+    monitor_hub.forget_label('case', instance.pk)
+    invalidate_stats_snapshot()
+
+
+@receiver(post_save, sender=ClinicalCase)
+def clinical_case_saved(sender, instance, created=False, raw=False, **kwargs):
+    """新病例创建计数器行"""
+    if created and not raw:
+        create_case_counters(instance.pk)
+
+
+@receiver(post_save, sender=ExaminationOption)
+@receiver(post_delete, sender=ExaminationOption)
+@receiver(post_save, sender=DiagnosisOption)
+@receiver(post_delete, sender=DiagnosisOption)
+@receiver(post_save, sender=TreatmentOption)
+@receiver(post_delete, sender=TreatmentOption)
+def case_option_changed(sender, instance, raw=False, **kwargs):
+    """选项增删后重新统计所属病例的选项数"""
+    if raw:
+        return
+    refresh_case_counters(instance.clinical_case_id, sessions=False)
+
+
+def _counter_values(instance, source=None):
+    """(completed_at, overall_score)：优先取 source（写入前的基线）中的值"""
+    source = source or {}
+    return tuple(source.get(name, getattr(instance, name)) for name in ('completed_at', 'overall_score'))
+
+
+@receiver(post_save, sender=StudentClinicalSession)
+@receiver(post_delete, sender=StudentClinicalSession)
+def student_session_changed(sender, instance, raw=False, **kwargs):
+    """会话整行保存/删除后清除该学生的统计缓存，递增成绩分析版本"""
+    if raw:
+        return
+    invalidate_student_stats(instance.student_id)
+    bump_score_revision(instance.clinical_case_id)
+
+
+@receiver(post_save, sender=StudentClinicalSession)
+def student_session_saved_counters(sender, instance, created=False, raw=False, update_fields=None, **kwargs):
+    """会话新建/整行保存后按前后差值增减病例计数（保存前的值取载入基线）"""
+    if raw or (update_fields is not None and not SESSION_COUNTER_FIELDS & set(update_fields)):
+        return
+    if created:
+        apply_session_delta(instance.clinical_case_id, new=_counter_values(instance))
+        return
+    loaded = getattr(instance, '_loaded_values', None)
+    if loaded is None or not SESSION_COUNTER_FIELDS <= set(loaded):
+        # 没有完整基线（如 only() 载入后保存）时无法求差值，按病例重新统计
+        refresh_case_counters(instance.clinical_case_id, options=False)
+        return
+    apply_session_delta(instance.clinical_case_id, _counter_values(instance, loaded), _counter_values(instance))
+
+
+@receiver(post_delete, sender=StudentClinicalSession)
+def student_session_deleted_counters(sender, instance, **kwargs):
+    """会话删除后减去它在病例计数中的贡献"""
+    loaded = getattr(instance, '_loaded_values', None)
+    apply_session_delta(instance.clinical_case_id, old=_counter_values(instance, loaded))
+
+
+@receiver(post_save, sender=StudentClinicalSession)
+def student_session_saved_monitor(sender, instance, raw=False, **kwargs):
+    """会话整行保存后推送到课堂实时监控"""
+    if not raw:
+        publish_session(instance)
+
+
+@receiver(post_delete, sender=StudentClinicalSession)
+def student_session_deleted_monitor(sender, instance, **kwargs):
+    """会话删除后从课堂实时监控中移除"""
+    publish_session_removed(instance)
+
+
+@receiver(session_fields_saved, sender=StudentClinicalSession)
+def student_session_fields_saved(sender, instance, fields, previous=None, **kwargs):
+    """save_session 增量写入：只在写入了相关字段时刷新"""
+    if STATS_FIELDS & fields:
+        invalidate_student_stats(instance.student_id)
+    if SESSION_COUNTER_FIELDS & fields:
+        apply_session_delta(instance.clinical_case_id, _counter_values(instance, previous), _counter_values(instance))
+    if ANALYTICS_FIELDS & fields:
+        bump_score_revision(instance.clinical_case_id)
+    if MONITOR_FIELDS & fields:
+        publish_session(instance)
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def user_groups_changed(sender, action, **kwargs):
+    """用户分组变化后使按分组缓存的成绩分析、统计快照失效"""
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_membership_revision()
+        invalidate_stats_snapshot()
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, raw=False, update_fields=None, **kwargs):
+    """用户新增/删除/启用状态变化后使统计快照过期（登录只更新 last_login，不触发）"""
+    if raw or (update_fields is not None and set(update_fields) <= {'last_login'}):
+        return
+    invalidate_stats_snapshot()
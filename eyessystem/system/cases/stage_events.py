@@ -0,0 +1,238 @@
+"""
+会话阶段事件日志
+阶段切换、首次进入阶段、开始新一轮学习各写一行 SessionStageEvent（一次小 INSERT），
+不再整体改写 session_data 里的 stage_times / stage_start_times / run_started_at，
+也不再把旧计时整份追加进 timing_archives（旧轮次按 run 编号保留在事件表中）
+
+仍需要旧键的读取方使用兼容视图：
+- legacy_timing(session): 返回本轮的 {'run', 'run_started_at', 'stage_start_times', 'stage_times'}
+- timing_session_data(session): 返回叠加了上述旧键的 session_data 副本
+- prefetch_legacy_timing(sessions): 列表页一次查询预取，避免逐条查询
+- typed_timing(session): 同一份数据的 datetime 版本，计时引擎直接使用，不再把 ISO 字符串解析回来
+
+会话上另有两列 run_started_at / stage_entered_at（apply_event_columns 在写事件时同步），
+用于 SQL 中按本轮开始时间排序、筛选，不必逐条读取事件
+"""
+import re
+from datetime import datetime, timezone as dt_timezone
+
+from django.db.models import Max, OuterRef, Subquery
+from django.utils import timezone
+
+from .models import SessionStageEvent
+
+
+EVENT_RUN_START = 'run_start'
+EVENT_STAGE_ENTER = 'stage_enter'
+EVENT_TRANSITION = 'transition'
+
+FIRST_STAGE = 'case_presentation'
+
+# 随事件同步到会话上的时间列
+EVENT_COLUMN_FIELDS = ('run_started_at', 'stage_entered_at')
+
+# session_data 中被事件表取代的旧计时键
+LEGACY_TIMING_KEYS = ('run_started_at', 'stage_start_times', 'stage_times')
+ARCHIVE_KEY = 'timing_archives'
+
+_CACHE_ATTR = '_legacy_timing_cache'
+_TRANSITION_KEY_RE = re.compile(r'^(.+)_to_(.+)$')
+
+
+def to_ms(dt):
+    """datetime -> 毫秒时间戳"""
+    return int(dt.timestamp() * 1000)
+
+
+def from_ms(ms):
+    """毫秒时间戳 -> UTC datetime"""
+    return datetime.fromtimestamp(ms / 1000, tz=dt_timezone.utc)
+
+
+def _parse_iso_ms(value):
+    if not value:
+        return None
+    try:
+        dt = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+        if timezone.is_naive(dt):
+            dt = timezone.make_aware(dt, timezone.get_current_timezone())
+        return to_ms(dt)
+    except Exception:
+        return None
+
+
+def new_event(session, run, stage, event_type, ts, from_stage=''):
+    """构造（不保存）一条事件，供调用方合并为一次 bulk_create"""
+    return SessionStageEvent(
+        session=session, run=run, stage=stage, from_stage=from_stage or '', event_type=event_type, ts=ts,
+    )
+
+
+def apply_event_columns(session, events):
+    """
+    按本次要写入的事件更新会话上的 run_started_at / stage_entered_at（只改对象，由调用方保存）
+
+    Returns:
+        tuple: 被修改的字段名
+    """
+    changed = []
+    for event in events:
+        at = from_ms(event.ts)
+        if event.event_type == EVENT_RUN_START:
+            session.run_started_at = at
+            session.stage_entered_at = at
+            changed.extend(EVENT_COLUMN_FIELDS)
+        elif event.event_type == EVENT_TRANSITION or (
+            event.event_type == EVENT_STAGE_ENTER and event.stage == session.session_status
+            and session.stage_entered_at is None
+        ):
+            session.stage_entered_at = at
+            changed.append('stage_entered_at')
+    return tuple(dict.fromkeys(changed))
+
+
+def write_events(session, events):
+    """一次 INSERT 写入本次请求产生的事件，并刷新该会话的兼容视图缓存；开始新一轮时累加每日汇总"""
+    if not events:
+        return
+    SessionStageEvent.objects.bulk_create(events)
+    if hasattr(session, _CACHE_ATTR):
+        delattr(session, _CACHE_ATTR)
+
+    run_starts = [from_ms(event.ts) for event in events if event.event_type == EVENT_RUN_START]
+    if run_starts:
+        from .rollups import record_run_starts
+        record_run_starts(session, run_starts)
+
+
+def _current_run_events(queryset):
+    """只取每个会话最大 run 的事件"""
+    latest_run = (
+        SessionStageEvent.objects.filter(session_id=OuterRef('session_id'))
+        .values('session_id')
+        .annotate(max_run=Max('run'))
+        .values('max_run')
+    )
+    return queryset.filter(run=Subquery(latest_run)).order_by('session_id', 'ts', 'id')
+
+
+def _build_timing(rows):
+    """
+    由同一轮的事件行（按 ts 升序）还原旧的计时字典；
+    'typed' 中是同样内容的 datetime 版本（不进入 session_data，供 typed_timing 使用）
+    """
+    if not rows:
+        return {}
+    run = rows[0][0]
+    run_started = None
+    start_dt = {}
+    transition_dt = {}
+    for _, stage, from_stage, event_type, ts in rows:
+        if event_type == EVENT_RUN_START:
+            if run_started is None:
+                run_started = from_ms(ts)
+        elif event_type == EVENT_STAGE_ENTER:
+            if stage not in start_dt:
+                start_dt[stage] = from_ms(ts)
+        elif event_type == EVENT_TRANSITION:
+            transition_dt[f'{from_stage}_to_{stage}'] = from_ms(ts)
+    return {
+        'run': run,
+        'run_started_at': run_started.isoformat() if run_started is not None else None,
+        'stage_start_times': {k: v.isoformat() for k, v in start_dt.items()},
+        'stage_times': {k: v.isoformat() for k, v in transition_dt.items()},
+        'typed': {
+            'run_started_at': run_started,
+            'stage_start_times': start_dt,
+            'stage_times': transition_dt,
+        },
+    }
+
+
+_ROW_FIELDS = ('run', 'stage', 'from_stage', 'event_type', 'ts')
+
+
+def legacy_timing(session):
+    """
+    本轮计时的兼容视图（旧 session_data 键名，时间为 ISO 字符串）
+    没有任何事件时返回 {}
+    """
+    cached = getattr(session, _CACHE_ATTR, None)
+    if cached is not None:
+        return cached
+    rows = list(
+        _current_run_events(SessionStageEvent.objects.filter(session_id=session.pk)).values_list(*_ROW_FIELDS)
+    )
+    timing = _build_timing(rows)
+    setattr(session, _CACHE_ATTR, timing)
+    return timing
+
+
+def prefetch_legacy_timing(sessions):
+    """为一批会话一次性查询本轮事件并缓存兼容视图"""
+    sessions = [s for s in sessions if s is not None and s.pk is not None]
+    if not sessions:
+        return sessions
+    grouped = {}
+    rows = _current_run_events(
+        SessionStageEvent.objects.filter(session_id__in=[s.pk for s in sessions])
+    ).values_list('session_id', *_ROW_FIELDS)
+    for session_id, *row in rows:
+        grouped.setdefault(session_id, []).append(row)
+    for session in sessions:
+        setattr(session, _CACHE_ATTR, _build_timing(grouped.get(session.pk, [])))
+    return sessions
+
+
+def typed_timing(session):
+    """本轮计时的 datetime 版本 {'run_started_at', 'stage_start_times', 'stage_times'}；没有事件时返回 None"""
+    return legacy_timing(session).get('typed')
+
+
+def timing_session_data(session):
+    """session_data 的只读副本；有事件记录时用事件表覆盖旧计时键"""
+    session_data = dict(getattr(session, 'session_data', None) or {})
+    timing = legacy_timing(session)
+    if timing:
+        for key in LEGACY_TIMING_KEYS:
+            session_data[key] = timing[key]
+    return session_data
+
+
+def events_from_session_data(session_data):
+    """
+    把 session_data 中的旧计时（timing_archives + 本轮）转换为事件元组
+    (run, stage, from_stage, event_type, ts)，供数据迁移回填使用
+    """
+    if not isinstance(session_data, dict):
+        return []
+
+    snapshots = [a for a in (session_data.get(ARCHIVE_KEY) or []) if isinstance(a, dict)]
+    snapshots.append({key: session_data.get(key) for key in LEGACY_TIMING_KEYS})
+
+    events = []
+    run = 0
+    for snapshot in snapshots:
+        sst = snapshot.get('stage_start_times') if isinstance(snapshot.get('stage_start_times'), dict) else {}
+        st = snapshot.get('stage_times') if isinstance(snapshot.get('stage_times'), dict) else {}
+        run_started_ms = _parse_iso_ms(snapshot.get('run_started_at'))
+        if run_started_ms is None and not sst and not st:
+            continue
+
+        run += 1
+        run_events = []
+        for stage, value in sst.items():
+            ts = _parse_iso_ms(value)
+            if ts is not None:
+                run_events.append((run, str(stage), '', EVENT_STAGE_ENTER, ts))
+        for key, value in st.items():
+            match = _TRANSITION_KEY_RE.match(str(key))
+            ts = _parse_iso_ms(value)
+            if match and ts is not None:
+                run_events.append((run, match.group(2), match.group(1), EVENT_TRANSITION, ts))
+
+        # 缺少 run_started_at 的旧数据不补造，读取方仍按原口径兜底
+        if run_started_ms is not None:
+            events.append((run, FIRST_STAGE, '', EVENT_RUN_START, run_started_ms))
+        events.extend(sorted(run_events, key=lambda e: e[4]))
+    return events
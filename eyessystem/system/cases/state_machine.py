@@ -0,0 +1,179 @@
+"""
+学习会话状态机
+- STAGES：会话阶段，与 StudentClinicalSession.session_status 的 choices 一致
+- TRANSITIONS：声明式的前进路线；停留在原阶段、作答中回到更早的阶段（复看）允许；
+  本轮结束后（学习反馈/已完成）只能回到病史采集重新开始，不能回到作答阶段再次提交计分接口。
+  导入时编译为 (from, to) 集合，校验为 O(1)
+- ENDPOINT_STAGES：各接口允许在哪些阶段调用；stage_required() 在视图执行前只查 session_status 一列，
+  不符合时直接返回 409，不再进入评分等数据库操作
+- 旧接口/旧数据中的阶段名（feedback、diagnosis、in_progress 等）统一经 canonical_stage() 归一
+"""
+import json
+from functools import wraps
+
+from django.http import JsonResponse
+
+from .models import StudentClinicalSession
+from .stage_events import EVENT_TRANSITION, new_event
+
+
+STAGES = (
+    'case_presentation',
+    'examination_selection',
+    'examination_results',
+    'diagnosis_reasoning',
+    'treatment_selection',
+    'learning_feedback',
+    'completed',
+)
+STAGE_LABELS = dict(StudentClinicalSession._meta.get_field('session_status').choices)
+_STAGE_INDEX = {stage: index for index, stage in enumerate(STAGES)}
+
+# 前进路线（检查结果页可跳过；治疗通过后可直接完成）
+TRANSITIONS = {
+    'case_presentation': ('examination_selection',),
+    'examination_selection': ('examination_results', 'diagnosis_reasoning'),
+    'examination_results': ('diagnosis_reasoning',),
+    'diagnosis_reasoning': ('treatment_selection',),
+    'treatment_selection': ('learning_feedback', 'completed'),
+    'learning_feedback': ('completed',),
+    'completed': (),
+}
+
+# 本轮已结束的阶段：回退只允许重新开始（病史采集）
+FINISHED_STAGES = frozenset({'learning_feedback', 'completed'})
+
+ALLOWED_TRANSITIONS = frozenset(
+    [(src, dst) for src, targets in TRANSITIONS.items() for dst in targets]
+    + [
+        (src, dst) for src in STAGES for dst in STAGES
+        if _STAGE_INDEX[dst] <= _STAGE_INDEX[src] and (src not in FINISHED_STAGES or dst in (src, STAGES[0]))
+    ]
+)
+
+# 旧接口/旧数据中的阶段名 -> 会话阶段
+LEGACY_STAGE_ALIASES = {
+    'history': 'case_presentation',
+    'in_progress': 'case_presentation',
+    'examination': 'examination_selection',
+    'diagnosis': 'diagnosis_reasoning',
+    'treatment': 'treatment_selection',
+    'feedback': 'learning_feedback',
+}
+
+# 会话阶段 -> 前端阶段名
+FRONTEND_STAGES = {
+    'case_presentation': 'history',
+    'examination_selection': 'examination',
+    'examination_results': 'examination',
+    'diagnosis_reasoning': 'diagnosis',
+    'treatment_selection': 'treatment',
+    'learning_feedback': 'feedback',
+    'completed': 'completed',
+}
+
+# 各接口允许调用的阶段
+ENDPOINT_STAGES = {
+    'chat': frozenset({'case_presentation', 'examination_selection', 'examination_results'}),
+    'submit_examination': frozenset({'case_presentation', 'examination_selection', 'examination_results'}),
+    'submit_diagnosis': frozenset({'examination_selection', 'examination_results', 'diagnosis_reasoning'}),
+    'submit_treatment': frozenset({'treatment_selection'}),
+}
+ENDPOINT_LABELS = {
+    'chat': '进行问诊',
+    'submit_examination': '提交检查',
+    'submit_diagnosis': '提交诊断',
+    'submit_treatment': '提交治疗方案',
+}
+
+
+class IllegalTransition(ValueError):
+    """不允许的阶段切换"""
+
+    def __init__(self, from_stage, to_stage):
+        self.from_stage = from_stage
+        self.to_stage = to_stage
+        super().__init__(
+            f'不能从{STAGE_LABELS.get(from_stage, from_stage)}直接进入{STAGE_LABELS.get(to_stage, to_stage)}'
+        )
+
+
+def canonical_stage(stage):
+    """阶段名归一；无法识别返回 None"""
+    stage = LEGACY_STAGE_ALIASES.get(stage, stage)
+    return stage if stage in _STAGE_INDEX else None
+
+
+def frontend_stage(stage):
+    """会话阶段 -> 前端阶段名（无法识别时视为病史采集）"""
+    return FRONTEND_STAGES.get(canonical_stage(stage), 'history')
+
+
+def can_transition(from_stage, to_stage):
+    return (canonical_stage(from_stage) or STAGES[0], canonical_stage(to_stage)) in ALLOWED_TRANSITIONS
+
+
+def stage_allows(stage, action):
+    """当前阶段是否允许调用某接口"""
+    return canonical_stage(stage) in ENDPOINT_STAGES[action]
+
+
+def transition(session, to_stage, run, ts):
+    """
+    校验并切换会话阶段（只改对象，由调用方保存）
+
+    Returns:
+        SessionStageEvent | None: 需写入的阶段切换事件，阶段未变化时为 None
+
+    Raises:
+        IllegalTransition: 不允许的切换
+    """
+    from_stage = session.session_status
+    to_stage = canonical_stage(to_stage)
+    if to_stage is None or not can_transition(from_stage, to_stage):
+        raise IllegalTransition(from_stage, to_stage)
+    if from_stage == to_stage:
+        return None
+    session.session_status = to_stage
+    return new_event(session, run, to_stage, EVENT_TRANSITION, ts, from_stage=from_stage)
+
+
+def _request_case_id(request, kwargs):
+    if kwargs.get('case_id'):
+        return kwargs['case_id']
+    try:
+        return json.loads(request.body).get('case_id')
+    except Exception:
+        return None
+
+
+def stage_required(action):
+    """
+    视图装饰器：会话当前阶段不在 ENDPOINT_STAGES[action] 中时返回 409
+    会话尚不存在或请求体无法解析时交给视图自行处理
+    """
+    allowed = ENDPOINT_STAGES[action]
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            case_id = _request_case_id(request, kwargs)
+            if case_id:
+                status = (
+                    StudentClinicalSession.objects
+                    .filter(student=request.user, clinical_case__case_id=case_id)
+                    .values_list('session_status', flat=True)
+                    .first()
+                )
+                if status is not None and canonical_stage(status) not in allowed:
+                    return JsonResponse({
+                        'success': False,
+                        'message': f'当前阶段（{STAGE_LABELS.get(status, status)}）不能{ENDPOINT_LABELS[action]}',
+                        'data': {
+                            'current_stage': status,
+                            'allowed_stages': sorted(allowed, key=_STAGE_INDEX.get),
+                        }
+                    }, status=409)
+            return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,134 @@
+"""
+全局统计快照（教师仪表板、系统管理页的顶部计数）
+- compute_stats_snapshot() 用少量聚合查询算出全部计数：用户一次、分组成员一次、病例与检查选项一次
+  （检查选项数取自 CaseCounters）、近 1 小时活跃会话一次、学习轮次读每日汇总一次
+- stats_snapshot() 读缓存，过期后仍先返回旧值（stale-while-revalidate），由后台线程重算；
+  cache.add 加锁，多个进程/线程同时发现过期时只有一个去重算
+- 只有缓存完全没有数据（首次访问、缓存被清空）时才在请求中同步计算
+- STATS_SNAPSHOT_TTL（秒）可在 settings 中调整；STATS_SNAPSHOT_BACKGROUND=False 时改为请求中同步重算
+"""
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import Group, User
+from django.core.cache import cache
+from django.db import DatabaseError, close_old_connections, connections
+from django.db.models import Count, Q, Sum
+from django.utils import timezone
+
+from .models import ClinicalCase, StudentClinicalSession
+from .rollups import rollup_totals
+
+
+logger = logging.getLogger(__name__)
+
+STATS_SNAPSHOT_TTL = 60
+# 缓存保留时长：超过 TTL 的旧值在这段时间内仍可先返回
+STATS_SNAPSHOT_MAX_AGE = 60 * 60
+STATS_REFRESH_LOCK_SECONDS = 30
+
+_SNAPSHOT_KEY = 'stats_snapshot'
+_LOCK_KEY = 'stats_snapshot:refreshing'
+
+TEACHER_GROUP = 'Teachers'
+STUDENT_GROUP = 'Students'
+
+
+def _ttl():
+    return getattr(settings, 'STATS_SNAPSHOT_TTL', STATS_SNAPSHOT_TTL)
+
+
+def compute_stats_snapshot():
+    """现场计算全部计数"""
+    users = User.objects.aggregate(
+        total_users=Count('id'),
+        active_users=Count('id', filter=Q(is_active=True)),
+        superusers=Count('id', filter=Q(is_superuser=True)),
+    )
+    members = dict(
+        Group.objects.filter(name__in=(TEACHER_GROUP, STUDENT_GROUP))
+        .annotate(members=Count('user')).values_list('name', 'members')
+    )
+    cases = ClinicalCase.objects.aggregate(
+        total_clinical_cases=Count('id'),
+        active_clinical_cases=Count('id', filter=Q(is_active=True)),
+        total_examinations=Sum('counters__examination_count'),
+    )
+    active_sessions_last_hour = StudentClinicalSession.objects.filter(
+        last_activity__gte=timezone.now() - timedelta(hours=1)
+    ).count()
+    totals = rollup_totals()
+
+    return {
+        **users,
+        'total_teachers': members.get(TEACHER_GROUP, 0),
+        'total_students': members.get(STUDENT_GROUP, 0),
+        'total_clinical_cases': cases['total_clinical_cases'],
+        'active_clinical_cases': cases['active_clinical_cases'],
+        'total_examinations': cases['total_examinations'] or 0,
+        'active_sessions_last_hour': active_sessions_last_hour,
+        'total_sessions': totals['sessions_started'],
+        'completed_sessions': totals['sessions_completed'],
+        'completion_rate': totals['completion_rate'],
+        'average_score': float(totals['average_score']),
+        'computed_at': timezone.now(),
+    }
+
+
+def refresh_stats_snapshot():
+    """重算并写入缓存"""
+    data = compute_stats_snapshot()
+    cache.set(_SNAPSHOT_KEY, {'data': data, 'fresh_until': time.time() + _ttl()}, STATS_SNAPSHOT_MAX_AGE)
+    return data
+
+
+def _refresh_worker():
+    close_old_connections()
+    try:
+        refresh_stats_snapshot()
+    except DatabaseError:
+        logger.exception('统计快照后台刷新失败')
+    finally:
+        cache.delete(_LOCK_KEY)
+        connections.close_all()
+
+
+def refresh_in_background():
+    """
+    已有其他刷新在进行时直接返回 None，否则启动后台刷新
+
+    Returns:
+        threading.Thread | None
+    """
+    if not cache.add(_LOCK_KEY, 1, STATS_REFRESH_LOCK_SECONDS):
+        return None
+    if not getattr(settings, 'STATS_SNAPSHOT_BACKGROUND', True):
+        try:
+            refresh_stats_snapshot()
+        finally:
+            cache.delete(_LOCK_KEY)
+        return None
+    thread = threading.Thread(target=_refresh_worker, name='stats-snapshot-refresh', daemon=True)
+    thread.start()
+    return thread
+
+
+def stats_snapshot():
+    """读取统计快照：新鲜直接返回；过期先返回旧值并后台重算；缓存为空时同步计算"""
+    entry = cache.get(_SNAPSHOT_KEY)
+    if entry is None:
+        return refresh_stats_snapshot()
+    if entry['fresh_until'] <= time.time():
+        refresh_in_background()
+    return entry['data']
+
+
+def invalidate_stats_snapshot():
+    """标记快照过期（下一次读取触发后台重算，仍先返回旧值）"""
+    entry = cache.get(_SNAPSHOT_KEY)
+    if entry is not None:
+        entry['fresh_until'] = 0
+        cache.set(_SNAPSHOT_KEY, entry, STATS_SNAPSHOT_MAX_AGE)
@@ -0,0 +1,83 @@
+"""
+学生端临床推理统计（学生仪表板与 clinical_user_stats 共用）
+- 一次分组条件聚合：以病例为主表左连接当前学生的会话，按难度分组同时得到
+  病例总数、已完成数、有效得分之和/条数、学习时长，不再逐项 count()
+- 结果按学生缓存，并记录案例库版本；病例增删改后版本变化自动重算
+- 会话阶段/完成状态/得分/学习时长变化时 invalidate_student_stats() 清除缓存
+  （save_session 与 StudentClinicalSession 的 post_save/post_delete 信号调用）
+- 清除只作用于当前进程的缓存（见 settings.CACHES）；TTL 取得较短，
+  多进程部署下其他进程最多 STATS_CACHE_TTL 后重算
+"""
+from django.core.cache import cache
+from django.db.models import Count, FilteredRelation, Q, Sum
+
+from .case_library import DIFFICULTY_LEVELS, library_revision
+from .models import ClinicalCase
+
+
+STATS_CACHE_TTL = 2 * 60
+
+# 影响统计结果的会话字段
+STATS_FIELDS = frozenset({'session_status', 'completed_at', 'overall_score', 'study_minutes'})
+
+_STATS_KEY = 'student_stats:{student_id}'
+
+
+def compute_student_stats(user):
+    """现场计算统计（一次查询）"""
+    completed = Q(mine__session_status='completed') | Q(mine__completed_at__isnull=False)
+    rows = (
+        ClinicalCase.objects
+        .annotate(mine=FilteredRelation('studentclinicalsession', condition=Q(studentclinicalsession__student=user)))
+        .values('difficulty_level')
+        .annotate(
+            total=Count('id', filter=Q(is_active=True)),
+            completed=Count('mine__id', filter=completed),
+            score_sum=Sum('mine__overall_score', filter=completed & Q(mine__overall_score__gt=0)),
+            score_count=Count('mine__id', filter=completed & Q(mine__overall_score__gt=0)),
+            minutes=Sum('mine__study_minutes', filter=completed),
+        )
+        .order_by()
+    )
+    by_level = {row['difficulty_level']: row for row in rows}
+
+    total_cases = sum(row['total'] for row in by_level.values())
+    completed_cases = sum(row['completed'] for row in by_level.values())
+    score_sum = sum(row['score_sum'] or 0 for row in by_level.values())
+    score_count = sum(row['score_count'] for row in by_level.values())
+    total_study_time = int(round(sum(row['minutes'] or 0 for row in by_level.values())))
+
+    progress_percentage = 0
+    if total_cases > 0:
+        progress_percentage = round((completed_cases / total_cases) * 100, 1)
+
+    return {
+        'total_cases': total_cases,
+        'completed_cases': completed_cases,
+        'progress_percentage': progress_percentage,
+        'total_study_time': total_study_time,
+        'average_score': round(score_sum / score_count, 2) if score_count else 0,
+        'difficulty_progress': {
+            level: {
+                'completed': by_level.get(level, {}).get('completed', 0),
+                'total': by_level.get(level, {}).get('total', 0),
+            }
+            for level in DIFFICULTY_LEVELS
+        },
+    }
+
+
+def student_stats(user):
+    """读取缓存的统计；案例库版本变化或未命中时重算"""
+    key = _STATS_KEY.format(student_id=user.pk)
+    revision = library_revision()
+    entry = cache.get(key)
+    if isinstance(entry, dict) and entry.get('revision') == revision:
+        return entry['stats']
+    stats = compute_student_stats(user)
+    cache.set(key, {'revision': revision, 'stats': stats}, STATS_CACHE_TTL)
+    return stats
+
+
+def invalidate_student_stats(student_id):
+    cache.delete(_STATS_KEY.format(student_id=student_id))
@@ -1,3 +1,1822 @@
-from django.test import TestCase
+import asyncio
+import copy
+import csv
+import importlib.util
+import json
+import random
+import re
+import threading
+import unittest
+from unittest import mock
+from datetime import datetime, timedelta, timezone as dt_timezone
+from difflib import SequenceMatcher
+from io import StringIO
 
-# Create your tests here.
+from django.contrib.auth.models import Group, User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.signals import request_finished
+from django.db import DatabaseError, connection
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+
+from cases import learning_notes
+from cases import scoring
+from cases import timing
+from cases.concurrency import SessionConflictError, changed_fields, save_session
+from cases.distractors import rebuild_treatment_distractors, sample_treatment_distractors
+from cases.feedback import escape_template_text, record_feedback
+from cases.hints import ladder_guidance
+from cases.item_analysis import compute_item_statistics, record_option_exposures, stash_option_exposure
+from cases.case_library import InvalidCursor, decode_cursor
+from cases.case_tuning import rebuild_case_tuning
+from cases.heartbeat import HEARTBEAT_INTERVAL_SECONDS, HEARTBEAT_MAX_SECONDS, HeartbeatBuffer, active_seconds, heartbeat_buffer
+from cases.learning_profiles import rebuild_learning_profiles
+from cases.live_monitor import AsyncSubscription, MonitorHub, Subscription, monitor_hub
+from cases.learning_notes import NotePatchError, NoteRevisionConflict, apply_ops, get_note, patch_note
+from cases.models import (
+    CaseCounters, CaseTuningSummary, ClinicalCase, DiagnosisOption, FeedbackTemplate, SessionStageEvent, TeachingFeedback, DailyCaseStats, ExaminationOption, DailyStudentStats, LearningNote, OptionExposure, SessionActiveTime, SessionRun,
+    StudentClinicalSession, StudentLearningProfile, TreatmentDistractor, TreatmentOption,
+)
+from cases.rollups import ROLLUP_TZ, rebuild_daily_stats, rollup_date, rollup_totals
+from cases.score_analytics import score_analytics, session_ranks_page
+from cases.session_runs import archive_run
+from cases.stats_snapshot import stats_snapshot
+from cases.state_machine import can_transition, canonical_stage
+from cases.student_stats import student_stats
+
+try:
+    import numpy as np
+    from cases.scoring import batch
+except ImportError:  # numpy 为可选依赖
+    np = None
+    batch = None
+
+
+# ==================== 评分一致性测试 ====================
+# 以下 _legacy_* 函数原样保留了重构前视图中的评分代码，作为对照基准
+
+def _legacy_examination_score(selected_examinations, required_ids, final_attempt_count):
+    total_required = len(required_ids)
+    selected_required = len(set(required_ids) & set(selected_examinations))
+    required_score = selected_required / total_required if total_required > 0 else 1.0
+    total_selected = len(selected_examinations)
+    efficiency_score = 1.0
+    if total_selected > 8:
+        efficiency_score -= (total_selected - 8) * 0.05
+    elif total_selected < 2:
+        efficiency_score -= (2 - total_selected) * 0.2
+    efficiency_score = max(0, efficiency_score)
+    base_examination_score = (required_score * 0.7 + efficiency_score * 0.3) * 100
+    selection_penalty = 0
+    if final_attempt_count > 1:
+        if final_attempt_count == 2:
+            selection_penalty = 5
+        elif final_attempt_count == 3:
+            selection_penalty = 10
+        else:
+            selection_penalty = 20
+    final_examination_score = max(0, base_examination_score - selection_penalty)
+    return max(0, min(100, final_examination_score)), base_examination_score, selection_penalty
+
+
+def _legacy_diagnosis_score(selected_diagnosis_ids, correct_diagnosis_ids):
+    correctly_selected = len(selected_diagnosis_ids & correct_diagnosis_ids)
+    incorrectly_selected = len(selected_diagnosis_ids - correct_diagnosis_ids)
+    missed = len(correct_diagnosis_ids - selected_diagnosis_ids)
+    if missed == 0 and incorrectly_selected == 0:
+        return 100, True
+    precision = correctly_selected / len(selected_diagnosis_ids) if selected_diagnosis_ids else 0
+    recall = correctly_selected / len(correct_diagnosis_ids)
+    if precision + recall > 0:
+        f1_score = 2 * (precision * recall) / (precision + recall)
+        return f1_score * 100, False
+    return 0, False
+
+
+def _legacy_treatment_score(selected_ids, optimal_treatments):
+    correct_selections = selected_ids & optimal_treatments
+    incorrect_selections = selected_ids - optimal_treatments
+    missed_selections = optimal_treatments - selected_ids
+    if len(optimal_treatments) == 0:
+        treatment_score = 0
+    else:
+        correct_rate = len(correct_selections) / len(optimal_treatments)
+        penalty = (len(incorrect_selections) + len(missed_selections)) * 0.1
+        treatment_score = max(0, (correct_rate - penalty)) * 100
+    is_perfect = len(correct_selections) == len(optimal_treatments) and len(incorrect_selections) == 0
+    return treatment_score, is_perfect
+
+
+def _legacy_treatment_flag_score(flags):
+    total_score = 0
+    for is_optimal, is_acceptable, is_contraindicated in flags:
+        if is_optimal:
+            total_score += 100
+        elif is_acceptable:
+            total_score += 70
+        elif is_contraindicated:
+            total_score += 0
+        else:
+            total_score += 50
+    return total_score / len(flags) if len(flags) > 0 else 0
+
+
+def _legacy_diagnosis_rationale(student_rationale, correct_rationale, key_points):
+    if not correct_rationale and not key_points:
+        word_count = len(student_rationale)
+        if word_count >= 200:
+            return 80
+        elif word_count >= 100:
+            return 60
+        elif word_count >= 50:
+            return 40
+        else:
+            return 20
+    score = 0
+    if correct_rationale:
+        similarity = SequenceMatcher(None, student_rationale, correct_rationale).ratio()
+        score += similarity * 60
+    if key_points:
+        if isinstance(key_points, str):
+            key_points = [kp.strip() for kp in re.split('[,，;；]', key_points) if kp.strip()]
+        matched_points = 0
+        for point in key_points:
+            if point.lower() in student_rationale.lower():
+                matched_points += 1
+        if len(key_points) > 0:
+            score += matched_points / len(key_points) * 40
+    word_count = len(student_rationale)
+    if word_count >= 200:
+        score += 10
+    elif word_count >= 100:
+        score += 5
+    return min(score, 100)
+
+
+def _legacy_treatment_rationale(student_rationale, correct_rationale, key_points_text):
+    if not correct_rationale:
+        return 50.0
+    similarity = SequenceMatcher(None, student_rationale.lower(), correct_rationale.lower()).ratio()
+    similarity_score = similarity * 60
+    key_points_score = 0
+    if key_points_text:
+        key_points = [kp.strip() for kp in key_points_text.split('\n') if kp.strip()]
+        if key_points:
+            matched_points = sum(1 for kp in key_points if kp.lower() in student_rationale.lower())
+            key_points_score = (matched_points / len(key_points)) * 40
+    return round(similarity_score + key_points_score, 2)
+
+
+def _random_selection(rng, universe, min_size=0):
+    size = rng.randint(min_size, len(universe))
+    return set(rng.sample(universe, size))
+
+
+class ScoringCoreParityTests(SimpleTestCase):
+    """cases.scoring.core 与重构前视图内评分逻辑逐项一致"""
+
+    def setUp(self):
+        self.rng = random.Random(20240601)
+        self.universe = list(range(1, 13))
+
+    def test_examination_score_matches_legacy(self):
+        for _ in range(500):
+            required = _random_selection(self.rng, self.universe)
+            selected = list(_random_selection(self.rng, self.universe))
+            final_attempt = self.rng.randint(1, 6)
+            expected_total, expected_base, expected_penalty = _legacy_examination_score(selected, required, final_attempt)
+            result = scoring.examination_score(selected, required, final_attempt=final_attempt)
+            self.assertEqual(result['total_score'], expected_total)
+            self.assertEqual(result['base_score'], expected_base)
+            self.assertEqual(result['penalty'], expected_penalty)
+
+    def test_diagnosis_set_score_matches_legacy(self):
+        for _ in range(500):
+            correct = _random_selection(self.rng, self.universe, min_size=1)
+            selected = _random_selection(self.rng, self.universe, min_size=1)
+            expected_score, expected_correct = _legacy_diagnosis_score(selected, correct)
+            result = scoring.diagnosis_set_score(selected, correct)
+            self.assertEqual(result['score'], expected_score)
+            self.assertEqual(result['is_correct'], expected_correct)
+
+    def test_diagnosis_attempt_score(self):
+        self.assertEqual(
+            [scoring.diagnosis_attempt_score(n) for n in range(1, 7)],
+            [100, 90, 80, 70, 60, 60],
+        )
+
+    def test_treatment_set_score_matches_legacy(self):
+        for _ in range(500):
+            optimal = _random_selection(self.rng, self.universe)
+            selected = _random_selection(self.rng, self.universe, min_size=1)
+            expected_score, expected_perfect = _legacy_treatment_score(selected, optimal)
+            result = scoring.treatment_set_score(selected, optimal)
+            self.assertEqual(result['score'], expected_score)
+            self.assertEqual(result['is_perfect'], expected_perfect)
+
+    def test_treatment_flag_score_matches_legacy(self):
+        for _ in range(200):
+            flags = [
+                (self.rng.random() < 0.3, self.rng.random() < 0.3, self.rng.random() < 0.3)
+                for _ in range(self.rng.randint(0, 6))
+            ]
+            self.assertEqual(scoring.treatment_flag_score(flags)['score'], _legacy_treatment_flag_score(flags))
+
+    def test_rationale_scores_match_legacy(self):
+        samples = [
+            ('', '', ''),
+            ('眼压升高，视野缺损，视杯扩大', '眼压升高伴视神经损害', '眼压,视野；视杯'),
+            ('Cataract with lens opacity' * 10, 'lens opacity', ''),
+            ('短', '', '关键点'),
+            ('玻璃体切割术 视网膜复位' * 20, '行玻璃体切割术联合视网膜复位', '玻璃体切割\n视网膜复位\n硅油'),
+        ]
+        for student, correct, key_points in samples:
+            self.assertEqual(
+                scoring.diagnosis_rationale_score(student, correct, key_points),
+                _legacy_diagnosis_rationale(student, correct, key_points),
+            )
+            self.assertEqual(
+                scoring.treatment_rationale_score(student, correct, key_points),
+                _legacy_treatment_rationale(student, correct, key_points),
+            )
+
+    def test_overall_score_weights(self):
+        self.assertEqual(scoring.overall_score(80, 90, 70), 80 * 0.3 + 90 * 0.5 + 70 * 0.2)
+        self.assertEqual(scoring.combine_choice_and_rationale(100, 50), 100 * 0.7 + 50 * 0.3)
+
+
+@unittest.skipIf(batch is None, 'numpy 未安装')
+class ScoringBatchParityTests(SimpleTestCase):
+    """cases.scoring.batch 批量结果与单条评分一致"""
+
+    def setUp(self):
+        self.rng = random.Random(20240602)
+        self.universe = list(range(1, 11))
+
+    def _pairs(self, count, min_selected=0, min_key=0):
+        selections = [sorted(_random_selection(self.rng, self.universe, min_selected)) for _ in range(count)]
+        keys = [sorted(_random_selection(self.rng, self.universe, min_key)) for _ in range(count)]
+        selected_matrix, _ = batch.selection_matrix(selections, self.universe)
+        key_matrix, _ = batch.selection_matrix(keys, self.universe)
+        return selections, keys, selected_matrix, key_matrix
+
+    def test_examination_scores(self):
+        selections, keys, selected, required = self._pairs(1000)
+        attempts = np.array([self.rng.randint(1, 5) for _ in selections])
+        result = batch.examination_scores(selected, required, final_attempt=attempts)
+        for i, (sel, key) in enumerate(zip(selections, keys)):
+            expected = scoring.examination_score(sel, key, final_attempt=int(attempts[i]))
+            self.assertAlmostEqual(result['total_score'][i], expected['total_score'], places=9)
+            self.assertEqual(result['penalty'][i], expected['penalty'])
+
+    def test_diagnosis_set_scores(self):
+        selections, keys, selected, correct = self._pairs(1000, min_selected=1, min_key=1)
+        result = batch.diagnosis_set_scores(selected, correct)
+        for i, (sel, key) in enumerate(zip(selections, keys)):
+            expected = scoring.diagnosis_set_score(sel, key)
+            self.assertAlmostEqual(result['score'][i], expected['score'], places=9)
+            self.assertEqual(bool(result['is_correct'][i]), expected['is_correct'])
+            self.assertEqual(result['missed'][i], expected['missed'])
+
+    def test_treatment_set_scores(self):
+        selections, keys, selected, optimal = self._pairs(1000, min_selected=1)
+        result = batch.treatment_set_scores(selected, optimal)
+        for i, (sel, key) in enumerate(zip(selections, keys)):
+            expected = scoring.treatment_set_score(sel, key)
+            self.assertAlmostEqual(result['score'][i], expected['score'], places=9)
+            self.assertEqual(bool(result['is_perfect'][i]), expected['is_perfect'])
+
+    def test_treatment_flag_scores(self):
+        flags = [(self.rng.random() < 0.3, self.rng.random() < 0.3, self.rng.random() < 0.3) for _ in self.universe]
+        selections, _, selected, _ = self._pairs(500)
+        result = batch.treatment_flag_scores(selected, *zip(*flags))
+        for i, sel in enumerate(selections):
+            expected = scoring.treatment_flag_score([flags[self.universe.index(item)] for item in sel])
+            self.assertAlmostEqual(result['score'][i], expected['score'], places=9)
+
+    def test_overall_scores(self):
+        exam, diag, treat = (np.array([self.rng.uniform(0, 100) for _ in range(100)]) for _ in range(3))
+        result = batch.overall_scores(exam, diag, treat)
+        for i in range(100):
+            self.assertAlmostEqual(result[i], scoring.overall_score(exam[i], diag[i], treat[i]), places=9)
+
+
+# ==================== 计时引擎一致性测试 ====================
+
+def _legacy_stage_durations(session_data, started_at, completed_at, last_activity):
+    """重构前 _build_review_payload_for_session 中的阶段用时算法（对照基准）"""
+    def parse(value):
+        if not value:
+            return None
+        try:
+            return datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+        except Exception:
+            return None
+
+    candidates = [t for t in (completed_at, last_activity) if t is not None]
+    end_time = max(candidates) if candidates else None
+    run_started_at = parse(session_data.get('run_started_at')) or started_at
+
+    def filter_dict(raw):
+        if not isinstance(raw, dict) or not raw or not run_started_at:
+            return raw
+        return {str(k): v for k, v in raw.items() if parse(v) is None or parse(v) >= run_started_at}
+
+    stage_times = filter_dict(session_data.get('stage_times')) or {}
+    sst = filter_dict(session_data.get('stage_start_times')) or {}
+    inferred = {}
+    for k, v in stage_times.items():
+        m = re.match(r'^(.+)_to_(.+)$', str(k))
+        dtv = parse(v)
+        if m and dtv is not None and (m.group(2) not in inferred or dtv < inferred[m.group(2)]):
+            inferred[m.group(2)] = dtv
+    starts = {}
+    for stg in timing.MAJOR_STAGES:
+        dtv = parse(sst.get(stg)) or inferred.get(stg)
+        if dtv is None and stg == 'case_presentation':
+            dtv = run_started_at
+        starts[stg] = dtv
+    all_starts = [dt for dt in starts.values() if dt is not None]
+    durations = {}
+    for stg in timing.MAJOR_STAGES:
+        sdt = starts[stg]
+        edt = None
+        if sdt is not None:
+            later = [dt for dt in all_starts if dt > sdt]
+            if end_time is not None and end_time > sdt:
+                later.append(end_time)
+            edt = min(later) if later else end_time
+        if not sdt or not edt or edt < sdt:
+            durations[stg] = None
+            continue
+        ms = int((edt - sdt).total_seconds() * 1000)
+        durations[stg] = None if ms < 0 or ms > 24 * 60 * 60 * 1000 else ms
+    return durations
+
+
+def _random_session_timing(rng):
+    base = datetime(2025, 1, 1, tzinfo=dt_timezone.utc) + timedelta(days=rng.randint(0, 300))
+    offsets = sorted(rng.randint(0, 4 * 3600) for _ in timing.MAJOR_STAGES)
+    run_start = base + timedelta(seconds=rng.randint(-600, 600))
+    session_data = {'run_started_at': run_start.isoformat(), 'stage_start_times': {}, 'stage_times': {}}
+    previous = None
+    for stage, offset in zip(timing.MAJOR_STAGES, offsets):
+        ts = (base + timedelta(seconds=offset)).isoformat()
+        if rng.random() < 0.7:
+            session_data['stage_start_times'][stage] = ts
+        if previous and rng.random() < 0.7:
+            session_data['stage_times'][f'{previous}_to_{stage}'] = ts
+        previous = stage
+    if rng.random() < 0.2:
+        session_data['stage_start_times']['examination_selection'] = 'bad-value'
+    started_at = base - timedelta(hours=rng.randint(0, 48))
+    completed_at = base + timedelta(seconds=offsets[-1] + rng.randint(0, 30 * 3600)) if rng.random() < 0.7 else None
+    last_activity = base + timedelta(seconds=rng.randint(0, 6 * 3600))
+    return session_data, started_at, completed_at, last_activity
+
+
+class TimingEngineParityTests(SimpleTestCase):
+    """cases.timing 与重构前的阶段用时算法一致"""
+
+    def setUp(self):
+        self.rng = random.Random(20240603)
+        self.samples = [_random_session_timing(self.rng) for _ in range(300)]
+
+    def test_stage_durations_match_legacy(self):
+        for session_data, started_at, completed_at, last_activity in self.samples:
+            parsed = timing.parse_timing(session_data, started_at, completed_at, last_activity)
+            result = timing.stage_windows(parsed['stage_start_dt'], parsed['end_time'])
+            self.assertEqual(
+                result['stage_durations_ms'],
+                _legacy_stage_durations(session_data, started_at, completed_at, last_activity),
+            )
+
+    @unittest.skipIf(np is None, 'numpy 未安装')
+    def test_bulk_matches_scalar(self):
+        parsed = [timing.parse_timing(*sample) for sample in self.samples]
+        bulk = timing.bulk_stage_durations(
+            [[p['stage_start_dt'][stage] for stage in timing.MAJOR_STAGES] for p in parsed],
+            [p['end_time'] for p in parsed],
+        )
+        for p, durations in zip(parsed, bulk):
+            self.assertEqual(durations, timing.stage_windows(p['stage_start_dt'], p['end_time'])['stage_durations_ms'])
+
+
+def _create_student_session(username='concurrency_student'):
+    student = User.objects.create_user(username=username, password='pw')
+    student.groups.add(Group.objects.get_or_create(name='Students')[0])
+    teacher = User.objects.create_user(username=f'{username}_teacher', password='pw')
+    clinical_case = ClinicalCase.objects.create(
+        title='并发测试病例', case_id=f'{username}_case', patient_age=40, patient_gender='M',
+        chief_complaint='视物模糊', present_illness='一周', learning_objectives=[], created_by=teacher,
+    )
+    session = StudentClinicalSession.objects.create(
+        student=student, clinical_case=clinical_case, session_data={'history_summary': {}},
+    )
+    return student, clinical_case, session
+
+
+def _create_diagnosis_option(clinical_case, name, is_correct, **fields):
+    return DiagnosisOption.objects.create(
+        clinical_case=clinical_case, diagnosis_name=name, is_correct_diagnosis=is_correct,
+        supporting_evidence='-', typical_symptoms=[], typical_signs=[], correct_feedback='-', incorrect_feedback='-',
+        **fields,
+    )
+
+
+def _reset_heartbeat_buffer():
+    # 全局缓冲区在测试事务内写库，随事务回滚；回滚后主键会复用，上次心跳时间一并清掉
+    heartbeat_buffer.flush()
+    heartbeat_buffer._last_beat.clear()
+
+
+class TreatmentDistractorPoolTests(TestCase):
+    """治疗干扰项池：保存/删除/批量更新后同步，分层抽样只读池一次"""
+
+    def setUp(self):
+        _, self.clinical_case, _ = _create_student_session('distractor_student')
+        self.other_case = ClinicalCase.objects.create(
+            title='干扰项来源病例', case_id='distractor_source', patient_age=50, patient_gender='F',
+            chief_complaint='眼痛', present_illness='三天', learning_objectives=[], created_by=self.clinical_case.created_by,
+        )
+
+    def _option(self, name, treatment_type='medication', is_optimal=True, clinical_case=None):
+        return TreatmentOption.objects.create(
+            clinical_case=clinical_case or self.other_case, treatment_type=treatment_type, treatment_name=name,
+            treatment_description='-', is_optimal=is_optimal, expected_outcome='-', selection_feedback='-',
+        )
+
+    def _pool(self):
+        return dict(TreatmentDistractor.objects.values_list('treatment_name', 'treatment_id'))
+
+    def test_signals_keep_one_entry_per_name(self):
+        first = self._option('激光光凝')
+        second = self._option('激光光凝', clinical_case=self.clinical_case)
+        self._option('人工泪液', is_optimal=False)
+        self.assertEqual(self._pool(), {'激光光凝': first.id})
+
+        first.delete()
+        self.assertEqual(self._pool(), {'激光光凝': second.id})
+        second.treatment_name = '玻璃体切割'
+        second.save()
+        self.assertEqual(self._pool(), {'玻璃体切割': second.id})
+
+    def test_queryset_update_syncs_pool(self):
+        option = self._option('激光光凝')
+        TreatmentOption.objects.filter(pk=option.pk).update(treatment_name='小梁切除', treatment_type='surgery')
+        self.assertEqual(self._pool(), {'小梁切除': option.id})
+        self.assertEqual(TreatmentDistractor.objects.get().treatment_type, 'surgery')
+        TreatmentOption.objects.filter(pk=option.pk).update(is_optimal=False)
+        self.assertEqual(self._pool(), {})
+
+    def test_stratified_sample(self):
+        surgery = self._option('小梁切除', 'surgery')
+        for index in range(5):
+            self._option(f'滴眼液{index}')
+        self._option('本病例治疗', clinical_case=self.clinical_case)
+
+        # 分层桶与剩余池各一次 COUNT，每个干扰项一次随机偏移取行（不读取整个池）
+        with self.assertNumQueries(5):
+            picked = sample_treatment_distractors(self.clinical_case, exclude_names=['滴眼液0'], strata=['surgery'])
+        self.assertEqual(len(picked), 3)
+        self.assertEqual(picked[0], surgery)
+        names = {option.treatment_name for option in picked}
+        self.assertFalse(names & {'滴眼液0', '本病例治疗'})
+
+    def test_rebuild_command(self):
+        option = self._option('激光光凝')
+        TreatmentDistractor.objects.all().delete()
+        call_command('rebuild_treatment_distractors', stdout=StringIO())
+        self.assertEqual(self._pool(), {'激光光凝': option.id})
+        self.assertEqual(rebuild_treatment_distractors(), 1)
+
+
+class TeachingFeedbackTests(TestCase):
+    """教学反馈：模板驻留、连续重复合并，压缩命令清理模板后仍可继续记录"""
+
+    def setUp(self):
+        _, _, self.session = _create_student_session('feedback_student')
+
+    def _compact(self):
+        call_command('compact_teaching_feedback', '--days', '0', stdout=StringIO())
+
+    def test_repeated_feedback_is_counted(self):
+        for _ in range(3):
+            text = record_feedback(self.session, 'diagnosis', 'corrective', '第 {attempt} 次尝试', {'attempt': 2})
+        self.assertEqual(text, '第 2 次尝试')
+        feedback = TeachingFeedback.objects.get()
+        self.assertEqual((feedback.repeat_count, feedback.content), (3, '第 2 次尝试'))
+        record_feedback(self.session, 'diagnosis', 'corrective', '第 {attempt} 次尝试', {'attempt': 3})
+        self.assertEqual((TeachingFeedback.objects.count(), FeedbackTemplate.objects.count()), (2, 1))
+
+    def test_compaction_interns_legacy_rows_and_merges(self):
+        for _ in range(2):
+            TeachingFeedback.objects.create(
+                student_session=self.session, feedback_stage='examination', feedback_type='guidance',
+                feedback_content='请补充{眼压}检查',
+            )
+        self._compact()
+        feedback = TeachingFeedback.objects.get()
+        self.assertEqual((feedback.feedback_content, feedback.repeat_count), ('', 2))
+        self.assertEqual(feedback.content, '请补充{眼压}检查')
+        self.assertEqual(feedback.template.template_text, escape_template_text('请补充{眼压}检查'))
+
+    def test_record_after_compaction_removed_template(self):
+        record_feedback(self.session, 'overall', 'positive', '完成得很好')
+        TeachingFeedback.objects.all().delete()
+        self._compact()
+        self.assertFalse(FeedbackTemplate.objects.exists())
+
+        record_feedback(self.session, 'overall', 'positive', '完成得很好')
+        feedback = TeachingFeedback.objects.select_related('template').get()
+        self.assertEqual(feedback.content, '完成得很好')
+
+
+class DiagnosisHintLadderTests(TestCase):
+    """诊断提示阶梯：随选项保存重建，按显示顺序排列；评分只以当前正确诊断为准"""
+
+    def setUp(self):
+        self.student, self.clinical_case, self.session = _create_student_session('hint_student')
+        self.session.session_status = 'diagnosis_reasoning'
+        self.session.save()
+        self.correct = self._option('原发性开角型青光眼', True, 2, hint_level_2='视盘杯盘比增大')
+        self.wrong = self._option('白内障', False, 1, hint_level_1='晶状体是否混浊？', hint_level_3='不符合')
+
+    def _option(self, name, is_correct, display_order, **hints):
+        return _create_diagnosis_option(self.clinical_case, name, is_correct, display_order=display_order, **hints)
+
+    def _ladder(self):
+        return ClinicalCase.objects.get(pk=self.clinical_case.pk).diagnosis_hint_ladder
+
+    def _submit(self, ids):
+        self.client.force_login(self.student)
+        response = self.client.post('/api/clinical/submit-diagnosis/', json.dumps({
+            'case_id': self.clinical_case.case_id, 'selected_diagnosis_ids': ids,
+        }), content_type='application/json')
+        return response.json()
+
+    def test_ladder_follows_display_order(self):
+        ladder = self._ladder()
+        self.assertEqual(ladder['correct_ids'], [self.correct.id])
+        self.assertEqual(ladder['partial']['4'], '\n✗ 白内障: 不符合\n✓ 原发性开角型青光眼: 这是正确的诊断')
+        self.assertEqual(ladder_guidance(ladder, 'partial', 2, {self.wrong.id}), '\n关于白内障: 晶状体是否混浊？')
+        self.assertEqual(ladder_guidance(ladder, 'partial', 2, {self.correct.id}), '')
+        self.assertEqual(ladder_guidance(ladder, 'none', 5), '\n✓ 原发性开角型青光眼: 视盘杯盘比增大')
+
+    def test_grading_ignores_stale_ladder(self):
+        # 批量 update 不触发信号，阶梯中仍是旧的正确诊断
+        DiagnosisOption.objects.filter(pk=self.correct.pk).update(is_correct_diagnosis=False)
+        DiagnosisOption.objects.filter(pk=self.wrong.pk).update(is_correct_diagnosis=True)
+        self.assertEqual(self._ladder()['correct_ids'], [self.correct.id])
+
+        data = self._submit([self.wrong.id])
+        self.assertTrue(data['success'])
+        self.assertEqual((data['data']['diagnosis_score'], data['data']['current_stage']), (100, 'treatment_selection'))
+        self.assertEqual(self._ladder()['correct_ids'], [self.wrong.id])
+
+
+class ItemAnalysisTests(TestCase):
+    """选项作答记录与题目分析：读接口不重复写 session，写入失败留日志，区分度方向正确"""
+
+    def setUp(self):
+        self.student, self.clinical_case, self.session = _create_student_session('item_student')
+        self.teacher = User.objects.get(username='item_student_teacher')
+        self.teacher.groups.add(Group.objects.get_or_create(name='Teachers')[0])
+        other_case = ClinicalCase.objects.create(
+            title='干扰来源', case_id='item_other_case', patient_age=30, patient_gender='F',
+            chief_complaint='-', present_illness='-', learning_objectives=[], created_by=self.teacher,
+        )
+        self.key = _create_diagnosis_option(self.clinical_case, '急性闭角型青光眼', True)
+        self.distractor = _create_diagnosis_option(other_case, '虹膜睫状体炎', False)
+
+    def _request(self):
+        from django.contrib.sessions.backends.db import SessionStore
+        return mock.Mock(session=SessionStore())
+
+    def test_stash_and_record(self):
+        request = self._request()
+        stash_option_exposure(request, self.clinical_case, 'diagnosis', [self.key, self.distractor])
+        request.session.save()
+        request.session.modified = False
+        stash_option_exposure(request, self.clinical_case, 'diagnosis', [self.key, self.distractor])
+        self.assertFalse(request.session.modified)
+
+        record_option_exposures(request, self.session, 'diagnosis', [self.distractor.id], [self.key.id])
+        rows = dict(OptionExposure.objects.values_list('option_id', 'selected'))
+        self.assertEqual(rows, {self.key.id: False, self.distractor.id: True})
+        self.assertTrue(OptionExposure.objects.get(option_id=self.distractor.id).is_distractor)
+
+    def test_record_failure_is_logged(self):
+        with mock.patch.object(OptionExposure.objects, 'bulk_create', side_effect=DatabaseError('no such table')):
+            with self.assertLogs('cases.item_analysis', 'ERROR'):
+                record_option_exposures(self._request(), self.session, 'diagnosis', [self.key.id], [self.key.id])
+        self.assertFalse(OptionExposure.objects.exists())
+
+    @unittest.skipUnless(importlib.util.find_spec('numpy'), '需要 numpy')
+    def test_item_statistics_and_api(self):
+        for index, score in enumerate((90, 80, 40, 30)):
+            student = User.objects.create_user(username=f'item_taker{index}', password='pw')
+            session = StudentClinicalSession.objects.create(
+                student=student, clinical_case=self.clinical_case,
+                completed_at=datetime.now(dt_timezone.utc), overall_score=score,
+            )
+            high = score >= 80
+            OptionExposure.objects.bulk_create([
+                OptionExposure(student=student, clinical_case=self.clinical_case, session=session, option_kind='diagnosis',
+                               option_id=self.key.id, is_key=True, selected=high),
+                OptionExposure(student=student, clinical_case=self.clinical_case, session=session, option_kind='diagnosis',
+                               option_id=self.distractor.id, is_distractor=True, selected=not high),
+            ])
+        self.assertEqual(compute_item_statistics(), 2)
+
+        self.client.force_login(self.teacher)
+        data = self.client.get(
+            f'/api/teacher/clinical-cases/{self.clinical_case.case_id}/item-analysis/', {'min_exposures': 1},
+        ).json()['data']
+        items = {item['name']: item for item in data['items']}
+        self.assertEqual(items['急性闭角型青光眼']['selection_rate'], 0.5)
+        self.assertEqual(items['急性闭角型青光眼']['discrimination'], 1.0)
+        self.assertEqual(items['虹膜睫状体炎']['discrimination'], -1.0)
+        self.assertEqual(items['虹膜睫状体炎']['flags'], [])
+
+
+class StudyMinutesTests(TestCase):
+    """学习时长：完成时写入，完成后继续活动（学习反馈页）时刷新；0036 迁移回填历史会话"""
+
+    def setUp(self):
+        self.student, self.clinical_case, self.session = _create_student_session('minutes_student')
+        now = datetime.now(dt_timezone.utc)
+        self.started, self.completed = now - timedelta(minutes=30), now - timedelta(minutes=10)
+        StudentClinicalSession.objects.filter(pk=self.session.pk).update(
+            run_started_at=self.started, completed_at=self.completed, session_status='completed',
+        )
+        SessionStageEvent.objects.bulk_create([
+            SessionStageEvent(session=self.session, stage=stage, event_type=event_type, ts=int(at.timestamp() * 1000))
+            for stage, event_type, at in (
+                ('case_presentation', 'run_start', self.started),
+                ('case_presentation', 'stage_enter', self.started),
+                ('learning_feedback', 'stage_enter', self.completed),
+            )
+        ])
+
+    def _load(self):
+        return StudentClinicalSession.objects.get(pk=self.session.pk)
+
+    def test_feedback_time_counted_after_completion(self):
+        session = self._load()
+        save_session(session, fields=timing.apply_study_minutes(session, session.completed_at))
+        session = self._load()
+        self.assertAlmostEqual(session.study_minutes, 20, delta=0.1)
+        self.assertEqual(session.feedback_minutes, 0)
+
+        session.session_status = 'learning_feedback'
+        save_session(session)
+        session = self._load()
+        self.assertAlmostEqual(session.study_minutes, 30, delta=0.1)
+        self.assertAlmostEqual(session.feedback_minutes, 10, delta=0.1)
+
+    def test_heartbeat_flush_refreshes_completed_session(self):
+        buffer = HeartbeatBuffer(flush_interval=3600)
+        buffer.record(self.session.pk, 'diagnosis_reasoning', 30)
+        buffer.record(self.session.pk, 'learning_feedback', 15)
+        buffer.flush()
+        session = self._load()
+        self.assertEqual((session.study_minutes, session.feedback_minutes), (0.75, 0.25))
+        self.assertIsNone(session.examination_minutes)
+
+    def test_backfill_migration(self):
+        from django.db.migrations.loader import MigrationLoader
+
+        migration = importlib.import_module('cases.migrations.0036_backfill_study_minutes')
+        apps = MigrationLoader(connection).project_state(('cases', '0036_backfill_study_minutes')).apps
+        migration.backfill_study_minutes(apps, None)
+        session = self._load()
+        self.assertAlmostEqual(session.study_minutes, 30, delta=0.1)
+        self.assertAlmostEqual(session.case_presentation_minutes, 20, delta=0.1)
+        self.assertAlmostEqual(session.feedback_minutes, 10, delta=0.1)
+        self.assertIsNone(session.diagnosis_minutes)
+
+
+class SessionConcurrencyTests(TestCase):
+    """save_session：比较并交换 + 不相交 JSON 键自动合并"""
+
+    def setUp(self):
+        _, _, self.session = _create_student_session()
+
+    def _load(self):
+        return StudentClinicalSession.objects.get(pk=self.session.pk)
+
+    def test_disjoint_json_keys_are_merged(self):
+        a, b = self._load(), self._load()
+        a.session_data['history_summary']['duration'] = '3天'
+        a.reflection = '反思'
+        b.session_data['history_summary']['severity'] = '重度'
+        b.session_data['examination_order'] = [1, 2]
+        save_session(a)
+        save_session(b)
+
+        latest = self._load()
+        self.assertEqual(latest.session_data['history_summary'], {'duration': '3天', 'severity': '重度'})
+        self.assertEqual(latest.session_data['examination_order'], [1, 2])
+        self.assertEqual(latest.reflection, '反思')
+        self.assertEqual(latest.version, self.session.version + 2)
+
+    def test_same_key_conflict_raises(self):
+        a, b = self._load(), self._load()
+        a.session_data['history_summary']['duration'] = '3天'
+        b.session_data['history_summary']['duration'] = '5天'
+        save_session(a)
+        with self.assertRaises(SessionConflictError):
+            save_session(b)
+        self.assertEqual(self._load().session_data['history_summary']['duration'], '3天')
+
+    def test_last_writer_wins_fields(self):
+        a, b = self._load(), self._load()
+        a.session_status = 'examination_selection'
+        b.session_status = 'diagnosis_reasoning'
+        save_session(a)
+        save_session(b)
+        self.assertEqual(self._load().session_status, 'diagnosis_reasoning')
+
+    def test_only_changed_fields_are_written(self):
+        a, b = self._load(), self._load()
+        StudentClinicalSession.objects.filter(pk=self.session.pk).update(reflection='外部写入')
+        a.diagnosis_reasoning_text = '推理'
+        save_session(a)
+        b.diagnosis_attempt_count = 2
+        save_session(b)
+        latest = self._load()
+        self.assertEqual(latest.reflection, '外部写入')
+        self.assertEqual(latest.diagnosis_reasoning_text, '推理')
+        self.assertEqual(latest.diagnosis_attempt_count, 2)
+
+    def test_load_defers_json_baseline_copy(self):
+        with mock.patch('cases.models.copy.deepcopy', wraps=copy.deepcopy) as deepcopy:
+            session = self._load()
+            self.assertFalse(deepcopy.called)
+            with self.assertNumQueries(0):
+                session.session_data['history_summary']['duration'] = '3天'
+            self.assertEqual(deepcopy.call_count, 1)
+        self.assertEqual(changed_fields(session), ['session_data'])
+        self.assertEqual(session._loaded_values['session_data']['history_summary'], {})
+
+    def test_assigned_json_field_is_written(self):
+        session = self._load()
+        session.selected_examinations = [1]
+        self.assertEqual(changed_fields(session), ['selected_examinations'])
+        save_session(session)
+        session.reflection = '反思'
+        session.save()
+        latest = self._load()
+        self.assertEqual((latest.selected_examinations, latest.reflection), ([1], '反思'))
+        self.assertEqual(latest.session_data, self.session.session_data)
+
+
+    def test_noop_save_keeps_version(self):
+        session = self._load()
+        with self.assertNumQueries(0):
+            save_session(session)
+            save_session(session, fields=[])
+        self.assertEqual(self._load().version, self.session.version)
+
+    def test_progress_autosave_only_writes_step_data(self):
+        student = self.session.student
+        self.client.force_login(student)
+        stale = self._load()
+        stale.session_data['history_summary']['duration'] = '3天'
+        save_session(stale)
+        response = self.client.post('/api/clinical/save-progress/', json.dumps({
+            'case_id': self.session.clinical_case.case_id, 'progress_data': {'step': 2},
+        }), content_type='application/json')
+        self.assertTrue(response.json()['success'])
+        self.assertEqual(self._load().session_data, {'history_summary': {'duration': '3天'}, 'step_data': {'step': 2}})
+
+
+class SessionConcurrencyStressTests(TransactionTestCase):
+    """同一会话并发请求：病史汇总、笔记、阶段切换互不覆盖"""
+
+    HISTORY_KEYS = ('chief_complaint', 'duration', 'symptom_nature', 'severity',
+                    'trigger_factors', 'past_history', 'family_history')
+
+    def test_parallel_requests_keep_every_write(self):
+        student, clinical_case, session = _create_student_session()
+        barrier = threading.Barrier(len(self.HISTORY_KEYS) + 2)
+        responses = []
+        lock = threading.Lock()
+
+        def post(url, payload):
+            try:
+                client = Client()
+                client.force_login(student)
+                barrier.wait()
+                response = client.post(url, json.dumps(payload), content_type='application/json')
+                with lock:
+                    responses.append((url, response.status_code, response.json()))
+            finally:
+                connection.close()
+
+        base = f'/api/clinical/case/{clinical_case.case_id}/'
+        jobs = [(base + 'save-history/', {key: f'{key}-value'}) for key in self.HISTORY_KEYS]
+        jobs.append(('/api/clinical/notes/save/', {'case_id': clinical_case.case_id, 'notes': '并发笔记'}))
+        jobs.append((base + 'update-stage/', {'stage': 'examination_selection'}))
+        threads = [threading.Thread(target=post, args=job) for job in jobs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(responses), len(jobs))
+        for url, status, body in responses:
+            self.assertEqual(status, 200, (url, body))
+            self.assertTrue(body['success'], (url, body))
+
+        session.refresh_from_db()
+        self.assertEqual(
+            session.session_data['history_summary'],
+            {key: f'{key}-value' for key in self.HISTORY_KEYS},
+        )
+        self.assertEqual(LearningNote.objects.get(student=student, clinical_case=clinical_case).content, '并发笔记')
+        self.assertEqual(session.session_status, 'examination_selection')
+        # 笔记写入独立的笔记表，不再递增会话版本
+        self.assertEqual(session.version, len(jobs) - 1)
+
+
+class LearningNotePatchTests(TestCase):
+    """学习笔记增量补丁：每个补丁按 revision 比较并交换后立即落库"""
+
+    def setUp(self):
+        self.student, self.clinical_case, _ = _create_student_session('note_student')
+
+    def _row(self):
+        return LearningNote.objects.get(student=self.student, clinical_case=self.clinical_case)
+
+    def test_apply_ops(self):
+        self.assertEqual(apply_ops('眼压升高', [{'pos': 2, 'delete': 2, 'insert': '正常'}]), '眼压正常')
+        self.assertEqual(apply_ops('', [{'pos': 0, 'insert': 'ab'}, {'pos': 2, 'insert': 'c'}]), 'abc')
+        with self.assertRaises(NotePatchError):
+            apply_ops('abc', [{'pos': 2, 'delete': 5}])
+
+    def test_every_patch_is_persisted(self):
+        patch_note(self.student, self.clinical_case, 0, [{'pos': 0, 'insert': '主诉'}])
+        patch_note(self.student, self.clinical_case, 1, [{'pos': 2, 'insert': '：视物模糊'}])
+        with self.assertNumQueries(2):
+            result = patch_note(self.student, self.clinical_case, 2, [{'pos': 7, 'insert': '一周'}])
+        self.assertEqual((result['content'], result['revision']), ('主诉：视物模糊一周', 3))
+        self.assertEqual((self._row().content, self._row().revision), ('主诉：视物模糊一周', 3))
+
+        unchanged = patch_note(self.student, self.clinical_case, 3, [])
+        self.assertEqual(unchanged['revision'], 3)
+        note = get_note(self.student, self.clinical_case)
+        self.assertEqual((note.content, note.revision), ('主诉：视物模糊一周', 3))
+
+    def test_concurrent_writer_wins_once(self):
+        patch_note(self.student, self.clinical_case, 0, [{'pos': 0, 'insert': 'a'}])
+        stale = self._row()
+        patch_note(self.student, self.clinical_case, 1, [{'pos': 1, 'insert': 'b'}])
+        with self.assertRaises(NoteRevisionConflict) as ctx:
+            learning_notes._persist(stale, 'ax', 2)
+        self.assertEqual((ctx.exception.revision, ctx.exception.content), (2, 'ab'))
+        self.assertEqual(self._row().content, 'ab')
+
+    def test_stale_revision_conflicts(self):
+        patch_note(self.student, self.clinical_case, 0, [{'pos': 0, 'insert': 'abc'}])
+        with self.assertRaises(NoteRevisionConflict) as ctx:
+            patch_note(self.student, self.clinical_case, 0, [{'pos': 0, 'insert': 'x'}])
+        self.assertEqual((ctx.exception.revision, ctx.exception.content), (1, 'abc'))
+
+
+class ClinicalProgressTests(TestCase):
+    """get-progress：字段选择、ETag/304、完成后读取复盘快照"""
+
+    def setUp(self):
+        self.student, self.clinical_case, self.session = _create_student_session('progress_student')
+        self.client.force_login(self.student)
+        self.url = f'/api/clinical/get-progress/{self.clinical_case.case_id}/'
+
+    def test_fields_projection(self):
+        data = self.client.get(self.url, {'fields': 'session_status,scores'}).json()['data']
+        self.assertEqual(
+            list(data),
+            ['session_status', 'examination_score', 'diagnosis_score', 'treatment_score', 'overall_score'],
+        )
+        self.assertIn('review', self.client.get(self.url).json()['data'])
+        self.assertEqual(self.client.get(self.url, {'fields': 'bogus'}).status_code, 400)
+
+    def test_etag_not_modified_until_session_changes(self):
+        response = self.client.get(self.url, {'fields': 'session_status'})
+        etag = response['ETag']
+        self.assertEqual(self.client.get(self.url, {'fields': 'session_status'}, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # 不同字段组合的 ETag 不同
+        self.assertEqual(self.client.get(self.url, {'fields': 'scores'}, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        session = StudentClinicalSession.objects.get(pk=self.session.pk)
+        session.session_status = 'examination_selection'
+        save_session(session)
+        response = self.client.get(self.url, {'fields': 'session_status'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['data']['session_status'], 'examination_selection')
+
+    def test_completed_session_reads_snapshot(self):
+        StudentClinicalSession.objects.filter(pk=self.session.pk).update(
+            completed_at=self.session.started_at + timedelta(minutes=5),
+            review_snapshot={'selected_examinations': [{'id': 1, 'name': '快照检查'}], 'session_total_ms': 300000},
+        )
+        review = self.client.get(self.url, {'fields': 'review'}).json()['data']['review']
+        self.assertEqual(review['selected_examinations'], [{'id': 1, 'name': '快照检查'}])
+        self.assertEqual(review['session_total_ms'], 300000)
+        self.assertIsNotNone(review['session_completed_at'])
+
+    def test_review_etag_follows_heartbeats(self):
+        self.addCleanup(_reset_heartbeat_buffer)
+        etag = self.client.get(self.url, {'fields': 'review'})['ETag']
+        self.assertEqual(self.client.get(self.url, {'fields': 'review'}, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        heartbeat_buffer.record(self.session.pk, 'case_presentation', 12)
+        response = self.client.get(self.url, {'fields': 'review'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['data']['review']['stage_active_seconds'], {'case_presentation': 12})
+        # 写库后修订号不变
+        etag = response['ETag']
+        heartbeat_buffer.flush()
+        self.assertEqual(self.client.get(self.url, {'fields': 'review'}, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+
+class HeartbeatTests(TestCase):
+    """学习心跳：进程内累加、批量写库、完成时按有效时长记录"""
+
+    def setUp(self):
+        self.student, self.clinical_case, self.session = _create_student_session('heartbeat_student')
+
+    def tearDown(self):
+        _reset_heartbeat_buffer()
+
+    def _clock(self):
+        patcher = mock.patch('cases.heartbeat.time.monotonic', return_value=1000.0)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def test_buffer_batches_writes(self):
+        clock = self._clock()
+        buffer = HeartbeatBuffer(flush_interval=10 ** 6)
+        self.assertEqual(buffer.record(self.session.pk, 'case_presentation', 10), 10)
+        clock.return_value += 8 * 3600
+        self.assertEqual(buffer.record(self.session.pk, 'case_presentation', 8 * 3600), HEARTBEAT_MAX_SECONDS)
+        buffer.record(self.session.pk, 'examination_selection', 5)
+        self.assertFalse(SessionActiveTime.objects.exists())
+
+        # 9 条写心跳（含按天明细）+ 6 条按天累加每日汇总（同一天的多个阶段合并为一次）
+        with self.assertNumQueries(15):
+            self.assertEqual(buffer.flush(), 2)
+        rows = dict(SessionActiveTime.objects.values_list('stage', 'active_seconds'))
+        self.assertEqual(rows, {'case_presentation': 10 + HEARTBEAT_MAX_SECONDS, 'examination_selection': 5})
+
+        clock.return_value += HEARTBEAT_INTERVAL_SECONDS
+        buffer.record(self.session.pk, 'examination_selection', 5)
+        buffer.flush()
+        self.assertEqual(SessionActiveTime.objects.get(stage='examination_selection').active_seconds, 10)
+
+    def test_credit_capped_by_beat_interval(self):
+        clock = self._clock()
+        buffer = HeartbeatBuffer(flush_interval=10 ** 6)
+        self.assertEqual(buffer.record(self.session.pk, 'case_presentation', 15), 15)
+        # 两个标签页同时上报：第二次只计入距上次心跳的间隔
+        clock.return_value += 4
+        self.assertEqual(buffer.record(self.session.pk, 'case_presentation', 15), 4)
+        self.assertEqual(buffer.record(self.session.pk, 'case_presentation', 15), 0)
+        clock.return_value += HEARTBEAT_INTERVAL_SECONDS
+        self.assertEqual(buffer.record(self.session.pk, 'case_presentation', 15), 15)
+        self.assertEqual(buffer.pending_seconds(self.session.pk), {'case_presentation': 34})
+        self.assertEqual(buffer.pending_beats(self.session.pk), 3)
+
+    def test_endpoint_accepts_beacon_form(self):
+        self.client.force_login(self.student)
+        url = f'/api/clinical/case/{self.clinical_case.case_id}/heartbeat/'
+        StudentClinicalSession.objects.filter(pk=self.session.pk).update(session_status='examination_selection')
+        self.assertEqual(self.client.post(url, {'stage': 'examination_results', 'active_seconds': '12.5'}).status_code, 204)
+        self.assertEqual(self.client.post(url, {'stage': 'bogus', 'active_seconds': '1'}).status_code, 400)
+        # 旧页面仍停留在上一阶段：不计入
+        self.assertEqual(self.client.post(url, {'stage': 'case_presentation', 'active_seconds': '5'}).status_code, 409)
+        self.assertEqual(active_seconds(self.session), {'examination_selection': 12.5})
+
+    def test_study_minutes_use_active_time(self):
+        heartbeat_buffer.record(self.session.pk, 'case_presentation', 30)
+        heartbeat_buffer.record(self.session.pk, 'diagnosis_reasoning', 30)
+        session = StudentClinicalSession.objects.get(pk=self.session.pk)
+        session.completed_at = session.started_at + timedelta(hours=30)
+        timing.apply_study_minutes(session, session.completed_at)
+        self.assertEqual(session.study_minutes, 1)
+        self.assertEqual(session.case_presentation_minutes, 0.5)
+        self.assertIsNone(session.examination_minutes)
+
+    def test_timing_cache_tracks_heartbeats_and_completion(self):
+        timing.timing_engine.clear()
+        session = StudentClinicalSession.objects.get(pk=self.session.pk)
+        first = timing.timing_engine.timing(session)
+        self.assertIs(timing.timing_engine.timing(session), first)
+        heartbeat_buffer.record(session.pk, 'case_presentation', 10)
+        second = timing.timing_engine.timing(session)
+        self.assertIsNot(second, first)
+        session.completed_at = session.last_activity
+        self.assertIsNot(timing.timing_engine.timing(session), second)
+
+
+class SessionRunTests(TestCase):
+    """历史轮次：每轮结束时归档一次，重置/删除会话后仍保留"""
+
+    def setUp(self):
+        self.student, self.clinical_case, self.session = _create_student_session('run_student')
+        self.client.force_login(self.student)
+
+    def test_completed_run_is_archived_once_and_survives_reset(self):
+        session = StudentClinicalSession.objects.get(pk=self.session.pk)
+        session.overall_score = 88
+        session.session_status = 'completed'
+        session.completed_at = session.started_at + timedelta(minutes=20)
+        save_session(session)
+        first = archive_run(session)
+        self.assertEqual(archive_run(session).pk, first.pk)
+
+        response = self.client.post('/api/clinical/reset-progress/', json.dumps({'case_id': self.clinical_case.case_id}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(StudentClinicalSession.objects.filter(pk=self.session.pk).exists())
+        run = SessionRun.objects.get(student=self.student, clinical_case=self.clinical_case)
+        self.assertEqual((run.end_reason, run.overall_score, run.session_id), ('completed', 88, None))
+
+    def test_restart_archives_abandoned_run(self):
+        url = f'/api/clinical/case/{self.clinical_case.case_id}/update-stage/'
+        self.client.post(url, json.dumps({'stage': 'examination_selection'}), content_type='application/json')
+        self.client.post(url, json.dumps({'stage': 'diagnosis_reasoning'}), content_type='application/json')
+        self.client.post(url, json.dumps({'stage': 'case_presentation', 'restart': True}), content_type='application/json')
+        # 新一轮没有作答，再次重新开始不产生空归档
+        self.client.post(url, json.dumps({'stage': 'case_presentation', 'restart': True}), content_type='application/json')
+        self.assertEqual(list(SessionRun.objects.values_list('run', 'end_reason')), [(1, 'reset')])
+
+    def test_case_detail_restart_keeps_archived_minutes(self):
+        url = f'/api/clinical/case/{self.clinical_case.case_id}/update-stage/'
+        self.client.post(url, json.dumps({'stage': 'case_presentation'}), content_type='application/json')
+        session = StudentClinicalSession.objects.get(pk=self.session.pk)
+        session.session_status = 'completed'
+        session.completed_at = datetime.now(dt_timezone.utc)
+        session.overall_score = 80
+        session.study_minutes = 12
+        save_session(session, fields=['session_status', 'completed_at', 'overall_score', 'study_minutes'])
+        archive_run(session)
+        # 学习反馈期间更短（或为空）的学习时长不覆盖已归档的值
+        session.study_minutes = 5
+        archive_run(session)
+
+        self.assertEqual(self.client.get(f'/api/clinical/case/{self.clinical_case.case_id}/').status_code, 200)
+        self.client.post(url, json.dumps({'stage': 'case_presentation'}), content_type='application/json')
+        session = StudentClinicalSession.objects.get(pk=self.session.pk)
+        self.assertEqual((session.session_status, session.completed_at, session.overall_score), ('case_presentation', None, 0))
+        self.assertEqual(list(SessionStageEvent.objects.filter(session=session, event_type='run_start').values_list('run', flat=True)), [1, 2])
+        self.assertEqual(list(SessionRun.objects.values_list('run', 'end_reason', 'study_minutes')), [(1, 'completed', 12)])
+
+
+class SessionStageEventTests(TestCase):
+    """阶段事件：切换时只追加事件行；0022 迁移把 session_data 旧计时回填为事件"""
+
+    def setUp(self):
+        self.student, self.clinical_case, self.session = _create_student_session('event_student')
+
+    def _events(self):
+        return list(SessionStageEvent.objects.filter(session=self.session).order_by('id').values_list(
+            'run', 'event_type', 'from_stage', 'stage',
+        ))
+
+    def test_update_stage_appends_events(self):
+        self.client.force_login(self.student)
+        url = f'/api/clinical/case/{self.clinical_case.case_id}/update-stage/'
+        for stage in ('case_presentation', 'examination_selection', 'examination_selection'):
+            self.client.post(url, json.dumps({'stage': stage}), content_type='application/json')
+        self.assertEqual(self._events(), [
+            (1, 'run_start', '', 'case_presentation'),
+            (1, 'stage_enter', '', 'case_presentation'),
+            (1, 'stage_enter', '', 'examination_selection'),
+            (1, 'transition', 'case_presentation', 'examination_selection'),
+        ])
+
+        self.client.post(url, json.dumps({'stage': 'case_presentation', 'restart': True}), content_type='application/json')
+        self.assertEqual(self._events()[4:6], [
+            (2, 'run_start', '', 'case_presentation'), (2, 'stage_enter', '', 'case_presentation'),
+        ])
+
+    def test_failed_writes_leave_stage_unchanged(self):
+        self.client.force_login(self.student)
+        url = f'/api/clinical/case/{self.clinical_case.case_id}/update-stage/'
+        self.client.post(url, json.dumps({'stage': 'case_presentation'}), content_type='application/json')
+        self.client.post(url, json.dumps({'stage': 'examination_selection'}), content_type='application/json')
+        before = self._events()
+
+        with mock.patch('cases.views.write_events', side_effect=DatabaseError('insert failed')):
+            response = self.client.post(url, json.dumps({'stage': 'diagnosis_reasoning'}), content_type='application/json')
+        self.assertFalse(response.json()['success'])
+        self.assertEqual(StudentClinicalSession.objects.get(pk=self.session.pk).session_status, 'examination_selection')
+
+        # 归档失败时不开始新一轮
+        with mock.patch('cases.session_runs.archive_run', side_effect=DatabaseError('archive failed')):
+            response = self.client.post(url, json.dumps({'stage': 'case_presentation', 'restart': True}), content_type='application/json')
+        self.assertFalse(response.json()['success'])
+        self.assertEqual(self._events(), before)
+
+    def test_backfill_migration(self):
+        from django.db.migrations.loader import MigrationLoader
+
+        migration = importlib.import_module('cases.migrations.0022_session_stage_event')
+        StudentClinicalSession.objects.filter(pk=self.session.pk).update(session_data={
+            'history_summary': {},
+            'timing_archives': [{'run_started_at': '2026-01-01T08:00:00+00:00', 'stage_start_times': {}, 'stage_times': {}}],
+            'run_started_at': '2026-01-02T08:00:00+00:00',
+            'stage_start_times': {'examination_selection': '2026-01-02T08:05:00+00:00'},
+            'stage_times': {'case_presentation_to_examination_selection': '2026-01-02T08:05:00Z'},
+        })
+        apps = MigrationLoader(connection).project_state(('cases', '0022_session_stage_event')).apps
+        migration.backfill_stage_events(apps, None)
+
+        self.assertEqual(self._events(), [
+            (1, 'run_start', '', 'case_presentation'),
+            (2, 'run_start', '', 'case_presentation'),
+            (2, 'stage_enter', '', 'examination_selection'),
+            (2, 'transition', 'case_presentation', 'examination_selection'),
+        ])
+        self.assertEqual(SessionStageEvent.objects.filter(session=self.session, run=2).values_list('ts', flat=True)[0], 1767340800000)
+        self.assertEqual(StudentClinicalSession.objects.get(pk=self.session.pk).session_data, {'history_summary': {}})
+
+
+class StageEventColumnTests(TestCase):
+    """阶段事件同步写入会话上的 run_started_at / stage_entered_at"""
+
+    def test_columns_follow_events(self):
+        student, clinical_case, session = _create_student_session('column_student')
+        self.client.force_login(student)
+        url = f'/api/clinical/case/{clinical_case.case_id}/update-stage/'
+        self.client.post(url, json.dumps({'stage': 'case_presentation'}), content_type='application/json')
+        self.client.post(url, json.dumps({'stage': 'examination_selection'}), content_type='application/json')
+
+        session = StudentClinicalSession.objects.get(pk=session.pk)
+        typed = timing.typed_timing(session)
+        self.assertEqual(session.run_started_at, typed['run_started_at'])
+        self.assertEqual(session.stage_entered_at, typed['stage_times']['case_presentation_to_examination_selection'])
+        self.assertEqual(
+            StudentClinicalSession.objects.filter(run_started_at__gte=typed['run_started_at']).count(), 1
+        )
+
+
+class SessionStateMachineTests(TestCase):
+    """阶段切换表与接口阶段校验"""
+
+    def setUp(self):
+        self.student, self.clinical_case, self.session = _create_student_session('state_student')
+        self.client.force_login(self.student)
+
+    def test_transition_table(self):
+        self.assertTrue(can_transition('case_presentation', 'examination_selection'))
+        self.assertTrue(can_transition('completed', 'case_presentation'))
+        self.assertTrue(can_transition('learning_feedback', 'completed'))
+        self.assertFalse(can_transition('completed', 'learning_feedback'))
+        self.assertFalse(can_transition('completed', 'treatment_selection'))
+        self.assertFalse(can_transition('learning_feedback', 'diagnosis_reasoning'))
+        self.assertTrue(can_transition('treatment_selection', 'case_presentation'))
+        self.assertFalse(can_transition('case_presentation', 'treatment_selection'))
+        self.assertFalse(can_transition('examination_results', 'completed'))
+        self.assertEqual(canonical_stage('feedback'), 'learning_feedback')
+        self.assertIsNone(canonical_stage('bogus'))
+
+    def test_finished_run_cannot_walk_back(self):
+        url = f'/api/clinical/case/{self.clinical_case.case_id}/update-stage/'
+        for status, stage in (('completed', 'treatment_selection'), ('learning_feedback', 'diagnosis_reasoning')):
+            StudentClinicalSession.objects.filter(pk=self.session.pk).update(session_status=status)
+            response = self.client.post(url, json.dumps({'stage': stage}), content_type='application/json')
+            self.assertEqual(response.status_code, 409)
+            self.assertEqual(StudentClinicalSession.objects.get(pk=self.session.pk).session_status, status)
+
+    def test_illegal_requests_are_rejected(self):
+        url = f'/api/clinical/case/{self.clinical_case.case_id}/update-stage/'
+        response = self.client.post(url, json.dumps({'stage': 'treatment_selection'}), content_type='application/json')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(StudentClinicalSession.objects.get(pk=self.session.pk).session_status, 'case_presentation')
+
+        # 会话阶段校验只查一列，不进入评分逻辑
+        with self.assertNumQueries(3):
+            response = self.client.post(
+                f'/api/clinical/case/{self.clinical_case.case_id}/submit-treatment/',
+                json.dumps({'treatment_ids': [1], 'treatment_rationale': '手术'}), content_type='application/json',
+            )
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['data']['allowed_stages'], ['treatment_selection'])
+
+
+class CaseLibraryTests(TestCase):
+    """学生端案例库：游标分页、学习状态筛选、查询数与卡片缓存"""
+
+    def setUp(self):
+        cache.clear()
+        self.student, self.started_case, self.session = _create_student_session('library_student')
+        teacher = User.objects.get(username='library_student_teacher')
+        for index in range(5):
+            ClinicalCase.objects.create(
+                title=f'案例库病例{index}', case_id=f'library_case_{index}', patient_age=30, patient_gender='F',
+                chief_complaint='眼红', present_illness='三天', learning_objectives=['a', 'b', 'c'],
+                difficulty_level='advanced' if index % 2 else 'beginner', created_by=teacher,
+            )
+        self.client.force_login(self.student)
+
+    def _page(self, **params):
+        response = self.client.get('/api/clinical/cases/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()['data']
+
+    def test_keyset_pages_cover_all_cases_once(self):
+        seen = []
+        cursor = None
+        while True:
+            params = {'limit': 2}
+            if cursor:
+                params['cursor'] = cursor
+            data = self._page(**params)
+            seen.extend(case['case_id'] for case in data['cases'])
+            cursor = data['next_cursor']
+            if not cursor:
+                break
+        self.assertEqual(len(seen), 6)
+        self.assertEqual(set(seen), set(ClinicalCase.objects.values_list('case_id', flat=True)))
+        self.assertRaises(InvalidCursor, decode_cursor, '!!')
+        self.assertEqual(self.client.get('/api/clinical/cases/', {'cursor': '!!'}).status_code, 400)
+
+    def test_status_and_difficulty_filters(self):
+        self.assertEqual(
+            [case['case_id'] for case in self._page(status='in_progress')['cases']], [self.started_case.case_id]
+        )
+        self.assertEqual(len(self._page(status='not_started')['cases']), 5)
+        self.assertEqual(self._page(status='completed')['cases'], [])
+        self.assertEqual(len(self._page(difficulty='advanced')['cases']), 2)
+
+        card = self._page(status='in_progress')['cases'][0]
+        self.assertEqual((card['status'], card['session_status']), ('in_progress', 'case_presentation'))
+
+    def test_query_count_is_independent_of_page_size(self):
+        self._page()
+        with self.assertNumQueries(4):
+            self.assertEqual(len(self._page()['cases']), 6)
+
+    def test_card_cache_follows_case_edits(self):
+        self.assertEqual(len(self._page()['cases'][0]['learning_objectives']), 2)
+        case = ClinicalCase.objects.get(case_id='library_case_4')
+        case.title = '改名后的病例'
+        case.save()
+        titles = [card['title'] for card in self._page()['cases']]
+        self.assertIn('改名后的病例', titles)
+
+
+class StudentStatsTests(TestCase):
+    """学生统计：一次聚合查询，按学生缓存，会话完成/病例变更后重算"""
+
+    def setUp(self):
+        cache.clear()
+        self.student, self.clinical_case, self.session = _create_student_session('stats_student')
+
+    def test_single_query_and_cache(self):
+        with self.assertNumQueries(1):
+            stats = student_stats(self.student)
+        self.assertEqual((stats['total_cases'], stats['completed_cases']), (1, 0))
+        self.assertEqual(stats['difficulty_progress']['intermediate'], {'completed': 0, 'total': 1})
+        with self.assertNumQueries(0):
+            student_stats(self.student)
+
+    def test_completion_and_case_changes_invalidate(self):
+        student_stats(self.student)
+        session = StudentClinicalSession.objects.get(pk=self.session.pk)
+        session.session_status = 'completed'
+        session.completed_at = datetime.now(dt_timezone.utc)
+        session.overall_score = 80
+        session.study_minutes = 12
+        save_session(session)
+        stats = student_stats(self.student)
+        self.assertEqual((stats['completed_cases'], stats['average_score'], stats['total_study_time']), (1, 80, 12))
+
+        ClinicalCase.objects.create(
+            title='新病例', case_id='stats_new_case', patient_age=50, patient_gender='M', chief_complaint='眼痛',
+            present_illness='两天', learning_objectives=[], difficulty_level='advanced', created_by=self.student,
+        )
+        stats = student_stats(self.student)
+        self.assertEqual((stats['total_cases'], stats['progress_percentage']), (2, 50.0))
+
+
+class DailyRollupTests(TestCase):
+    """每日汇总：事件增量累加与夜间重算结果一致"""
+
+    def setUp(self):
+        self.student, self.clinical_case, self.session = _create_student_session('rollup_student')
+        self.client.force_login(self.student)
+
+    def _snapshot(self):
+        return (
+            sorted(DailyCaseStats.objects.values_list(
+                'clinical_case_id', 'date', 'sessions_started', 'sessions_completed', 'score_sum', 'score_count')),
+            sorted(DailyStudentStats.objects.values_list(
+                'student_id', 'date', 'sessions_started', 'sessions_completed', 'score_sum', 'score_count')),
+        )
+
+    def test_incremental_matches_rebuild(self):
+        url = f'/api/clinical/case/{self.clinical_case.case_id}/update-stage/'
+        self.client.post(url, json.dumps({'stage': 'case_presentation'}), content_type='application/json')
+        self.client.post(url, json.dumps({'stage': 'examination_selection'}), content_type='application/json')
+
+        session = StudentClinicalSession.objects.get(pk=self.session.pk)
+        session.completed_at = datetime.now(dt_timezone.utc)
+        session.session_status = 'completed'
+        session.overall_score = 90
+        session.save()
+        archive_run(session)
+        archive_run(session)
+        self.client.post(url, json.dumps({'stage': 'case_presentation', 'restart': True}), content_type='application/json')
+
+        totals = rollup_totals(clinical_case=self.clinical_case)
+        self.assertEqual((totals['sessions_started'], totals['sessions_completed'], totals['average_score']), (2, 1, 90))
+        self.assertEqual(DailyStudentStats.objects.get(student=self.student).date, rollup_date(session.completed_at))
+
+        incremental = self._snapshot()
+        rebuild_daily_stats()
+        self.assertEqual(self._snapshot(), incremental)
+
+    def test_active_time_across_midnight(self):
+        clock = mock.patch('cases.heartbeat.time.monotonic', return_value=1000.0)
+        monotonic = clock.start()
+        self.addCleanup(clock.stop)
+        today = rollup_date(datetime.now(dt_timezone.utc))
+        midnight = datetime.combine(today, datetime.min.time(), tzinfo=ROLLUP_TZ)
+        buffer = HeartbeatBuffer(flush_interval=10 ** 6)
+        buffer.record(self.session.pk, 'case_presentation', 20, at=midnight - timedelta(seconds=10))
+        buffer.flush()
+        monotonic.return_value += 20
+        buffer.record(self.session.pk, 'case_presentation', 10, at=midnight + timedelta(seconds=10))
+        buffer.flush()
+
+        def active_by_day():
+            return dict(DailyStudentStats.objects.values_list('date', 'active_seconds'))
+
+        expected = {today - timedelta(days=1): 20, today: 10}
+        self.assertEqual(active_by_day(), expected)
+        # 夜间只重算今天：昨天的 20 秒不会再被计入今天
+        rebuild_daily_stats(today, today)
+        self.assertEqual(active_by_day(), expected)
+        rebuild_daily_stats()
+        self.assertEqual(active_by_day(), expected)
+
+    def test_case_scores_page_reads_rollups(self):
+        teacher = User.objects.create_user(username='rollup_teacher', password='pw')
+        teacher.groups.add(Group.objects.get_or_create(name='Teachers')[0])
+        rebuild_daily_stats()
+        self.client.force_login(teacher)
+        response = self.client.get(f'/teacher/clinical-cases/{self.clinical_case.case_id}/scores/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['total_sessions'], 1)
+
+
+class CaseCountersTests(TestCase):
+    """病例计数器随选项、会话变化刷新"""
+
+    def test_counters_follow_options_and_sessions(self):
+        student, clinical_case, session = _create_student_session('counter_student')
+        counters = CaseCounters.objects.get(pk=clinical_case.pk)
+        self.assertEqual((counters.session_count, counters.examination_count), (1, 0))
+
+        exam = ExaminationOption.objects.create(
+            clinical_case=clinical_case, examination_type='basic', examination_name='视力',
+            examination_description='-', normal_result='-', actual_result='-',
+        )
+        session = StudentClinicalSession.objects.get(pk=session.pk)
+        session.completed_at = datetime.now(dt_timezone.utc)
+        session.overall_score = 70
+        save_session(session)
+
+        counters.refresh_from_db()
+        self.assertEqual((counters.examination_count, counters.completed_count, counters.average_score), (1, 1, 70))
+        self.assertEqual(counters.completion_rate, 100.0)
+
+        exam.delete()
+        counters.refresh_from_db()
+        self.assertEqual(counters.examination_count, 0)
+
+        clinical_case.delete()
+        self.assertFalse(CaseCounters.objects.exists())
+
+    def test_session_changes_apply_deltas(self):
+        _, clinical_case, session = _create_student_session('counter_delta_student')
+        session = StudentClinicalSession.objects.get(pk=session.pk)
+        session.completed_at = datetime.now(dt_timezone.utc)
+        session.overall_score = 70
+        with CaptureQueriesContext(connection) as queries:
+            save_session(session)
+        self.assertFalse([query for query in queries if 'COUNT(' in query['sql']])
+
+        session.overall_score = 50
+        session.save()
+        counters = CaseCounters.objects.get(pk=clinical_case.pk)
+        self.assertEqual((counters.session_count, counters.completed_count, counters.score_sum, counters.score_count),
+                         (1, 1, 50, 1))
+
+        StudentClinicalSession.objects.get(pk=session.pk).delete()
+        counters.refresh_from_db()
+        self.assertEqual((counters.session_count, counters.completed_count, counters.score_sum, counters.score_count),
+                         (0, 0, 0, 0))
+
+    def test_rebuild_command_repairs_drift(self):
+        _, clinical_case, _ = _create_student_session('counter_repair_student')
+        CaseCounters.objects.filter(pk=clinical_case.pk).update(session_count=9, examination_count=3)
+        call_command('rebuild_case_counters', '--case', clinical_case.case_id, stdout=StringIO())
+        counters = CaseCounters.objects.get(pk=clinical_case.pk)
+        self.assertEqual((counters.session_count, counters.examination_count), (1, 0))
+
+    def test_backfill_migration(self):
+        from django.db.migrations.loader import MigrationLoader
+
+        _, clinical_case, session = _create_student_session('counter_backfill_student')
+        StudentClinicalSession.objects.filter(pk=session.pk).update(completed_at=session.started_at, overall_score=80)
+        _create_diagnosis_option(clinical_case, '青光眼', True)
+        CaseCounters.objects.all().delete()
+
+        migration = importlib.import_module('cases.migrations.0033_case_counters')
+        migration.backfill_case_counters(MigrationLoader(connection).project_state(('cases', '0033_case_counters')).apps, None)
+        counters = CaseCounters.objects.get(pk=clinical_case.pk)
+        self.assertEqual(
+            (counters.diagnosis_count, counters.session_count, counters.completed_count, counters.score_sum, counters.score_count),
+            (1, 1, 1, 80, 1),
+        )
+
+
+class SessionExportTests(TestCase):
+    """教师端成绩导出"""
+
+    def setUp(self):
+        self.student, self.clinical_case, self.session = _create_student_session('export_student')
+        exam = ExaminationOption.objects.create(
+            clinical_case=self.clinical_case, examination_type='basic', examination_name='裂隙灯',
+            examination_description='-', normal_result='-', actual_result='-',
+        )
+        StudentClinicalSession.objects.filter(pk=self.session.pk).update(
+            selected_examinations=[exam.pk], overall_score=66, diagnosis_attempt_count=2,
+            session_data={'examination_selection_success': {'final_attempt': 3, 'total_errors': 2}},
+        )
+        for attempt in (1, 2):
+            OptionExposure.objects.create(
+                student=self.student, clinical_case=self.clinical_case, session=self.session,
+                option_kind='treatment', option_id=1, attempt=attempt,
+            )
+        teacher = User.objects.get(username='export_student_teacher')
+        teacher.groups.add(Group.objects.get_or_create(name='Teachers')[0])
+        self.client.force_login(teacher)
+
+    def test_case_csv_export(self):
+        response = self.client.get(f'/teacher/clinical-cases/{self.clinical_case.case_id}/scores/export/')
+        self.assertEqual(response.status_code, 200)
+        lines = b''.join(response.streaming_content).decode('utf-8-sig').splitlines()
+        self.assertEqual(len(lines), 2)
+        row = lines[1].split(',')
+        self.assertEqual((row[0], row[2], row[10]), ('export_student', self.clinical_case.case_id, '66.0'))
+        self.assertEqual(row[11:15], ['3', '2', '2', '2'])
+        self.assertIn('裂隙灯', lines[1])
+
+    def test_group_filter_and_bad_format(self):
+        response = self.client.get('/teacher/exports/sessions/', {'group': 'Teachers'})
+        self.assertEqual(len(b''.join(response.streaming_content).decode('utf-8-sig').splitlines()), 1)
+        response = self.client.get('/teacher/exports/sessions/', {'format': 'pdf'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_filename_and_formula_cells_are_escaped(self):
+        response = self.client.get('/teacher/exports/sessions/', {'group': 'Students"\r\nX-Injected: 1'})
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="scores_group_Students\\"__X-Injected: 1.csv"')
+        response = self.client.get('/teacher/exports/sessions/', {'group': '2026级"一班'})
+        self.assertIn("filename*=utf-8''scores_group_2026", response['Content-Disposition'])
+
+        User.objects.filter(pk=self.student.pk).update(first_name='=HYPERLINK("http://x")', last_name='')
+        ClinicalCase.objects.filter(pk=self.clinical_case.pk).update(case_id='-C001', title='+青光眼')
+        response = self.client.get('/teacher/exports/sessions/')
+        row = next(csv.reader(b''.join(response.streaming_content).decode('utf-8-sig').splitlines()[1:]))
+        self.assertEqual(row[1:4], ['\'=HYPERLINK("http://x")', '-C001', "'+青光眼"])
+
+    @unittest.skipUnless(importlib.util.find_spec('xlsxwriter'), '需要 xlsxwriter')
+    def test_xlsx_export(self):
+        response = self.client.get('/teacher/exports/sessions/', {'format': 'xlsx'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(b''.join(response.streaming_content).startswith(b'PK'))
+
+
+@unittest.skipUnless(importlib.util.find_spec('numpy'), '需要 numpy')
+class ScoreAnalyticsTests(TestCase):
+    """成绩分布：百分位排名、z 分数与缓存版本"""
+
+    def setUp(self):
+        cache.clear()
+        self.student, self.clinical_case, _ = _create_student_session('analytics_student')
+        teacher = User.objects.get(username='analytics_student_teacher')
+        now = datetime.now(dt_timezone.utc)
+        for index, score in enumerate((60, 80, 100)):
+            student = User.objects.create_user(username=f'analytics_peer{index}', password='pw')
+            StudentClinicalSession.objects.create(
+                student=student, clinical_case=self.clinical_case, completed_at=now,
+                overall_score=score, diagnosis_score=score / 2, examination_score=50,
+            )
+        teacher.groups.add(Group.objects.get_or_create(name='Teachers')[0])
+        self.client.force_login(teacher)
+
+    def test_distribution_and_ranks(self):
+        data = self.client.get('/api/teacher/analytics/scores/', {'case_id': self.clinical_case.case_id}).json()['data']
+        self.assertEqual(data['count'], 3)
+        self.assertNotIn('sessions', data)
+        self.assertEqual(data['overall_counts'], [[60, 1], [80, 1], [100, 1]])
+        overall = data['distributions']['overall_score']
+        self.assertEqual((overall['mean'], overall['quantiles'][2]), (80, 80))
+        self.assertEqual(sum(overall['histogram']), 3)
+        self.assertEqual(data['correlations']['overall_score']['diagnosis_score'], 1.0)
+        self.assertIsNone(data['correlations']['overall_score']['examination_score'])
+
+        data = self.client.get('/api/teacher/analytics/scores/', {'case_id': self.clinical_case.case_id, 'page': 1}).json()['data']
+        self.assertEqual([item['overall_score'] for item in data['sessions']], [100, 80, 60])
+        ranks = {item['overall_score']: (item['percentile_rank'], item['z_score']) for item in data['sessions']}
+        self.assertEqual(ranks[60], (16.7, -1.225))
+        self.assertEqual(ranks[100], (83.3, 1.225))
+        self.assertEqual(self.client.get('/teacher/analytics/').status_code, 200)
+
+    def test_ranks_are_paged(self):
+        analytics = score_analytics(self.clinical_case.pk)
+        page_obj, sessions = session_ranks_page(analytics, self.clinical_case.pk, page=2, page_size=2)
+        self.assertEqual((page_obj.number, page_obj.paginator.num_pages), (2, 2))
+        self.assertEqual([(item['overall_score'], item['percentile_rank']) for item in sessions], [(60, 16.7)])
+
+    def test_cache_follows_score_changes(self):
+        first = score_analytics(self.clinical_case.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(score_analytics(self.clinical_case.pk)['revision'], first['revision'])
+
+        session = StudentClinicalSession.objects.get(student__username='analytics_peer0')
+        session.overall_score = 90
+        save_session(session)
+        self.assertEqual(score_analytics(self.clinical_case.pk)['distributions']['overall_score']['min'], 80)
+
+        Group.objects.get_or_create(name='Class A')[0].user_set.add(session.student)
+        self.assertEqual(score_analytics(group='Class A')['count'], 1)
+
+
+class LearningProfileTests(TestCase):
+    """学生学习画像：每轮完成增量累加，与按 SessionRun 重算一致"""
+
+    def setUp(self):
+        self.student, self.clinical_case, self.session = _create_student_session('profile_student')
+        self.teacher = User.objects.get(username='profile_student_teacher')
+        self.teacher.groups.add(Group.objects.get_or_create(name='Teachers')[0])
+
+    def _complete(self, session, score, diagnosis_attempts, examination_attempts=None):
+        session.completed_at = datetime.now(dt_timezone.utc)
+        session.session_status = 'completed'
+        session.overall_score = score
+        session.diagnosis_attempt_count = diagnosis_attempts
+        if examination_attempts:
+            session.session_data = {'examination_selection_success': {'final_attempt': examination_attempts}}
+        session.save()
+        archive_run(session)
+
+    def _fields(self):
+        profile = StudentLearningProfile.objects.get(student=self.student)
+        return {field.attname: getattr(profile, field.attname) for field in profile._meta.fields if field.name != 'updated_at'}
+
+    def test_incremental_matches_rebuild(self):
+        self._complete(self.session, 60, 3, examination_attempts=2)
+        for index, (score, examination_attempts) in enumerate(((75, 1), (90, None))):
+            clinical_case = ClinicalCase.objects.create(
+                title=f'画像病例{index}', case_id=f'profile_case{index}', patient_age=40, patient_gender='M',
+                chief_complaint='视物模糊', present_illness='一周', learning_objectives=[], created_by=self.teacher,
+            )
+            session = StudentClinicalSession.objects.create(student=self.student, clinical_case=clinical_case)
+            self._complete(session, score, 1, examination_attempts)
+
+        profile = StudentLearningProfile.objects.get(student=self.student)
+        self.assertEqual((profile.runs_completed, profile.average_score, profile.score_trend), (3, 75, 15))
+        self.assertEqual(profile.stage_summary('diagnosis'), {'runs': 3, 'average_attempts': 5 / 3, 'first_try_rate': 66.7})
+        self.assertEqual(profile.stage_summary('examination'), {'runs': 2, 'average_attempts': 1.5, 'first_try_rate': 50.0})
+        self.assertEqual((profile.hinted_runs, profile.guidance_level_sum), (1, 2))
+
+        incremental = self._fields()
+        rebuild_learning_profiles()
+        self.assertEqual(self._fields(), incremental)
+
+        from django.db.migrations.loader import MigrationLoader
+
+        StudentLearningProfile.objects.all().delete()
+        migration = importlib.import_module('cases.migrations.0034_learning_profiles')
+        migration.backfill_learning_profiles(
+            MigrationLoader(connection).project_state(('cases', '0034_learning_profiles')).apps, None
+        )
+        self.assertEqual(self._fields(), incremental)
+
+    def test_update_failure_is_logged(self):
+        with mock.patch.object(StudentLearningProfile.objects, 'get_or_create', side_effect=DatabaseError('locked')):
+            with self.assertLogs('cases.learning_profiles', 'ERROR'):
+                self._complete(self.session, 80, 1)
+        self.assertTrue(SessionRun.objects.filter(session=self.session).exists())
+
+    def test_teacher_api(self):
+        self._complete(self.session, 80, 1)
+        self.client.force_login(self.teacher)
+        data = self.client.get('/api/teacher/learning-profiles/', {'sort': 'hints'}).json()['data']
+        self.assertEqual([item['student'] for item in data['profiles']], ['profile_student'])
+        data = self.client.get(f'/api/teacher/students/{self.student.id}/learning-profile/').json()['data']
+        self.assertEqual((data['runs_completed'], data['stages']['diagnosis']['first_try_rate']), (1, 100.0))
+        self.assertEqual(self.client.get('/teacher/learning-profiles/').status_code, 200)
+
+
+class CaseTuningTests(TestCase):
+    """病例调优摘要：每轮完成累加直方图，与重算一致；接口只读一行"""
+
+    def setUp(self):
+        self.student, self.clinical_case, self.session = _create_student_session('tuning_student')
+        self.teacher = User.objects.get(username='tuning_student_teacher')
+        self.teacher.groups.add(Group.objects.get_or_create(name='Teachers')[0])
+
+    def _complete(self, scores, diagnosis_attempts, examination_attempts, session=None):
+        session = session or self.session
+        session.completed_at = datetime.now(dt_timezone.utc)
+        session.session_status = 'completed'
+        session.examination_score, session.diagnosis_score, session.treatment_score = scores
+        session.diagnosis_attempt_count = diagnosis_attempts
+        session.session_data = {'examination_selection_success': {'final_attempt': examination_attempts}}
+        session.save()
+        archive_run(session)
+
+    def test_update_failure_is_logged(self):
+        with mock.patch.object(CaseTuningSummary.objects, 'get_or_create', side_effect=DatabaseError('locked')):
+            with self.assertLogs('cases.case_tuning', 'ERROR'):
+                self._complete((95, 100, 40), 1, 1)
+        self.assertFalse(CaseTuningSummary.objects.exists())
+
+    def test_incremental_matches_rebuild(self):
+        self._complete((95, 100, 40), 1, 1)
+        other = User.objects.create_user(username='tuning_other', password='pw')
+        session = StudentClinicalSession.objects.create(student=other, clinical_case=self.clinical_case)
+        self._complete((55, 60, 100), 7, 2, session)
+        summary = CaseTuningSummary.objects.get(clinical_case=self.clinical_case)
+        self.assertEqual(summary.runs_completed, 2)
+        self.assertEqual(summary.histograms['diagnosis_attempts'], [1, 0, 0, 0, 1])
+        self.assertEqual(summary.histograms['examination_score'][5], 1)
+        self.assertEqual(summary.histograms['diagnosis_score'][9], 1)
+
+        incremental = (summary.histograms, summary.sums)
+        rebuild_case_tuning()
+        summary = CaseTuningSummary.objects.get(clinical_case=self.clinical_case)
+        self.assertEqual((summary.runs_completed, summary.histograms, summary.sums), (2, *incremental))
+
+        from django.db.migrations.loader import MigrationLoader
+
+        CaseTuningSummary.objects.all().delete()
+        migration = importlib.import_module('cases.migrations.0035_case_tuning_summary')
+        migration.backfill_case_tuning(
+            MigrationLoader(connection).project_state(('cases', '0035_case_tuning_summary')).apps, None
+        )
+        summary = CaseTuningSummary.objects.get(clinical_case=self.clinical_case)
+        self.assertEqual((summary.runs_completed, summary.histograms, summary.sums), (2, *incremental))
+
+    def test_teacher_api(self):
+        self._complete((80, 80, 80), 2, 1)
+        self.client.force_login(self.teacher)
+        url = f'/api/teacher/clinical-cases/{self.clinical_case.case_id}/tuning/'
+        self.client.get(url)
+        with self.assertNumQueries(5):  # 会话、用户、分组判断、病例 + 摘要一次
+            data = self.client.get(url).json()['data']
+        attempts = data['histograms']['diagnosis_attempts']
+        self.assertEqual((data['runs_completed'], attempts['counts'][1], attempts['first_try_rate']), (1, 1, 0.0))
+        self.assertEqual(attempts['bins'][-1], '5+')
+        self.assertEqual(data['histograms']['examination_score']['mean'], 80)
+        page = self.client.get(f'/teacher/clinical-cases/{self.clinical_case.case_id}/tuning/')
+        self.assertContains(page, '诊断尝试次数')
+
+
+class LiveMonitorTests(TestCase):
+    """课堂实时监控：快照之后只推送事件，不再查询"""
+
+    def setUp(self):
+        self.student, self.clinical_case, self.session = _create_student_session('monitor_student')
+        teacher = User.objects.get(username='monitor_student_teacher')
+        teacher.groups.add(Group.objects.get_or_create(name='Teachers')[0])
+        self.client.force_login(teacher)
+
+    def _close(self, response):
+        # 未读完的流式响应直接关闭时会发送 request_finished，由 close_old_connections 关掉测试数据库连接
+        with mock.patch.object(request_finished, 'send'):
+            response.close()
+
+    def _advance(self, status):
+        session = StudentClinicalSession.objects.get(pk=self.session.pk)
+        session.session_status = status
+        with self.captureOnCommitCallbacks(execute=True):
+            save_session(session)
+
+    def test_hub_publishes_stage_changes(self):
+        subscription = monitor_hub.subscribe(Subscription(self.clinical_case.pk))
+        try:
+            self._advance('diagnosis_reasoning')
+            event = subscription.get(0)
+            self.assertEqual((event['type'], event['stage'], event['student']), ('session', 'diagnosis_reasoning', 'monitor_student'))
+            self.assertIsNone(subscription.get(0))
+        finally:
+            monitor_hub.unsubscribe(subscription)
+
+        overflow = Subscription(maxsize=1)
+        overflow.deliver({})
+        overflow.deliver({})
+        self.assertTrue(overflow.lagged)
+
+    def test_queues_and_labels_are_bounded(self):
+        unbounded = Subscription(maxsize=0)
+        unbounded.deliver({})
+        unbounded.deliver({})
+        self.assertEqual((unbounded.maxsize, unbounded.lagged), (1, True))
+
+        async def fill():
+            subscription = AsyncSubscription(maxsize=2)
+            for _ in range(3):
+                subscription.deliver({})
+            await asyncio.sleep(0)
+            return subscription._queue.qsize(), subscription.lagged
+        self.assertEqual(asyncio.run(fill()), (2, True))
+
+        hub = MonitorHub()
+        with mock.patch('cases.live_monitor.MONITOR_LABEL_CACHE_SIZE', 2):
+            for pk in (1, 2, 1, 3):
+                hub.label('student', pk, lambda pk=pk: f's{pk}')
+        self.assertEqual(list(hub._labels), [('student', 1), ('student', 3)])
+
+    def test_stream_snapshot_then_events(self):
+        self.assertEqual(self.client.get('/teacher/live-monitor/').status_code, 200)
+        response = self.client.get('/teacher/live-monitor/stream/', {'case_id': self.clinical_case.case_id})
+        self.assertEqual(response['Content-Type'], 'text/event-stream; charset=utf-8')
+        chunks = iter(response.streaming_content)
+        next(chunks)
+        snapshot = next(chunks).decode()
+        self.assertTrue(snapshot.startswith('event: snapshot\n'))
+        self.assertEqual(json.loads(snapshot.split('data: ', 1)[1])['sessions'][0]['session_id'], self.session.pk)
+
+        self._advance('treatment_selection')
+        with self.assertNumQueries(0):
+            event = next(chunks).decode()
+        self.assertIn('"stage": "treatment_selection"', event)
+        self._close(response)
+        self.assertEqual(monitor_hub.subscriber_count, 0)
+
+    @mock.patch('cases.live_monitor.MONITOR_MAX_SYNC_STREAMS', 1)
+    def test_sync_streams_are_capped(self):
+        first = self.client.get('/teacher/live-monitor/stream/')
+        busy = self.client.get('/teacher/live-monitor/stream/')
+        self.assertEqual(busy.status_code, 503)
+        self.assertEqual(busy['Retry-After'], '30')
+        # 尚未开始发送的连接关闭时同样归还名额
+        self._close(first)
+        second = self.client.get('/teacher/live-monitor/stream/')
+        self.assertEqual(second.status_code, 200)
+        self._close(second)
+
+
+class StatsSnapshotTests(TestCase):
+    """统计快照：新鲜时不查询，过期时先返回旧值再由后台线程重算"""
+
+    def setUp(self):
+        cache.clear()
+
+    def _join_refresh(self):
+        for thread in threading.enumerate():
+            if thread.name == 'stats-snapshot-refresh':
+                thread.join(5)
+
+    def test_stale_while_revalidate(self):
+        first = stats_snapshot()
+        with self.assertNumQueries(0):
+            self.assertEqual(stats_snapshot(), first)
+
+        User.objects.create_user(username='snapshot_user', password='pw')
+        refreshed = dict(first, total_users=first['total_users'] + 1)
+        with mock.patch('cases.stats_snapshot.compute_stats_snapshot', return_value=refreshed) as compute:
+            with self.assertNumQueries(0):
+                self.assertEqual(stats_snapshot()['total_users'], first['total_users'])
+            self._join_refresh()
+            self.assertEqual(compute.call_count, 1)
+        self.assertEqual(stats_snapshot()['total_users'], first['total_users'] + 1)
+
+    def test_refresh_failure_is_logged(self):
+        from cases.stats_snapshot import _refresh_worker
+
+        # 与实际一样在后台线程中运行（线程结束时关闭自己的数据库连接）
+        with mock.patch('cases.stats_snapshot.compute_stats_snapshot', side_effect=DatabaseError('locked')):
+            with self.assertLogs('cases.stats_snapshot', 'ERROR'):
+                worker = threading.Thread(target=_refresh_worker)
+                worker.start()
+                worker.join(5)
+
+    def test_teacher_pages_read_snapshot(self):
+        teacher = User.objects.create_user(username='snapshot_teacher', password='pw')
+        teacher.groups.add(Group.objects.get_or_create(name='Teachers')[0])
+        User.objects.create_user(username='snapshot_student').groups.add(Group.objects.get_or_create(name='Students')[0])
+        self.client.force_login(teacher)
+        response = self.client.get('/system/')
+        self.assertEqual((response.context['stats']['total_teachers'], response.context['stats']['total_students']), (1, 1))
+        self.assertEqual(self.client.get('/teacher/').context['total_students'], 1)
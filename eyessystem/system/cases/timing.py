@@ -0,0 +1,448 @@
+"""
+会话计时引擎
+复盘、学习进度、学习时长统计共用同一套口径：
+- 本轮起点：run_started_at，缺失时取 stage_times 最早时间，最后回退 started_at
+- 结束时间：max(completed_at, last_activity)
+- 阶段开始：stage_start_times 优先，其次 stage_times 中 *_to_<stage> 的首次进入；
+  case_presentation 缺失时用本轮起点
+- 阶段结束：开始之后最近的下一事件（其他阶段开始/会话结束）
+- 阶段用时为负或超过 24h 视为异常（返回 None）
+
+TimingEngine.timing() 每个会话只解析一次，按 (session.id, last_activity, completed_at, 心跳修订号) 缓存；
+TimingEngine.bulk() 批量计算，阶段窗口部分用 NumPy 向量化（未安装 numpy 时逐条计算）
+"""
+import re
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.utils import timezone
+
+from .stage_events import prefetch_legacy_timing, timing_session_data, typed_timing
+
+
+MAJOR_STAGES = ('case_presentation', 'examination_selection', 'diagnosis_reasoning', 'treatment_selection', 'learning_feedback')
+MAX_DURATION_MS = 24 * 60 * 60 * 1000
+
+# 单阶段用时允许超过总用时的误差（毫秒），仅用于异常标记
+TOTAL_TOLERANCE_MS = 30_000
+
+_TRANSITION_KEY_RE = re.compile(r'^(.+)_to_(.+)$')
+_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+_ONE_US = timedelta(microseconds=1)
+
+
+def parse_iso(value):
+    """解析 ISO 时间字符串，naive 时间按当前时区处理；失败返回 None"""
+    if not value:
+        return None
+    try:
+        dt = timezone.datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+        if timezone.is_naive(dt):
+            dt = timezone.make_aware(dt, timezone.get_current_timezone())
+        return dt
+    except Exception:
+        return None
+
+
+def _us(dt):
+    """datetime -> 整数微秒（避免浮点误差）"""
+    return (dt - _EPOCH) // _ONE_US
+
+
+def _elapsed_ms(start, end):
+    return (_us(end) - _us(start)) // 1000
+
+
+def _filter_by_run(raw, parsed, run_start):
+    """按本轮起点过滤旧 timing（避免历史污染），无法解析的值原样保留"""
+    if not isinstance(raw, dict) or not raw or not run_start:
+        return raw
+    return {k: v for k, v in raw.items() if parsed.get(str(k)) is None or parsed[str(k)] >= run_start}
+
+
+def parse_timing(session_data, started_at=None, completed_at=None, last_activity=None, typed=None):
+    """
+    解析阶段：把 session_data 中的计时字段解析为阶段开始时间等（每个值只解析一次）
+    typed 为 stage_events.typed_timing() 的 datetime 版本，提供时直接使用，不再解析 ISO 字符串
+
+    Returns:
+        dict: run_started_at / session_started_at / end_time / session_total_ms / study_seconds /
+              stage_times / stage_start_times（本轮、原始字符串）/ inferred_to_stage / stage_start_dt
+    """
+    session_data = session_data or {}
+    raw_stage_times = session_data.get('stage_times')
+    raw_stage_start_times = session_data.get('stage_start_times')
+    st = raw_stage_times if isinstance(raw_stage_times, dict) else {}
+    sst = raw_stage_start_times if isinstance(raw_stage_start_times, dict) else {}
+    if typed is not None:
+        parsed_st = typed['stage_times']
+        parsed_sst = typed['stage_start_times']
+        run_started_at = typed['run_started_at']
+    else:
+        parsed_st = {str(k): parse_iso(v) for k, v in st.items()}
+        parsed_sst = {str(k): parse_iso(v) for k, v in sst.items()}
+        run_started_at = parse_iso(session_data.get('run_started_at'))
+    end_candidates = [t for t in (completed_at, last_activity) if t is not None]
+    end_time = max(end_candidates) if end_candidates else None
+
+    # 本轮起点兜底：stage_times 最早时间戳，最后才回退 started_at（会话创建时间，可能偏旧）
+    session_started_at = run_started_at
+    if session_started_at is None:
+        parsed_values = [v for v in parsed_st.values() if v is not None]
+        session_started_at = min(parsed_values) if parsed_values else started_at
+
+    session_total_ms = None
+    if session_started_at and end_time and end_time >= session_started_at:
+        session_total_ms = _elapsed_ms(session_started_at, end_time)
+
+    # 学习时长只认显式的本轮起点，其次 started_at；非正或超 24h 视为无效
+    study_seconds = None
+    study_start = run_started_at or started_at
+    if study_start and end_time:
+        seconds = (end_time - study_start).total_seconds()
+        if 0 < seconds <= MAX_DURATION_MS / 1000:
+            study_seconds = seconds
+
+    stage_times = _filter_by_run(raw_stage_times, parsed_st, run_started_at)
+    stage_start_times = _filter_by_run(raw_stage_start_times, parsed_sst, run_started_at)
+
+    # 由 stage_times（key: old_to_new）反推每个阶段的首次进入时间
+    inferred_to_stage = {}
+    for key in (stage_times or {}):
+        match = _TRANSITION_KEY_RE.match(str(key))
+        dtv = parsed_st.get(str(key))
+        if not match or dtv is None:
+            continue
+        to_stage = match.group(2)
+        if to_stage not in inferred_to_stage or dtv < inferred_to_stage[to_stage]:
+            inferred_to_stage[to_stage] = dtv
+
+    kept_sst = {str(k) for k in (stage_start_times or {})}
+    stage_start_dt = {}
+    for stage in MAJOR_STAGES:
+        dtv = (parsed_sst.get(stage) if stage in kept_sst else None) or inferred_to_stage.get(stage)
+        if dtv is None and stage == 'case_presentation':
+            dtv = session_started_at
+        stage_start_dt[stage] = dtv
+
+    return {
+        'run_started_at': run_started_at,
+        'session_started_at': session_started_at,
+        'end_time': end_time,
+        'session_total_ms': session_total_ms,
+        'study_seconds': study_seconds,
+        'stage_times': stage_times,
+        'stage_start_times': stage_start_times,
+        'inferred_to_stage': inferred_to_stage,
+        'stage_start_dt': stage_start_dt,
+    }
+
+
+def stage_windows(stage_start_dt, end_time, session_total_ms=None):
+    """
+    窗口阶段：根据各阶段开始时间计算结束时间与用时
+
+    Returns:
+        dict: stage_end_dt / stage_elapsed_ms（未做 24h 裁剪，调试用）/ stage_durations_ms / stage_anomalies
+    """
+    starts = [dt for dt in stage_start_dt.values() if dt is not None]
+    stage_end_dt = {}
+    stage_elapsed_ms = {}
+    stage_durations_ms = {}
+    stage_anomalies = {}
+    for stage in MAJOR_STAGES:
+        sdt = stage_start_dt.get(stage)
+        if sdt is None:
+            stage_end_dt[stage] = None
+        else:
+            candidates = [dt for dt in starts if dt > sdt]
+            if end_time is not None and end_time > sdt:
+                candidates.append(end_time)
+            stage_end_dt[stage] = min(candidates) if candidates else end_time
+
+        edt = stage_end_dt[stage]
+        stage_elapsed_ms[stage] = None
+        stage_durations_ms[stage] = None
+        if not sdt or not edt:
+            stage_anomalies[stage] = 'missing_start_or_end'
+            continue
+        if edt < sdt:
+            stage_anomalies[stage] = 'end_before_start'
+            continue
+        ms = _elapsed_ms(sdt, edt)
+        stage_elapsed_ms[stage] = ms
+        if ms > MAX_DURATION_MS:
+            stage_anomalies[stage] = 'duration_gt_24h'
+        else:
+            stage_durations_ms[stage] = ms
+        if isinstance(session_total_ms, int) and session_total_ms >= 0 and ms > session_total_ms + TOTAL_TOLERANCE_MS:
+            stage_anomalies[stage] = (stage_anomalies.get(stage) or '') + '|duration_gt_total'
+
+    return {
+        'stage_end_dt': stage_end_dt,
+        'stage_elapsed_ms': stage_elapsed_ms,
+        'stage_durations_ms': stage_durations_ms,
+        'stage_anomalies': stage_anomalies,
+    }
+
+
+def bulk_stage_durations(start_rows, end_times):
+    """
+    向量化计算多会话的阶段用时（需要 numpy），结果与 stage_windows() 的 stage_durations_ms 一致
+
+    Args:
+        start_rows: 每个会话一行，按 MAJOR_STAGES 顺序的阶段开始时间（datetime 或 None）
+        end_times: 每个会话的结束时间（datetime 或 None）
+
+    Returns:
+        list[dict]: 每个会话 {stage: ms 或 None}
+    """
+    import numpy as np
+
+    n = len(start_rows)
+    if n == 0:
+        return []
+    # 微秒时间戳在 float64 的精确整数范围内，用 NaN 表示缺失
+    starts = np.array(
+        [[_us(dt) if dt is not None else np.nan for dt in row] for row in start_rows], dtype=float
+    ).reshape(n, len(MAJOR_STAGES))
+    ends = np.array([_us(dt) if dt is not None else np.nan for dt in end_times], dtype=float)
+
+    own = starts[:, :, None]
+    later_starts = np.where(starts[:, None, :] > own, starts[:, None, :], np.inf).min(axis=2)
+    later_end = np.where(ends[:, None] > starts, ends[:, None], np.inf)
+    nearest = np.minimum(later_starts, later_end)
+    stage_ends = np.where(np.isinf(nearest), ends[:, None], nearest)
+
+    with np.errstate(invalid='ignore'):
+        elapsed = np.floor_divide(stage_ends - starts, 1000)
+        valid = ~np.isnan(starts) & ~np.isnan(stage_ends) & (stage_ends >= starts) & (elapsed <= MAX_DURATION_MS)
+    elapsed = np.where(valid, elapsed, 0).astype(np.int64)
+
+    return [
+        {stage: (int(elapsed[i, j]) if valid[i, j] else None) for j, stage in enumerate(MAJOR_STAGES)}
+        for i in range(n)
+    ]
+
+
+class TimingEngine:
+    """
+    会话计时引擎（进程内 LRU 缓存）
+    缓存键为 (session.id, last_activity, completed_at, 心跳修订号)：阶段切换/提交刷新 last_activity，
+    完成/重新开始改变 completed_at，心跳计入有效时长改变修订号，旧结果自然失效
+    """
+
+    def __init__(self, max_entries=2048):
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+
+    @staticmethod
+    def _key(session, revision=None):
+        return (session.pk, getattr(session, 'last_activity', None), getattr(session, 'completed_at', None), revision)
+
+    def _get(self, key):
+        result = self._cache.get(key)
+        if result is not None:
+            self._cache.move_to_end(key)
+        return result
+
+    def _put(self, key, result):
+        if key[0] is None:
+            return
+        self._cache[key] = result
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    def _parse(self, session):
+        return parse_timing(
+            timing_session_data(session),
+            started_at=getattr(session, 'started_at', None),
+            completed_at=getattr(session, 'completed_at', None),
+            last_activity=getattr(session, 'last_activity', None),
+            typed=typed_timing(session),
+        )
+
+    def timing(self, session):
+        """单个会话的完整计时结果（只读，勿修改返回的 dict）"""
+        from .heartbeat import active_revision
+        key = self._key(session, active_revision(session.pk) if session.pk is not None else None)
+        result = self._get(key)
+        if result is None:
+            result = self._parse(session)
+            result.update(stage_windows(result['stage_start_dt'], result['end_time'], result['session_total_ms']))
+            self._put(key, result)
+        return result
+
+    def bulk(self, sessions):
+        """
+        批量计算（教师端列表、导出用），返回 {session.id: {'session_total_ms', 'study_seconds', 'stage_durations_ms'}}
+        已缓存的会话直接复用（心跳修订号一次查询取回），其余一次预取阶段事件后向量化计算阶段用时
+        """
+        from .heartbeat import active_revisions
+        sessions = [s for s in sessions if s is not None]
+        revisions = active_revisions([s.pk for s in sessions if s.pk is not None]) if sessions else {}
+        results = {}
+        pending = []
+        for session in sessions:
+            cached = self._get(self._key(session, revisions.get(session.pk)))
+            if cached is not None:
+                results[session.pk] = cached
+            else:
+                pending.append(session)
+
+        if pending:
+            prefetch_legacy_timing(pending)
+            parsed = [self._parse(session) for session in pending]
+            try:
+                durations = bulk_stage_durations(
+                    [[p['stage_start_dt'][stage] for stage in MAJOR_STAGES] for p in parsed],
+                    [p['end_time'] for p in parsed],
+                )
+            except ImportError:
+                durations = [stage_windows(p['stage_start_dt'], p['end_time'])['stage_durations_ms'] for p in parsed]
+            for session, p, stage_durations_ms in zip(pending, parsed, durations):
+                p['stage_durations_ms'] = stage_durations_ms
+                results[session.pk] = p
+
+        return {
+            pk: {
+                'session_total_ms': r['session_total_ms'],
+                'study_seconds': r['study_seconds'],
+                'stage_durations_ms': r['stage_durations_ms'],
+            }
+            for pk, r in results.items()
+        }
+
+    def clear(self):
+        self._cache.clear()
+
+
+timing_engine = TimingEngine()
+
+
+def study_minutes(timing):
+    """单个会话的学习时长（分钟，四舍五入），无法计算返回 None"""
+    seconds = timing.get('study_seconds')
+    if seconds is None:
+        return None
+    return int(round(seconds / 60))
+
+
+# 完成时写入会话的各阶段分钟数字段
+STAGE_MINUTES_FIELDS = {
+    'case_presentation': 'case_presentation_minutes',
+    'examination_selection': 'examination_minutes',
+    'diagnosis_reasoning': 'diagnosis_minutes',
+    'treatment_selection': 'treatment_minutes',
+    'learning_feedback': 'feedback_minutes',
+}
+STUDY_MINUTES_FIELDS = ('study_minutes',) + tuple(STAGE_MINUTES_FIELDS.values())
+
+
+def study_minutes_values(timing):
+    """计时结果 -> 学习时长字段值（分钟，保留小数，汇总时再取整）"""
+    seconds = timing.get('study_seconds')
+    durations = timing.get('stage_durations_ms') or {}
+    values = {'study_minutes': seconds / 60 if seconds is not None else None}
+    for stage, field in STAGE_MINUTES_FIELDS.items():
+        ms = durations.get(stage)
+        values[field] = ms / 60000 if ms is not None else None
+    return values
+
+
+def apply_study_minutes(session, end_time=None):
+    """
+    本轮完成时调用（保存前）：按统一口径计算学习时长并写到会话字段上
+    end_time 为本次保存时的 last_activity（缺省为当前时间）；有心跳记录时以有效学习时长为准
+
+    Returns:
+        tuple: 被修改的字段名，便于 save(update_fields=...)
+    """
+    end_time = end_time or timezone.now()
+    parsed = parse_timing(
+        timing_session_data(session),
+        started_at=getattr(session, 'started_at', None),
+        completed_at=getattr(session, 'completed_at', None),
+        last_activity=end_time,
+        typed=typed_timing(session),
+    )
+    parsed.update(stage_windows(parsed['stage_start_dt'], parsed['end_time']))
+    values = study_minutes_values(parsed)
+
+    # 有心跳记录时改用有效学习时长（挂机、离开页面的时间不计入）
+    from .heartbeat import active_seconds
+    active = active_seconds(session)
+    if active:
+        values['study_minutes'] = sum(active.values()) / 60
+        for stage, field in STAGE_MINUTES_FIELDS.items():
+            values[field] = active[stage] / 60 if stage in active else None
+
+    for field, value in values.items():
+        setattr(session, field, value)
+    return STUDY_MINUTES_FIELDS
+
+
+def refresh_study_minutes(session, end_time=None):
+    """
+    已完成的会话在完成后仍有活动（停留在学习反馈页）时调用：按 max(completed_at, end_time) 重新计算，
+    与完成前一样把学习反馈阶段计入；未完成的会话不处理
+
+    Returns:
+        tuple: 被修改的字段名
+    """
+    if getattr(session, 'completed_at', None) is None:
+        return ()
+    return apply_study_minutes(session, max(session.completed_at, end_time or timezone.now()))
+
+
+def clear_study_minutes(session):
+    """开始新一轮时清空上一轮的学习时长"""
+    for field in STUDY_MINUTES_FIELDS:
+        setattr(session, field, None)
+    return STUDY_MINUTES_FIELDS
+
+
+def debug_timing(session, timing):
+    """开发模式下 get-progress?debug_time=1 的计时明细"""
+    from django.conf import settings
+
+    session_data = timing_session_data(session)
+
+    def iso(dt):
+        return dt.isoformat() if dt else None
+
+    raw_stage_start_times = session_data.get('stage_start_times') if isinstance(session_data.get('stage_start_times'), dict) else {}
+    return {
+        'tz': {
+            'USE_TZ': bool(getattr(settings, 'USE_TZ', False)),
+            'TIME_ZONE': str(getattr(settings, 'TIME_ZONE', '')),
+            'now_iso': timezone.now().isoformat(),
+        },
+        'session_fields': {
+            'session_status': getattr(session, 'session_status', None),
+            'started_at': iso(getattr(session, 'started_at', None)),
+            'completed_at': iso(getattr(session, 'completed_at', None)),
+            'last_activity': iso(getattr(session, 'last_activity', None)),
+        },
+        'run_started_at': {
+            'raw': session_data.get('run_started_at'),
+            'parsed': iso(timing['session_started_at']),
+        },
+        'stage_start_times': {
+            'raw': raw_stage_start_times,
+            'parsed': {str(k): iso(parse_iso(v)) for k, v in raw_stage_start_times.items()},
+        },
+        'stage_times': {
+            'raw': session_data.get('stage_times') if isinstance(session_data.get('stage_times'), dict) else {},
+            'inferred_to_stage_first_enter': {k: iso(v) for k, v in timing['inferred_to_stage'].items()},
+        },
+        'derived': {
+            'end_time_used': iso(timing['end_time']),
+            'session_total_ms': timing['session_total_ms'],
+            'stage_start_dt': {k: iso(v) for k, v in timing['stage_start_dt'].items()},
+            'stage_end_dt': {k: iso(v) for k, v in timing['stage_end_dt'].items()},
+            'stage_durations_ms': timing['stage_elapsed_ms'],
+            'stage_anomalies': timing['stage_anomalies'],
+        },
+    }
@@ -7,10 +7,22 @@ from django.http import JsonResponse
 from django.shortcuts import get_object_or_404
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.views.decorators.http import require_POST, require_http_methods
+from django.db import transaction
 from django.utils import timezone
 from cases.models import ClinicalCase, TreatmentOption, StudentClinicalSession
+from cases.distractors import sample_treatment_distractors
+from cases import scoring
+from cases.concurrency import SessionConflictError, save_session
+from cases.item_analysis import record_option_exposures, stash_option_exposure
+from cases.stage_events import (
+    EVENT_RUN_START, EVENT_STAGE_ENTER, EVENT_TRANSITION, apply_event_columns, legacy_timing, new_event, to_ms,
+    write_events,
+)
+from cases.review import apply_review_snapshot
+from cases.session_runs import archive_run
+from cases.state_machine import stage_required
+from cases.timing import apply_study_minutes
 import json
-from difflib import SequenceMatcher
 
 
 def is_student(user):
@@ -42,27 +54,24 @@ def get_treatment_options(request, case_id):
                 'message': '该病例没有设置最佳治疗方案，请联系教师'
             }, status=400)
         
-        # 2. 从其他病例中随机选择最佳治疗作为干扰项（排除当前病例）
+        # 2. 从干扰项池中抽取其他病例的最佳治疗作为干扰项（排除当前病例与同名治疗）
+        #    干扰项池写入时已按名称去重，这里每个桶一次 COUNT、每个干扰项一次随机偏移取行，查询数不随池大小增长
+        #    可选参数：strata=surgery,medication 分层抽样；difficulty=easy 限定难度
         distractor_count = 3  # 干扰项数量
-        distractor_treatments = list(TreatmentOption.objects.filter(
-            is_optimal=True
-        ).exclude(
-            clinical_case=clinical_case
-        ))
-        
-        # 排除同名治疗
+        strata = [s.strip() for s in request.GET.get('strata', '').split(',') if s.strip()]
         optimal_names = {t.treatment_name for t in optimal_treatments}
-        distractor_treatments = [t for t in distractor_treatments if t.treatment_name not in optimal_names]
-        
-        # 随机选择干扰项
-        if len(distractor_treatments) > distractor_count:
-            selected_distractors = random.sample(distractor_treatments, distractor_count)
-        else:
-            selected_distractors = distractor_treatments
+        selected_distractors = sample_treatment_distractors(
+            clinical_case,
+            exclude_names=optimal_names,
+            count=distractor_count,
+            strata=strata,
+            difficulty_level=request.GET.get('difficulty') or None,
+        )
         
         # 3. 合并选项并随机排序
         all_options = optimal_treatments + selected_distractors
         random.shuffle(all_options)
+        stash_option_exposure(request, clinical_case, 'treatment', all_options)
         
         # 4. 构建返回数据（包含所有必要字段用于前端显示）
         options_data = [{
@@ -99,6 +108,7 @@ def get_treatment_options(request, case_id):
 @require_POST
 @login_required
 @user_passes_test(is_student, login_url='login')
+@stage_required('submit_treatment')
 def submit_treatment(request, case_id):
     """提交治疗方案并评分"""
     try:
@@ -153,20 +163,13 @@ def submit_treatment(request, case_id):
         
         # 正确选择的治疗（在最佳治疗列表中）
         correct_selections = selected_ids & optimal_treatments
-        # 错误选择的治疗（不在最佳治疗列表中）
-        incorrect_selections = selected_ids - optimal_treatments
-        # 遗漏的治疗（在最佳治疗中但未选）
-        missed_selections = optimal_treatments - selected_ids
         
-        # 治疗选择得分计算
-        if len(optimal_treatments) == 0:
-            treatment_score = 0
-        else:
-            # 基础分：正确率
-            correct_rate = len(correct_selections) / len(optimal_treatments)
-            # 扣分：错误选择和遗漏
-            penalty = (len(incorrect_selections) + len(missed_selections)) * 0.1
-            treatment_score = max(0, (correct_rate - penalty)) * 100
+        # 记录本次作答分布（干扰项分析）
+        record_option_exposures(request, session, 'treatment', treatment_ids, optimal_treatments)
+        
+        # 治疗选择得分：正确率 - 0.1 ×（错选数 + 漏选数）
+        treatment_result = scoring.treatment_set_score(selected_ids, optimal_treatments)
+        treatment_score = treatment_result['score']
         
         # 3. 治疗依据评分（基于文本相似度）
         # 使用第一个正确选择的治疗的依据作为参考
@@ -184,20 +187,17 @@ def submit_treatment(request, case_id):
             rationale_score = 0
         
         # 4. 总分计算（治疗选择占70%，依据占30%）
-        total_score = treatment_score * 0.7 + rationale_score * 0.3
+        total_score = scoring.combine_choice_and_rationale(treatment_score, rationale_score)
         
         # 5. 判断是否完全正确
-        is_perfect = (
-            len(correct_selections) == len(optimal_treatments) and
-            len(incorrect_selections) == 0
-        )
+        is_perfect = treatment_result['is_perfect']
         
         # 6. 生成反馈
         feedback = generate_treatment_feedback(
             is_perfect,
-            len(correct_selections),
+            treatment_result['correct_count'],
             len(optimal_treatments),
-            len(incorrect_selections),
+            treatment_result['incorrect_count'],
             rationale_score,
             selected_treatments
         )
@@ -211,9 +211,9 @@ def submit_treatment(request, case_id):
             'treatment_names': [t.treatment_name for t in selected_treatments],
             'treatment_rationale': treatment_rationale,
             'is_perfect': is_perfect,
-            'correct_count': len(correct_selections),
-            'incorrect_count': len(incorrect_selections),
-            'missed_count': len(missed_selections),
+            'correct_count': treatment_result['correct_count'],
+            'incorrect_count': treatment_result['incorrect_count'],
+            'missed_count': treatment_result['missed_count'],
             'treatment_score': round(treatment_score, 2),
             'rationale_score': round(rationale_score, 2),
             'total_score': round(total_score, 2)
@@ -223,9 +223,9 @@ def submit_treatment(request, case_id):
         session.selected_treatments = list(treatment_ids)
         session.treatment_score = round(total_score, 2)
 
+        events = []
         if is_perfect:
             now = timezone.now()
-            now_iso = now.isoformat()
             old_stage = getattr(session, 'session_status', None)
 
             # 通过后端统一计算总体得分，避免前端出现“总分=0”的默认值问题
@@ -233,35 +233,36 @@ def submit_treatment(request, case_id):
             session.completed_at = now
             session.session_status = 'learning_feedback'
 
-            # 同步更新 last_activity / stage_start_times / stage_times，避免“完成时间早于学习反馈开始时间”
+            # 同步更新 last_activity 并记录进入学习反馈的阶段事件，避免“完成时间早于学习反馈开始时间”
             try:
                 if hasattr(session, 'last_activity'):
                     session.last_activity = now
             except Exception:
                 pass
 
-            try:
-                if not session.session_data:
-                    session.session_data = {}
-                if not session.session_data.get('run_started_at'):
-                    session.session_data['run_started_at'] = now_iso
-
-                stage_start_times = session.session_data.get('stage_start_times')
-                if not isinstance(stage_start_times, dict):
-                    stage_start_times = {}
-                if not stage_start_times.get('learning_feedback'):
-                    stage_start_times['learning_feedback'] = now_iso
-                session.session_data['stage_start_times'] = stage_start_times
+            now_ms = to_ms(now)
+            timing = legacy_timing(session)
+            run = timing.get('run') or 0
+            if not timing.get('run_started_at'):
+                run += 1
+                events.append(new_event(session, run, 'case_presentation', EVENT_RUN_START, now_ms))
+                timing = {}
+            if not (timing.get('stage_start_times') or {}).get('learning_feedback'):
+                events.append(new_event(session, run, 'learning_feedback', EVENT_STAGE_ENTER, now_ms))
+            if old_stage and old_stage != 'learning_feedback':
+                events.append(new_event(session, run, 'learning_feedback', EVENT_TRANSITION, now_ms, from_stage=old_stage))
+            apply_event_columns(session, events)
 
-                if old_stage and old_stage != 'learning_feedback':
-                    stage_times = session.session_data.get('stage_times')
-                    if not isinstance(stage_times, dict):
-                        stage_times = {}
-                    stage_times[f'{old_stage}_to_learning_feedback'] = now_iso
-                    session.session_data['stage_times'] = stage_times
-            except Exception:
-                pass
-        session.save()
+        # 阶段事件与会话在同一事务中写入：任一失败都不会留下没有事件记录的阶段变化
+        with transaction.atomic():
+            if is_perfect:
+                # 学习时长与复盘快照按刚写入的事件计算
+                write_events(session, events)
+                apply_study_minutes(session, now)
+                apply_review_snapshot(session, now)
+            save_session(session)
+        if is_perfect:
+            archive_run(session)
 
         overall_feedback = None
         if is_perfect:
@@ -277,9 +278,9 @@ def submit_treatment(request, case_id):
             'success': True,
             'data': {
                 'is_perfect': is_perfect,
-                'correct_count': len(correct_selections),
+                'correct_count': treatment_result['correct_count'],
                 'total_optimal': len(optimal_treatments),
-                'incorrect_count': len(incorrect_selections),
+                'incorrect_count': treatment_result['incorrect_count'],
                 'treatment_score': round(treatment_score, 2),
                 'rationale_score': round(rationale_score, 2),
                 'total_score': round(total_score, 2),
@@ -303,6 +304,11 @@ def submit_treatment(request, case_id):
             'success': False,
             'message': '无效的JSON数据'
         }, status=400)
+    except SessionConflictError as e:
+        return JsonResponse({
+            'success': False,
+            'message': str(e)
+        }, status=409)
     except Exception as e:
         return JsonResponse({
             'success': False,
@@ -314,27 +320,9 @@ def calculate_rationale_score(student_rationale, correct_rationale, key_points_t
     """
     计算治疗依据得分（0-100）
     基于：文本相似度（60%）+ 关键点覆盖度（40%）
+    评分实现见 cases.scoring.core.treatment_rationale_score
     """
-    if not correct_rationale:
-        return 50.0  # 如果没有参考依据，给予基础分
-    
-    # 1. 文本相似度得分（60%）
-    similarity = SequenceMatcher(None, student_rationale.lower(), correct_rationale.lower()).ratio()
-    similarity_score = similarity * 60
-    
-    # 2. 关键点覆盖度得分（40%）
-    key_points_score = 0
-    if key_points_text:
-        key_points = [kp.strip() for kp in key_points_text.split('\n') if kp.strip()]
-        if key_points:
-            matched_points = sum(
-                1 for kp in key_points 
-                if kp.lower() in student_rationale.lower()
-            )
-            key_points_score = (matched_points / len(key_points)) * 40
-    
-    total_score = similarity_score + key_points_score
-    return round(total_score, 2)
+    return scoring.treatment_rationale_score(student_rationale, correct_rationale, key_points_text)
 
 
 def generate_treatment_feedback(is_perfect, correct_count, total_optimal, 
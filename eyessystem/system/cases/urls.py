@@ -40,6 +40,18 @@ urlpatterns = [
     path('teacher/clinical-cases/<str:case_id>/delete/', views.teacher_clinical_case_delete, name='teacher_clinical_case_delete'),
     path('teacher/clinical-cases/<str:case_id>/preview/', views.teacher_clinical_case_preview, name='teacher_clinical_case_preview'),
     path('teacher/clinical-cases/<str:case_id>/scores/', views.teacher_clinical_case_scores, name='teacher_clinical_case_scores'),
+    path('teacher/clinical-cases/<str:case_id>/scores/export/', views.teacher_clinical_case_scores_export, name='teacher_clinical_case_scores_export'),
+    path('teacher/exports/sessions/', views.teacher_sessions_export, name='teacher_sessions_export'),
+    path('teacher/analytics/', views.teacher_score_analytics, name='teacher_score_analytics'),
+    path('api/teacher/analytics/scores/', views.teacher_score_analytics_api, name='teacher_score_analytics_api'),
+    path('teacher/learning-profiles/', views.teacher_learning_profiles, name='teacher_learning_profiles'),
+    path('api/teacher/learning-profiles/', views.teacher_learning_profiles_api, name='teacher_learning_profiles_api'),
+    path('api/teacher/students/<int:student_id>/learning-profile/', views.teacher_student_learning_profile_api, name='teacher_student_learning_profile_api'),
+    path('teacher/live-monitor/', views.teacher_live_monitor, name='teacher_live_monitor'),
+    path('teacher/live-monitor/stream/', views.teacher_live_monitor_stream, name='teacher_live_monitor_stream'),
+    path('api/teacher/clinical-cases/<str:case_id>/item-analysis/', views.teacher_case_item_analysis, name='teacher_case_item_analysis'),
+    path('teacher/clinical-cases/<str:case_id>/tuning/', views.teacher_case_tuning, name='teacher_case_tuning'),
+    path('api/teacher/clinical-cases/<str:case_id>/tuning/', views.teacher_case_tuning_api, name='teacher_case_tuning_api'),
     
     # 教师端 - 检查选项管理
     path('teacher/clinical-cases/<str:case_id>/examinations/', views.teacher_examination_options, name='teacher_examination_options'),
@@ -93,6 +105,7 @@ urlpatterns = [
     
     # 会话管理API
     path('api/clinical/case/<str:case_id>/update-stage/', views.update_session_stage, name='update_session_stage'),
+    path('api/clinical/case/<str:case_id>/heartbeat/', views.session_heartbeat, name='session_heartbeat'),
     path('api/clinical/case/<str:case_id>/save-history/', views.save_history_summary, name='save_history_summary'),
     path('api/clinical/case/<str:case_id>/get-history/', views.get_history_summary, name='get_history_summary'),
     path('api/clinical/case/<str:case_id>/physical-exam/', views.get_physical_exam, name='get_physical_exam'),
@@ -2,19 +2,48 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import authenticate, login, logout, update_session_auth_hash
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib.auth.models import User, Group
-from django.http import JsonResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
 from django.views.decorators.http import require_POST, require_http_methods
 from django.contrib import messages
-from django.db.models import Q, Avg
+from django.db import transaction
+from django.db.models import Q, Avg, Sum, F, FloatField
+from django.db.models.functions import Cast, NullIf
 from django.utils import timezone
 from django.conf import settings
+from django.utils.http import parse_etags, quote_etag
 from .models import (
     ClinicalCase, ExaminationOption, DiagnosisOption, TreatmentOption, 
-    StudentClinicalSession, TeachingFeedback
+    StudentClinicalSession, TeachingFeedback, LearningNote, CaseCounters, StudentLearningProfile
 )
 from .models import ChatMessage, PatientResponseTemplate
+from .feedback import record_feedback, escape_template_text
+from .heartbeat import active_revision, heartbeat_buffer, normalize_stage
+from .hints import get_diagnosis_hint_ladder, ladder_guidance
+from .case_library import PAGE_SIZE as CASE_PAGE_SIZE, InvalidCursor, student_case_page
+from .case_counters import create_case_counters
+from .exports import ExportUnavailable, export_queryset, export_response
+from .learning_profiles import profile_summary
+from .case_tuning import tuning_summary
+from .live_monitor import MONITOR_BUSY_RETRY_SECONDS, MonitorBusy, astream_events, open_sync_stream
+from .score_analytics import AnalyticsUnavailable, score_analytics, session_ranks_page
+from .rollups import rollup_totals
+from .stats_snapshot import stats_snapshot
+from .student_stats import student_stats
+from .concurrency import SessionConflictError, save_session
+from .item_analysis import case_item_analysis, record_option_exposures, stash_option_exposure
+from .learning_notes import (
+    NotePatchError, NoteRevisionConflict, get_note, patch_note, replace_ops,
+)
+from .review import apply_review_snapshot, session_review
+from .session_runs import archive_run, run_history, start_new_run
+from .state_machine import STAGES, IllegalTransition, can_transition, frontend_stage, stage_allows, stage_required, transition
+from .stage_events import (
+    EVENT_RUN_START, EVENT_STAGE_ENTER, apply_event_columns, legacy_timing, new_event, to_ms, write_events,
+)
+from .timing import apply_study_minutes, debug_timing, study_minutes, timing_engine
+from . import scoring
 import json
-import re
 from datetime import datetime, timedelta
 from django.views.decorators.csrf import csrf_exempt
 
@@ -36,7 +65,7 @@ def validate_examination_selection(required_exam_ids, selected_exam_ids, require
     # 获取本次会话的提交尝试计数器
     current_attempt_count = session.session_data.get('examination_current_attempt_count', 0) + 1
     session.session_data['examination_current_attempt_count'] = current_attempt_count
-    session.save()
+    save_session(session)
     
     examination_errors = session.session_data.get('examination_selection_errors', [])
     attempt_count = current_attempt_count  # 使用当前会话的实际提交次数
@@ -160,7 +189,7 @@ def record_examination_error(session, validation_result):
     session.required_examinations_completed = False
     
     # 保存会话
-    session.save()
+    save_session(session)
     
     # 记录到step_completion_status中
     if 'examination_selection' not in session.step_completion_status:
@@ -172,7 +201,7 @@ def record_examination_error(session, validation_result):
         'last_error_time': timezone.now().isoformat()
     })
     
-    session.save()
+    save_session(session)
 
 
 def record_examination_success(session, final_attempt_count):
@@ -210,7 +239,7 @@ def record_examination_success(session, final_attempt_count):
         'performance_rating': calculate_performance_rating(final_attempt_count)
     })
     
-    session.save()
+    save_session(session)
 
 
 def calculate_performance_rating(attempt_count):
@@ -424,110 +453,38 @@ def _format_minutes_as_hm(total_minutes: int) -> str:
     return f"{minutes}min"
 
 
-def _parse_iso_dt(value):
-    if not value:
-        return None
-    try:
-        dt = timezone.datetime.fromisoformat(str(value).replace('Z', '+00:00'))
-        if timezone.is_naive(dt):
-            dt = timezone.make_aware(dt, timezone.get_current_timezone())
-        return dt
-    except Exception:
-        return None
+def _completed_sessions_q():
+    return Q(session_status='completed') | Q(completed_at__isnull=False)
 
 
 def _get_user_total_study_time_minutes(user) -> int:
-    """统一的学习时长口径（分钟），供教师端/学生端复用。"""
-    user_sessions = StudentClinicalSession.objects.filter(student=user)
-    completed_qs = user_sessions.filter(Q(session_status='completed') | Q(completed_at__isnull=False))
-
-    total_study_time = 0
-    for session in completed_qs:
-        start_time = None
-        try:
-            sd = getattr(session, 'session_data', None) or {}
-            start_time = _parse_iso_dt(sd.get('run_started_at'))
-        except Exception:
-            start_time = None
-
-        if not start_time:
-            start_time = getattr(session, 'started_at', None)
-        if not start_time:
-            continue
-
-        completed_at = getattr(session, 'completed_at', None)
-        last_activity = getattr(session, 'last_activity', None)
-        end_time = None
-        if completed_at and last_activity:
-            end_time = max(completed_at, last_activity)
-        else:
-            end_time = completed_at or last_activity
-        if not end_time:
-            continue
-
-        duration_seconds = (end_time - start_time).total_seconds()
-        if duration_seconds <= 0:
-            continue
-        if duration_seconds > 24 * 60 * 60:
-            continue
-
-        total_study_time += (duration_seconds / 60)
-
-    return int(round(total_study_time))
-
-
-def _get_session_study_time_minutes(session) -> int | None:
-    """单个会话（单病例）学习时长口径（分钟）。
-
-    口径与总学习时长一致：start=run_started_at 优先，其次 started_at；
-    end=max(completed_at,last_activity)；过滤非正值/超 24h 的异常数据。
-    返回 None 表示无法计算。
-    """
-    if session is None:
-        return None
-
-    start_time = None
-    try:
-        sd = getattr(session, 'session_data', None) or {}
-        start_time = _parse_iso_dt(sd.get('run_started_at'))
-    except Exception:
-        start_time = None
-
-    if not start_time:
-        start_time = getattr(session, 'started_at', None)
-    if not start_time:
-        return None
-
-    completed_at = getattr(session, 'completed_at', None)
-    last_activity = getattr(session, 'last_activity', None)
-    if completed_at and last_activity:
-        end_time = max(completed_at, last_activity)
-    else:
-        end_time = completed_at or last_activity
-    if not end_time:
-        return None
+    """统一的学习时长口径（分钟），供教师端/学生端复用；study_minutes 在本轮完成时写入。"""
+    total = (
+        StudentClinicalSession.objects.filter(_completed_sessions_q(), student=user)
+        .aggregate(total=Sum('study_minutes'))['total']
+    )
+    return int(round(total or 0))
 
-    duration_seconds = (end_time - start_time).total_seconds()
-    if duration_seconds <= 0:
-        return None
-    if duration_seconds > 24 * 60 * 60:
-        return None
 
-    return int(round(duration_seconds / 60))
+def _get_users_total_study_time_minutes(user_ids) -> dict:
+    """批量版本：一次 GROUP BY 查询返回 {student_id: 分钟}"""
+    rows = (
+        StudentClinicalSession.objects.filter(_completed_sessions_q(), student_id__in=user_ids)
+        .values('student_id')
+        .annotate(total=Sum('study_minutes'))
+    )
+    totals = {row['student_id']: int(round(row['total'] or 0)) for row in rows}
+    return {user_id: totals.get(user_id, 0) for user_id in user_ids}
 
 
-def _filter_timing_dict(raw_dict, run_start):
-    """按本轮 run_started_at 过滤旧 timing（避免历史污染）。"""
-    if not isinstance(raw_dict, dict) or not raw_dict:
-        return raw_dict
-    if not run_start:
-        return raw_dict
-    filtered = {}
-    for k, v in raw_dict.items():
-        dtv = _parse_iso_dt(v)
-        if dtv is None or dtv >= run_start:
-            filtered[str(k)] = v
-    return filtered
+def _sessions_study_minutes(sessions) -> dict:
+    """会话学习时长（分钟）：已完成的读取 study_minutes，其余按当前活动时间批量估算"""
+    sessions = list(sessions)
+    result = {s.pk: int(round(s.study_minutes)) for s in sessions if s.study_minutes is not None}
+    pending = [s for s in sessions if s.pk not in result]
+    for pk, timing in timing_engine.bulk(pending).items():
+        result[pk] = study_minutes(timing)
+    return result
 
 
 def _build_review_payload_for_session(session) -> dict:
@@ -536,114 +493,10 @@ def _build_review_payload_for_session(session) -> dict:
         return {}
 
     session_data = getattr(session, 'session_data', None) or {}
-
+    timing = timing_engine.timing(session)
     completed_at = getattr(session, 'completed_at', None)
     last_activity = getattr(session, 'last_activity', None)
-    end_time = None
-    try:
-        candidates = [t for t in (completed_at, last_activity) if t is not None]
-        if candidates:
-            end_time = max(candidates)
-    except Exception:
-        end_time = completed_at or last_activity
-
-    run_started_at = _parse_iso_dt(session_data.get('run_started_at'))
-    if run_started_at is None:
-        try:
-            st = session_data.get('stage_times') or {}
-            if isinstance(st, dict) and st:
-                parsed = [_parse_iso_dt(v) for v in st.values()]
-                parsed = [x for x in parsed if x is not None]
-                if parsed:
-                    run_started_at = min(parsed)
-        except Exception:
-            pass
-    if run_started_at is None:
-        run_started_at = getattr(session, 'started_at', None)
-
-    session_total_ms = None
-    if run_started_at and end_time and end_time >= run_started_at:
-        try:
-            session_total_ms = int((end_time - run_started_at).total_seconds() * 1000)
-        except Exception:
-            session_total_ms = None
-
-    stage_times = _filter_timing_dict(session_data.get('stage_times'), run_started_at)
-    stage_start_times = _filter_timing_dict(session_data.get('stage_start_times'), run_started_at)
-
-    # 后端权威口径：各阶段用时（毫秒）
-    stage_durations_ms = None
-    try:
-        end_time2 = end_time
-        run_started_at2 = run_started_at
-        if run_started_at2 is None:
-            try:
-                st2 = stage_times or {}
-                if isinstance(st2, dict) and st2:
-                    parsed2 = [_parse_iso_dt(v) for v in st2.values()]
-                    parsed2 = [x for x in parsed2 if x is not None]
-                    if parsed2:
-                        run_started_at2 = min(parsed2)
-            except Exception:
-                pass
-        if run_started_at2 is None:
-            run_started_at2 = getattr(session, 'started_at', None)
-
-        major_stages = ['case_presentation', 'examination_selection', 'diagnosis_reasoning', 'treatment_selection', 'learning_feedback']
-
-        # 计算阶段开始
-        stage_start_dt = {}
-        sst = stage_start_times or {}
-        if not isinstance(sst, dict):
-            sst = {}
-
-        inferred_to_stage = {}
-        st = stage_times or {}
-        if isinstance(st, dict):
-            for k, v in st.items():
-                m = re.match(r'^(.+)_to_(.+)$', str(k))
-                if not m:
-                    continue
-                to_stage = m.group(2)
-                dtv = _parse_iso_dt(v)
-                if dtv is None:
-                    continue
-                if to_stage not in inferred_to_stage or dtv < inferred_to_stage[to_stage]:
-                    inferred_to_stage[to_stage] = dtv
-
-        for stg in major_stages:
-            dtv = _parse_iso_dt(sst.get(stg)) or inferred_to_stage.get(stg)
-            if dtv is None and stg == 'case_presentation':
-                dtv = run_started_at2
-            stage_start_dt[stg] = dtv
-
-        # 计算阶段结束：开始之后最近的下一事件（其他阶段开始/会话结束）
-        stage_end_dt = {}
-        all_starts = [dt for dt in stage_start_dt.values() if dt is not None]
-        for stg in major_stages:
-            sdt = stage_start_dt.get(stg)
-            if sdt is None:
-                stage_end_dt[stg] = None
-                continue
-            candidates = [dt for dt in all_starts if dt > sdt]
-            if end_time2 is not None and end_time2 > sdt:
-                candidates.append(end_time2)
-            stage_end_dt[stg] = min(candidates) if candidates else end_time2
-
-        stage_durations_ms = {}
-        for stg in major_stages:
-            sdt = stage_start_dt.get(stg)
-            edt = stage_end_dt.get(stg)
-            if not sdt or not edt or edt < sdt:
-                stage_durations_ms[stg] = None
-                continue
-            ms = int((edt - sdt).total_seconds() * 1000)
-            if ms < 0 or ms > 24 * 60 * 60 * 1000:
-                stage_durations_ms[stg] = None
-            else:
-                stage_durations_ms[stg] = ms
-    except Exception:
-        stage_durations_ms = None
+    run_started_at = timing['session_started_at']
 
     # 检查选择详情
     selected_exam_ids = []
@@ -772,61 +625,20 @@ def _build_review_payload_for_session(session) -> dict:
         'diagnosis': diagnosis_record,
         'selected_treatments': selected_treatment_details,
         'treatment': treatment_record,
-        'stage_times': stage_times,
-        'stage_start_times': stage_start_times,
-        'stage_durations_ms': stage_durations_ms,
+        'stage_times': timing['stage_times'],
+        'stage_start_times': timing['stage_start_times'],
+        'stage_durations_ms': timing['stage_durations_ms'],
         'session_started_at': run_started_at.isoformat() if run_started_at else None,
         'session_completed_at': completed_at.isoformat() if completed_at else None,
         'session_last_activity_at': last_activity.isoformat() if last_activity else None,
-        'session_total_ms': session_total_ms,
+        'session_total_ms': timing['session_total_ms'],
     }
 
 
 def _get_student_clinical_stats(user):
-    """统一的学生端临床推理统计口径（dashboard 与 API 共用）"""
-    total_cases = ClinicalCase.objects.filter(is_active=True).count()
-    user_sessions = StudentClinicalSession.objects.filter(student=user)
-
-    completed_qs = user_sessions.filter(Q(session_status='completed') | Q(completed_at__isnull=False))
-    completed_cases = completed_qs.count()
-
-    progress_percentage = 0
-    if total_cases > 0:
-        progress_percentage = round((completed_cases / total_cases) * 100, 1)
-
-    # 平均分：只统计有有效得分的记录；优先使用已完成会话
-    avg_overall = (
-        completed_qs.filter(overall_score__gt=0)
-        .aggregate(Avg('overall_score'))
-        .get('overall_score__avg')
-        or 0
-    )
-
-    # 总学习时长（分钟）：使用“本轮学习起点 run_started_at”避免老会话 created_at/started_at 导致爆炸
-    total_study_time = _get_user_total_study_time_minutes(user)
-
-    stats = {
-        'total_cases': total_cases,
-        'completed_cases': completed_cases,
-        'progress_percentage': progress_percentage,
-        'total_study_time': total_study_time,
-        'formatted_study_time': _format_minutes_as_hm(total_study_time),
-        'average_score': round(avg_overall, 2),
-        'difficulty_progress': {
-            'beginner': {
-                'completed': completed_qs.filter(clinical_case__difficulty_level='beginner').count(),
-                'total': ClinicalCase.objects.filter(difficulty_level='beginner', is_active=True).count(),
-            },
-            'intermediate': {
-                'completed': completed_qs.filter(clinical_case__difficulty_level='intermediate').count(),
-                'total': ClinicalCase.objects.filter(difficulty_level='intermediate', is_active=True).count(),
-            },
-            'advanced': {
-                'completed': completed_qs.filter(clinical_case__difficulty_level='advanced').count(),
-                'total': ClinicalCase.objects.filter(difficulty_level='advanced', is_active=True).count(),
-            },
-        },
-    }
+    """统一的学生端临床推理统计口径（dashboard 与 API 共用；一次聚合查询，按学生缓存）"""
+    stats = dict(student_stats(user))
+    stats['formatted_study_time'] = _format_minutes_as_hm(stats['total_study_time'])
     return stats
 
 
@@ -868,36 +680,22 @@ def student_dashboard(request):
 @user_passes_test(is_teacher, login_url='login')
 def teacher_dashboard(request):
     """教师仪表板"""
-    # 临床推理病例统计
-    total_clinical_cases = ClinicalCase.objects.count()
-    active_clinical_cases = ClinicalCase.objects.filter(is_active=True).count()
-    total_students = User.objects.filter(groups__name='Students').count()
-    
-    # 检查选项统计
-    total_examinations = ExaminationOption.objects.count()
-    
-    # 学生学习统计
-    total_sessions = StudentClinicalSession.objects.count()
-    completed_sessions = StudentClinicalSession.objects.filter(completed_at__isnull=False).count()
+    # 顶部计数读取统计快照（过期时先返回旧值并后台重算，页面不等待聚合查询）
+    stats = stats_snapshot()
     
-    # 计算完成率
-    completion_rate = round((completed_sessions / total_sessions * 100), 1) if total_sessions > 0 else 0
-    
-    # 最近活动
-    recent_sessions = StudentClinicalSession.objects.select_related('student', 'clinical_case').order_by('-started_at')[:10]
+    # 最近活动：按本轮开始时间排序（run_started_at 索引，重新开始的会话排在前面）
+    recent_sessions = StudentClinicalSession.objects.select_related('student', 'clinical_case').order_by('-run_started_at')[:10]
     
     # 为每个会话计算学习时长（与学生端统计口径对齐：run_started_at 作为本轮起点，过滤历史脏数据）
     sessions_with_time = []
-    cached_user_total_minutes = {}
+    recent_sessions = list(recent_sessions)
+    user_total_minutes = _get_users_total_study_time_minutes({session.student_id for session in recent_sessions})
+    recent_minutes = _sessions_study_minutes(recent_sessions)
     for session in recent_sessions:
-        student_id = getattr(session.student, 'id', None)
-        if student_id not in cached_user_total_minutes:
-            cached_user_total_minutes[student_id] = _get_user_total_study_time_minutes(session.student)
-
-        total_minutes = cached_user_total_minutes[student_id]
+        total_minutes = user_total_minutes[session.student_id]
         formatted_time = _format_minutes_as_hm(total_minutes)
 
-        case_minutes = _get_session_study_time_minutes(session)
+        case_minutes = recent_minutes.get(session.pk)
         formatted_case_time = _format_minutes_as_hm(case_minutes) if isinstance(case_minutes, int) else '-'
 
         sessions_with_time.append(
@@ -909,13 +707,15 @@ def teacher_dashboard(request):
         )
     
     context = {
-        'total_clinical_cases': total_clinical_cases,
-        'active_clinical_cases': active_clinical_cases,
-        'total_students': total_students,
-        'total_examinations': total_examinations,
-        'total_sessions': total_sessions,
-        'completed_sessions': completed_sessions,
-        'completion_rate': completion_rate,
+        'total_clinical_cases': stats['total_clinical_cases'],
+        'active_clinical_cases': stats['active_clinical_cases'],
+        'total_students': stats['total_students'],
+        'total_examinations': stats['total_examinations'],
+        'total_sessions': stats['total_sessions'],
+        'completed_sessions': stats['completed_sessions'],
+        'completion_rate': stats['completion_rate'],
+        'active_sessions_last_hour': stats['active_sessions_last_hour'],
+        'stats_computed_at': stats['computed_at'],
         'recent_sessions': sessions_with_time,
     }
     
@@ -957,10 +757,32 @@ def teacher_session_review(request, session_id: int):
         'review': review,
         'total_study_time': _format_minutes_as_hm(total_minutes) if isinstance(total_minutes, int) else '-',
         'stage_minutes': stage_minutes,
+        # 该学生在此病例的历史轮次（含已重置删除的会话）
+        'runs': run_history(session.student_id, session.clinical_case_id),
     }
     return render(request, 'teacher/session_review.html', context)
 
 
+# 开始新一轮时清零的作答与得分字段
+RUN_PROGRESS_FIELDS = (
+    'diagnosis_attempt_count', 'diagnosis_guidance_level',
+    'examination_score', 'diagnosis_score', 'treatment_score', 'overall_score',
+    'selected_examinations', 'selected_diagnoses', 'selected_treatments',
+)
+
+
+def _reset_run_progress(session):
+    """开始新一轮：重置尝试次数和指导级别（避免“终生惩罚”）、本轮得分与当前选择"""
+    session.diagnosis_attempt_count = 0
+    session.diagnosis_guidance_level = 0
+    session.examination_score = 0
+    session.diagnosis_score = 0
+    session.treatment_score = 0
+    session.overall_score = 0
+    session.selected_examinations = []
+    session.selected_diagnoses = []
+    session.selected_treatments = []
+
 
 
 
@@ -1029,34 +851,24 @@ def clinical_case_detail(request, case_id):
             defaults={'session_status': 'case_presentation'}
         )
         
-        # 如果是新会话，重置状态
-        if created:
+        # 如果是已完成的会话，开始新一轮学习（新会话由 get_or_create 的 defaults 设为病史展示阶段）
+        if not created and (session.session_status == 'completed' or session.completed_at is not None):
+            # 上一轮归档到 SessionRun（完成时通常已归档，这里兜底旧数据），写入新一轮的 run_start 事件
+            run_start, update_fields = start_new_run(session, to_ms(timezone.now()))
             session.session_status = 'case_presentation'
-            session.save()
-        else:
-            # 如果是已完成的会话，重置为新的学习会话（保留历史记录但重置计数）
-            if session.session_status == 'completed' or session.completed_at is not None:
-                # 重置会话状态，开始新一轮学习
-                session.session_status = 'case_presentation'
-                session.completed_at = None
-                # 重置本轮计时，避免继承历史 started_at / stage_times
-                session.started_at = timezone.now()
-                session.time_spent = {}
-                session.step_start_times = {}
-                session.session_data = {}
-                # 重置尝试次数和指导级别，避免"终生惩罚"
-                session.diagnosis_attempt_count = 0
-                session.diagnosis_guidance_level = 0
-                # 重置分数（但保留历史最高分在其他字段中）
-                session.examination_score = 0
-                session.diagnosis_score = 0
-                session.treatment_score = 0
-                session.overall_score = 0
-                # 清空当前选择
-                session.selected_examinations.clear()
-                session.selected_diagnoses = []
-                session.selected_treatments = []
-                session.save()
+            # 重置本轮计时，避免继承历史 started_at / stage_times
+            session.started_at = timezone.now()
+            session.time_spent = {}
+            session.step_start_times = {}
+            session.session_data = {}
+            _reset_run_progress(session)
+            update_fields += [
+                'session_status', 'started_at', 'time_spent', 'step_start_times', 'session_data', *RUN_PROGRESS_FIELDS,
+                *apply_event_columns(session, [run_start]),
+            ]
+            with transaction.atomic():
+                save_session(session, fields=update_fields)
+                write_events(session, [run_start])
         
         case_data = {
             'case_id': clinical_case.case_id,
@@ -1111,29 +923,16 @@ def clinical_case_detail(request, case_id):
             defaults={'session_status': 'case_presentation'}
         )
         
-        # 如果是新会话，重置状态
-        if created:
+        # 如果是已完成的会话，开始新一轮学习（新会话由 get_or_create 的 defaults 设为病史展示阶段）
+        if not created and (session.session_status == 'completed' or session.completed_at is not None):
+            # 上一轮归档到 SessionRun（完成时通常已归档，这里兜底旧数据），写入新一轮的 run_start 事件
+            run_start, update_fields = start_new_run(session, to_ms(timezone.now()))
             session.session_status = 'case_presentation'
-            session.save()
-        else:
-            # 如果是已完成的会话，重置为新的学习会话（保留历史记录但重置计数）
-            if session.session_status == 'completed' or session.completed_at is not None:
-                # 重置会话状态，开始新一轮学习
-                session.session_status = 'case_presentation'
-                session.completed_at = None
-                # 重置尝试次数和指导级别，避免"终生惩罚"
-                session.diagnosis_attempt_count = 0
-                session.diagnosis_guidance_level = 0
-                # 重置分数（但保留历史最高分在其他字段中）
-                session.examination_score = 0
-                session.diagnosis_score = 0
-                session.treatment_score = 0
-                session.overall_score = 0
-                # 清空当前选择
-                session.selected_examinations.clear()
-                session.selected_diagnoses = []
-                session.selected_treatments = []
-                session.save()
+            _reset_run_progress(session)
+            update_fields += ['session_status', *RUN_PROGRESS_FIELDS, *apply_event_columns(session, [run_start])]
+            with transaction.atomic():
+                save_session(session, fields=update_fields)
+                write_events(session, [run_start])
         
         case_data = {
             'case_id': clinical_case.case_id,
@@ -1172,30 +971,53 @@ def clinical_case_detail(request, case_id):
 @user_passes_test(is_student, login_url='login')
 @require_POST
 def save_clinical_notes(request):
-    """保存临床笔记到数据库"""
+    """
+    保存临床笔记（增量补丁）
+    请求体：{case_id, base_revision, ops: [{pos, delete, insert}]}，每个补丁立即落库；
+    旧版整篇提交 {case_id, notes} 仍然支持（按当前版本生成一次替换）
+    """
     try:
         data = json.loads(request.body)
         case_id = data.get('case_id')
-        notes = data.get('notes', '')
         
         clinical_case = get_object_or_404(ClinicalCase, case_id=case_id, is_active=True)
-        session = get_object_or_404(StudentClinicalSession, 
-                                  student=request.user, 
-                                  clinical_case=clinical_case)
+        get_object_or_404(StudentClinicalSession.objects.only('id'),
+                          student=request.user,
+                          clinical_case=clinical_case)
         
-        # 保存笔记到数据库
-        session.learning_notes = notes
-        session.save()
+        if 'ops' in data:
+            result = patch_note(request.user, clinical_case, data.get('base_revision'), data.get('ops'))
+        else:
+            notes = data.get('notes', '') or ''
+            note = get_note(request.user, clinical_case)
+            current = note.content if note else ''
+            result = patch_note(request.user, clinical_case, note.revision if note else 0,
+                                replace_ops(current, notes))
         
         return JsonResponse({
             'success': True,
             'message': '笔记已保存',
             'data': {
-                'notes_length': len(notes),
+                'notes_length': len(result['content']),
+                'revision': result['revision'],
                 'save_time': timezone.now().strftime('%H:%M:%S')
             }
         })
         
+    except NotePatchError as e:
+        return JsonResponse({
+            'success': False,
+            'message': str(e)
+        }, status=400)
+    except NoteRevisionConflict as e:
+        return JsonResponse({
+            'success': False,
+            'message': str(e),
+            'data': {
+                'revision': e.revision,
+                'notes': e.content
+            }
+        }, status=409)
     except Exception as e:
         return JsonResponse({
             'success': False,
@@ -1209,15 +1031,17 @@ def get_clinical_notes(request, case_id):
     """获取临床笔记"""
     try:
         clinical_case = get_object_or_404(ClinicalCase, case_id=case_id, is_active=True)
-        session = get_object_or_404(StudentClinicalSession, 
-                                  student=request.user, 
-                                  clinical_case=clinical_case)
+        get_object_or_404(StudentClinicalSession.objects.only('id'),
+                          student=request.user,
+                          clinical_case=clinical_case)
+        note = get_note(request.user, clinical_case)
         
         return JsonResponse({
             'success': True,
             'data': {
-                'notes': session.learning_notes or '',
-                'last_updated': session.last_activity.strftime('%Y-%m-%d %H:%M:%S') if session.learning_notes else None
+                'notes': note.content if note else '',
+                'revision': note.revision if note else 0,
+                'last_updated': note.updated_at.strftime('%Y-%m-%d %H:%M:%S') if note and note.content else None
             }
         })
         
@@ -1231,6 +1055,7 @@ def get_clinical_notes(request, case_id):
 @login_required
 @user_passes_test(is_student, login_url='login')
 @require_POST
+@stage_required('submit_examination')
 def submit_examination_choices(request):
     """提交检查选择 - 检查阶段"""
     try:
@@ -1249,94 +1074,52 @@ def submit_examination_choices(request):
         
         # 计算检查选择得分
         examination_options = ExaminationOption.objects.filter(clinical_case=clinical_case)
+        exam_flags = {
+            str(exam_id): (is_required, diagnostic_value)
+            for exam_id, is_required, diagnostic_value in examination_options.values_list('id', 'is_required', 'diagnostic_value')
+        }
+        required_exam_ids = {exam_id for exam_id, (is_required, _) in exam_flags.items() if is_required}
+        
+        # 统计不必要检查数量（仅用于反馈，不影响评分）：非必选且诊断价值低于2
+        unnecessary_count = sum(
+            1 for exam_id in selected_examinations
+            if str(exam_id) in exam_flags
+            and not exam_flags[str(exam_id)][0]
+            and exam_flags[str(exam_id)][1] < 2
+        )
         
-        # 1. 必选检查评分（60%权重）
-        required_options = examination_options.filter(is_required=True)
-        total_required = required_options.count()
-        selected_required = required_options.filter(id__in=selected_examinations).count()
-        
-        if total_required > 0:
-            required_score = selected_required / total_required
-        else:
-            required_score = 1.0  # 如果没有必选检查，给满分
-        
-        # 2. 检查效率评分（30%权重）- 基于检查数量和质量的合理性
-        total_selected = len(selected_examinations)
-        efficiency_score = 1.0
-        
-        # 效率评分逻辑：
-        # - 选择过多检查（超过8项）会降低效率分
-        # - 选择过少检查（少于2项）也会降低效率分
-        # - 最优范围：2-6项检查
-        if total_selected > 8:
-            # 每多选一项检查扣5%
-            efficiency_score -= (total_selected - 8) * 0.05
-        elif total_selected < 2:
-            # 检查太少扣分更重
-            efficiency_score -= (2 - total_selected) * 0.2
-        
-        # 确保效率分不为负
-        efficiency_score = max(0, efficiency_score)
-        
-        # 3. 统计不必要检查数量（仅用于反馈，不影响评分）
-        unnecessary_examinations = []
-        for exam_id in selected_examinations:
-            if not examination_options.filter(
-                Q(id=exam_id) & Q(is_required=True)
-            ).exists():
-                # 检查是否为高价值检查（诊断价值高的检查）
-                exam_option = examination_options.filter(id=exam_id).first()
-                if exam_option and exam_option.diagnostic_value < 2:  # 低价值检查视为不必要
-                    unnecessary_examinations.append(exam_id)
-        unnecessary_count = len(unnecessary_examinations)
-        
-        # 基础得分计算：必选检查70% + 检查效率30%
-        base_examination_score = (
-            required_score * 0.7 + 
-            efficiency_score * 0.3
-        ) * 100
-        
-        # 根据检查选择的最终尝试次数计算惩罚
-        selection_penalty = 0
+        # 根据检查选择的最终尝试次数计算惩罚（从成功记录或步骤完成状态中获取）
+        final_attempt_count = 1
         if hasattr(session, 'session_data') and session.session_data:
-            # 从成功记录中获取最终尝试次数，如果没有则从步骤完成状态中获取
-            final_attempt_count = 1
-            
             if 'examination_selection_success' in session.session_data:
                 final_attempt_count = session.session_data['examination_selection_success'].get('final_attempt', 1)
             elif 'examination_selection' in session.step_completion_status:
                 final_attempt_count = session.step_completion_status['examination_selection'].get('final_attempt', 1)
-            
-            # 只有当尝试次数大于1时才应用惩罚
-            if final_attempt_count > 1:
-                # 基于最终尝试次数计算惩罚：第2次尝试扣5分，第3次扣10分，第4次及以后扣20分
-                if final_attempt_count == 2:
-                    selection_penalty = 5
-                elif final_attempt_count == 3:
-                    selection_penalty = 10
-                else:
-                    selection_penalty = 20
         
-        # 最终得分 = 基础得分 - 基于尝试次数的惩罚
-        final_examination_score = max(0, base_examination_score - selection_penalty)
+        # 必选检查70% + 检查效率30% - 尝试次数惩罚
+        exam_result = scoring.examination_score(
+            [str(exam_id) for exam_id in selected_examinations],
+            required_exam_ids,
+            final_attempt=final_attempt_count,
+        )
         
-        session.examination_score = max(0, min(100, final_examination_score))
-        session.save()
+        session.examination_score = exam_result['total_score']
+        save_session(session)
         
         # 准备得分详情用于调试和反馈
         score_details = {
             'total_score': round(session.examination_score, 1),
-            'base_score': round(base_examination_score, 1),
-            'selection_penalty': round(selection_penalty, 1),
-            'required_score': round(required_score * 70, 1),
-            'efficiency_score': round(efficiency_score * 30, 1),
-            'required_stats': f"{selected_required}/{total_required}",
-            'efficiency_stats': f"选择了{total_selected}项检查",
+            'base_score': round(exam_result['base_score'], 1),
+            'selection_penalty': round(exam_result['penalty'], 1),
+            'required_score': round(exam_result['required_score'] * 70, 1),
+            'efficiency_score': round(exam_result['efficiency_score'] * 30, 1),
+            'required_stats': f"{exam_result['selected_required']}/{exam_result['total_required']}",
+            'efficiency_stats': f"选择了{exam_result['total_selected']}项检查",
             'unnecessary_count': unnecessary_count,
-            'total_selected': total_selected,
+            'total_selected': exam_result['total_selected'],
             'penalty_info': {
                 'error_attempts': len(session.session_data.get('examination_selection_errors', [])) if hasattr(session, 'session_data') and session.session_data else 0,
-                'penalty_applied': selection_penalty
+                'penalty_applied': exam_result['penalty']
             }
         }
         
@@ -1383,6 +1166,11 @@ def submit_examination_choices(request):
             'message': f'检查结果获取成功，检查选择得分：{session.examination_score:.1f}分'
         })
         
+    except SessionConflictError as e:
+        return JsonResponse({
+            'success': False,
+            'message': str(e)
+        }, status=409)
     except Exception as e:
         return JsonResponse({
             'success': False,
@@ -1393,6 +1181,7 @@ def submit_examination_choices(request):
 @login_required
 @user_passes_test(is_student, login_url='login')
 @require_POST
+@stage_required('submit_diagnosis')
 def submit_diagnosis_choice(request):
     """提交诊断选择 - 诊断阶段"""
     try:
@@ -1429,24 +1218,29 @@ def submit_diagnosis_choice(request):
                 'message': '选择的诊断选项无效'
             }, status=400)
         
-        # 获取所有正确诊断以供比较
-        all_correct_diagnoses = DiagnosisOption.objects.filter(
-            clinical_case=clinical_case, 
+        # 评分以当前的正确诊断为准；各级提示来自病例的预生成提示阶梯（与正确诊断不一致时重建）
+        correct_diagnosis_ids = set(DiagnosisOption.objects.filter(
+            clinical_case=clinical_case,
             is_correct_diagnosis=True
-        )
-        correct_diagnosis_ids = set(all_correct_diagnoses.values_list('id', flat=True))
+        ).values_list('id', flat=True))
+        hint_ladder = get_diagnosis_hint_ladder(clinical_case, correct_diagnosis_ids)
         selected_diagnosis_ids_set = set(selected_diagnosis_ids)
         
         # 计算诊断结果
-        correct_diagnoses = diagnosis_options.filter(is_correct_diagnosis=True)
         total_selected = len(diagnosis_options)
-        correct_selected = len(correct_diagnoses)
+        correct_selected = sum(1 for option in diagnosis_options if option.is_correct_diagnosis)
         
         # 检查是否完全正确
         is_completely_correct = (selected_diagnosis_ids_set == correct_diagnosis_ids)
         
         # 增加尝试次数
         session.diagnosis_attempt_count += 1
+        
+        # 记录本次作答分布（干扰项分析）
+        record_option_exposures(
+            request, session, 'diagnosis', selected_diagnosis_ids, correct_diagnosis_ids,
+            attempt=session.diagnosis_attempt_count,
+        )
 
         # 持久化“诊断选择 + 诊断依据”，用于学习反馈复盘（刷新不丢）
         if not getattr(session, 'session_data', None):
@@ -1466,18 +1260,21 @@ def submit_diagnosis_choice(request):
                 'attempt_count': session.diagnosis_attempt_count,
             }
         
+        # 反馈文本中的动态数字放入模板参数，便于相同反馈驻留复用
+        feedback_params = {}
         if is_completely_correct:
             # 诊断完全正确 - 进入治疗阶段
             session.selected_diagnoses = selected_diagnosis_ids
             session.session_status = 'treatment_selection'
             # 修复：使用当前尝试次数计算分数（第1次=100分，第2次=90分，以此类推，最低60分）
-            session.diagnosis_score = max(100 - (session.diagnosis_attempt_count - 1) * 10, 60)  # 最低60分
+            session.diagnosis_score = scoring.diagnosis_attempt_score(session.diagnosis_attempt_count)  # 最低60分
             
-            feedback_message = f"恭喜！您的鉴别诊断完全正确！"
+            feedback_message = "恭喜！您的鉴别诊断完全正确！"
             if session.diagnosis_attempt_count > 1:
-                feedback_message += f"（第{session.diagnosis_attempt_count}次尝试，得分：{session.diagnosis_score:.0f}分）"
+                feedback_message += "（第{attempt}次尝试，得分：{score:.0f}分）"
+                feedback_params = {'attempt': session.diagnosis_attempt_count, 'score': session.diagnosis_score}
             else:
-                feedback_message += f"（首次尝试即正确，满分100分！）"
+                feedback_message += "（首次尝试即正确，满分100分！）"
             feedback_type = 'positive'
             
         elif correct_selected > 0:
@@ -1488,42 +1285,36 @@ def submit_diagnosis_choice(request):
             # 根据尝试次数提供不同级别的指导
             if session.diagnosis_attempt_count == 1:
                 session.diagnosis_guidance_level = 1
-                guidance_hint = f"您选择了{correct_selected}个正确诊断，但还有{missing_correct}个正确诊断未选择"
+                guidance_hint = "您选择了{correct_selected}个正确诊断，但还有{missing_correct}个正确诊断未选择"
+                feedback_params = {'correct_selected': correct_selected, 'missing_correct': missing_correct}
                 if wrong_selected > 0:
-                    guidance_hint += f"，同时选择了{wrong_selected}个错误诊断"
+                    guidance_hint += "，同时选择了{wrong_selected}个错误诊断"
+                    feedback_params['wrong_selected'] = wrong_selected
                 guidance_hint += "。请重新思考并调整您的选择。"
                 
             elif session.diagnosis_attempt_count == 2:
                 session.diagnosis_guidance_level = 2
+                # 给出所选错误诊断的轻度提示
                 guidance_hint = "提示：请仔细回顾患者的症状、体征和检查结果。"
-                # 给出轻度提示
-                wrong_options = diagnosis_options.filter(is_correct_diagnosis=False)
-                if wrong_options.exists():
-                    for option in wrong_options:
-                        if option.hint_level_1:
-                            guidance_hint += f"\n关于{option.diagnosis_name}: {option.hint_level_1}"
+                guidance_hint += escape_template_text(
+                    ladder_guidance(hint_ladder, 'partial', 2, selected_diagnosis_ids_set)
+                )
                             
             elif session.diagnosis_attempt_count == 3:
                 session.diagnosis_guidance_level = 3  
+                # 给出所选错误诊断的中度提示
                 guidance_hint = "进一步提示："
-                # 给出中度提示
-                wrong_options = diagnosis_options.filter(is_correct_diagnosis=False)
-                if wrong_options.exists():
-                    for option in wrong_options:
-                        if option.hint_level_2:
-                            guidance_hint += f"\n{option.diagnosis_name}: {option.hint_level_2}"
+                guidance_hint += escape_template_text(
+                    ladder_guidance(hint_ladder, 'partial', 3, selected_diagnosis_ids_set)
+                )
                             
             else:  # 第4次及以上
                 session.diagnosis_guidance_level = 3
+                # 给出全部选项的强提示
                 guidance_hint = "详细指导："
-                # 给出强提示
-                all_diagnosis_options = DiagnosisOption.objects.filter(clinical_case=clinical_case)
-                for option in all_diagnosis_options:
-                    if option.is_correct_diagnosis:
-                        guidance_hint += f"\n✓ {option.diagnosis_name}: 这是正确的诊断"
-                    else:
-                        if option.hint_level_3:
-                            guidance_hint += f"\n✗ {option.diagnosis_name}: {option.hint_level_3}"
+                guidance_hint += escape_template_text(
+                    ladder_guidance(hint_ladder, 'partial', session.diagnosis_attempt_count)
+                )
             
             feedback_message = guidance_hint
             feedback_type = 'guidance'
@@ -1535,35 +1326,31 @@ def submit_diagnosis_choice(request):
             session.diagnosis_guidance_level = min(session.diagnosis_attempt_count, 3)
             
             if session.diagnosis_attempt_count == 1:
-                feedback_message = f"您选择的{total_selected}个诊断都不正确。请重新分析患者的症状、体征和检查结果，考虑可能的鉴别诊断。\n\n💡 提示：仔细观察患者的检查结果和临床表现。"
+                feedback_message = "您选择的{total_selected}个诊断都不正确。请重新分析患者的症状、体征和检查结果，考虑可能的鉴别诊断。\n\n💡 提示：仔细观察患者的检查结果和临床表现。"
+                feedback_params = {'total_selected': total_selected}
             elif session.diagnosis_attempt_count == 2:
-                feedback_message = "请注意以下诊断要点："
                 # 给出正确诊断的轻度提示
-                for correct_diagnosis in all_correct_diagnoses:
-                    if correct_diagnosis.hint_level_1:
-                        feedback_message += f"\n• {correct_diagnosis.diagnosis_name}: {correct_diagnosis.hint_level_1}"
+                feedback_message = "请注意以下诊断要点："
+                feedback_message += escape_template_text(ladder_guidance(hint_ladder, 'none', 2))
             else:
-                feedback_message = "详细指导 - 请考虑以下正确诊断："
                 # 给出正确诊断的详细提示
-                for correct_diagnosis in all_correct_diagnoses:
-                    feedback_message += f"\n✓ {correct_diagnosis.diagnosis_name}: "
-                    if correct_diagnosis.hint_level_2:
-                        feedback_message += correct_diagnosis.hint_level_2
-                    else:
-                        feedback_message += "这是正确的鉴别诊断选项"
+                feedback_message = "详细指导 - 请考虑以下正确诊断："
+                feedback_message += escape_template_text(
+                    ladder_guidance(hint_ladder, 'none', session.diagnosis_attempt_count)
+                )
                         
             feedback_type = 'corrective'
             session.diagnosis_score = 0
         
-        session.save()
+        save_session(session)
         
-        # 创建诊断阶段反馈
-        TeachingFeedback.objects.create(
-            student_session=session,
+        # 创建诊断阶段反馈（模板驻留存储，连续相同反馈只累加次数）
+        feedback_message = record_feedback(
+            session,
             feedback_stage='diagnosis',
             feedback_type=feedback_type,
-            feedback_content=feedback_message,
-            is_automated=True
+            template_text=feedback_message,
+            params=feedback_params,
         )
         
         # 准备返回数据
@@ -1644,6 +1431,11 @@ def submit_diagnosis_choice(request):
             'data': response_data
         })
         
+    except SessionConflictError as e:
+        return JsonResponse({
+            'success': False,
+            'message': str(e)
+        }, status=409)
     except Exception as e:
         return JsonResponse({
             'success': False,
@@ -1654,6 +1446,7 @@ def submit_diagnosis_choice(request):
 @login_required
 @user_passes_test(is_student, login_url='login')
 @require_POST
+@stage_required('submit_treatment')
 def submit_treatment_choices(request):
     """提交治疗方案选择 - 治疗阶段"""
     try:
@@ -1667,9 +1460,8 @@ def submit_treatment_choices(request):
                                   student=request.user, 
                                   clinical_case=clinical_case)
         
-        # 更新会话状态
+        # 更新会话状态（提交后直接完成，见下方 completed）
         session.selected_treatments = selected_treatments
-        session.session_status = 'feedback'
         
         # 计算治疗方案得分
         treatment_options = TreatmentOption.objects.filter(
@@ -1677,26 +1469,22 @@ def submit_treatment_choices(request):
             clinical_case=clinical_case
         )
         
-        total_score = 0
-        optimal_count = 0
-        acceptable_count = 0
-        contraindicated_count = 0
+        # 逐项计分（最佳100 / 可接受70 / 禁忌0 / 中性50）后按提交数量取平均
+        treatment_options = list(treatment_options)
+        optimal_treatment_ids = TreatmentOption.objects.filter(
+            clinical_case=clinical_case, is_optimal=True
+        ).values_list('id', flat=True)
+        record_option_exposures(request, session, 'treatment', selected_treatments, optimal_treatment_ids)
+        treatment_result = scoring.treatment_flag_score(
+            [(t.is_optimal, t.is_acceptable, t.is_contraindicated) for t in treatment_options],
+            selected_count=len(selected_treatments),
+        )
+        optimal_count = treatment_result['optimal_count']
+        contraindicated_count = treatment_result['contraindicated_count']
         
         treatment_feedback = []
         
         for treatment in treatment_options:
-            if treatment.is_optimal:
-                optimal_count += 1
-                total_score += 100
-            elif treatment.is_acceptable:
-                acceptable_count += 1
-                total_score += 70
-            elif treatment.is_contraindicated:
-                contraindicated_count += 1
-                total_score += 0  # 禁忌治疗不加分
-            else:
-                total_score += 50  # 中性治疗
-            
             treatment_feedback.append({
                 'treatment_name': treatment.treatment_name,
                 'feedback': treatment.selection_feedback,
@@ -1705,48 +1493,50 @@ def submit_treatment_choices(request):
                 'is_contraindicated': treatment.is_contraindicated
             })
         
-        # 计算平均分
-        if len(selected_treatments) > 0:
-            session.treatment_score = total_score / len(selected_treatments)
-        else:
-            session.treatment_score = 0
+        session.treatment_score = treatment_result['score']
         
         # 计算总体得分
         session.calculate_overall_score()
         session.completed_at = timezone.now()
         session.session_status = 'completed'
-        session.save()
+        apply_study_minutes(session, session.completed_at)
+        apply_review_snapshot(session, session.completed_at)
+        save_session(session)
+        archive_run(session)
         
         # 创建治疗阶段反馈
-        treatment_feedback_content = f"您选择了{len(selected_treatments)}个治疗方案。"
+        treatment_feedback_template = "您选择了{selected_count}个治疗方案。"
+        treatment_feedback_params = {'selected_count': len(selected_treatments)}
         if optimal_count > 0:
-            treatment_feedback_content += f"其中{optimal_count}个为最佳治疗。"
+            treatment_feedback_template += "其中{optimal_count}个为最佳治疗。"
+            treatment_feedback_params['optimal_count'] = optimal_count
         if contraindicated_count > 0:
-            treatment_feedback_content += f"请注意：有{contraindicated_count}个禁忌治疗需要避免。"
+            treatment_feedback_template += "请注意：有{contraindicated_count}个禁忌治疗需要避免。"
+            treatment_feedback_params['contraindicated_count'] = contraindicated_count
         
-        TeachingFeedback.objects.create(
-            student_session=session,
+        record_feedback(
+            session,
             feedback_stage='treatment',
             feedback_type='guidance',
-            feedback_content=treatment_feedback_content,
-            is_automated=True
+            template_text=treatment_feedback_template,
+            params=treatment_feedback_params,
         )
         
         # 创建总体反馈
-        overall_feedback = f"恭喜完成临床推理！总体得分：{session.overall_score:.1f}分。"
+        overall_template = "恭喜完成临床推理！总体得分：{overall_score:.1f}分。"
         if session.overall_score >= 90:
-            overall_feedback += "表现优秀！您展现了出色的临床思维能力。"
+            overall_template += "表现优秀！您展现了出色的临床思维能力。"
         elif session.overall_score >= 70:
-            overall_feedback += "表现良好，继续努力提升临床推理能力。"
+            overall_template += "表现良好，继续努力提升临床推理能力。"
         else:
-            overall_feedback += "还有提升空间，建议复习相关知识点。"
+            overall_template += "还有提升空间，建议复习相关知识点。"
         
-        TeachingFeedback.objects.create(
-            student_session=session,
+        overall_feedback = record_feedback(
+            session,
             feedback_stage='overall',
             feedback_type='encouragement',
-            feedback_content=overall_feedback,
-            is_automated=True
+            template_text=overall_template,
+            params={'overall_score': session.overall_score},
         )
         
         return JsonResponse({
@@ -1767,6 +1557,11 @@ def submit_treatment_choices(request):
             'message': '临床推理学习完成！'
         })
         
+    except SessionConflictError as e:
+        return JsonResponse({
+            'success': False,
+            'message': str(e)
+        }, status=409)
     except Exception as e:
         return JsonResponse({
             'success': False,
@@ -1790,13 +1585,14 @@ def get_clinical_learning_progress(request, case_id):
             # 获取相关反馈
             feedbacks = TeachingFeedback.objects.filter(
                 student_session=session
-            ).order_by('created_at')
+            ).select_related('template').order_by('created_at')
             
             feedback_data = [{
                 'stage': feedback.feedback_stage,
                 'type': feedback.feedback_type,
-                'content': feedback.feedback_content,
+                'content': feedback.content,
                 'suggestions': feedback.improvement_suggestions,
+                'repeat_count': feedback.repeat_count,
                 'created_at': feedback.created_at.isoformat()
             } for feedback in feedbacks]
             
@@ -1866,9 +1662,10 @@ def get_examination_options(request, case_id):
         
         # 如果没有必选项，返回该案例的所有检查项
         if not required_examinations.exists():
-            all_case_examinations = ExaminationOption.objects.filter(
+            all_case_examinations = list(ExaminationOption.objects.filter(
                 clinical_case=clinical_case
-            ).order_by('display_order', 'examination_type')
+            ).order_by('display_order', 'examination_type'))
+            stash_option_exposure(request, clinical_case, 'examination', all_case_examinations)
             
             options_data = [{
                 'id': option.id,
@@ -1962,6 +1759,7 @@ def get_examination_options(request, case_id):
         
         # 随机打乱顺序
         random.shuffle(all_examinations)
+        stash_option_exposure(request, clinical_case, 'examination', all_examinations)
         
         # 构建返回数据
         options_data = [{
@@ -2153,6 +1951,7 @@ def get_examination_result(request, case_id, exam_id):
 @login_required
 @user_passes_test(is_student, login_url='login')
 @require_POST
+@stage_required('submit_examination')
 def confirm_examination_selection(request):
     """确认检查选择并获取检查顺序 - 严格验证必选项"""
     try:
@@ -2193,6 +1992,12 @@ def confirm_examination_selection(request):
             required_exam_ids, selected_exam_ids, required_exams, session
         )
         
+        # 记录本次作答分布（干扰项分析），无论验证是否通过
+        record_option_exposures(
+            request, session, 'examination', selected_exam_ids, required_exam_ids,
+            attempt=validation_result.get('attempt_count'),
+        )
+        
         if not validation_result['is_valid']:
             # 记录错误操作并应用评分惩罚
             record_examination_error(session, validation_result)
@@ -2232,7 +2037,7 @@ def confirm_examination_selection(request):
             'validation_success': True
         })
         
-        session.save()
+        save_session(session)
         
         # 计算当前应用的惩罚（用于显示）
         total_penalty = session.session_data.get('examination_selection_penalty', 0)
@@ -2260,6 +2065,11 @@ def confirm_examination_selection(request):
             }
         })
         
+    except SessionConflictError as e:
+        return JsonResponse({
+            'success': False,
+            'message': str(e)
+        }, status=409)
     except Exception as e:
         return JsonResponse({
             'success': False,
@@ -2271,38 +2081,24 @@ def confirm_examination_selection(request):
 @login_required
 @user_passes_test(is_student, login_url='login')
 def clinical_cases_list(request):
-    """返回临床案例列表（用于前端案例库）"""
+    """
+    返回临床案例列表（用于前端案例库）
+    参数：difficulty、status（not_started/in_progress/completed）、cursor、limit；
+    按创建时间倒序游标分页，响应中的 next_cursor 用于取下一页
+    """
     try:
-        difficulty = request.GET.get('difficulty')
-        qs = ClinicalCase.objects.filter(is_active=True)
-        if difficulty in ['beginner', 'intermediate', 'advanced']:
-            qs = qs.filter(difficulty_level=difficulty)
-
-        cases = []
-        for c in qs.order_by('-created_at'):
-            # 尝试获取学生会话以显示进度
-            try:
-                session = StudentClinicalSession.objects.get(student=request.user, clinical_case=c)
-                status = session.session_status
-                overall = session.overall_score
-            except StudentClinicalSession.DoesNotExist:
-                status = 'not_started'
-                overall = 0
-
-            cases.append({
-                'case_id': c.case_id,
-                'title': c.title,
-                'patient_age': c.patient_age,
-                'patient_gender': c.get_patient_gender_display(),
-                'chief_complaint': c.chief_complaint[:120],
-                'learning_objectives': c.learning_objectives or [],
-                'case_images': c.case_images or [],
-                'difficulty_level': c.difficulty_level,
-                'status': status,
-                'progress': {'overall_score': overall}
-            })
+        try:
+            page = student_case_page(
+                request.user,
+                difficulty=request.GET.get('difficulty'),
+                status=request.GET.get('status'),
+                cursor=request.GET.get('cursor'),
+                limit=request.GET.get('limit', CASE_PAGE_SIZE),
+            )
+        except InvalidCursor as e:
+            return JsonResponse({'success': False, 'message': str(e), 'data': {'cases': []}}, status=400)
 
-        return JsonResponse({'success': True, 'data': {'cases': cases}})
+        return JsonResponse({'success': True, 'data': page})
     except Exception as e:
         try:
             import traceback
@@ -2386,448 +2182,109 @@ def save_clinical_progress(request):
         
         clinical_case = get_object_or_404(ClinicalCase, case_id=case_id, is_active=True)
         
-        # 获取或创建学习会话
+        # 获取或创建学习会话；进度存放在 session_data['step_data']
         session, created = StudentClinicalSession.objects.get_or_create(
             student=request.user,
             clinical_case=clinical_case,
-            defaults={
-                'session_status': 'in_progress',
-                'step_data': progress_data,
-                'start_time': timezone.now()
-            }
+            defaults={'session_data': {'step_data': progress_data}}
         )
         
         if not created:
-            # 更新现有会话
-            session.step_data = progress_data
-            session.session_status = 'in_progress'
-            session.save()
+            # 更新现有会话（阶段由 update_session_stage 维护，这里不改）；
+            # save_session 只写 session_data 并按键合并，不覆盖并发请求写入的其他键与字段
+            session.session_data['step_data'] = progress_data
+            save_session(session, fields=['session_data'])
         
         return JsonResponse({'success': True, 'message': '进度已保存'})
     except Exception as e:
         return JsonResponse({'success': False, 'message': str(e)}, status=500)
 
 
+PROGRESS_SCORE_FIELDS = ('examination_score', 'diagnosis_score', 'treatment_score', 'overall_score')
+PROGRESS_FIELDS = ('session_status', 'step_data') + PROGRESS_SCORE_FIELDS + ('review',)
+PROGRESS_FIELD_ALIASES = {'scores': PROGRESS_SCORE_FIELDS}
+
+
+def _parse_progress_fields(raw):
+    """解析 ?fields=a,b（支持 scores 别名），缺省返回全部字段；未知字段抛出 ValueError"""
+    if not raw:
+        return PROGRESS_FIELDS
+    requested = set()
+    for name in raw.split(','):
+        name = name.strip()
+        if not name:
+            continue
+        if name in PROGRESS_FIELD_ALIASES:
+            requested.update(PROGRESS_FIELD_ALIASES[name])
+        elif name in PROGRESS_FIELDS:
+            requested.add(name)
+        else:
+            raise ValueError(name)
+    return tuple(field for field in PROGRESS_FIELDS if field in requested)
+
+
 @login_required
 @user_passes_test(is_student, login_url='login')
 def get_clinical_progress(request, case_id):
-    """获取学生的临床推理学习进度"""
+    """
+    获取学生的临床推理学习进度
+    - ?fields=session_status,scores 只计算需要的部分（缺省返回全部，review 最重）
+    - 响应带 ETag（由 last_activity / version 和所选字段决定；未完成会话的 review 还包含心跳修订号，
+      心跳不改动会话行，但会改变 stage_active_seconds），If-None-Match 命中返回 304
+    - 已完成会话的 review 直接读取完成时写入的快照
+    """
     try:
-        clinical_case = get_object_or_404(ClinicalCase, case_id=case_id, is_active=True)
-        
         try:
-            session = StudentClinicalSession.objects.get(
-                student=request.user,
-                clinical_case=clinical_case
-            )
-
-            # 复盘所需数据：检查选择、诊断提交、阶段用时等（即使部分字段异常，也不要让接口500）
-            review_payload = {
-                'selected_examinations': [],
-                'diagnosis': None,
-                'selected_treatments': [],
-                'treatment': None,
-                'stage_times': None,
-                'stage_start_times': None,
-                'session_started_at': None,
-                'session_completed_at': None,
-                'session_last_activity_at': None,
-                'session_total_ms': None,
-            }
-            try:
-                session_data = getattr(session, 'session_data', None) or {}
-
-                # 可选：后端计时 debug 输出（只在开发模式开启，避免泄露/干扰生产）
-                debug_time_enabled = bool(getattr(settings, 'DEBUG', False)) and (request.GET.get('debug_time') in ('1', 'true', 'True'))
-                debug_time = None
-
-                # 会话时间（用于前端校准总用时与阶段用时）
-                try:
-                    # 注意：StudentClinicalSession.started_at 是 auto_now_add（会话创建时间），
-                    # 不能作为“本轮学习开始时间”，否则旧会话会导致总用时异常变大。
-                    completed_at = getattr(session, 'completed_at', None)
-                    last_activity = getattr(session, 'last_activity', None)
-                    review_payload['session_completed_at'] = completed_at.isoformat() if completed_at else None
-                    review_payload['session_last_activity_at'] = last_activity.isoformat() if last_activity else None
-
-                    def _parse_dt(value):
-                        if not value:
-                            return None
-                        try:
-                            dt = timezone.datetime.fromisoformat(str(value).replace('Z', '+00:00'))
-                            if timezone.is_naive(dt):
-                                dt = timezone.make_aware(dt, timezone.get_current_timezone())
-                            return dt
-                        except Exception:
-                            return None
-
-                    run_started_at = _parse_dt(session_data.get('run_started_at'))
-
-                    # 兜底：若没有 run_started_at，用 stage_times 的最早时间戳作为“本轮起点”
-                    if run_started_at is None:
-                        try:
-                            st = session_data.get('stage_times') or {}
-                            if isinstance(st, dict) and st:
-                                parsed = [_parse_dt(v) for v in st.values()]
-                                parsed = [x for x in parsed if x is not None]
-                                if parsed:
-                                    run_started_at = min(parsed)
-                        except Exception:
-                            pass
-
-                    # 最后兜底：使用会话创建时间（可能偏旧，但至少有值）
-                    if run_started_at is None:
-                        started_at = getattr(session, 'started_at', None)
-                        run_started_at = started_at
-
-                    review_payload['session_started_at'] = run_started_at.isoformat() if run_started_at else None
-
-                    # 结束时间：优先取“更晚”的那个，避免 completed_at < last_activity 造成用时/阶段结束时间倒挂
-                    end_time = None
-                    try:
-                        candidates = [t for t in (completed_at, last_activity) if t is not None]
-                        if candidates:
-                            end_time = max(candidates)
-                    except Exception:
-                        end_time = completed_at or last_activity
-                    if run_started_at and end_time and end_time >= run_started_at:
-                        review_payload['session_total_ms'] = int((end_time - run_started_at).total_seconds() * 1000)
-
-                    # 组织 debug_time（不影响正常逻辑）
-                    if debug_time_enabled:
-                        try:
-                            major_stages = ['case_presentation', 'examination_selection', 'diagnosis_reasoning', 'treatment_selection', 'learning_feedback']
-
-                            raw_stage_start_times = session_data.get('stage_start_times') if isinstance(session_data.get('stage_start_times'), dict) else {}
-                            raw_stage_times = session_data.get('stage_times') if isinstance(session_data.get('stage_times'), dict) else {}
-
-                            parsed_stage_start_times = {}
-                            for k, v in (raw_stage_start_times or {}).items():
-                                parsed_stage_start_times[str(k)] = _parse_dt(v)
-
-                            # 按本轮 run_started_at 过滤旧的 stage_times（避免历史污染导致“阶段顺序倒挂”）
-                            filtered_stage_times = {}
-                            if isinstance(raw_stage_times, dict) and raw_stage_times:
-                                for key, val in raw_stage_times.items():
-                                    dtv = _parse_dt(val)
-                                    if dtv is None:
-                                        continue
-                                    if run_started_at and dtv < run_started_at:
-                                        continue
-                                    filtered_stage_times[str(key)] = val
-
-                            # 由 stage_times 反推进入某阶段的时间（key: old_to_new）
-                            inferred_to_stage_times = {}
-                            for key, val in (filtered_stage_times or {}).items():
-                                m = re.match(r'^(.+)_to_(.+)$', str(key))
-                                if not m:
-                                    continue
-                                to_stage = m.group(2)
-                                dtv = _parse_dt(val)
-                                if dtv is not None:
-                                    # 同一 to_stage 可能多次出现，取最早一次作为“首次进入”
-                                    if to_stage not in inferred_to_stage_times or dtv < inferred_to_stage_times[to_stage]:
-                                        inferred_to_stage_times[to_stage] = dtv
-
-                            # 计算每个主阶段的开始时间：优先 stage_start_times，其次 stage_times 推断，其次 run_started_at（仅用于 case_presentation）
-                            stage_start_dt = {}
-                            for stg in major_stages:
-                                dtv = parsed_stage_start_times.get(stg) or inferred_to_stage_times.get(stg)
-                                if dtv is None and stg == 'case_presentation':
-                                    dtv = run_started_at
-                                stage_start_dt[stg] = dtv
-
-                            # 计算结束时间：不再依赖固定阶段顺序；
-                            # 而是为每个阶段选择“开始时间之后最近发生的下一事件（其他阶段开始/会话结束）”。
-                            stage_end_dt = {}
-                            all_starts = [dt for dt in stage_start_dt.values() if dt is not None]
-                            for stg in major_stages:
-                                sdt = stage_start_dt.get(stg)
-                                if sdt is None:
-                                    stage_end_dt[stg] = None
-                                    continue
-                                candidates = []
-                                for dt in all_starts:
-                                    if dt > sdt:
-                                        candidates.append(dt)
-                                if end_time is not None and end_time > sdt:
-                                    candidates.append(end_time)
-                                stage_end_dt[stg] = min(candidates) if candidates else end_time
-
-                            stage_durations_ms = {}
-                            stage_anomalies = {}
-                            total_ms = review_payload.get('session_total_ms')
-                            for stg in major_stages:
-                                sdt = stage_start_dt.get(stg)
-                                edt = stage_end_dt.get(stg)
-                                if not sdt or not edt:
-                                    stage_durations_ms[stg] = None
-                                    stage_anomalies[stg] = 'missing_start_or_end'
-                                    continue
-                                if edt < sdt:
-                                    stage_durations_ms[stg] = None
-                                    stage_anomalies[stg] = 'end_before_start'
-                                    continue
-                                ms = int((edt - sdt).total_seconds() * 1000)
-                                # 极端异常：超过 24h 直接标记
-                                if ms > 24 * 60 * 60 * 1000:
-                                    stage_durations_ms[stg] = ms
-                                    stage_anomalies[stg] = 'duration_gt_24h'
-                                else:
-                                    stage_durations_ms[stg] = ms
-
-                                # 合理性校验：阶段用时不应远大于总用时（允许 30s 误差）
-                                if isinstance(total_ms, int) and total_ms >= 0 and ms > total_ms + 30_000:
-                                    stage_anomalies[stg] = (stage_anomalies.get(stg) or '') + '|duration_gt_total'
-
-                            debug_time = {
-                                'tz': {
-                                    'USE_TZ': bool(getattr(settings, 'USE_TZ', False)),
-                                    'TIME_ZONE': str(getattr(settings, 'TIME_ZONE', '')),
-                                    'now_iso': timezone.now().isoformat(),
-                                },
-                                'session_fields': {
-                                    'session_status': getattr(session, 'session_status', None),
-                                    'started_at': getattr(session, 'started_at', None).isoformat() if getattr(session, 'started_at', None) else None,
-                                    'completed_at': completed_at.isoformat() if completed_at else None,
-                                    'last_activity': last_activity.isoformat() if last_activity else None,
-                                },
-                                'run_started_at': {
-                                    'raw': session_data.get('run_started_at'),
-                                    'parsed': run_started_at.isoformat() if run_started_at else None,
-                                },
-                                'stage_start_times': {
-                                    'raw': raw_stage_start_times,
-                                    'parsed': {k: (v.isoformat() if v else None) for k, v in parsed_stage_start_times.items()},
-                                },
-                                'stage_times': {
-                                    'raw': raw_stage_times,
-                                    'inferred_to_stage_first_enter': {k: (v.isoformat() if v else None) for k, v in inferred_to_stage_times.items()},
-                                },
-                                'derived': {
-                                    'end_time_used': end_time.isoformat() if end_time else None,
-                                    'session_total_ms': review_payload.get('session_total_ms'),
-                                    'stage_start_dt': {k: (v.isoformat() if v else None) for k, v in stage_start_dt.items()},
-                                    'stage_end_dt': {k: (v.isoformat() if v else None) for k, v in stage_end_dt.items()},
-                                    'stage_durations_ms': stage_durations_ms,
-                                    'stage_anomalies': stage_anomalies,
-                                },
-                            }
-                        except Exception:
-                            debug_time = {'error': 'debug_time_build_failed'}
-                except Exception:
-                    pass
+            fields = _parse_progress_fields(request.GET.get('fields'))
+        except ValueError as e:
+            return JsonResponse({'success': False, 'message': f'未知字段：{e}'}, status=400)
 
-                # selected_examinations 可能是 list(JSONField) 或 M2M manager，做兼容读取
-                selected_exam_ids = []
-                try:
-                    selected_exams_obj = getattr(session, 'selected_examinations', None)
-                    if hasattr(selected_exams_obj, 'values_list'):
-                        selected_exam_ids = list(selected_exams_obj.values_list('id', flat=True))
-                    else:
-                        selected_exam_ids = list(selected_exams_obj or [])
-                except Exception:
-                    selected_exam_ids = []
-
-                selected_exam_details = []
-                if selected_exam_ids:
-                    try:
-                        from cases.models import ExaminationOption
-                        exam_rows = list(ExaminationOption.objects.filter(id__in=selected_exam_ids).values('id', 'examination_name'))
-                        id_to_name = {row['id']: row.get('examination_name') for row in exam_rows}
-                        selected_exam_details = [
-                            {'id': int(exam_id), 'name': id_to_name.get(int(exam_id)) or f'检查#{exam_id}'}
-                            for exam_id in selected_exam_ids
-                        ]
-                    except Exception:
-                        selected_exam_details = [{'id': int(exam_id), 'name': f'检查#{exam_id}'} for exam_id in selected_exam_ids]
-
-                diagnosis_record = session_data.get('diagnosis')
-                treatment_record = session_data.get('treatment')
-
-                # 仅返回“本轮”计时数据，避免旧 run 的 stage_times 混入导致前端复盘/调试紊乱
-                def _filter_timing_dict(raw_dict, run_start):
-                    if not isinstance(raw_dict, dict) or not raw_dict:
-                        return raw_dict
-                    if not run_start:
-                        return raw_dict
-                    filtered = {}
-                    for k, v in raw_dict.items():
-                        dtv = None
-                        try:
-                            dtv = timezone.datetime.fromisoformat(str(v).replace('Z', '+00:00'))
-                            if timezone.is_naive(dtv):
-                                dtv = timezone.make_aware(dtv, timezone.get_current_timezone())
-                        except Exception:
-                            dtv = None
-                        if dtv is None or dtv >= run_start:
-                            filtered[str(k)] = v
-                    return filtered
-
-                run_started_at = None
-                try:
-                    run_started_at = timezone.datetime.fromisoformat(str(session_data.get('run_started_at')).replace('Z', '+00:00')) if session_data.get('run_started_at') else None
-                    if run_started_at and timezone.is_naive(run_started_at):
-                        run_started_at = timezone.make_aware(run_started_at, timezone.get_current_timezone())
-                except Exception:
-                    run_started_at = None
-
-                stage_times = _filter_timing_dict(session_data.get('stage_times'), run_started_at)
-                stage_start_times = _filter_timing_dict(session_data.get('stage_start_times'), run_started_at)
-
-                # 后端权威口径：计算各主阶段用时（毫秒），前端不再兜底/估算。
-                stage_durations_ms = None
-                try:
-                    def _parse_dt2(value):
-                        if not value:
-                            return None
-                        try:
-                            dt = timezone.datetime.fromisoformat(str(value).replace('Z', '+00:00'))
-                            if timezone.is_naive(dt):
-                                dt = timezone.make_aware(dt, timezone.get_current_timezone())
-                            return dt
-                        except Exception:
-                            return None
-
-                    completed_at2 = getattr(session, 'completed_at', None)
-                    last_activity2 = getattr(session, 'last_activity', None)
-                    end_time2 = None
-                    try:
-                        candidates2 = [t for t in (completed_at2, last_activity2) if t is not None]
-                        if candidates2:
-                            end_time2 = max(candidates2)
-                    except Exception:
-                        end_time2 = completed_at2 or last_activity2
-
-                    # run_started_at 再兜底一次：若缺失，用本轮 stage_times 最早时间戳；最后才回退 started_at
-                    run_started_at2 = run_started_at
-                    if run_started_at2 is None:
-                        try:
-                            st2 = stage_times or {}
-                            if isinstance(st2, dict) and st2:
-                                parsed2 = [_parse_dt2(v) for v in st2.values()]
-                                parsed2 = [x for x in parsed2 if x is not None]
-                                if parsed2:
-                                    run_started_at2 = min(parsed2)
-                        except Exception:
-                            pass
-                    if run_started_at2 is None:
-                        run_started_at2 = getattr(session, 'started_at', None)
+        # 可选：后端计时 debug 输出（只在开发模式开启，避免泄露/干扰生产）
+        debug_time_enabled = 'review' in fields and bool(getattr(settings, 'DEBUG', False)) and (
+            request.GET.get('debug_time') in ('1', 'true', 'True')
+        )
 
-                    major_stages2 = ['case_presentation', 'examination_selection', 'diagnosis_reasoning', 'treatment_selection', 'learning_feedback']
+        clinical_case = get_object_or_404(ClinicalCase, case_id=case_id, is_active=True)
+        
+        sessions = StudentClinicalSession.objects.filter(student=request.user, clinical_case=clinical_case)
+        if 'review' not in fields:
+            sessions = sessions.only('id', 'session_status', 'last_activity', 'version', *PROGRESS_SCORE_FIELDS)
+        session = sessions.first()
+        if session is None:
+            return JsonResponse({'success': True, 'data': {'session_status': 'case_presentation'}})
 
-                    # 计算阶段开始：优先 stage_start_times，其次 stage_times 的 to_stage 首次进入；case_presentation 用 run_started_at
-                    stage_start_dt2 = {}
+        # 已完成会话的 review 读取快照，心跳不再改变其内容
+        active = active_revision(session.pk) if 'review' in fields and session.completed_at is None else ''
+        etag = quote_etag('{}-{}-{}-{}-{}{}'.format(
+            session.pk, to_ms(session.last_activity), session.version, '.'.join(fields), active,
+            '-debug' if debug_time_enabled else '',
+        ))
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            response = HttpResponseNotModified()
+            response['ETag'] = etag
+            return response
+
+        progress_data = {}
+        for field in fields:
+            if field == 'step_data':
+                progress_data['step_data'] = (session.session_data or {}).get('step_data') or {}
+            elif field == 'review':
+                # 复盘所需数据：检查选择、诊断提交、阶段用时等（即使部分字段异常，也不要让接口500）
+                review_payload = session_review(session)
+                if debug_time_enabled:
                     try:
-                        sst2 = stage_start_times or {}
-                        if not isinstance(sst2, dict):
-                            sst2 = {}
-                        inferred_to_stage2 = {}
-                        st2 = stage_times or {}
-                        if isinstance(st2, dict):
-                            for k, v in st2.items():
-                                m = re.match(r'^(.+)_to_(.+)$', str(k))
-                                if not m:
-                                    continue
-                                to_stage = m.group(2)
-                                dtv = _parse_dt2(v)
-                                if dtv is None:
-                                    continue
-                                if to_stage not in inferred_to_stage2 or dtv < inferred_to_stage2[to_stage]:
-                                    inferred_to_stage2[to_stage] = dtv
-
-                        for stg in major_stages2:
-                            dtv = _parse_dt2(sst2.get(stg)) or inferred_to_stage2.get(stg)
-                            if dtv is None and stg == 'case_presentation':
-                                dtv = run_started_at2
-                            stage_start_dt2[stg] = dtv
+                        review_payload['debug_time'] = debug_timing(session, timing_engine.timing(session))
                     except Exception:
-                        stage_start_dt2 = {stg: (run_started_at2 if stg == 'case_presentation' else None) for stg in major_stages2}
-
-                    # 计算阶段结束：选“开始之后最近的下一事件（其他阶段开始/会话结束）”
-                    stage_end_dt2 = {}
-                    all_starts2 = [dt for dt in stage_start_dt2.values() if dt is not None]
-                    for stg in major_stages2:
-                        sdt = stage_start_dt2.get(stg)
-                        if sdt is None:
-                            stage_end_dt2[stg] = None
-                            continue
-                        candidates = [dt for dt in all_starts2 if dt > sdt]
-                        if end_time2 is not None and end_time2 > sdt:
-                            candidates.append(end_time2)
-                        stage_end_dt2[stg] = min(candidates) if candidates else end_time2
-
-                    # 生成 durations
-                    stage_durations_ms = {}
-                    for stg in major_stages2:
-                        sdt = stage_start_dt2.get(stg)
-                        edt = stage_end_dt2.get(stg)
-                        if not sdt or not edt or edt < sdt:
-                            stage_durations_ms[stg] = None
-                            continue
-                        ms = int((edt - sdt).total_seconds() * 1000)
-                        if ms < 0 or ms > 24 * 60 * 60 * 1000:
-                            stage_durations_ms[stg] = None
-                        else:
-                            stage_durations_ms[stg] = ms
-                except Exception:
-                    stage_durations_ms = None
-
-                # selected_treatments 可能来自 session_data['treatment'] 或 M2M/list
-                selected_treatment_ids = []
-                try:
-                    selected_treats_obj = getattr(session, 'selected_treatments', None)
-                    if isinstance(treatment_record, dict) and treatment_record.get('treatment_ids'):
-                        selected_treatment_ids = list(treatment_record.get('treatment_ids') or [])
-                    elif hasattr(selected_treats_obj, 'values_list'):
-                        selected_treatment_ids = list(selected_treats_obj.values_list('id', flat=True))
-                    else:
-                        selected_treatment_ids = list(selected_treats_obj or [])
-                except Exception:
-                    selected_treatment_ids = []
+                        review_payload['debug_time'] = {'error': 'debug_time_build_failed'}
+                progress_data['review'] = review_payload
+            else:
+                progress_data[field] = getattr(session, field, None)
 
-                selected_treatment_details = []
-                if selected_treatment_ids:
-                    try:
-                        from cases.models import TreatmentOption
-                        rows = list(TreatmentOption.objects.filter(id__in=selected_treatment_ids).values('id', 'treatment_name'))
-                        id_to_name = {row['id']: row.get('treatment_name') for row in rows}
-                        selected_treatment_details = [
-                            {'id': int(tid), 'name': id_to_name.get(int(tid)) or f'治疗#{tid}'}
-                            for tid in selected_treatment_ids
-                        ]
-                    except Exception:
-                        selected_treatment_details = [{'id': int(tid), 'name': f'治疗#{tid}'} for tid in selected_treatment_ids]
-
-                review_payload = {
-                    'selected_examinations': selected_exam_details,
-                    'diagnosis': diagnosis_record,
-                    'selected_treatments': selected_treatment_details,
-                    'treatment': treatment_record,
-                    'stage_times': stage_times,
-                    'stage_start_times': stage_start_times,
-                    'stage_durations_ms': stage_durations_ms,
-                    'session_started_at': review_payload.get('session_started_at'),
-                    'session_completed_at': review_payload.get('session_completed_at'),
-                    'session_last_activity_at': review_payload.get('session_last_activity_at'),
-                    'session_total_ms': review_payload.get('session_total_ms'),
-                    **({'debug_time': debug_time} if debug_time_enabled else {}),
-                }
-            except Exception:
-                # 保持 review_payload 默认值，确保接口继续成功返回
-                pass
-            progress_data = {
-                'session_status': getattr(session, 'session_status', None),
-                'step_data': getattr(session, 'step_data', None) or {},
-                'examination_score': getattr(session, 'examination_score', None),
-                'diagnosis_score': getattr(session, 'diagnosis_score', None),
-                'treatment_score': getattr(session, 'treatment_score', None),
-                'overall_score': getattr(session, 'overall_score', None),
-                'review': review_payload,
-            }
-            return JsonResponse({'success': True, 'data': progress_data})
-        except StudentClinicalSession.DoesNotExist:
-            return JsonResponse({'success': True, 'data': {'session_status': 'case_presentation'}})
+        response = JsonResponse({'success': True, 'data': progress_data})
+        response['ETag'] = etag
+        # 允许浏览器缓存但每次都带 If-None-Match 回源校验
+        response['Cache-Control'] = 'private, no-cache'
+        return response
     except Exception as e:
         return JsonResponse({'success': False, 'message': str(e)}, status=500)
 
@@ -2849,12 +2306,13 @@ def reset_clinical_progress(request):
         
         clinical_case = get_object_or_404(ClinicalCase, case_id=case_id, is_active=True)
         
-        # 删除现有会话或重置为初始状态
+        # 删除现有会话；本轮先归档到 SessionRun，历史轮次不随会话删除
         try:
             session = StudentClinicalSession.objects.get(
                 student=request.user,
                 clinical_case=clinical_case
             )
+            archive_run(session)
             session.delete()
         except StudentClinicalSession.DoesNotExist:
             pass
@@ -2894,23 +2352,8 @@ def teacher_clinical_case_list(request):
     elif status_filter == 'inactive':
         cases = cases.filter(is_active=False)
     
-    # 为每个病例添加统计数据（注意：多表 join 会导致 Count 被放大，必须 distinct）
-    from django.db.models import Count, Avg
-    cases = cases.annotate(
-        examination_count=Count('examination_options', distinct=True),
-        diagnosis_count=Count('diagnosis_options', distinct=True),
-        treatment_count=Count('treatment_options', distinct=True),
-        student_sessions_count=Count('studentclinicalsession', distinct=True),
-        completed_sessions_count=Count(
-            'studentclinicalsession',
-            filter=Q(studentclinicalsession__completed_at__isnull=False),
-            distinct=True,
-        ),
-        avg_score=Avg(
-            'studentclinicalsession__overall_score',
-            filter=Q(studentclinicalsession__overall_score__gt=0),
-        ),
-    )
+    # 统计数据读取病例计数器（一对一连接，不再连接选项表和会话表做聚合）
+    cases = cases.select_related('counters')
     
     # 分页
     from django.core.paginator import Paginator
@@ -2918,12 +2361,19 @@ def teacher_clinical_case_list(request):
     page_number = request.GET.get('page')
     page_obj = paginator.get_page(page_number)
     
-    # 为分页后的每个病例补齐展示字段（不再做额外查询，避免 N+1）
+    # 为分页后的每个病例补齐展示字段（缺少计数器行的病例补建一次）
     for case in page_obj:
-        total_sessions = int(getattr(case, 'student_sessions_count', 0) or 0)
-        completed_sessions = int(getattr(case, 'completed_sessions_count', 0) or 0)
-        case.completion_rate = round((completed_sessions / total_sessions * 100), 1) if total_sessions > 0 else 0
-        case.avg_score = float(getattr(case, 'avg_score', 0) or 0)
+        try:
+            counters = case.counters
+        except CaseCounters.DoesNotExist:
+            create_case_counters(case.pk)
+            counters = CaseCounters.objects.get(pk=case.pk)
+        case.examination_count = counters.examination_count
+        case.diagnosis_count = counters.diagnosis_count
+        case.treatment_count = counters.treatment_count
+        case.student_sessions_count = counters.session_count
+        case.completion_rate = counters.completion_rate
+        case.avg_score = float(counters.average_score)
     
     context = {
         'page_obj': page_obj,
@@ -3143,8 +2593,9 @@ def teacher_clinical_case_scores(request, case_id):
     page_obj = paginator.get_page(page_number)
 
     items = []
+    page_minutes = _sessions_study_minutes(page_obj)
     for session in page_obj:
-        case_minutes = _get_session_study_time_minutes(session)
+        case_minutes = page_minutes.get(session.pk)
         items.append(
             {
                 'session': session,
@@ -3152,26 +2603,323 @@ def teacher_clinical_case_scores(request, case_id):
             }
         )
 
-    # 汇总：平均分（与列表页一致，统计 overall_score>0）
-    from django.db.models import Avg
-    avg_score = (
-        sessions_qs.filter(overall_score__gt=0)
-        .aggregate(Avg('overall_score'))
-        .get('overall_score__avg')
-        or 0
-    )
+    # 汇总：读取病例每日汇总（完成且得分大于 0 的轮次平均分）
+    totals = rollup_totals(clinical_case=clinical_case)
 
     context = {
         'clinical_case': clinical_case,
         'page_obj': page_obj,
         'items': items,
-        'avg_score': float(avg_score or 0),
-        'total_sessions': sessions_qs.count(),
-        'completed_sessions': sessions_qs.filter(Q(session_status='completed') | Q(completed_at__isnull=False)).count(),
+        'avg_score': float(totals['average_score']),
+        'total_sessions': totals['sessions_started'],
+        'completed_sessions': totals['sessions_completed'],
     }
     return render(request, 'teacher/clinical_case_scores.html', context)
 
 
+def _analytics_scope(request):
+    """分析范围：?case_id=（病例编号）与 ?group=（学生分组名）"""
+    case_id = request.GET.get('case_id', '').strip()
+    clinical_case = get_object_or_404(ClinicalCase, case_id=case_id) if case_id else None
+    group = request.GET.get('group', '').strip() or None
+    return clinical_case, group
+
+
+@login_required
+@user_passes_test(is_teacher, login_url='login')
+def teacher_score_analytics_api(request):
+    """教师端API：成绩分布与各项得分相关系数；传入 ?page= 时附带该页会话的百分位排名与 z 分数"""
+    clinical_case, group = _analytics_scope(request)
+    try:
+        case_pk = clinical_case.pk if clinical_case else None
+        data = dict(score_analytics(case_pk, group), case_id=clinical_case.case_id if clinical_case else None, group=group)
+        if 'page' in request.GET:
+            page_obj, sessions = session_ranks_page(data, case_pk, group, request.GET.get('page'))
+            data.update(sessions=sessions, page=page_obj.number, num_pages=page_obj.paginator.num_pages)
+        return JsonResponse({
+            'success': True,
+            'data': data,
+            'message': '成绩分析获取成功' if data['count'] else '该范围内暂无已完成的学习记录'
+        })
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'message': f'获取成绩分析失败：{str(e)}'
+        }, status=500)
+
+
+@login_required
+@user_passes_test(is_teacher, login_url='login')
+def teacher_score_analytics(request):
+    """教师端：成绩分析页面"""
+    clinical_case, group = _analytics_scope(request)
+    case_pk = clinical_case.pk if clinical_case else None
+    error = None
+    analytics = None
+    try:
+        analytics = score_analytics(case_pk, group)
+    except AnalyticsUnavailable as e:
+        error = str(e)
+
+    distributions = []
+    correlation_rows = []
+    sessions = []
+    page_obj = None
+    if analytics:
+        edges = analytics['histogram_edges']
+        for field, dist in analytics['distributions'].items():
+            peak = max(dist['histogram']) or 1
+            distributions.append(dict(dist, field=field, bins=[
+                {'label': f'{edges[i]}-{edges[i + 1]}', 'count': count, 'width': round(count / peak * 100)}
+                for i, count in enumerate(dist['histogram'])
+            ], quantile_pairs=list(zip(analytics['percentiles'], dist['quantiles']))))
+        labels = {field: dist['label'] for field, dist in analytics['distributions'].items()}
+        for field, row in analytics['correlations'].items():
+            correlation_rows.append({'label': labels[field], 'values': list(row.values())})
+        page_obj, sessions = session_ranks_page(analytics, case_pk, group, request.GET.get('page'))
+
+    context = {
+        'analytics': analytics,
+        'error': error,
+        'distributions': distributions,
+        'correlation_labels': [dist['label'] for dist in distributions],
+        'correlation_rows': correlation_rows,
+        'sessions': sessions,
+        'page_obj': page_obj,
+        'selected_case': clinical_case,
+        'selected_group': group or '',
+        'case_choices': ClinicalCase.objects.order_by('case_id').values_list('case_id', 'title'),
+        'group_choices': Group.objects.exclude(name='Teachers').order_by('name').values_list('name', flat=True),
+    }
+    return render(request, 'teacher/score_analytics.html', context)
+
+
+PROFILE_PAGE_SIZE = 50
+PROFILE_SORTS = {
+    'recent': (F('last_completed_at').desc(nulls_last=True),),
+    'score': ('-score_ewma',),
+    'hints': (F('hint_ratio').desc(nulls_last=True), '-hinted_runs'),
+}
+
+
+def _learning_profile_page(request):
+    """学习画像列表：?group=（学生分组名）、?sort=recent|score|hints、?page="""
+    group = request.GET.get('group', '').strip() or None
+    sort = request.GET.get('sort', 'recent')
+    if sort not in PROFILE_SORTS:
+        sort = 'recent'
+    profiles = StudentLearningProfile.objects.select_related('student').annotate(
+        hint_ratio=Cast('hinted_runs', FloatField()) / NullIf('diagnosis_runs', 0),
+    )
+    if group:
+        profiles = profiles.filter(student__groups__name=group)
+    from django.core.paginator import Paginator
+    page_obj = Paginator(profiles.order_by(*PROFILE_SORTS[sort], 'student_id'), PROFILE_PAGE_SIZE).get_page(request.GET.get('page'))
+    return page_obj, group, sort
+
+
+@login_required
+@user_passes_test(is_teacher, login_url='login')
+def teacher_learning_profiles_api(request):
+    """教师端API：学生学习画像列表（各阶段提交次数、提示依赖、得分趋势）"""
+    try:
+        page_obj, group, sort = _learning_profile_page(request)
+        return JsonResponse({
+            'success': True,
+            'data': {
+                'profiles': [profile_summary(profile) for profile in page_obj],
+                'group': group,
+                'sort': sort,
+                'page': page_obj.number,
+                'num_pages': page_obj.paginator.num_pages,
+                'total': page_obj.paginator.count,
+            },
+            'message': '学习画像获取成功'
+        })
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'message': f'获取学习画像失败：{str(e)}'
+        }, status=500)
+
+
+@login_required
+@user_passes_test(is_teacher, login_url='login')
+def teacher_student_learning_profile_api(request, student_id):
+    """教师端API：单个学生的学习画像（尚无完成记录时各项为 0）"""
+    student = get_object_or_404(User, id=student_id)
+    try:
+        profile = StudentLearningProfile.objects.filter(student=student).first() or StudentLearningProfile(student=student)
+        return JsonResponse({
+            'success': True,
+            'data': profile_summary(profile),
+            'message': '学习画像获取成功' if profile.runs_completed else '该学生暂无已完成的学习记录'
+        })
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'message': f'获取学习画像失败：{str(e)}'
+        }, status=500)
+
+
+@login_required
+@user_passes_test(is_teacher, login_url='login')
+def teacher_learning_profiles(request):
+    """教师端：学生学习画像页面"""
+    page_obj, group, sort = _learning_profile_page(request)
+    context = {
+        'page_obj': page_obj,
+        'profiles': [profile_summary(profile) for profile in page_obj],
+        'selected_group': group or '',
+        'selected_sort': sort,
+        'group_choices': Group.objects.exclude(name='Teachers').order_by('name').values_list('name', flat=True),
+    }
+    return render(request, 'teacher/learning_profiles.html', context)
+
+
+def _monitor_case(request):
+    """监控范围：?case_id=（病例编号），缺省为全部病例"""
+    case_id = request.GET.get('case_id', '').strip()
+    return get_object_or_404(ClinicalCase, case_id=case_id) if case_id else None
+
+
+@login_required
+@user_passes_test(is_teacher, login_url='login')
+def teacher_live_monitor(request):
+    """教师端：课堂实时监控页面"""
+    clinical_case = _monitor_case(request)
+    context = {
+        'selected_case': clinical_case,
+        'case_choices': ClinicalCase.objects.order_by('case_id').values_list('case_id', 'title'),
+        'busy_retry_seconds': MONITOR_BUSY_RETRY_SECONDS,
+    }
+    return render(request, 'teacher/live_monitor.html', context)
+
+
+@login_required
+@user_passes_test(is_teacher, login_url='login')
+def teacher_live_monitor_stream(request):
+    """教师端：课堂实时监控事件流（text/event-stream，先发快照，之后只推送事件）"""
+    clinical_case = _monitor_case(request)
+    case_pk = clinical_case.pk if clinical_case else None
+    if isinstance(request, ASGIRequest):
+        # ASGI 下用异步生成器，等待事件时不占用线程
+        events = astream_events(case_pk)
+    else:
+        # WSGI 下每个连接占用一个线程，超过上限时拒绝
+        try:
+            events = open_sync_stream(case_pk)
+        except MonitorBusy as e:
+            response = JsonResponse({'success': False, 'message': str(e)}, status=503)
+            response['Retry-After'] = str(MONITOR_BUSY_RETRY_SECONDS)
+            return response
+    response = StreamingHttpResponse(events, content_type='text/event-stream; charset=utf-8')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def _export_sessions(request, queryset, filename):
+    """导出会话明细（?format=csv|xlsx，默认 csv）"""
+    try:
+        return export_response(queryset, request.GET.get('format', 'csv'), filename)
+    except ValueError as e:
+        return JsonResponse({'success': False, 'message': str(e)}, status=400)
+    except ExportUnavailable as e:
+        return JsonResponse({'success': False, 'message': str(e)}, status=500)
+
+
+@login_required
+@user_passes_test(is_teacher, login_url='login')
+def teacher_clinical_case_scores_export(request, case_id):
+    """教师端：导出某个病例的全部会话明细"""
+    clinical_case = get_object_or_404(ClinicalCase, case_id=case_id)
+    return _export_sessions(request, export_queryset(clinical_case=clinical_case), f'scores_{clinical_case.case_id}')
+
+
+@login_required
+@user_passes_test(is_teacher, login_url='login')
+def teacher_sessions_export(request):
+    """教师端：导出全系统会话明细；?group= 只导出该学生分组（班级/批次）"""
+    group = request.GET.get('group', '').strip()
+    filename = f'scores_group_{group}' if group else 'scores_all'
+    return _export_sessions(request, export_queryset(group=group or None), filename)
+
+
+@login_required
+@user_passes_test(is_teacher, login_url='login')
+def teacher_case_item_analysis(request, case_id):
+    """教师端API：某个病例各选项的作答分布与区分度（由 compute_item_analysis 命令离线计算）"""
+    try:
+        clinical_case = get_object_or_404(ClinicalCase, case_id=case_id)
+        try:
+            min_exposures = max(1, int(request.GET.get('min_exposures', 10)))
+        except (TypeError, ValueError):
+            min_exposures = 10
+        
+        items = case_item_analysis(clinical_case, min_exposures=min_exposures)
+        kind = request.GET.get('kind')
+        if kind:
+            items = [item for item in items if item['kind'] == kind]
+        
+        return JsonResponse({
+            'success': True,
+            'data': {
+                'case_id': clinical_case.case_id,
+                'items': items,
+                'total_count': len(items),
+                'computed_at': items[0]['computed_at'] if items else None,
+            },
+            'message': '选项分析获取成功' if items else '暂无分析数据，请先运行 compute_item_analysis 命令'
+        })
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'message': f'获取选项分析失败：{str(e)}'
+        }, status=500)
+
+
+@login_required
+@user_passes_test(is_teacher, login_url='login')
+def teacher_case_tuning_api(request, case_id):
+    """教师端API：某个病例各项得分与提交次数的直方图（读取完成时累加的调优摘要）"""
+    try:
+        clinical_case = get_object_or_404(ClinicalCase, case_id=case_id)
+        data = tuning_summary(clinical_case)
+        return JsonResponse({
+            'success': True,
+            'data': data,
+            'message': '调优数据获取成功' if data['runs_completed'] else '该病例暂无已完成的学习记录'
+        })
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'message': f'获取调优数据失败：{str(e)}'
+        }, status=500)
+
+
+@login_required
+@user_passes_test(is_teacher, login_url='login')
+def teacher_case_tuning(request, case_id):
+    """教师端：病例调优页面（得分/提交次数分布 + 选项分析）"""
+    clinical_case = get_object_or_404(ClinicalCase, case_id=case_id)
+    summary = tuning_summary(clinical_case)
+    histograms = []
+    for name, histogram in summary['histograms'].items():
+        peak = max(histogram['counts']) or 1
+        histograms.append(dict(histogram, name=name, rows=[
+            {'label': label, 'count': count, 'width': round(count / peak * 100)}
+            for label, count in zip(histogram['bins'], histogram['counts'])
+        ]))
+    context = {
+        'clinical_case': clinical_case,
+        'summary': summary,
+        'histograms': histograms,
+        'items': case_item_analysis(clinical_case),
+    }
+    return render(request, 'teacher/case_tuning.html', context)
+
+
 @login_required
 def test_delete_view(request):
     """测试删除功能的简单页面"""
@@ -3198,27 +2946,13 @@ def system_management(request):
     """系统管理主页面"""
     from django.contrib.auth.models import User, Group
     
-    # 统计数据
-    total_users = User.objects.count()
-    teachers_count = User.objects.filter(groups__name='Teachers').count()
-    students_count = User.objects.filter(groups__name='Students').count()
-    superusers_count = User.objects.filter(is_superuser=True).count()
-    
     # 最近注册的用户
-    recent_users = User.objects.order_by('-date_joined')[:10]
-    
-    # 活跃用户统计
-    from datetime import datetime, timedelta
-    last_30_days = datetime.now() - timedelta(days=30)
-    active_users = User.objects.filter(last_login__gte=last_30_days).count()
+    recent_users = User.objects.prefetch_related('groups').order_by('-date_joined')[:10]
     
     context = {
-        'total_users': total_users,
-        'teachers_count': teachers_count,
-        'students_count': students_count,
-        'superusers_count': superusers_count,
-        'active_users': active_users,
         'recent_users': recent_users,
+        # 用户计数读取统计快照
+        'stats': stats_snapshot(),
     }
     
     return render(request, 'teacher/system_management.html', context)
@@ -3464,24 +3198,8 @@ def user_detail(request, user_id):
     # 获取用户的学习统计
     user_sessions = StudentClinicalSession.objects.filter(student=user_obj)
     completed_sessions = user_sessions.filter(completed_at__isnull=False).count()
-    total_study_time = 0
-    
-    for session in user_sessions.filter(completed_at__isnull=False):
-        if session.completed_at and session.started_at:
-            # 使用last_activity作为实际学习结束时间
-            if session.last_activity:
-                duration = session.last_activity - session.started_at
-            else:
-                duration = session.completed_at - session.started_at
-            
-            duration_minutes = duration.total_seconds() / 60
-            if duration_minutes > 0:
-                total_study_time += duration_minutes
-    
-    # 格式化学习时长
-    hours = int(total_study_time // 60)
-    minutes = int(total_study_time % 60)
-    formatted_study_time = f"{hours}h {minutes}min" if hours > 0 else f"{minutes}min"
+    # 与学生端/教师首页同一口径
+    formatted_study_time = _format_minutes_as_hm(_get_user_total_study_time_minutes(user_obj))
     
     context = {
         'user_obj': user_obj,
@@ -3490,6 +3208,7 @@ def user_detail(request, user_id):
         'completed_sessions': completed_sessions,
         'formatted_study_time': formatted_study_time,
         'recent_sessions': user_sessions.order_by('-started_at')[:5],
+        'learning_profile': StudentLearningProfile.objects.filter(student=user_obj).first(),
     }
     
     return render(request, 'teacher/user_detail.html', context)
@@ -4066,15 +3785,17 @@ def teacher_treatment_delete(request, treatment_id):
 def student_learning_notes(request):
     """学生端 - 查看学习笔记"""
     
-    # 获取该学生的所有临床会话及其笔记
-    sessions_with_notes = StudentClinicalSession.objects.filter(
-        student=request.user,
-        learning_notes__isnull=False
-    ).exclude(learning_notes='').select_related('clinical_case').order_by('-last_activity')
+    # 按 (student, updated_at) 索引读取笔记表
+    notes = list(
+        LearningNote.objects.filter(student=request.user)
+        .exclude(content='')
+        .select_related('clinical_case')
+        .order_by('-updated_at')
+    )
     
     context = {
-        'sessions_with_notes': sessions_with_notes,
-        'total_notes_count': sessions_with_notes.count(),
+        'notes': notes,
+        'total_notes_count': len(notes),
     }
     
     return render(request, 'student/learning_notes.html', context)
@@ -4122,17 +3843,13 @@ def chat_api(request, case_id):
         sys.stdout.write(f"会话ID: {session.id}\n")
         sys.stdout.flush()
         
-        # 检查当前阶段是否允许聊天（病史采集和检查选择阶段允许，诊断和治疗阶段禁止）
-        allowed_chat_stages = ['case_presentation', 'examination_selection', 'examination_results']
-        forbidden_chat_stages = ['diagnosis_reasoning', 'treatment_selection', 'learning_feedback', 'completed']
-        
-        sys.stdout.write(f"允许聊天的阶段: {allowed_chat_stages}\n")
-        sys.stdout.write(f"禁止聊天的阶段: {forbidden_chat_stages}\n")
-        sys.stdout.write(f"session.session_status in forbidden_chat_stages: {session.session_status in forbidden_chat_stages}\n")
+        # 检查当前阶段是否允许聊天（病史采集和检查选择阶段允许，诊断和治疗阶段禁止，见 state_machine.ENDPOINT_STAGES）
+        chat_allowed = stage_allows(session.session_status, 'chat')
+        sys.stdout.write(f"允许聊天: {chat_allowed}\n")
         sys.stdout.flush()
         
-        if session.session_status in forbidden_chat_stages:
-            sys.stdout.write(f"❌ 阶段检查失败: '{session.session_status}' 在禁止列表中\n")
+        if not chat_allowed:
+            sys.stdout.write(f"❌ 阶段检查失败: '{session.session_status}' 不允许聊天\n")
             sys.stdout.write(f"{'='*60}\n")
             sys.stdout.flush()
             return JsonResponse({
@@ -4596,22 +4313,11 @@ def update_session_stage(request, case_id):
         data = json.loads(request.body)
         new_stage = data.get('stage', '').strip()
         
-        # 有效的阶段值（前后端已统一命名）
-        valid_stages = [
-            'case_presentation',
-            'examination_selection',
-            'examination_results',
-            'diagnosis_reasoning',
-            'treatment_selection',
-            'learning_feedback',
-            'completed'
-        ]
-        
-        # 验证阶段值
-        if new_stage not in valid_stages:
+        # 验证阶段值（前后端已统一命名，见 state_machine.STAGES）
+        if new_stage not in STAGES:
             return JsonResponse({
                 'success': False,
-                'error': f'无效的阶段值: {new_stage}。有效值为: {valid_stages}'
+                'error': f'无效的阶段值: {new_stage}。有效值为: {list(STAGES)}'
             })
         
         # 前后端已统一命名，直接使用
@@ -4624,125 +4330,76 @@ def update_session_stage(request, case_id):
             clinical_case=clinical_case,
             defaults={'session_status': actual_stage}
         )
+        if not created and not can_transition(session.session_status, actual_stage):
+            return JsonResponse({
+                'success': False,
+                'error': str(IllegalTransition(session.session_status, actual_stage))
+            }, status=409)
 
         # 若用户重新回到病史采集（case_presentation），通常表示开始新一轮学习。
-        # 为避免继承上一轮计时导致“总用时/阶段用时爆炸”，这里重置本轮计时相关字段。
+        # 为避免继承上一轮计时导致“总用时/阶段用时爆炸”，这里开始新的一轮（run +1），
+        # 旧轮次的事件原样保留在 SessionStageEvent 中，不再复制进 timing_archives。
         # 触发条件：
         # - 明确完成态（learning_feedback/completed 或 completed_at 不为空）后回到病史采集
-        # - 或者：当前阶段已是病史采集，但 session_data 里存在后续阶段的旧计时痕迹（常见于刷新/返回第一阶段）
+        # - 或者：当前阶段已是病史采集，但本轮已记录过后续阶段（常见于刷新/返回第一阶段）
         # - 或者：前端显式传入 restart/reset_timing=true
-        try:
-            if not session.session_data:
-                session.session_data = {}
-            old_status = getattr(session, 'session_status', None)
-            is_completed_like = (old_status in ('learning_feedback', 'completed')) or (getattr(session, 'completed_at', None) is not None)
-
-            restart_flag = False
-            try:
-                restart_flag = bool(data.get('restart') or data.get('reset_timing'))
-            except Exception:
-                restart_flag = False
-
-            # 检测“已回到第一阶段但计时仍残留”的情况：
-            # - session_status 已是 case_presentation（前端/刷新可能把视图带回第一阶段）
-            # - 但 stage_start_times/stage_times 中已经记录过后续阶段（说明不是第一次进入）
-            has_progress_markers = False
-            try:
-                sst = session.session_data.get('stage_start_times')
-                st = session.session_data.get('stage_times')
-                if isinstance(sst, dict):
-                    has_progress_markers = any(k and str(k) != 'case_presentation' for k in sst.keys())
-                if not has_progress_markers and isinstance(st, dict):
-                    has_progress_markers = bool(st)
-            except Exception:
-                has_progress_markers = False
-
-            is_restart_to_case = (actual_stage == 'case_presentation') and (
-                restart_flag or is_completed_like or (old_status == 'case_presentation' and has_progress_markers)
-            )
-
-            if is_restart_to_case:
-                now_iso = timezone.now().isoformat()
-
-                archives = session.session_data.get('timing_archives')
-                if not isinstance(archives, list):
-                    archives = []
-                archives.append({
-                    'archived_at': now_iso,
-                    'run_started_at': session.session_data.get('run_started_at'),
-                    'stage_start_times': session.session_data.get('stage_start_times'),
-                    'stage_times': session.session_data.get('stage_times'),
-                    'session_status_before': old_status,
-                    'completed_at_before': getattr(session, 'completed_at', None).isoformat() if getattr(session, 'completed_at', None) else None,
-                })
-
-                session.session_data['timing_archives'] = archives
-                session.session_data['run_started_at'] = now_iso
-                session.session_data['stage_start_times'] = {}
-                session.session_data['stage_times'] = {}
-                # 清理完成标记，让新一轮有正确的 end_time 口径
-                if getattr(session, 'completed_at', None) is not None:
-                    session.completed_at = None
-        except Exception:
-            pass
+        now_ms = to_ms(timezone.now())
+        update_fields = []
+        events = []
+        timing = legacy_timing(session)
+        run = timing.get('run') or 0
+        old_status = session.session_status
+        is_completed_like = old_status in ('learning_feedback', 'completed') or session.completed_at is not None
+        restart_flag = bool(data.get('restart') or data.get('reset_timing'))
+        has_progress_markers = any(
+            k and str(k) != 'case_presentation' for k in (timing.get('stage_start_times') or {})
+        ) or bool(timing.get('stage_times'))
+
+        is_restart_to_case = (actual_stage == 'case_presentation') and (
+            restart_flag or is_completed_like or (old_status == 'case_presentation' and has_progress_markers)
+        )
 
-        # 初始化本轮开始时间（用于前端/复盘计时对齐）
-        if not session.session_data:
-            session.session_data = {}
-        changed_meta = False
-        now_iso = timezone.now().isoformat()
-        if not session.session_data.get('run_started_at'):
-            # 旧会话首次补齐 run_started_at：为避免历史 stage_times/stage_start_times 污染本轮，先归档再清空
-            try:
-                existing_stage_times = session.session_data.get('stage_times')
-                existing_stage_start_times = session.session_data.get('stage_start_times')
-                if (isinstance(existing_stage_times, dict) and existing_stage_times) or (isinstance(existing_stage_start_times, dict) and existing_stage_start_times):
-                    archives = session.session_data.get('timing_archives')
-                    if not isinstance(archives, list):
-                        archives = []
-                    archives.append({
-                        'archived_at': now_iso,
-                        'run_started_at': session.session_data.get('run_started_at'),
-                        'stage_start_times': existing_stage_start_times,
-                        'stage_times': existing_stage_times,
-                        'session_status_before': getattr(session, 'session_status', None),
-                        'completed_at_before': getattr(session, 'completed_at', None).isoformat() if getattr(session, 'completed_at', None) else None,
-                        'reason': 'init_run_started_at_reset_timing',
-                    })
-                    session.session_data['timing_archives'] = archives
-                    session.session_data['stage_start_times'] = {}
-                    session.session_data['stage_times'] = {}
-            except Exception:
-                pass
-            session.session_data['run_started_at'] = now_iso
-            changed_meta = True
+        if is_restart_to_case:
+            # 上一轮尚未写库的心跳归入上一轮并归档（归档失败直接报错，不开始新一轮）；
+            # 清理完成标记，让新一轮有正确的 end_time 口径
+            run_start, restart_fields = start_new_run(session, now_ms)
+            run = run_start.run
+            events.append(run_start)
+            update_fields.extend(restart_fields)
+            timing = {}
+
+        # 初始化本轮开始时间（用于前端/复盘计时对齐）；缺少开始时间的旧轮次直接开新一轮
+        if not events and not timing.get('run_started_at'):
+            run += 1
+            events.append(new_event(session, run, 'case_presentation', EVENT_RUN_START, now_ms))
+            timing = {}
 
         # 记录“每个阶段首次进入时间”（即使没有发生 stage 切换，也要写入，避免前端显示（未记录））
-        stage_start_times = session.session_data.get('stage_start_times')
-        if not isinstance(stage_start_times, dict):
-            stage_start_times = {}
-        if not stage_start_times.get(actual_stage):
-            stage_start_times[actual_stage] = now_iso
-            session.session_data['stage_start_times'] = stage_start_times
-            changed_meta = True
-        
+        if not (timing.get('stage_start_times') or {}).get(actual_stage):
+            events.append(new_event(session, run, actual_stage, EVENT_STAGE_ENTER, now_ms))
+
         # 记录阶段切换时间
-        if session.session_status != actual_stage:
-            old_stage = session.session_status
-            session.session_status = actual_stage
-            
-            # 更新时间记录
-            stage_times = session.session_data.get('stage_times', {})
-            stage_times[f'{old_stage}_to_{new_stage}'] = now_iso
-            session.session_data['stage_times'] = stage_times
-            
+        old_stage = session.session_status
+        transition_event = transition(session, actual_stage, run, now_ms)
+        if transition_event is not None:
+            update_fields.append('session_status')
+            events.append(transition_event)
+
             # 如果进入检查阶段，重置检查相关的错误计数
             if actual_stage == 'examination_selection':
-                session.session_data.pop('examination_current_attempt_count', None)
-                session.session_data.pop('examination_selection_errors', None)
-            
-            session.save()
-            
+                session_data = session.session_data or {}
+                if 'examination_current_attempt_count' in session_data or 'examination_selection_errors' in session_data:
+                    session_data.pop('examination_current_attempt_count', None)
+                    session_data.pop('examination_selection_errors', None)
+                    session.session_data = session_data
+                    update_fields.append('session_data')
+
+            update_fields.extend(apply_event_columns(session, events))
+            # 会话与事件日志同一事务写入：事件写入失败时阶段不变
+            with transaction.atomic():
+                save_session(session, fields=update_fields)
+                write_events(session, events)
+
             return JsonResponse({
                 'success': True,
                 'message': f'已切换到{new_stage}阶段',
@@ -4754,9 +4411,12 @@ def update_session_stage(request, case_id):
                 }
             })
         else:
-            # 阶段未切换，但如果补齐了 run_started_at / stage_start_times，也需要落库
-            if changed_meta:
-                session.save()
+            # 阶段未切换，但如果补齐了本轮开始/阶段首次进入时间，也需要落库
+            if events or update_fields:
+                update_fields.extend(apply_event_columns(session, events))
+                with transaction.atomic():
+                    save_session(session, fields=update_fields)
+                    write_events(session, events)
             return JsonResponse({
                 'success': True,
                 'message': f'已在{new_stage}阶段',
@@ -4771,6 +4431,11 @@ def update_session_stage(request, case_id):
             'success': False,
             'error': '无效的JSON数据'
         })
+    except SessionConflictError as e:
+        return JsonResponse({
+            'success': False,
+            'error': str(e)
+        }, status=409)
     except Exception as e:
         return JsonResponse({
             'success': False,
@@ -4778,6 +4443,41 @@ def update_session_stage(request, case_id):
         })
 
 
+@login_required
+@user_passes_test(is_student, login_url='login')
+@require_POST
+def session_heartbeat(request, case_id):
+    """
+    学习心跳：上报 {stage, active_seconds}，只累加到进程内缓冲区（定期批量写库）
+    兼容 navigator.sendBeacon 的表单提交（csrfmiddlewaretoken 放在表单中），成功返回 204；
+    stage 不是会话当前阶段时返回 409（旧页面/其他标签页的心跳不计入）
+    """
+    try:
+        if request.content_type == 'application/json':
+            data = json.loads(request.body or b'{}')
+        else:
+            data = request.POST
+        stage = normalize_stage(data.get('stage'))
+        seconds = float(data.get('active_seconds') or 0)
+    except (ValueError, TypeError):
+        return JsonResponse({'success': False, 'message': '无效的心跳数据'}, status=400)
+    if stage is None:
+        return JsonResponse({'success': False, 'message': '无效的阶段'}, status=400)
+
+    session = StudentClinicalSession.objects.filter(
+        student=request.user, clinical_case__case_id=case_id
+    ).values_list('id', 'session_status').first()
+    if session is None:
+        return JsonResponse({'success': False, 'message': '会话不存在'}, status=404)
+    session_id, session_status = session
+    if stage != normalize_stage(session_status):
+        return JsonResponse({'success': False, 'message': '阶段已切换'}, status=409)
+
+    if seconds > 0:
+        heartbeat_buffer.record(session_id, stage, seconds)
+    return HttpResponse(status=204)
+
+
 @require_POST 
 def save_history_summary(request, case_id):
     """
@@ -4817,7 +4517,7 @@ def save_history_summary(request, case_id):
             history_summary['family_history'] = data['family_history']
             
         session.session_data['history_summary'] = history_summary
-        session.save()
+        save_session(session)
         
         return JsonResponse({
             'success': True,
@@ -4832,6 +4532,11 @@ def save_history_summary(request, case_id):
             'success': False,
             'error': '无效的JSON数据'
         })
+    except SessionConflictError as e:
+        return JsonResponse({
+            'success': False,
+            'error': str(e)
+        }, status=409)
     except Exception as e:
         return JsonResponse({
             'success': False,
@@ -4844,17 +4549,6 @@ def get_history_summary(request, case_id):
     获取病史汇总信息
     """
     try:
-        # 阶段反向映射：模型值 -> 前端值
-        reverse_stage_mapping = {
-            'case_presentation': 'history',
-            'examination_selection': 'examination',
-            'examination_results': 'examination',
-            'diagnosis_reasoning': 'diagnosis',
-            'treatment_selection': 'treatment',
-            'learning_feedback': 'feedback',
-            'completed': 'completed'
-        }
-        
         # 获取临床病例和会话
         clinical_case = get_object_or_404(ClinicalCase, case_id=case_id)
         session = get_object_or_404(
@@ -4868,13 +4562,13 @@ def get_history_summary(request, case_id):
             history_summary = session.session_data.get('history_summary', {})
         
         # 将数据库中的阶段值映射回前端使用的值
-        frontend_stage = reverse_stage_mapping.get(session.session_status, 'history')
+        current_stage = frontend_stage(session.session_status)
         
         return JsonResponse({
             'success': True,
             'data': {
                 'history_summary': history_summary,
-                'current_stage': frontend_stage
+                'current_stage': current_stage
             }
         })
         
@@ -78,6 +78,20 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        # 并发写入时等待写锁，而不是立即报 database is locked
+        "OPTIONS": {"timeout": 20},
+        # 测试库使用文件：会话并发测试需要多个连接同时读写
+        "TEST": {"NAME": BASE_DIR / "test_db.sqlite3"},
+    }
+}
+
+# 缓存：按单进程部署（python manage.py runserver）使用进程内缓存。
+# 案例库卡片、学生统计、成绩分析等缓存靠缓存中的版本号与删除失效，只在同一进程内可见；
+# 改为多进程/多机部署（gunicorn 多 worker 等）时必须换成共享后端（Redis、Memcached），
+# 否则其他进程要等各自的 TTL 到期才会看到变化
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
     }
 }
 